@@ -184,6 +184,9 @@ CREATE TABLE notifications (
     sent_at TIMESTAMP,
     notification_type VARCHAR(50) CHECK (notification_type IN ('system', 'user', 'transaction', 'other')) DEFAULT 'system',
     is_read BOOLEAN DEFAULT FALSE,
+    attempts INT UNSIGNED NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMP NULL,
+    last_error VARCHAR(255),
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
     FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
@@ -358,6 +361,90 @@ CREATE TABLE bus_features (
     FOREIGN KEY (feature_id) REFERENCES features(id) ON DELETE CASCADE
 );
 
+CREATE TABLE daily_revenue_summary (
+    day DATE NOT NULL,
+    provider_id BIGINT UNSIGNED NOT NULL DEFAULT 0,
+    transport_type ENUM('plane', 'train', 'bus') NOT NULL,
+    class_type ENUM('economy', 'business', 'VIP') NOT NULL,
+    payments INT UNSIGNED NOT NULL DEFAULT 0,
+    revenue DECIMAL(30) NOT NULL DEFAULT 0,
+    refunds DECIMAL(30) NOT NULL DEFAULT 0,
+    refreshed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    PRIMARY KEY (day, provider_id, transport_type, class_type)
+);
+
+CREATE TABLE daily_occupancy_summary (
+    day DATE NOT NULL,
+    provider_id BIGINT UNSIGNED NOT NULL DEFAULT 0,
+    transport_type ENUM('plane', 'train', 'bus') NOT NULL,
+    class_type ENUM('economy', 'business', 'VIP') NOT NULL,
+    tickets INT UNSIGNED NOT NULL DEFAULT 0,
+    total_seats BIGINT UNSIGNED NOT NULL DEFAULT 0,
+    sold_seats BIGINT UNSIGNED NOT NULL DEFAULT 0,
+    refreshed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    PRIMARY KEY (day, provider_id, transport_type, class_type)
+);
+
+CREATE TABLE summary_watermarks (
+    name VARCHAR(64) PRIMARY KEY,
+    changed_through TIMESTAMP NULL,
+    last_id BIGINT UNSIGNED NOT NULL DEFAULT 0,
+    refreshed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+);
+
+CREATE TABLE support_search_documents (
+    ticket_id BIGINT UNSIGNED PRIMARY KEY,
+    last_message_id BIGINT UNSIGNED NOT NULL DEFAULT 0,
+    text_hash CHAR(32) NOT NULL DEFAULT '',
+    FOREIGN KEY (ticket_id) REFERENCES support_tickets(id) ON DELETE CASCADE
+);
+
+CREATE TABLE support_search_terms (
+    term VARCHAR(64) NOT NULL,
+    ticket_id BIGINT UNSIGNED NOT NULL,
+    weight INT UNSIGNED NOT NULL DEFAULT 0,
+    PRIMARY KEY (term, ticket_id)
+);
+
+CREATE TABLE support_search_vocabulary (
+    term VARCHAR(64) PRIMARY KEY,
+    tickets INT UNSIGNED NOT NULL DEFAULT 0
+);
+
+CREATE TABLE ticket_rating_summary (
+    ticket_id BIGINT UNSIGNED PRIMARY KEY,
+    reviews INT UNSIGNED NOT NULL DEFAULT 0,
+    rating_sum INT UNSIGNED NOT NULL DEFAULT 0,
+    rating_1 INT UNSIGNED NOT NULL DEFAULT 0,
+    rating_2 INT UNSIGNED NOT NULL DEFAULT 0,
+    rating_3 INT UNSIGNED NOT NULL DEFAULT 0,
+    rating_4 INT UNSIGNED NOT NULL DEFAULT 0,
+    rating_5 INT UNSIGNED NOT NULL DEFAULT 0
+);
+
+CREATE TABLE provider_rating_summary (
+    provider_id BIGINT UNSIGNED PRIMARY KEY,
+    reviews BIGINT UNSIGNED NOT NULL DEFAULT 0,
+    rating_sum BIGINT UNSIGNED NOT NULL DEFAULT 0,
+    rating_1 BIGINT UNSIGNED NOT NULL DEFAULT 0,
+    rating_2 BIGINT UNSIGNED NOT NULL DEFAULT 0,
+    rating_3 BIGINT UNSIGNED NOT NULL DEFAULT 0,
+    rating_4 BIGINT UNSIGNED NOT NULL DEFAULT 0,
+    rating_5 BIGINT UNSIGNED NOT NULL DEFAULT 0
+);
+
+CREATE TABLE amenity_bits (
+    feature_id BIGINT UNSIGNED PRIMARY KEY,
+    bit SMALLINT UNSIGNED NOT NULL UNIQUE,
+    FOREIGN KEY (feature_id) REFERENCES features(id) ON DELETE CASCADE
+);
+
+CREATE TABLE ticket_amenities (
+    ticket_id BIGINT UNSIGNED PRIMARY KEY,
+    mask_0 BIGINT UNSIGNED NOT NULL DEFAULT 0,
+    mask_1 BIGINT UNSIGNED NOT NULL DEFAULT 0
+);
+
 
 CREATE INDEX idx_users_email ON users(email);
 CREATE INDEX idx_users_phone ON users(phone);
@@ -369,11 +456,13 @@ CREATE INDEX idx_payment_methods_name ON payment_methods(name);
 CREATE INDEX idx_service_providers_name ON service_providers(name);
 CREATE INDEX idx_travel_tickets_departure_city ON travel_tickets(departure_city);
 CREATE INDEX idx_travel_tickets_arrival_city ON travel_tickets(arrival_city);
+CREATE INDEX idx_travel_tickets_route ON travel_tickets(departure_city, arrival_city, departure_time, status, class_type);
 CREATE INDEX idx_travel_tickets_transport_company_id ON travel_tickets(transport_company_id);
 CREATE INDEX idx_user_reservations_ticket_id ON user_reservations(ticket_id);
 CREATE INDEX idx_user_reservations_payment_id ON user_reservations(payment_id);
+CREATE INDEX idx_user_reservations_status_reserved_at ON user_reservations(status, reserved_at);
 CREATE INDEX idx_reports_ticket_id ON reports(ticket_id);
-CREATE INDEX idx_notifications_status ON notifications(status);
+CREATE INDEX idx_notifications_status_created_at ON notifications(status, created_at);
 CREATE INDEX idx_payments_reservation_id ON payments(reservation_id);
 CREATE INDEX idx_refund_requests_payment_id ON refund_requests(payment_id);
 CREATE INDEX idx_reviews_ticket_id ON reviews(ticket_id);
@@ -382,7 +471,7 @@ CREATE INDEX idx_flight_details_ticket_id ON flight_details(ticket_id);
 CREATE INDEX idx_bus_details_ticket_id ON bus_details(ticket_id);
 CREATE INDEX idx_discounts_code ON discounts(code);
 CREATE INDEX idx_user_discounts_discount_id ON user_discounts(discount_id);
-CREATE INDEX idx_ticket_discounts_ticket_id ON ticket_discounts(ticket_id);
+CREATE INDEX idx_ticket_discounts_ticket_id ON ticket_discounts(ticket_id, discount_id);
 CREATE INDEX idx_ticket_discounts_discount_id ON ticket_discounts(discount_id);
 CREATE INDEX idx_support_categories_name ON support_categories(name);
 CREATE INDEX idx_support_tickets_category_id ON support_tickets(category_id);
@@ -402,9 +491,19 @@ CREATE INDEX idx_notifications_user_id ON notifications(user_id);
 CREATE INDEX idx_payments_user_id ON payments(user_id);
 CREATE INDEX idx_refund_requests_user_id ON refund_requests(user_id);
 CREATE INDEX idx_reviews_user_id ON reviews(user_id);
-CREATE INDEX idx_user_loyalty_user_id ON user_loyalty(user_id);
+CREATE UNIQUE INDEX idx_user_loyalty_user_id ON user_loyalty(user_id);
 CREATE INDEX idx_user_discounts_user_id ON user_discounts(user_id);
 CREATE INDEX idx_user_referrals_referrer_id ON user_referrals(referrer_id);
 CREATE INDEX idx_user_referrals_referred_id ON user_referrals(referred_id);
 CREATE INDEX idx_support_tickets_user_id ON support_tickets(user_id);
 CREATE INDEX idx_support_ticket_conversations_user_id ON support_ticket_conversations(user_id);
+CREATE INDEX idx_travel_tickets_departure_time ON travel_tickets(departure_time);
+CREATE INDEX idx_payments_payment_date ON payments(payment_date);
+CREATE INDEX idx_payments_updated_at ON payments(updated_at);
+CREATE INDEX idx_discounts_updated_at ON discounts(updated_at);
+CREATE INDEX idx_support_tickets_updated_at ON support_tickets(updated_at);
+CREATE INDEX idx_support_search_terms_ticket_id ON support_search_terms(ticket_id);
+CREATE INDEX idx_user_reservations_updated_at ON user_reservations(updated_at);
+CREATE INDEX idx_train_details_updated_at ON train_details(updated_at);
+CREATE INDEX idx_flight_details_updated_at ON flight_details(updated_at);
+CREATE INDEX idx_bus_details_updated_at ON bus_details(updated_at);
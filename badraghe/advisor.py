@@ -0,0 +1,364 @@
+import argparse
+import json
+import os
+import re
+import sys
+
+from badraghe import schema as schema_module
+from badraghe.search import LEGACY_INDEX
+from badraghe.config import SQL_FILE
+from badraghe.statements import iter_statements
+
+# The hot statements of this repo's own modules, used when no query log is given.
+DEFAULT_QUERIES = [
+    "SELECT * FROM users WHERE email = %s",
+    "SELECT t.id FROM travel_tickets t WHERE t.departure_city = %s AND t.arrival_city = %s "
+    "AND t.departure_time >= %s AND t.departure_time < %s AND t.status = %s ORDER BY t.departure_time, t.id LIMIT %s",
+    "SELECT id, ticket_id FROM user_reservations WHERE status = 'temporary' "
+    "AND reserved_at < NOW() - INTERVAL %s SECOND ORDER BY reserved_at LIMIT %s FOR UPDATE SKIP LOCKED",
+    "SELECT id FROM notifications WHERE status = 'pending' AND (next_attempt_at IS NULL OR next_attempt_at <= NOW()) "
+    "ORDER BY created_at LIMIT %s FOR UPDATE SKIP LOCKED",
+    "SELECT p.amount FROM payments p WHERE p.status = 'successful' AND p.payment_date >= %s AND p.payment_date < %s",
+    "SELECT DISTINCT DATE(payment_date) FROM payments WHERE updated_at > %s",
+    "SELECT role_id FROM user_role WHERE user_id = %s AND (expired_at IS NULL OR expired_at > NOW())",
+    "SELECT user_id, reservation_id, amount FROM payments WHERE id = %s",
+]
+
+# Indexes named in FORCE INDEX hints: reported, but never dropped from the corrected migration.
+KEEP = {LEGACY_INDEX}
+ROW_OVERHEAD = 5
+TYPE_BYTES = {"BIGINT": 8, "INT": 4, "SMALLINT": 2, "TINYINT": 1, "BOOLEAN": 1, "ENUM": 1, "DATE": 3,
+              "TIMESTAMP": 4, "DATETIME": 5, "JSON": 20, "TEXT": 20}
+
+
+class Key:
+    def __init__(self, name, table, columns, kind, unique=False):
+        self.name = name
+        self.table = table
+        self.columns = columns
+        self.kind = kind
+        self.unique = unique
+
+    def __repr__(self):
+        return f"Key({self.name!r}, {self.columns!r}, {self.kind})"
+
+
+class Finding:
+    def __init__(self, kind, table, columns, reason, index=None, bytes_per_row=0, on_update=()):
+        self.kind = kind
+        self.table = table
+        self.columns = columns
+        self.reason = reason
+        self.index = index
+        self.bytes_per_row = bytes_per_row
+        self.on_update = list(on_update)
+
+    def as_dict(self):
+        return {
+            "kind": self.kind,
+            "table": self.table,
+            "index": self.index,
+            "columns": self.columns,
+            "reason": self.reason,
+            "bytes_per_row": self.bytes_per_row,
+            "changes_on_every_update": self.on_update,
+        }
+
+
+def table_keys(schema, table):
+    """Every B-tree InnoDB keeps for `table`: primary, unique, explicit and implicit foreign-key indexes."""
+    keys = []
+    if table.primary_key:
+        keys.append(Key("PRIMARY", table.name, table.primary_key, "primary", unique=True))
+    for columns in table.unique_keys:
+        if columns != table.primary_key:
+            keys.append(Key(f"UNIQUE({', '.join(columns)})", table.name, columns, "unique", unique=True))
+    for index in schema.indexes:
+        if index.table == table.name and not getattr(index, "fulltext", False):
+            keys.append(Key(index.name, table.name, index.columns, "index", unique=index.unique))
+    for fk in table.foreign_keys:
+        if not any(key.columns[:len(fk.columns)] == fk.columns for key in keys):
+            keys.append(Key(f"FK({', '.join(fk.columns)})", table.name, fk.columns, "foreign"))
+    return keys
+
+
+def column_bytes(column):
+    if column.type_name in ("VARCHAR", "CHAR"):
+        return (column.size[0] if column.size else 32) // 2 + 1
+    if column.type_name == "DECIMAL":
+        return ((column.size[0] if column.size else 10) + 1) // 2
+    return TYPE_BYTES.get(column.type_name, 8)
+
+
+def entry_bytes(table, columns):
+    """Rough size of one secondary index entry: its columns, the primary key and the record header."""
+    key_columns = list(dict.fromkeys(list(columns) + table.primary_key))
+    return ROW_OVERHEAD + sum(column_bytes(table.columns[name]) for name in key_columns if name in table.columns)
+
+
+def _finding(kind, table, key, reason):
+    on_update = [name for name in key.columns if table.columns.get(name) and table.columns[name].on_update]
+    return Finding(kind, table.name, key.columns, reason, key.name, entry_bytes(table, key.columns), on_update)
+
+
+def redundant_indexes(schema):
+    """Explicit indexes that duplicate, or are a left prefix of, another index on the same table.
+
+    A unique index is only redundant when it duplicates another unique key,
+    since a longer index cannot enforce its uniqueness.
+    """
+    findings = []
+    for table in schema.tables.values():
+        keys = table_keys(schema, table)
+        dropped = set()
+        for key in keys:
+            if key.kind != "index":
+                continue
+            for other in keys:
+                if other is key or other.name in dropped or other.kind == "foreign":
+                    continue
+                if other.columns == key.columns and (other.unique or not key.unique):
+                    if other.kind == "index" and other.unique == key.unique and keys.index(other) > keys.index(key):
+                        continue
+                    label = "PRIMARY KEY" if other.kind == "primary" else other.name
+                    findings.append(_finding("duplicate", table, key, f"duplicates {label}"))
+                    dropped.add(key.name)
+                    break
+                if not key.unique and len(other.columns) > len(key.columns) \
+                        and other.columns[:len(key.columns)] == key.columns:
+                    label = "PRIMARY KEY" if other.kind == "primary" else other.name
+                    findings.append(_finding("prefix", table, key,
+                                             f"left prefix of {label} ({', '.join(other.columns)})"))
+                    dropped.add(key.name)
+                    break
+    return findings
+
+
+def _split_conjuncts(text):
+    parts, depth, current, between = [], 0, [], False
+    for token in re.split(r"(\(|\)|\bAND\b|\bBETWEEN\b)", text, flags=re.I):
+        upper = token.upper()
+        if token == "(":
+            depth += 1
+        elif token == ")":
+            depth -= 1
+        elif upper == "BETWEEN" and depth == 0:
+            between = True
+        elif upper == "AND" and depth == 0:
+            if between:
+                between = False
+            else:
+                parts.append("".join(current).strip())
+                current = []
+                continue
+        current.append(token)
+    parts.append("".join(current).strip())
+    return [part for part in parts if part]
+
+
+PREDICATE_RE = re.compile(
+    r"^(?:`?(\w+)`?\.)?`?(\w+)`?\s*(<=>|>=|<=|<>|!=|=|>|<|\bIN\b|\bIS NULL\b|\bBETWEEN\b|\bLIKE\b)\s*(.*)$",
+    re.I | re.S,
+)
+TABLE_RE = re.compile(
+    r"\b(?:FROM|JOIN)\s+`?(\w+)`?(?:\s+(?:AS\s+)?(?!(?:WHERE|JOIN|ON|LEFT|RIGHT|INNER|STRAIGHT_JOIN|GROUP|ORDER|"
+    r"LIMIT|FORCE|USE|IGNORE|FOR|SET)\b)(\w+))?",
+    re.I,
+)
+
+
+def parse_query(sql, schema):
+    """Per-table equality, range and ORDER BY columns a query filters on with constants."""
+    aliases = {}
+    for table, alias in TABLE_RE.findall(sql):
+        if table in schema.tables:
+            aliases[table] = table
+            if alias:
+                aliases[alias] = table
+
+    def resolve(qualifier, column):
+        if qualifier:
+            table = aliases.get(qualifier)
+            return table if table and column in schema.tables[table].columns else None
+        owners = {table for table in aliases.values() if column in schema.tables[table].columns}
+        return owners.pop() if len(owners) == 1 else None
+
+    usage = {}
+    where = re.search(r"\bWHERE\b(.*?)(?:\bGROUP BY\b|\bORDER BY\b|\bLIMIT\b|\bFOR UPDATE\b|\bFOR SHARE\b|$)",
+                      sql, re.I | re.S)
+    for conjunct in _split_conjuncts(where.group(1)) if where else []:
+        match = PREDICATE_RE.match(conjunct)
+        if not match:
+            continue
+        qualifier, column, operator, rhs = match.groups()
+        if re.match(r"^`?\w+`?\.`?\w+`?\s*$", rhs):
+            continue
+        table = resolve(qualifier, column)
+        if table is None:
+            continue
+        operator = operator.upper()
+        kind = "eq" if operator in ("=", "<=>", "IN", "IS NULL") else "range"
+        if operator == "LIKE" and not re.match(r"^['\"][^%_]", rhs.strip()) and rhs.strip() != "%s":
+            continue
+        if operator in ("<>", "!="):
+            continue
+        entry = usage.setdefault(table, {"eq": [], "range": [], "order": []})
+        if column not in entry[kind]:
+            entry[kind].append(column)
+
+    order = re.search(r"\bORDER BY\b(.*?)(?:\bLIMIT\b|\bFOR UPDATE\b|\bFOR SHARE\b|$)", sql, re.I | re.S)
+    if order:
+        for item in order.group(1).split(","):
+            match = re.match(r"\s*(?:`?(\w+)`?\.)?`?(\w+)`?", item)
+            table = resolve(*match.groups()) if match else None
+            if table:
+                usage.setdefault(table, {"eq": [], "range": [], "order": []})["order"].append(match.group(2))
+    return usage
+
+
+def _score(columns, eq, ranges, order):
+    used = 0
+    rest = list(columns)
+    while rest and rest[0] in eq:
+        used += 1
+        rest.pop(0)
+    if rest and rest[0] in ranges:
+        used += 1
+        rest.pop(0)
+    elif not ranges and order and rest[:len(order)] == order:
+        used += len(order)
+        rest = rest[len(order):]
+    # Equality columns further right are still filtered inside the index (index condition pushdown).
+    used += sum(1 for name in rest if name in eq and name not in columns[:used])
+    return used
+
+
+def missing_indexes(schema, queries, dropped=()):
+    """Composite indexes that would serve the logged queries better than any existing one."""
+    findings = {}
+    for sql, count in queries:
+        for table_name, usage in parse_query(sql, schema).items():
+            eq, ranges, order = usage["eq"], usage["range"], usage["order"]
+            order = [name for name in order if name not in eq]
+            if not eq and not ranges:
+                continue
+            table = schema.tables[table_name]
+            ideal = len(eq) + (1 if ranges else len(order))
+            keys = [key for key in table_keys(schema, table) if key.name not in dropped]
+            best = max((_score(key.columns, eq, ranges, order) for key in keys), default=0)
+            if best >= ideal:
+                continue
+            columns = eq + (ranges[:1] if ranges else order)
+            name = f"idx_{table_name}_{'_'.join(columns)}"
+            finding = findings.get(name)
+            if finding is None:
+                key = Key(name, table_name, columns, "index")
+                finding = _finding("missing", table, key, "")
+                finding.count = 0
+                finding.sql = sql
+                findings[name] = finding
+            finding.count += count
+            example = " ".join(finding.sql.split())[:100]
+            finding.reason = f"best existing index serves {best}/{ideal} predicate columns " \
+                             f"({finding.count} queries), e.g. {example}"
+    return list(findings.values())
+
+
+def write_amplification(schema, drop=(), add=()):
+    """B-tree writes per INSERT for each table, before and after dropping/adding indexes."""
+    result = {}
+    for table in schema.tables.values():
+        keys = table_keys(schema, table)
+        before = len(keys) + (0 if table.primary_key else 1)
+        dropped = sum(1 for key in keys if key.name in drop)
+        added = sum(1 for finding in add if finding.table == table.name)
+        if dropped or added:
+            result[table.name] = {"before": before, "after": before - dropped + added}
+    return result
+
+
+def load_queries(path):
+    """Read (sql, count) pairs from an instrument report (JSON) or a file of SQL statements."""
+    with open(path, "r") as f:
+        if path.endswith(".json"):
+            report = json.load(f)
+            return [(item["fingerprint"].replace("?", "%s"), item["count"]) for item in report["statements"]]
+        return [(statement.sql, 1) for statement in iter_statements(f)]
+
+
+def corrected_migration(path, drop, add, output):
+    """Write a copy of the migration without the dropped indexes and with the added ones."""
+    skip = set()
+    with open(path, "r") as f:
+        lines = f.readlines()
+    with open(path, "r") as f:
+        for statement in iter_statements(f):
+            if statement.kind == "create_index":
+                name = re.search(r"INDEX\s+`?(\w+)`?", statement.sql, re.I).group(1)
+                if name in drop:
+                    skip.add(statement.line)
+
+    with open(output, "w") as f:
+        for number, line in enumerate(lines, 1):
+            if number not in skip:
+                f.write(line)
+        if add:
+            if lines and not lines[-1].endswith("\n"):
+                f.write("\n")
+            f.write("\n-- Indexes suggested by badraghe.advisor\n")
+            for finding in add:
+                f.write(f"CREATE INDEX {finding.index} ON {finding.table}({', '.join(finding.columns)});\n")
+
+
+def droppable(findings):
+    return {finding.index for finding in findings if finding.index not in KEEP}
+
+
+def advise(path=SQL_FILE, queries=None):
+    schema = schema_module.load(path)
+    redundant = redundant_indexes(schema)
+    dropped = droppable(redundant)
+    missing = missing_indexes(schema, queries if queries is not None else [(sql, 1) for sql in DEFAULT_QUERIES],
+                              dropped)
+    return schema, redundant, missing
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Report redundant and missing indexes in the migration.")
+    parser.add_argument("path", nargs="?", default=SQL_FILE)
+    parser.add_argument("--queries", help="instrument report (.json) or file of SQL statements")
+    parser.add_argument("--output", help="write the corrected migration here")
+    parser.add_argument("--json", help="write the findings as JSON")
+    args = parser.parse_args(argv)
+
+    queries = load_queries(args.queries) if args.queries else None
+    schema, redundant, missing = advise(args.path, queries)
+    dropped = droppable(redundant)
+
+    print(f"🧹 {len(redundant)} redundant indexes:")
+    for finding in redundant:
+        note = f", rewritten on every UPDATE via {', '.join(finding.on_update)}" if finding.on_update else ""
+        note += ", kept for FORCE INDEX" if finding.index in KEEP else ""
+        print(f"   {finding.index:<45} {finding.reason} (~{finding.bytes_per_row} bytes/row{note})")
+    print(f"💡 {len(missing)} missing indexes:")
+    for finding in missing:
+        print(f"   {finding.table}({', '.join(finding.columns)}): {finding.reason}")
+    print("✍️  B-tree writes per INSERT:")
+    for table, counts in write_amplification(schema, dropped, missing).items():
+        print(f"   {table:<30}{counts['before']:>3} -> {counts['after']}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"redundant": [finding.as_dict() for finding in redundant],
+                       "missing": [finding.as_dict() for finding in missing],
+                       "write_amplification": write_amplification(schema, dropped, missing)}, f, indent=2)
+    if args.output:
+        if os.path.abspath(args.output) == os.path.abspath(args.path):
+            parser.error("--output must not overwrite the original migration")
+        corrected_migration(args.path, dropped, missing, args.output)
+        print(f"✅ Corrected migration written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
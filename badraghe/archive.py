@@ -0,0 +1,229 @@
+import argparse
+import time
+from datetime import datetime, timedelta
+
+import pymysql
+
+from badraghe import facets, ratings, summary
+from badraghe import schema as schema_module
+from badraghe.pool import get_pool
+
+ARCHIVE_SUFFIX = "_archive"
+ROOTS = {"travel_tickets": "departure_time", "payments": "payment_date"}
+RETRYABLE = {1205, 1213}
+
+CHECKPOINT_TABLE = """
+CREATE TABLE IF NOT EXISTS archive_checkpoints (
+    root_table VARCHAR(64) PRIMARY KEY,
+    cutoff TIMESTAMP NULL,
+    last_time TIMESTAMP NULL,
+    last_id BIGINT UNSIGNED NOT NULL DEFAULT 0,
+    rows_archived BIGINT UNSIGNED NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+)
+"""
+
+
+def cascade_plan(schema, root):
+    """Every table whose rows are deleted along with `root` rows, parents first.
+
+    Each entry is (table, path) where path is the chain of ON DELETE CASCADE
+    foreign keys leading from the table back to `root`. A table reachable
+    through several chains appears once per chain. SET NULL references
+    (reports.ticket_id, user_reservations.payment_id) leave their rows in
+    place, exactly as the DELETE will.
+    """
+    plan = [(root, [])]
+    queue = [(root, [])]
+    while queue:
+        parent, path = queue.pop(0)
+        seen = {root} | {child for child, _ in path}
+        for table in schema.tables.values():
+            for fk in table.foreign_keys:
+                if fk.ref_table == parent and fk.on_delete == "CASCADE" and table.name not in seen:
+                    entry = (table.name, path + [(table.name, fk)])
+                    plan.append(entry)
+                    queue.append(entry)
+    return plan
+
+
+def _select_sql(root, path, columns):
+    """SELECT the rows of path[-1] that belong to a chunk of root ids (bound as %s placeholders)."""
+    if not path:
+        return f"SELECT {', '.join(f'a0.{column}' for column in columns)} FROM {root} a0 WHERE a0.id IN ({{ids}})"
+    depth = len(path)
+    sql = f"SELECT {', '.join(f'a{depth}.{column}' for column in columns)} FROM {path[-1][0]} a{depth}"
+    for level in range(depth - 1, 0, -1):
+        _, fk = path[level]
+        condition = " AND ".join(f"a{level + 1}.{column} = a{level}.{ref}" for column, ref in zip(fk.columns, fk.ref_columns))
+        sql += f" JOIN {path[level - 1][0]} a{level} ON {condition}"
+    return sql + f" WHERE a1.{path[0][1].columns[0]} IN ({{ids}})"
+
+
+class Archiver:
+    """Moves old rows of `root` and everything cascading from them into *_archive tables.
+
+    Work is done in chunks of `chunk_size` root rows, each in its own short
+    READ COMMITTED transaction: copy every dependent table with INSERT IGNORE,
+    DELETE the root rows (the schema's cascades remove the dependents), and
+    advance the checkpoint. Chunks walk the time column's index in
+    (time, id) order, so old rows scattered among live ones never lock the
+    live rows between them. A stopped run resumes after the last committed
+    chunk, and `pause` seconds between chunks keep replicas and buyers ahead.
+
+    A run that stopped part way is resumed with the cutoff it started with,
+    whatever `before` says, until it finishes; `restart` abandons it and
+    starts over from the first id with `before`.
+    """
+
+    def __init__(self, root="travel_tickets", before=None, chunk_size=500, pause=0.1, pool=None, schema=None,
+                 restart=False):
+        self.root = root
+        self.restart = restart
+        self.time_column = ROOTS[root]
+        self.before = before or datetime.now().replace(microsecond=0) - timedelta(days=365)
+        self.chunk_size = chunk_size
+        self.pause = pause
+        self.pool = pool or get_pool()
+        self.plan = cascade_plan(schema or schema_module.load(), root)
+        self.columns = {}
+        self.archived = {}
+        self.chunks = 0
+
+    def ensure_tables(self):
+        with self.pool.connection() as connection, connection.cursor() as cursor:
+            cursor.execute(CHECKPOINT_TABLE)
+            cursor.execute(
+                "SELECT COUNT(*) FROM information_schema.COLUMNS "
+                "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'archive_checkpoints' AND COLUMN_NAME = 'last_time'"
+            )
+            row = cursor.fetchone()
+            if not (row[0] if not isinstance(row, dict) else next(iter(row.values()))):
+                # Checkpoint tables created before runs walked the time index.
+                cursor.execute("ALTER TABLE archive_checkpoints ADD COLUMN last_time TIMESTAMP NULL AFTER cutoff")
+            for table in dict.fromkeys(table for table, _ in self.plan):
+                cursor.execute(f"CREATE TABLE IF NOT EXISTS {table}{ARCHIVE_SUFFIX} LIKE {table}")
+                cursor.execute(
+                    "SELECT COLUMN_NAME FROM information_schema.COLUMNS "
+                    "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s ORDER BY ORDINAL_POSITION",
+                    (table,),
+                )
+                self.columns[table] = [row[0] if not isinstance(row, dict) else row["COLUMN_NAME"]
+                                       for row in cursor.fetchall()]
+
+    def _checkpoint(self, cursor):
+        """The (time, id) the run continues after, or None to start from the oldest row."""
+        cursor.execute("SELECT cutoff, last_time, last_id FROM archive_checkpoints WHERE root_table = %s", (self.root,))
+        row = cursor.fetchone()
+        if row is None:
+            cursor.execute("INSERT INTO archive_checkpoints (root_table, cutoff) VALUES (%s, %s)", (self.root, self.before))
+            return None
+        cutoff, last_time, last_id = row.values() if isinstance(row, dict) else row
+        if cutoff is not None and last_time is not None and not self.restart:
+            # An interrupted run: finish it with the cutoff it started with.
+            self.before = cutoff
+            return last_time, last_id
+        cursor.execute("UPDATE archive_checkpoints SET cutoff = %s, last_time = NULL, last_id = 0 WHERE root_table = %s",
+                       (self.before, self.root))
+        return None
+
+    def _finish(self, connection):
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE archive_checkpoints SET cutoff = NULL WHERE root_table = %s", (self.root,))
+        connection.commit()
+
+    def archive_chunk(self, connection, after=None):
+        """Archive the next chunk after the (time, id) `after`; returns its ids and the new position."""
+        column = self.time_column
+        where, args = f"{column} < %s", [self.before]
+        if after is not None:
+            # Spelled out rather than as (time, id) > (%s, %s) so the range is taken on the time index.
+            where += f" AND ({column} > %s OR ({column} = %s AND id > %s))"
+            args += [after[0], after[0], after[1]]
+        with connection.cursor() as cursor:
+            cursor.execute("SET TRANSACTION ISOLATION LEVEL READ COMMITTED")
+            connection.begin()
+            cursor.execute(
+                f"SELECT {column}, id FROM {self.root} WHERE {where} ORDER BY {column}, id LIMIT %s FOR UPDATE",
+                args + [self.chunk_size],
+            )
+            rows = [tuple(row.values()) if isinstance(row, dict) else tuple(row) for row in cursor.fetchall()]
+            if not rows:
+                connection.rollback()
+                return [], after
+            ids = [row_id for _, row_id in rows]
+            after = rows[-1]
+
+            placeholders = ", ".join(["%s"] * len(ids))
+            moved = {}
+            for table, path in self.plan:
+                columns = self.columns[table]
+                select = _select_sql(self.root, path, columns).format(ids=placeholders)
+                cursor.execute(f"INSERT IGNORE INTO {table}{ARCHIVE_SUFFIX} ({', '.join(columns)}) {select}", ids)
+                moved[table] = moved.get(table, 0) + cursor.rowcount
+
+            if self.root == "travel_tickets":
+                ratings.forget_tickets(cursor, ids)
+                facets.forget_tickets(cursor, ids)
+                summary.forget_tickets(cursor, ids)
+            elif self.root == "payments":
+                summary.forget_payments(cursor, ids)
+            cursor.execute(f"DELETE FROM {self.root} WHERE id IN ({placeholders})", ids)
+            cursor.execute(
+                "UPDATE archive_checkpoints SET last_time = %s, last_id = %s, rows_archived = rows_archived + %s "
+                "WHERE root_table = %s",
+                (after[0], after[1], len(ids), self.root),
+            )
+        connection.commit()
+        for table, count in moved.items():
+            self.archived[table] = self.archived.get(table, 0) + count
+        return ids, after
+
+    def run(self, max_chunks=None):
+        self.ensure_tables()
+        with self.pool.connection(autocommit=False) as connection:
+            with connection.cursor() as cursor:
+                after = self._checkpoint(cursor)
+            connection.commit()
+            if after is not None:
+                print(f"↩️  Resuming the interrupted run after {after[0]} (id {after[1]}) with cutoff {self.before}")
+
+            while max_chunks is None or self.chunks < max_chunks:
+                try:
+                    ids, after = self.archive_chunk(connection, after)
+                except pymysql.err.OperationalError as e:
+                    connection.rollback()
+                    if e.args[0] not in RETRYABLE:
+                        raise
+                    time.sleep(self.pause)
+                    continue
+                if not ids:
+                    self._finish(connection)
+                    break
+                self.chunks += 1
+                print(f"📦 Chunk {self.chunks}: archived {len(ids)} {self.root} rows up to {after[0]}")
+                time.sleep(self.pause)
+        return self.archived
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Move old rows and their cascading dependents to *_archive tables.")
+    parser.add_argument("--table", choices=sorted(ROOTS), default="travel_tickets")
+    parser.add_argument("--older-than-days", type=int, default=365)
+    parser.add_argument("--chunk-size", type=int, default=500)
+    parser.add_argument("--pause", type=float, default=0.1, help="seconds to sleep between chunks")
+    parser.add_argument("--max-chunks", type=int)
+    parser.add_argument("--restart", action="store_true", help="abandon an interrupted run instead of resuming it")
+    args = parser.parse_args(argv)
+
+    before = datetime.now().replace(microsecond=0) - timedelta(days=args.older_than_days)
+    archiver = Archiver(args.table, before, args.chunk_size, args.pause, restart=args.restart)
+    print(f"🚀 Archiving {args.table} with {archiver.time_column} before {before}...")
+    archived = archiver.run(args.max_chunks)
+    print(f"✅ {archiver.chunks} chunks archived.")
+    for table, count in archived.items():
+        print(f"   {table:<28}{count:>12} rows")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,612 @@
+import argparse
+import hashlib
+import json
+import math
+import random
+import sys
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+import pymysql
+
+from badraghe import config, inventory, pricing, search, support_search
+from badraghe.config import SQL_FILE
+from badraghe.pool import ConnectionPool
+from badraghe.router import Router
+
+DEFAULT_MIX = {"search": 70, "hold": 15, "payment": 10, "refund": 5}
+SEARCH_MAX_PAGES = 10
+HISTOGRAM_BUCKETS_MS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500]
+NO_SUCH_TABLE = 1146
+RETRYABLE = {1205, 1213}
+
+WORKLOADS = {}
+READ_ONLY = set()
+
+
+def workload(name, read_only=False):
+    """Register a workload; `read_only` ones are sent to the replica when run through a Router."""
+    def register(function):
+        WORKLOADS[name] = function
+        if read_only:
+            READ_ONLY.add(name)
+        return function
+    return register
+
+
+def _optional_column(cursor, sql):
+    """The first column of `sql`'s rows, or [] on a schema that predates its table."""
+    try:
+        cursor.execute(sql)
+    except pymysql.err.ProgrammingError as e:
+        if e.args[0] != NO_SUCH_TABLE:
+            raise
+        return []
+    return [row[0] for row in cursor.fetchall()]
+
+
+def allocate_id(cursor, table):
+    """The next id of `table`, which has no AUTO_INCREMENT, held until the caller's transaction ends.
+
+    The locking read of the highest id also locks the gap above it (at
+    REPEATABLE READ), so another allocator, in this process or another
+    one, waits for the commit instead of taking the same id.
+    """
+    cursor.execute(f"SELECT id FROM {table} ORDER BY id DESC LIMIT 1 FOR UPDATE")
+    row = cursor.fetchone()
+    return (row[0] if row else 0) + 1
+
+
+class BenchContext:
+    """Id ranges and routes sampled once before a run, shared by all workers."""
+
+    def __init__(self, max_ids, routes, first_departure, last_departure, search_terms=(), amenities=()):
+        self.max_ids = max_ids
+        self.routes = routes
+        self.first_departure = first_departure
+        self.last_departure = last_departure
+        self.search_terms = list(search_terms)
+        self.amenities = list(amenities)
+        self.state = {}
+
+    @classmethod
+    def load(cls, connection):
+        max_ids = {}
+        with connection.cursor() as cursor:
+            for table in ("users", "travel_tickets", "user_reservations", "payment_methods", "payments",
+                          "refund_requests", "notifications"):
+                cursor.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}")
+                max_ids[table] = cursor.fetchone()[0]
+            cursor.execute("SELECT DISTINCT departure_city, arrival_city FROM travel_tickets LIMIT 1000")
+            routes = [tuple(row) for row in cursor.fetchall()]
+            cursor.execute("SELECT MIN(departure_time), MAX(departure_time) FROM travel_tickets")
+            first_departure, last_departure = cursor.fetchone()
+            search_terms = _optional_column(
+                cursor, "SELECT term FROM support_search_vocabulary WHERE tickets > 0 AND term <> '' LIMIT 1000")
+            amenities = _optional_column(cursor, "SELECT feature_id FROM amenity_bits")
+        connection.commit()
+
+        empty = [table for table in ("users", "travel_tickets", "payment_methods") if not max_ids[table]]
+        if empty:
+            raise RuntimeError(f"Nothing to benchmark: {', '.join(empty)} empty, run `python -m badraghe.seed` first")
+        return cls(max_ids, routes, first_departure, last_departure, search_terms, amenities)
+
+    def random_id(self, rng, table):
+        return rng.randint(1, self.max_ids[table]) if self.max_ids[table] else None
+
+    def random_departure(self, rng):
+        span = int((self.last_departure - self.first_departure).total_seconds())
+        return self.first_departure + timedelta(seconds=rng.randint(0, max(span, 0)))
+
+
+@workload("search", read_only=True)
+def route_search(connection, rng, context):
+    departure_city, arrival_city = rng.choice(context.routes)
+    day = context.random_departure(rng).replace(hour=0, minute=0, second=0)
+    search.search_routes(connection, departure_city, arrival_city, day, day + timedelta(days=1))
+    connection.commit()
+
+
+def _page_through(connection, rng, context, keyset):
+    departure_city, arrival_city = rng.choice(context.routes)
+    after = None
+    for page in range(rng.randint(1, SEARCH_MAX_PAGES)):
+        if keyset:
+            after = search.search_routes(connection, departure_city, arrival_city, after=after).after
+            if after is None:
+                break
+        else:
+            if not search.search_routes_offset(connection, departure_city, arrival_city, page=page).rows:
+                break
+    connection.commit()
+
+
+@workload("search_pages", read_only=True)
+def route_search_pages(connection, rng, context):
+    _page_through(connection, rng, context, keyset=True)
+
+
+@workload("search_pages_legacy", read_only=True)
+def route_search_pages_legacy(connection, rng, context):
+    """OFFSET paging on the single-column departure_city index, the pre-route-index baseline."""
+    _page_through(connection, rng, context, keyset=False)
+
+
+def _priced_search(connection, rng, context, price):
+    departure_city, arrival_city = rng.choice(context.routes)
+    day = context.random_departure(rng).replace(hour=0, minute=0, second=0)
+    price(connection, search.search_routes(connection, departure_city, arrival_city, day, day + timedelta(days=1)).rows)
+    connection.commit()
+
+
+@workload("search_priced", read_only=True)
+def route_search_priced(connection, rng, context):
+    _priced_search(connection, rng, context, pricing.price_tickets)
+
+
+@workload("search_priced_sql", read_only=True)
+def route_search_priced_sql(connection, rng, context):
+    """Pricing with a discount join per ticket, the baseline for search_priced."""
+    _priced_search(connection, rng, context, pricing.price_tickets_sql)
+
+
+@workload("search_amenities", read_only=True)
+def route_search_amenities(connection, rng, context):
+    """A route's first page filtered to one or two amenities, plus facet counts for the filtered tickets."""
+    if not context.amenities:
+        raise RuntimeError("amenity_bits is missing or empty, run `python -m badraghe.facets rebuild` first")
+    departure_city, arrival_city = rng.choice(context.routes)
+    amenities = rng.sample(context.amenities, min(rng.randint(1, 2), len(context.amenities)))
+    search.search_routes(connection, departure_city, arrival_city, amenities=amenities)
+    search.amenity_facets(connection, departure_city, arrival_city, amenities=amenities)
+    connection.commit()
+
+
+@workload("route_facets", read_only=True)
+def route_facets(connection, rng, context):
+    departure_city, arrival_city = rng.choice(context.routes)
+    search.amenity_facets(connection, departure_city, arrival_city)
+    connection.commit()
+
+
+@workload("route_facets_join", read_only=True)
+def route_facets_join(connection, rng, context):
+    """Facet counts through the details and junction tables, the baseline for route_facets."""
+    departure_city, arrival_city = rng.choice(context.routes)
+    search.amenity_facets_join(connection, departure_city, arrival_city)
+    connection.commit()
+
+
+def _support_query(rng, context):
+    if not context.search_terms:
+        raise RuntimeError("support_search_vocabulary is missing or empty, "
+                           "run `python -m badraghe.support_search rebuild` first")
+    return " ".join(rng.sample(context.search_terms, min(rng.randint(1, 2), len(context.search_terms))))
+
+
+@workload("support_search", read_only=True)
+def support_ticket_search(connection, rng, context):
+    query = _support_query(rng, context)
+    after = None
+    for _ in range(rng.randint(1, SEARCH_MAX_PAGES)):
+        after = support_search.search_tickets(connection, query, after=after).after
+        if after is None:
+            break
+    connection.commit()
+
+
+@workload("support_search_like", read_only=True)
+def support_ticket_search_like(connection, rng, context):
+    """A LIKE scan over tickets and messages, the baseline for support_search (first page only)."""
+    support_search.search_tickets_like(connection, _support_query(rng, context).split()[0])
+    connection.commit()
+
+
+@workload("hold")
+def seat_hold(connection, rng, context):
+    try:
+        inventory.hold_seat(connection, context.random_id(rng, "users"), context.random_id(rng, "travel_tickets"))
+    except inventory.SoldOut:
+        pass
+
+
+@workload("payment")
+def payment_insert(connection, rng, context):
+    reservation_id = context.random_id(rng, "user_reservations")
+    if reservation_id is None:
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            INSERT INTO payments (user_id, reservation_id, amount, payment_method_id, status, transaction_id)
+            SELECT user_id, id, COALESCE(price_paid, 0), %s, 'successful', %s FROM user_reservations WHERE id = %s
+            """,
+            (context.random_id(rng, "payment_methods"), uuid.uuid4().hex, reservation_id),
+        )
+    connection.commit()
+
+
+@workload("refund")
+def refund_flow(connection, rng, context):
+    payment_id = context.random_id(rng, "payments")
+    if payment_id is None:
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT user_id, reservation_id, amount FROM payments WHERE id = %s", (payment_id,))
+        payment = cursor.fetchone()
+        if payment:
+            user_id, reservation_id, amount = payment
+            cursor.execute(
+                """
+                INSERT INTO refund_requests (id, user_id, payment_id, reason, refund_amount)
+                VALUES (%s, %s, %s, %s, %s)
+                """,
+                (allocate_id(cursor, "refund_requests"), user_id, payment_id, "benchmark refund", amount // 2),
+            )
+            cursor.execute(
+                "UPDATE user_reservations SET refund_status = 'pending' WHERE id = %s",
+                (reservation_id,),
+            )
+    connection.commit()
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    rank = math.ceil(fraction * len(sorted_values))
+    return sorted_values[min(max(rank, 1), len(sorted_values)) - 1]
+
+
+def histogram(latencies_ms):
+    counts = [0] * (len(HISTOGRAM_BUCKETS_MS) + 1)
+    bucket = 0
+    for value in latencies_ms:
+        while bucket < len(HISTOGRAM_BUCKETS_MS) and value > HISTOGRAM_BUCKETS_MS[bucket]:
+            bucket += 1
+        counts[bucket] += 1
+    labels = [f"<={limit}ms" for limit in HISTOGRAM_BUCKETS_MS] + [f">{HISTOGRAM_BUCKETS_MS[-1]}ms"]
+    return dict(zip(labels, counts))
+
+
+def summarize(latencies, errors, seconds):
+    latencies_ms = sorted(value * 1000 for value in latencies)
+    count = len(latencies_ms)
+    return {
+        "count": count,
+        "errors": errors,
+        "throughput": count / seconds if seconds else 0.0,
+        "mean_ms": sum(latencies_ms) / count if count else 0.0,
+        "p50_ms": percentile(latencies_ms, 0.50),
+        "p95_ms": percentile(latencies_ms, 0.95),
+        "p99_ms": percentile(latencies_ms, 0.99),
+        "max_ms": latencies_ms[-1] if count else 0.0,
+        "histogram": histogram(latencies_ms),
+    }
+
+
+def _run_worker(pool, context, mix, deadline, seed, results, lock, router=None):
+    rng = random.Random(seed)
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    latencies = {name: [] for name in names}
+    errors = dict.fromkeys(names, 0)
+
+    if router is None:
+        with pool.connection(autocommit=False) as connection:
+            while time.perf_counter() < deadline:
+                name = rng.choices(names, weights)[0]
+                started = time.perf_counter()
+                try:
+                    WORKLOADS[name](connection, rng, context)
+                except pymysql.MySQLError:
+                    connection.rollback()
+                    errors[name] += 1
+                    continue
+                latencies[name].append(time.perf_counter() - started)
+    else:
+        while time.perf_counter() < deadline:
+            name = rng.choices(names, weights)[0]
+            route = router.read if name in READ_ONLY else router.write
+            started = time.perf_counter()
+            with route(autocommit=False) as connection:
+                try:
+                    WORKLOADS[name](connection, rng, context)
+                except pymysql.MySQLError:
+                    connection.rollback()
+                    errors[name] += 1
+                    continue
+            latencies[name].append(time.perf_counter() - started)
+
+    with lock:
+        for name in names:
+            results["latencies"][name].extend(latencies[name])
+            results["errors"][name] += errors[name]
+
+
+def _hammer_worker(pool, user_id, ticket_id, started, results, lock):
+    """Hold seats until the ticket sells out, retrying lock waits and deadlocks.
+
+    Any other error stops the worker and is re-raised by hot_ticket().
+    """
+    latencies, finished, rejections, errors, failure = [], [], 0, 0, None
+    with pool.connection(autocommit=False) as connection:
+        while True:
+            begin = time.perf_counter()
+            try:
+                inventory.hold_seat(connection, user_id, ticket_id)
+            except inventory.SoldOut:
+                rejections += 1
+                break
+            except pymysql.MySQLError as e:
+                connection.rollback()
+                if e.args[0] not in RETRYABLE:
+                    failure = e
+                    break
+                errors += 1
+                continue
+            end = time.perf_counter()
+            latencies.append(end - begin)
+            finished.append(end - started)
+
+    with lock:
+        results["latencies"] += latencies
+        results["finished"] += finished
+        results["rejections"] += rejections
+        results["errors"] += errors
+        if failure is not None:
+            results["failures"].append(failure)
+
+
+def hot_ticket(seats=1000, threads=32, pool=None):
+    """Let `threads` buyers race for the seats of one ticket until it sells out.
+
+    Returns the hold latencies, holds per second over the run, and the
+    final seat count and status, so overselling shows up as `oversold` > 0.
+    """
+    owned_pool = pool is None
+    if owned_pool:
+        pool = ConnectionPool(size=threads + 1, autocommit=False)
+    try:
+        with pool.connection(autocommit=True) as connection, connection.cursor() as cursor:
+            cursor.execute("SELECT MIN(id) FROM users")
+            user_id = cursor.fetchone()[0]
+            if user_id is None:
+                raise RuntimeError("Nothing to benchmark: users empty, run `python -m badraghe.seed` first")
+            cursor.execute(
+                """
+                INSERT INTO travel_tickets (transport_type, departure_city, arrival_city, departure_time, arrival_time,
+                                            price, available_seats, total_seats, class_type)
+                VALUES ('train', 'Hot-Tehran', 'Hot-Mashhad', NOW() + INTERVAL 1 DAY, NOW() + INTERVAL 2 DAY,
+                        100000, %s, %s, 'economy')
+                """,
+                (seats, seats),
+            )
+            ticket_id = cursor.lastrowid
+
+        results = {"latencies": [], "finished": [], "rejections": 0, "errors": 0, "failures": []}
+        lock = threading.Lock()
+        started = time.perf_counter()
+        workers = [
+            threading.Thread(target=_hammer_worker, args=(pool, user_id, ticket_id, started, results, lock))
+            for _ in range(threads)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - started
+        if results["failures"]:
+            raise results["failures"][0]
+
+        with pool.connection(autocommit=True) as connection, connection.cursor() as cursor:
+            cursor.execute("SELECT available_seats, status FROM travel_tickets WHERE id = %s", (ticket_id,))
+            available_seats, status = cursor.fetchone()
+            cursor.execute("SELECT COUNT(*) FROM user_reservations WHERE ticket_id = %s AND status = 'temporary'",
+                           (ticket_id,))
+            reservations = cursor.fetchone()[0]
+    finally:
+        if owned_pool:
+            pool.close()
+
+    holds_per_second = [0] * (int(elapsed) + 1)
+    for offset in results["finished"]:
+        holds_per_second[int(offset)] += 1
+    holds = len(results["latencies"])
+    return {
+        "ticket_id": ticket_id,
+        "seats": seats,
+        "threads": threads,
+        "holds": holds,
+        "reservations": reservations,
+        "oversold": max(holds, reservations) - seats,
+        "available_seats": available_seats,
+        "status": status,
+        "rejections": results["rejections"],
+        "latency": summarize(results["latencies"], results["errors"], elapsed),
+        "holds_per_second": holds_per_second,
+    }
+
+
+def schema_version(path=SQL_FILE):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()[:12]
+
+
+def run(mix=None, duration=10.0, concurrency=8, seed=0, label=None, pool=None, context=None, replica=False):
+    mix = {name: weight for name, weight in (mix or DEFAULT_MIX).items() if weight > 0}
+    unknown = set(mix) - set(WORKLOADS)
+    if unknown:
+        raise ValueError(f"Unknown workloads: {', '.join(sorted(unknown))}")
+
+    owned_pool = pool is None
+    if owned_pool:
+        pool = ConnectionPool(size=concurrency + 1, autocommit=False)
+    router = None
+    if replica:
+        router = Router(pool, ConnectionPool(size=concurrency + 1, autocommit=False, connector=config.connect_replica))
+    try:
+        if context is None:
+            with pool.connection(autocommit=False) as connection:
+                context = BenchContext.load(connection)
+
+        results = {"latencies": {name: [] for name in mix}, "errors": dict.fromkeys(mix, 0)}
+        lock = threading.Lock()
+        started = time.perf_counter()
+        deadline = started + duration
+        threads = [
+            threading.Thread(target=_run_worker, args=(pool, context, mix, deadline, seed + i, results, lock, router))
+            for i in range(concurrency)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        pool_status = pool.status()
+        router_status = router.status() if router else None
+    finally:
+        if owned_pool:
+            pool.close()
+        if router:
+            router.replica.close()
+
+    all_latencies = [value for name in mix for value in results["latencies"][name]]
+    return {
+        "meta": {
+            "label": label,
+            "schema_version": schema_version(),
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "duration": elapsed,
+            "concurrency": concurrency,
+            "mix": mix,
+            "pool": pool_status,
+            "router": router_status,
+        },
+        "operations": {
+            name: summarize(results["latencies"][name], results["errors"][name], elapsed) for name in mix
+        },
+        "total": summarize(all_latencies, sum(results["errors"].values()), elapsed),
+    }
+
+
+def compare(baseline, candidate, threshold=0.10):
+    """Compare two result documents and list per-operation regressions.
+
+    Latency percentiles regress when they grow by more than `threshold`,
+    throughput when it drops by more than `threshold`. A metric whose
+    baseline is 0 (an operation with no samples) has no relative change:
+    its change is None and it is never a regression.
+    """
+    rows = []
+    regressions = []
+    for name in sorted(set(baseline["operations"]) & set(candidate["operations"])):
+        before = baseline["operations"][name]
+        after = candidate["operations"][name]
+        for metric, higher_is_worse in (("p50_ms", True), ("p95_ms", True), ("p99_ms", True), ("throughput", False)):
+            old, new = before[metric], after[metric]
+            if old:
+                change = (new - old) / old
+                regressed = change > threshold if higher_is_worse else change < -threshold
+            else:
+                change, regressed = (0.0 if not new else None), False
+            rows.append((name, metric, old, new, change, regressed))
+            if regressed:
+                regressions.append(f"{name}.{metric}")
+    return rows, regressions
+
+
+def print_results(results):
+    meta = results["meta"]
+    print(f"📊 {meta['label'] or 'benchmark'} | schema {meta['schema_version']} | "
+          f"{meta['concurrency']} workers | {meta['duration']:.1f}s")
+    print(f"   {'operation':<12}{'ops':>9}{'ops/s':>10}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'errors':>8}")
+    for name, summary in list(results["operations"].items()) + [("total", results["total"])]:
+        print(f"   {name:<12}{summary['count']:>9}{summary['throughput']:>10.1f}{summary['p50_ms']:>9.2f}"
+              f"{summary['p95_ms']:>9.2f}{summary['p99_ms']:>9.2f}{summary['errors']:>8}")
+    router = meta.get("router")
+    if router:
+        lag = "unknown" if router["lag"] is None else f"{router['lag']:.0f}s"
+        print(f"   🔀 {router['replica_reads']} replica reads, {router['primary_reads']} primary reads "
+              f"({router['lag_fallbacks']} for lag), {router['writes']} writes, replica lag {lag}")
+
+
+def print_comparison(rows, regressions):
+    for name, metric, old, new, change, regressed in rows:
+        marker = "⛔" if regressed else "✅"
+        change = "no baseline" if change is None else f"{change:+.1%}"
+        print(f"{marker} {name:<12}{metric:<12}{old:>10.2f} -> {new:>10.2f} ({change})")
+    if regressions:
+        print(f"⛔ {len(regressions)} regression(s): {', '.join(regressions)}")
+    else:
+        print("✅ No regressions.")
+
+
+def _parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Mixed reservation/search/payment workload benchmark.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run a workload mix and write the results as JSON")
+    run_parser.add_argument("--mix", type=_parse_mix, default=DEFAULT_MIX, help="e.g. search=70,hold=15,payment=10")
+    run_parser.add_argument("--duration", type=float, default=10.0)
+    run_parser.add_argument("--concurrency", type=int, default=8)
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--label")
+    run_parser.add_argument("--output", help="write results to this JSON file")
+    run_parser.add_argument("--replica", action="store_true",
+                            help="send read-only workloads to the replica (BADRAGHE_REPLICA_HOST) through a Router")
+
+    compare_parser = commands.add_parser("compare", help="flag regressions between two result files")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+    compare_parser.add_argument("--threshold", type=float, default=0.10)
+
+    hot_parser = commands.add_parser("hot-ticket", help="race many buyers for the seats of one ticket")
+    hot_parser.add_argument("--seats", type=int, default=1000)
+    hot_parser.add_argument("--threads", type=int, default=32)
+    hot_parser.add_argument("--output", help="write results to this JSON file")
+
+    args = parser.parse_args(argv)
+    if args.command == "hot-ticket":
+        results = hot_ticket(args.seats, args.threads)
+        latency = results["latency"]
+        print(f"🎫 {results['holds']}/{results['seats']} seats held by {results['threads']} threads, "
+              f"{results['rejections']} sold-out rejections, {latency['errors']} retried errors")
+        print(f"   {latency['throughput']:.1f} holds/s, p50 {latency['p50_ms']:.2f}ms, p99 {latency['p99_ms']:.2f}ms, "
+              f"per second: {results['holds_per_second']}")
+        marker = "⛔" if results["oversold"] > 0 or results["available_seats"] != 0 else "✅"
+        print(f"{marker} oversold by {results['oversold']}, {results['available_seats']} seats left, "
+              f"status {results['status']}")
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
+        return 1 if marker == "⛔" else 0
+
+    if args.command == "run":
+        results = run(args.mix, args.duration, args.concurrency, args.seed, args.label, replica=args.replica)
+        print_results(results)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    rows, regressions = compare(baseline, candidate, args.threshold)
+    print_comparison(rows, regressions)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,55 @@
+import os
+
+import pymysql
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SQL_FILE = os.path.join(ROOT_DIR, "badrage-migration.sql")
+
+DB_HOST = os.environ.get("BADRAGHE_DB_HOST", "127.0.0.1")
+DB_PORT = int(os.environ.get("BADRAGHE_DB_PORT", "3306"))
+DB_USER = os.environ.get("BADRAGHE_DB_USER", "user")
+DB_PASSWORD = os.environ.get("BADRAGHE_DB_PASSWORD", "password")
+DB_NAME = os.environ.get("BADRAGHE_DB_NAME", "badrage_database")
+DB_ROOT_PASSWORD = os.environ.get("BADRAGHE_DB_ROOT_PASSWORD", "rootpass")
+DB_CONTAINER = os.environ.get("BADRAGHE_DB_CONTAINER", "mysql_server")
+
+REPLICA_HOST = os.environ.get("BADRAGHE_REPLICA_HOST", "")
+REPLICA_PORT = int(os.environ.get("BADRAGHE_REPLICA_PORT", "3307"))
+REPLICA_USER = os.environ.get("BADRAGHE_REPLICA_USER", "reader")
+REPLICA_PASSWORD = os.environ.get("BADRAGHE_REPLICA_PASSWORD", "password")
+
+INSTRUMENT = os.environ.get("BADRAGHE_INSTRUMENT", "") not in ("", "0")
+
+BACKEND = os.environ.get("BADRAGHE_BACKEND", "mysql")
+SQLITE_DATABASE = os.environ.get("BADRAGHE_SQLITE_DATABASE", "file:/badraghe?vfs=memdb")
+
+
+def connect(**kwargs):
+    kwargs.setdefault("cursorclass", pymysql.cursors.Cursor)
+    if BACKEND == "sqlite":
+        from badraghe import sqlite_backend
+
+        return sqlite_backend.connect(**kwargs)
+    return pymysql.connect(
+        host=DB_HOST,
+        user=DB_USER,
+        password=DB_PASSWORD,
+        database=DB_NAME,
+        port=DB_PORT,
+        **kwargs
+    )
+
+
+def connect_replica(**kwargs):
+    """Connect to the read replica (the `replica` compose profile); SQLite has none and uses connect()."""
+    kwargs.setdefault("cursorclass", pymysql.cursors.Cursor)
+    if BACKEND == "sqlite":
+        return connect(**kwargs)
+    return pymysql.connect(
+        host=REPLICA_HOST or DB_HOST,
+        user=REPLICA_USER,
+        password=REPLICA_PASSWORD,
+        database=DB_NAME,
+        port=REPLICA_PORT,
+        **kwargs
+    )
@@ -0,0 +1,292 @@
+import argparse
+import sys
+import time
+from datetime import timedelta
+
+from badraghe.pool import get_pool
+
+WATERMARK = "ticket_amenities"
+OVERLAP = timedelta(seconds=60)
+MASK_WORDS = 2
+BITS_PER_WORD = 63
+MASK_COLUMNS = [f"mask_{word}" for word in range(MASK_WORDS)]
+TICKETS_PER_BATCH = 50000
+IDS_PER_QUERY = 1000
+FEATURE_TABLES = {
+    "plane": ("flight_details", "flight_features", "flight_id"),
+    "train": ("train_details", "train_features", "train_id"),
+    "bus": ("bus_details", "bus_features", "bus_id"),
+}
+
+
+class TooManyFeatures(Exception):
+    pass
+
+
+def _rows(cursor):
+    return [tuple(row.values()) if isinstance(row, dict) else row for row in cursor.fetchall()]
+
+
+def _chunks(items, size=IDS_PER_QUERY):
+    items = sorted(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+# Bits. Each amenity owns one bit of the ticket_amenities mask columns;
+# 63 bits per column keep every mask a positive signed 64-bit integer,
+# which the SQLite backend stores exactly.
+
+def bit_of(position):
+    """(column index, single-bit mask) of bit `position`."""
+    return position // BITS_PER_WORD, 1 << (position % BITS_PER_WORD)
+
+
+def feature_bits(cursor, feature_ids=None):
+    """{feature_id: bit} for `feature_ids` (all features when None) that have a bit."""
+    if feature_ids is None:
+        cursor.execute("SELECT feature_id, bit FROM amenity_bits")
+        return dict(_rows(cursor))
+    bits = {}
+    for chunk in _chunks(set(feature_ids)):
+        cursor.execute(f"SELECT feature_id, bit FROM amenity_bits WHERE feature_id IN ({', '.join(['%s'] * len(chunk))})",
+                       chunk)
+        bits.update(_rows(cursor))
+    return bits
+
+
+def assign_bits(cursor, feature_ids):
+    """{feature_id: bit} for `feature_ids`, giving the ones without a bit the next free bits."""
+    bits = feature_bits(cursor, feature_ids)
+    for feature_id in sorted(set(feature_ids) - set(bits)):
+        while feature_id not in bits:
+            cursor.execute("SELECT COALESCE(MAX(bit) + 1, 0) FROM amenity_bits")
+            bit = _rows(cursor)[0][0]
+            if bit >= MASK_WORDS * BITS_PER_WORD:
+                raise TooManyFeatures(f"ticket_amenities has room for {MASK_WORDS * BITS_PER_WORD} amenities; "
+                                      f"add a mask column and raise MASK_WORDS")
+            cursor.execute("INSERT IGNORE INTO amenity_bits (feature_id, bit) VALUES (%s, %s)", (feature_id, bit))
+            bits.update(feature_bits(cursor, [feature_id]))
+    return bits
+
+
+def masks(bits):
+    """The per-column masks with `bits` set."""
+    words = [0] * MASK_WORDS
+    for bit in bits:
+        word, mask = bit_of(bit)
+        words[word] |= mask
+    return words
+
+
+def condition(words, match_all=True, alias="a"):
+    """SQL (and args) matching rows of ticket_amenities `alias` with all (or any) of the bits in `words`."""
+    used = [(column, mask) for column, mask in zip(MASK_COLUMNS, words) if mask]
+    if not used:
+        return ("TRUE" if match_all else "FALSE"), []
+    if match_all:
+        return " AND ".join(f"({alias}.{column} & %s) = %s" for column, _ in used), \
+            [value for _, mask in used for value in (mask, mask)]
+    return "(" + " OR ".join(f"({alias}.{column} & %s) <> 0" for column, _ in used) + ")", [mask for _, mask in used]
+
+
+def counts_sql(bits, alias="a"):
+    """SELECT expressions counting each feature's tickets in one pass, named f_<feature_id>."""
+    columns = []
+    for feature_id, bit in sorted(bits.items()):
+        word, _ = bit_of(bit)
+        columns.append(f"SUM(({alias}.{MASK_COLUMNS[word]} >> {bit % BITS_PER_WORD}) & 1) AS f_{feature_id}")
+    return columns
+
+
+# Maintenance
+
+def _ticket_features_sql(where):
+    parts = []
+    for transport_type, (details, features, key) in FEATURE_TABLES.items():
+        parts.append(
+            f"SELECT d.ticket_id, f.feature_id FROM {details} d "
+            f"JOIN {features} f ON f.{key} = d.id "
+            f"JOIN travel_tickets t ON t.id = d.ticket_id AND t.transport_type = '{transport_type}' "
+            f"WHERE {where.format(column='d.ticket_id')}"
+        )
+    return " UNION ALL ".join(parts)
+
+
+def _ticket_features(cursor, where, args):
+    cursor.execute(_ticket_features_sql(where), list(args) * len(FEATURE_TABLES))
+    features = {}
+    for ticket_id, feature_id in _rows(cursor):
+        features.setdefault(ticket_id, set()).add(feature_id)
+    return features
+
+
+def _write(cursor, ticket_masks, cleared):
+    if ticket_masks:
+        cursor.executemany(
+            f"INSERT INTO ticket_amenities (ticket_id, {', '.join(MASK_COLUMNS)}) "
+            f"VALUES (%s, {', '.join(['%s'] * MASK_WORDS)}) "
+            f"ON DUPLICATE KEY UPDATE {', '.join(f'{column} = VALUES({column})' for column in MASK_COLUMNS)}",
+            [[ticket_id] + words for ticket_id, words in sorted(ticket_masks.items())],
+        )
+    for chunk in _chunks(cleared):
+        cursor.execute(f"DELETE FROM ticket_amenities WHERE ticket_id IN ({', '.join(['%s'] * len(chunk))})", chunk)
+
+
+def refresh_tickets(cursor, ticket_ids):
+    """Recompute the masks of `ticket_ids` from the junction tables. Tickets without amenities get no row."""
+    ticket_ids = set(ticket_ids)
+    for chunk in _chunks(ticket_ids):
+        features = _ticket_features(cursor, f"{{column}} IN ({', '.join(['%s'] * len(chunk))})", chunk)
+        bits = assign_bits(cursor, {feature_id for ids in features.values() for feature_id in ids})
+        _write(cursor, {ticket_id: masks(bits[feature_id] for feature_id in ids) for ticket_id, ids in features.items()},
+               set(chunk) - set(features))
+
+
+def forget_tickets(cursor, ticket_ids):
+    """Drop the masks of tickets that are about to be deleted (the archiver runs this in its transaction)."""
+    _write(cursor, {}, ticket_ids)
+
+
+def _detail_ticket(cursor, transport_type, detail_id):
+    details, _, _ = FEATURE_TABLES[transport_type]
+    cursor.execute(f"SELECT ticket_id FROM {details} WHERE id = %s", (detail_id,))
+    row = _rows(cursor)
+    if not row:
+        raise LookupError(f"{details} row {detail_id} does not exist")
+    return row[0][0]
+
+
+# Writes that keep the masks exact: each changes a details row's amenities and
+# its ticket's mask in one transaction.
+
+def add_features(connection, transport_type, detail_id, feature_ids):
+    _, features, key = FEATURE_TABLES[transport_type]
+    connection.begin()
+    try:
+        with connection.cursor() as cursor:
+            ticket_id = _detail_ticket(cursor, transport_type, detail_id)
+            cursor.executemany(f"INSERT IGNORE INTO {features} ({key}, feature_id) VALUES (%s, %s)",
+                               [(detail_id, feature_id) for feature_id in sorted(set(feature_ids))])
+            refresh_tickets(cursor, [ticket_id])
+    except Exception:
+        connection.rollback()
+        raise
+    connection.commit()
+
+
+def remove_features(connection, transport_type, detail_id, feature_ids):
+    _, features, key = FEATURE_TABLES[transport_type]
+    feature_ids = sorted(set(feature_ids))
+    connection.begin()
+    try:
+        with connection.cursor() as cursor:
+            ticket_id = _detail_ticket(cursor, transport_type, detail_id)
+            if feature_ids:
+                cursor.execute(f"DELETE FROM {features} WHERE {key} = %s AND feature_id IN "
+                               f"({', '.join(['%s'] * len(feature_ids))})", [detail_id] + feature_ids)
+            refresh_tickets(cursor, [ticket_id])
+    except Exception:
+        connection.rollback()
+        raise
+    connection.commit()
+
+
+def _save_watermark(connection, now):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            INSERT INTO summary_watermarks (name, changed_through, last_id) VALUES (%s, %s, 0)
+            ON DUPLICATE KEY UPDATE changed_through = VALUES(changed_through)
+            """,
+            (WATERMARK, now),
+        )
+    connection.commit()
+
+
+def refresh(pool=None):
+    """Recompute the masks of tickets whose details rows changed since the last run; returns how many.
+
+    Catches details rows inserted or updated outside add_features/remove_features
+    (their updated_at, re-read with OVERLAP). Junction rows written directly
+    and deleted details are not seen; rebuild() catches those. Without a
+    watermark this falls back to rebuild().
+    """
+    pool = pool or get_pool()
+    with pool.connection(autocommit=False) as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT changed_through FROM summary_watermarks WHERE name = %s", (WATERMARK,))
+            watermark = _rows(cursor)
+        connection.commit()
+        if not watermark:
+            return rebuild(pool)
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT NOW()")
+            now = _rows(cursor)[0][0]
+            tickets = set()
+            for details, _, _ in FEATURE_TABLES.values():
+                cursor.execute(f"SELECT ticket_id FROM {details} WHERE updated_at > %s",
+                               (watermark[0][0] - OVERLAP,))
+                tickets |= {row[0] for row in _rows(cursor)}
+        connection.commit()
+        for chunk in _chunks(tickets, TICKETS_PER_BATCH):
+            with connection.cursor() as cursor:
+                refresh_tickets(cursor, chunk)
+            connection.commit()
+        _save_watermark(connection, now)
+    return len(tickets)
+
+
+def rebuild(pool=None, tickets_per_batch=TICKETS_PER_BATCH):
+    """Recompute every mask, `tickets_per_batch` ticket ids per transaction.
+
+    Features keep the bits they already have, so masks written before and
+    during the rebuild stay readable; features without one get the next
+    free bits. Each batch rewrites the masks of one ticket id range and
+    drops the rows of tickets in it that no longer have amenities. Returns
+    the number of tickets with at least one amenity.
+    """
+    pool = pool or get_pool()
+    indexed = 0
+    with pool.connection(autocommit=False) as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT NOW(), (SELECT COALESCE(MAX(id), 0) FROM travel_tickets)")
+            now, last_ticket_id = _rows(cursor)[0]
+            cursor.execute(
+                " UNION ".join(f"SELECT DISTINCT feature_id FROM {features}" for _, features, _ in FEATURE_TABLES.values())
+            )
+            assign_bits(cursor, [row[0] for row in _rows(cursor)])
+        connection.commit()
+        for first in range(1, last_ticket_id + 1, tickets_per_batch):
+            bounds = (first, first + tickets_per_batch - 1)
+            with connection.cursor() as cursor:
+                features = _ticket_features(cursor, "{column} BETWEEN %s AND %s", bounds)
+                bits = assign_bits(cursor, {feature_id for ids in features.values() for feature_id in ids})
+                cursor.execute("SELECT ticket_id FROM ticket_amenities WHERE ticket_id BETWEEN %s AND %s", bounds)
+                stale = {row[0] for row in _rows(cursor)} - set(features)
+                _write(cursor, {ticket_id: masks(bits[feature_id] for feature_id in ids)
+                                for ticket_id, ids in features.items()}, stale)
+            connection.commit()
+            indexed += len(features)
+        _save_watermark(connection, now)
+    return indexed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintain the per-ticket amenity bitmasks.")
+    parser.add_argument("command", choices=["rebuild", "refresh"])
+    parser.add_argument("--tickets-per-batch", type=int, default=TICKETS_PER_BATCH)
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    if args.command == "rebuild":
+        count = rebuild(tickets_per_batch=args.tickets_per_batch)
+        print(f"✅ {count:,} tickets with amenities indexed in {time.perf_counter() - started:.1f}s")
+    else:
+        count = refresh()
+        print(f"✅ {count:,} tickets refreshed in {time.perf_counter() - started:.2f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,343 @@
+import argparse
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import pymysql
+
+from badraghe.pool import PoolTimeout, get_pool
+
+BATCH_SIZE = 500
+FLUSH_INTERVAL = 0.05
+CACHE_SIZE = 100000
+MAX_BUFFER = 20000
+MAX_BACKOFF = 5.0
+RETRYABLE = {1205, 1213}
+CONNECTION_LOST = {2003, 2006, 2013}
+DUPLICATE_KEY = 1062
+COLUMNS = ["user_id", "reservation_id", "amount", "payment_method_id", "status", "transaction_id", "currency",
+           "payment_details"]
+
+# A retried callback never downgrades a payment: only a pending one takes the new status.
+UPSERT = f"""
+    INSERT INTO payments ({', '.join(COLUMNS)})
+    VALUES ({', '.join(['%s'] * len(COLUMNS))})
+    ON DUPLICATE KEY UPDATE
+        status = IF(status = 'pending', VALUES(status), status),
+        payment_details = COALESCE(VALUES(payment_details), payment_details)
+"""
+INSERT = f"INSERT INTO payments ({', '.join(COLUMNS)}) VALUES ({', '.join(['%s'] * len(COLUMNS))})"
+
+
+def _values(callback):
+    return (callback["user_id"], callback["reservation_id"], callback["amount"], callback["payment_method_id"],
+            callback.get("status", "successful"), callback["transaction_id"], callback.get("currency", "IRR"),
+            callback.get("payment_details"))
+
+
+def _mark_paid(cursor, transaction_ids):
+    """Move the reservations of the successful payments among `transaction_ids` to 'paid'."""
+    cursor.execute(
+        f"""
+        UPDATE user_reservations r JOIN payments p ON p.reservation_id = r.id
+        SET r.status = 'paid', r.payment_id = p.id
+        WHERE p.transaction_id IN ({', '.join(['%s'] * len(transaction_ids))})
+          AND p.status = 'successful' AND r.status IN ('temporary', 'reserved')
+        """,
+        list(transaction_ids),
+    )
+    return max(cursor.rowcount, 0)
+
+
+def write_batch(connection, callbacks):
+    """Upsert a batch of callbacks and pay their reservations in one transaction; returns reservations paid.
+
+    Rows go in transaction_id order so concurrent batches lock the unique
+    index in the same order. Callbacks already in payments update it instead
+    of failing, so a batch with retries in it still commits.
+    """
+    callbacks = sorted(callbacks, key=lambda callback: callback["transaction_id"])
+    connection.begin()
+    try:
+        with connection.cursor() as cursor:
+            cursor.executemany(UPSERT, [_values(callback) for callback in callbacks])
+            paid = _mark_paid(cursor, [callback["transaction_id"] for callback in callbacks])
+    except Exception:
+        connection.rollback()
+        raise
+    connection.commit()
+    return paid
+
+
+def ingest_one(connection, callback):
+    """The unbatched path: insert one payment and pay its reservation. Returns False for a duplicate."""
+    connection.begin()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(INSERT, _values(callback))
+            _mark_paid(cursor, [callback["transaction_id"]])
+    except pymysql.err.IntegrityError as e:
+        connection.rollback()
+        if e.args[0] == DUPLICATE_KEY:
+            return False
+        raise
+    except Exception:
+        connection.rollback()
+        raise
+    connection.commit()
+    return True
+
+
+class RecentKeys:
+    """The last `size` transaction ids written, evicting the least recently seen."""
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self._keys = OrderedDict()
+
+    def __contains__(self, key):
+        if key in self._keys:
+            self._keys.move_to_end(key)
+            return True
+        return False
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, key):
+        self._keys[key] = None
+        self._keys.move_to_end(key)
+        if len(self._keys) > self.size:
+            self._keys.popitem(last=False)
+
+
+class PaymentIngestor:
+    """Buffers payment gateway callbacks and writes them to payments in batches.
+
+    submit() drops callbacks whose transaction_id was written recently or is
+    still buffered, and otherwise queues them. A flusher thread writes the
+    buffer every `batch_size` callbacks or `flush_interval` seconds, each
+    batch in one transaction with its reservations. Retries older than the
+    cache are caught by the unique key on payments.transaction_id instead.
+    submit() blocks while `max_buffer` callbacks are waiting.
+
+    A batch that hits another integrity error (a missing reservation, say)
+    is written one callback at a time so only the bad callbacks are rejected.
+    A batch that fails on a lost connection, a lock wait timeout or a
+    deadlock is retried with backoff; any other error rejects the whole
+    batch into `dead_letters` so later callbacks are not held up behind it.
+    """
+
+    def __init__(self, pool=None, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL, cache_size=CACHE_SIZE,
+                 max_buffer=MAX_BUFFER):
+        self.pool = pool or get_pool()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.recent = RecentKeys(cache_size)
+        self.stats = {"accepted": 0, "dropped": 0, "written": 0, "rejected": 0, "paid": 0,
+                      "batches": 0, "retries": 0}
+        self.dead_letters = []
+        self._buffer = []
+        self._pending = set()
+        self._changed = threading.Condition()
+        self._stopped = False
+        self._thread = None
+
+    def submit(self, callback):
+        """Queue a callback; returns False if it was dropped as a duplicate."""
+        transaction_id = callback["transaction_id"]
+        with self._changed:
+            if transaction_id in self._pending or transaction_id in self.recent:
+                self.stats["dropped"] += 1
+                return False
+            while len(self._buffer) >= self.max_buffer:
+                self._changed.wait()
+            self._buffer.append(callback)
+            self._pending.add(transaction_id)
+            self.stats["accepted"] += 1
+            if len(self._buffer) >= self.batch_size:
+                self._changed.notify_all()
+        return True
+
+    def _take(self):
+        batch, self._buffer = self._buffer[:self.batch_size], self._buffer[self.batch_size:]
+        return batch
+
+    def _write(self, connection, batch):
+        while True:
+            try:
+                paid = write_batch(connection, batch)
+                written = [callback["transaction_id"] for callback in batch]
+                break
+            except pymysql.err.OperationalError as e:
+                if e.args[0] not in RETRYABLE:
+                    raise
+                self.stats["retries"] += 1
+            except pymysql.err.IntegrityError:
+                paid, written = 0, []
+                for callback in batch:
+                    try:
+                        paid += write_batch(connection, [callback])
+                        written.append(callback["transaction_id"])
+                    except pymysql.err.IntegrityError as e:
+                        print(f"⚠️ Rejected payment callback {callback['transaction_id']}: {e}")
+                        self.stats["rejected"] += 1
+                break
+        with self._changed:
+            for transaction_id in written:
+                self.recent.add(transaction_id)
+            self._pending.difference_update(callback["transaction_id"] for callback in batch)
+            self.stats["written"] += len(written)
+            self.stats["paid"] += paid
+            self.stats["batches"] += 1
+            self._changed.notify_all()
+
+    def _reject(self, batch, error):
+        print(f"⚠️ Rejected a batch of {len(batch)} payment callbacks: {error}")
+        with self._changed:
+            self.dead_letters.extend(batch)
+            self._pending.difference_update(callback["transaction_id"] for callback in batch)
+            self.stats["rejected"] += len(batch)
+            self.stats["batches"] += 1
+            self._changed.notify_all()
+
+    def flush(self):
+        """Write everything buffered now, in this thread. Returns the number of callbacks written."""
+        written = self.stats["written"]
+        with self.pool.connection(autocommit=False) as connection:
+            while True:
+                with self._changed:
+                    batch = self._take()
+                if not batch:
+                    break
+                self._write(connection, batch)
+        return self.stats["written"] - written
+
+    def _run(self):
+        backoff = self.flush_interval
+        while True:
+            with self._changed:
+                self._changed.wait_for(lambda: self._stopped or len(self._buffer) >= self.batch_size,
+                                       self.flush_interval)
+                batch = self._take()
+                if not batch and self._stopped:
+                    return
+            if not batch:
+                continue
+            try:
+                with self.pool.connection(autocommit=False) as connection:
+                    self._write(connection, batch)
+            except (pymysql.MySQLError, PoolTimeout) as e:
+                if isinstance(e, pymysql.MySQLError) and e.args and e.args[0] not in RETRYABLE | CONNECTION_LOST:
+                    self._reject(batch, e)
+                    continue
+                print(f"⚠️ Payment batch failed, retrying in {backoff:.2f}s: {e}")
+                with self._changed:
+                    self._buffer[:0] = batch
+                    self.stats["retries"] += 1
+                time.sleep(backoff)
+                backoff = min(backoff * 2, MAX_BACKOFF)
+            else:
+                backoff = self.flush_interval
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="payment-ingestor", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Write what is still buffered and stop the flusher thread."""
+        with self._changed:
+            self._stopped = True
+            self._changed.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+        return self.stats
+
+
+def _callbacks(pool, count, duplicates, seed):
+    """`count` callbacks for existing reservations, with a `duplicates` share being replays of earlier ones."""
+    rng = random.Random(seed)
+    with pool.connection() as connection, connection.cursor() as cursor:
+        cursor.execute("SELECT MIN(id) FROM payment_methods")
+        method_id = cursor.fetchone()[0]
+        cursor.execute("SELECT id, user_id, COALESCE(price_paid, 0) FROM user_reservations ORDER BY id DESC LIMIT %s",
+                       (count,))
+        reservations = [row if not isinstance(row, dict) else tuple(row.values()) for row in cursor.fetchall()]
+    if method_id is None or not reservations:
+        raise SystemExit("⛔ payment_methods and user_reservations need rows; run python -m badraghe.seed first")
+    callbacks = []
+    for index in range(count):
+        if callbacks and rng.random() < duplicates:
+            callbacks.append(rng.choice(callbacks))
+            continue
+        reservation_id, user_id, amount = reservations[index % len(reservations)]
+        callbacks.append({"transaction_id": f"ingest-{uuid.uuid4().hex}", "reservation_id": reservation_id,
+                          "user_id": user_id, "amount": amount, "payment_method_id": method_id,
+                          "status": "successful"})
+    return callbacks
+
+
+def bench(pool, count, duplicates=0.2, threads=8, batch_size=BATCH_SIZE, seed=None):
+    """Callbacks per second through ingest_one and through a PaymentIngestor, from `threads` producers."""
+    results = {}
+    pool = pool or get_pool()
+    callbacks = _callbacks(pool, count, duplicates, seed)
+    local = threading.local()
+    connections = []
+
+    def single(callback):
+        if not hasattr(local, "connection"):
+            local.connection = pool.acquire(autocommit=False)
+            connections.append(local.connection)
+        return ingest_one(local.connection, callback)
+
+    started = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(threads) as executor:
+            written = sum(executor.map(single, callbacks))
+    finally:
+        for connection in connections:
+            pool.release(connection)
+    elapsed = time.perf_counter() - started
+    results["single"] = {"callbacks": count, "written": written, "seconds": elapsed, "per_second": count / elapsed}
+
+    callbacks = _callbacks(pool, count, duplicates, seed)
+    ingestor = PaymentIngestor(pool, batch_size=batch_size).start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        list(executor.map(ingestor.submit, callbacks))
+    stats = ingestor.stop()
+    elapsed = time.perf_counter() - started
+    results["batched"] = {"callbacks": count, "written": stats["written"], "seconds": elapsed,
+                          "per_second": count / elapsed, "batches": stats["batches"], "dropped": stats["dropped"]}
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Batched, deduplicated payment callback ingestion.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    bench_parser = subparsers.add_parser("bench", help="compare callback throughput with and without batching")
+    bench_parser.add_argument("--callbacks", type=int, default=20000)
+    bench_parser.add_argument("--duplicates", type=float, default=0.2, help="share of callbacks that are retries")
+    bench_parser.add_argument("--threads", type=int, default=8, help="concurrent callback producers")
+    bench_parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    bench_parser.add_argument("--seed", type=int)
+    args = parser.parse_args(argv)
+
+    print(f"🚀 Ingesting {args.callbacks:,} callbacks ({args.duplicates:.0%} retries) from {args.threads} threads...")
+    results = bench(None, args.callbacks, args.duplicates, args.threads, args.batch_size, args.seed)
+    for mode, result in results.items():
+        print(f"✅ {mode:>7}: {result['written']:,} payments written in {result['seconds']:.2f}s "
+              f"({result['per_second']:,.0f} callbacks/s)")
+    print(f"📈 batching is {results['batched']['per_second'] / results['single']['per_second']:.1f}x faster")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
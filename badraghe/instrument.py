@@ -0,0 +1,269 @@
+import atexit
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+import pymysql
+
+from badraghe import config
+
+SLOW_MS = 200.0
+N_PLUS_ONE = 10
+SAMPLE_RATE = 0.01
+LOCKING_READ = re.compile(r"\bfor\s+(?:update|share)\b|\block\s+in\s+share\s+mode\b")
+
+_SKIPPED_FILES = (os.path.dirname(pymysql.__file__), os.path.abspath(__file__), os.path.dirname(threading.__file__))
+
+_FINGERPRINT_RULES = [
+    (re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.|\"\")*\""), "?"),
+    (re.compile(r"/\*.*?\*/|--[^\n]*|#[^\n]*", re.S), " "),
+    (re.compile(r"%\(\w+\)s|%s"), "?"),
+    (re.compile(r"\b\d+(?:\.\d+)?\b"), "?"),
+    (re.compile(r"\s+"), " "),
+    (re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)"), "(?+)"),
+    (re.compile(r"(\(\?\+\))(?:\s*,\s*\(\?\+\))+"), r"\1+"),
+]
+_fingerprints = {}
+
+
+def fingerprint(sql):
+    """Normalize a statement to its shape: literals and placeholders become ?, lists collapse."""
+    cached = _fingerprints.get(sql)
+    if cached is None:
+        cached = sql
+        for pattern, replacement in _FINGERPRINT_RULES:
+            cached = pattern.sub(replacement, cached)
+        cached = cached.strip().lower()
+        if len(_fingerprints) < 100000:
+            _fingerprints[sql] = cached
+    return cached
+
+
+def call_site():
+    frame = sys._getframe(2)
+    while frame is not None and frame.f_code.co_filename.startswith(_SKIPPED_FILES):
+        frame = frame.f_back
+    if frame is None:
+        return "?"
+    return f"{os.path.relpath(frame.f_code.co_filename, config.ROOT_DIR)}:{frame.f_lineno} {frame.f_code.co_name}"
+
+
+class QueryStats:
+    __slots__ = ("fingerprint", "count", "seconds", "max_seconds", "rows", "rows_examined", "examined_samples",
+                 "slow", "explain", "sites")
+
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.count = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.rows = 0
+        self.rows_examined = 0
+        self.examined_samples = 0
+        self.slow = 0
+        self.explain = None
+        self.sites = {}
+
+    def as_dict(self):
+        return {
+            "fingerprint": self.fingerprint,
+            "count": self.count,
+            "total_ms": self.seconds * 1000,
+            "avg_ms": self.seconds * 1000 / self.count if self.count else 0.0,
+            "max_ms": self.max_seconds * 1000,
+            "rows": self.rows,
+            "avg_rows_examined": self.rows_examined / self.examined_samples if self.examined_samples else None,
+            "slow": self.slow,
+            "sites": self.sites,
+            "explain": self.explain,
+        }
+
+
+class Recorder:
+    """Collects per-fingerprint statement statistics.
+
+    Every statement costs a fingerprint lookup, two clock reads and a short
+    frame walk. Rows examined come from performance_schema for a sample of
+    statements (`sample_rate`) plus every slow one, and the plan of the
+    first slow run of each SELECT shape is kept. The plan comes from
+    EXPLAIN FORMAT=TREE, which does not run the statement; with `analyze`
+    it comes from EXPLAIN ANALYZE, which runs it a second time. Locking
+    reads (FOR UPDATE/FOR SHARE) are never explained, since that would
+    take their row locks again inside the caller's transaction. A shape
+    executed `n_plus_one` times in a row from the same call site is
+    reported as N+1.
+    """
+
+    def __init__(self, slow_ms=SLOW_MS, n_plus_one=N_PLUS_ONE, sample_rate=SAMPLE_RATE, analyze=False):
+        self.slow_seconds = slow_ms / 1000
+        self.n_plus_one = n_plus_one
+        self.sample_rate = sample_rate
+        self.analyze = analyze
+        self.stats = {}
+        self.repeats = {}
+        self._lock = threading.Lock()
+        self._examined_available = True
+
+    def _rows_examined(self, connection):
+        try:
+            with pymysql.cursors.Cursor(connection) as cursor:
+                cursor.execute(
+                    "SELECT ROWS_EXAMINED FROM performance_schema.events_statements_history "
+                    "WHERE THREAD_ID = PS_CURRENT_THREAD_ID() ORDER BY EVENT_ID DESC LIMIT 1"
+                )
+                row = cursor.fetchone()
+            return row[0] if row else None
+        except pymysql.MySQLError:
+            self._examined_available = False
+            return None
+
+    def _explain(self, connection, sql):
+        explain = "EXPLAIN ANALYZE" if self.analyze else "EXPLAIN FORMAT=TREE"
+        try:
+            with pymysql.cursors.Cursor(connection) as cursor:
+                cursor.execute(f"{explain} {sql}")
+                return "\n".join(row[0] for row in cursor.fetchall())
+        except pymysql.MySQLError as e:
+            return f"{explain} failed: {e}"
+
+    def record(self, cursor, query, args, seconds, rows):
+        shape = fingerprint(query)
+        site = call_site()
+        slow = seconds >= self.slow_seconds
+        buffered = not isinstance(cursor, pymysql.cursors.SSCursor)
+
+        examined = None
+        if buffered and self._examined_available and (slow or random.random() < self.sample_rate):
+            examined = self._rows_examined(cursor.connection)
+
+        with self._lock:
+            stats = self.stats.get(shape)
+            if stats is None:
+                stats = self.stats[shape] = QueryStats(shape)
+            stats.count += 1
+            stats.seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+            stats.rows += max(rows, 0)
+            stats.sites[site] = stats.sites.get(site, 0) + 1
+            if examined is not None:
+                stats.rows_examined += examined
+                stats.examined_samples += 1
+            need_explain = slow and stats.explain is None
+            if slow:
+                stats.slow += 1
+                if need_explain:
+                    stats.explain = ""
+
+        self._track_repeats(cursor.connection, shape, site)
+        if need_explain and buffered and shape.startswith(("select", "with")) and not LOCKING_READ.search(shape):
+            sql = cursor.mogrify(query, args)
+            stats.explain = self._explain(cursor.connection, sql)
+
+    def _track_repeats(self, connection, shape, site):
+        last = getattr(connection, "_instrument_last", None)
+        key = (shape, site)
+        if last and last[0] == key:
+            run = last[1] + 1
+        else:
+            run = 1
+        connection._instrument_last = (key, run)
+        if run >= self.n_plus_one:
+            with self._lock:
+                self.repeats[key] = max(self.repeats.get(key, 0), run)
+
+    def n_plus_one_report(self):
+        return [{"fingerprint": shape, "site": site, "run": run} for (shape, site), run in
+                sorted(self.repeats.items(), key=lambda item: -item[1])]
+
+    def as_dict(self, sort="total_ms"):
+        with self._lock:
+            stats = [stats.as_dict() for stats in self.stats.values()]
+        return {
+            "statements": sorted(stats, key=lambda item: item[sort], reverse=True),
+            "n_plus_one": self.n_plus_one_report(),
+        }
+
+    def report(self, top=20, path=None):
+        data = self.as_dict()
+        if path:
+            with open(path, "w") as f:
+                json.dump(data, f, indent=2, default=str)
+        if not data["statements"]:
+            return
+        print(f"🔬 {len(data['statements'])} statement shapes, top {min(top, len(data['statements']))} by total time:")
+        for item in data["statements"][:top]:
+            examined = "" if item["avg_rows_examined"] is None else f" {item['avg_rows_examined']:.0f} examined"
+            print(f"   {item['total_ms']:10.1f}ms {item['count']:>8}x {item['avg_ms']:8.2f}ms avg{examined}  "
+                  f"{item['fingerprint'][:90]}")
+            if item["explain"]:
+                print("      " + item["explain"].replace("\n", "\n      "))
+        for item in data["n_plus_one"]:
+            print(f"⚠️ N+1: {item['run']} consecutive runs at {item['site']}: {item['fingerprint'][:90]}")
+
+
+class InstrumentedCursorMixin:
+    recorder = None
+    _in_many = False
+
+    def execute(self, query, args=None):
+        if self._in_many:
+            return super().execute(query, args)
+        started = time.perf_counter()
+        result = super().execute(query, args)
+        self.recorder.record(self, query, args, time.perf_counter() - started, self.rowcount)
+        return result
+
+    def executemany(self, query, args):
+        self._in_many = True
+        started = time.perf_counter()
+        try:
+            result = super().executemany(query, args)
+        finally:
+            self._in_many = False
+        self.recorder.record(self, query, None, time.perf_counter() - started, self.rowcount)
+        return result
+
+
+_cursor_classes = {}
+
+
+def instrumented(cursorclass, recorder):
+    """Return a subclass of `cursorclass` that reports every statement to `recorder`."""
+    key = (cursorclass, id(recorder))
+    cls = _cursor_classes.get(key)
+    if cls is None:
+        cls = type(f"Instrumented{cursorclass.__name__}", (InstrumentedCursorMixin, cursorclass), {"recorder": recorder})
+        _cursor_classes[key] = cls
+    return cls
+
+
+def instrument_connection(connection, recorder=None):
+    """Make every cursor opened on `connection` an instrumented one."""
+    recorder = recorder or get_recorder()
+    original = connection.cursor
+
+    def cursor(cursor=None):
+        return original(instrumented(cursor or connection.cursorclass, recorder))
+
+    connection.cursor = cursor
+    return connection
+
+
+_default_recorder = None
+_default_lock = threading.Lock()
+
+
+def get_recorder():
+    """Return the process-wide recorder; its report is printed (and saved to
+    BADRAGHE_INSTRUMENT_REPORT, if set) when the process exits."""
+    global _default_recorder
+    with _default_lock:
+        if _default_recorder is None:
+            _default_recorder = Recorder(float(os.environ.get("BADRAGHE_SLOW_QUERY_MS", SLOW_MS)),
+                                         analyze=os.environ.get("BADRAGHE_EXPLAIN_ANALYZE", "") not in ("", "0"))
+            atexit.register(_default_recorder.report, path=os.environ.get("BADRAGHE_INSTRUMENT_REPORT"))
+        return _default_recorder
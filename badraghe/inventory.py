@@ -0,0 +1,207 @@
+import argparse
+import threading
+import time
+
+import pymysql
+
+from badraghe.pool import get_pool
+
+HOLD_TTL = 600
+SWEEP_BATCH = 500
+DEADLOCK = 1213
+
+
+class SoldOut(Exception):
+    pass
+
+
+class HoldExpired(Exception):
+    pass
+
+
+def hold_seat(connection, user_id, ticket_id):
+    """Take one seat of `ticket_id` and return the id of the temporary reservation.
+
+    The seat is taken by a single conditional UPDATE, so concurrent buyers
+    queue on the ticket row instead of reading a stale count. The last seat
+    flips the ticket to 'sold_out' in the same statement. Raises SoldOut
+    when no seat is left.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            UPDATE travel_tickets
+            SET available_seats = available_seats - 1,
+                status = IF(available_seats = 0, 'sold_out', status)
+            WHERE id = %s AND status = 'available' AND available_seats > 0
+            """,
+            (ticket_id,),
+        )
+        if not cursor.rowcount:
+            connection.rollback()
+            raise SoldOut(f"ticket {ticket_id} has no available seats")
+        cursor.execute(
+            """
+            INSERT INTO user_reservations (user_id, ticket_id, status, reserved_at, price_paid)
+            SELECT %s, id, 'temporary', NOW(), price FROM travel_tickets WHERE id = %s
+            """,
+            (user_id, ticket_id),
+        )
+        reservation_id = cursor.lastrowid
+    connection.commit()
+    return reservation_id
+
+
+def confirm_hold(connection, reservation_id, ttl=HOLD_TTL):
+    """Turn a temporary hold into a reservation, unless it already expired."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            UPDATE user_reservations SET status = 'reserved'
+            WHERE id = %s AND status = 'temporary' AND reserved_at >= NOW() - INTERVAL %s SECOND
+            """,
+            (reservation_id, ttl),
+        )
+        confirmed = cursor.rowcount
+    connection.commit()
+    if not confirmed:
+        raise HoldExpired(f"reservation {reservation_id} is not an active hold")
+
+
+def _restore_seats(cursor, seats_by_ticket):
+    cursor.executemany(
+        """
+        UPDATE travel_tickets
+        SET available_seats = available_seats + %s,
+            status = IF(status = 'sold_out', 'available', status)
+        WHERE id = %s
+        """,
+        [(seats, ticket_id) for ticket_id, seats in sorted(seats_by_ticket.items())],
+    )
+
+
+def release_hold(connection, reservation_id):
+    """Cancel a temporary hold and put its seat back. Returns False if it was not held."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT ticket_id FROM user_reservations WHERE id = %s AND status = 'temporary' FOR UPDATE",
+            (reservation_id,),
+        )
+        row = cursor.fetchone()
+        if row is None:
+            connection.rollback()
+            return False
+        ticket_id = row["ticket_id"] if isinstance(row, dict) else row[0]
+        cursor.execute("UPDATE user_reservations SET status = 'canceled' WHERE id = %s", (reservation_id,))
+        _restore_seats(cursor, {ticket_id: 1})
+    connection.commit()
+    return True
+
+
+def release_expired(connection, ttl=HOLD_TTL, batch_size=SWEEP_BATCH):
+    """Cancel one batch of holds older than `ttl` seconds and restore their seats.
+
+    Rows are claimed with SKIP LOCKED under READ COMMITTED, so the sweeper
+    never waits on (or gap-locks against) buyers, and several sweepers can
+    run side by side. Returns the number of holds released.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL READ COMMITTED")
+        connection.begin()
+        cursor.execute(
+            """
+            SELECT id, ticket_id FROM user_reservations
+            WHERE status = 'temporary' AND reserved_at < NOW() - INTERVAL %s SECOND
+            ORDER BY reserved_at
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+            """,
+            (ttl, batch_size),
+        )
+        rows = [(row["id"], row["ticket_id"]) if isinstance(row, dict) else row for row in cursor.fetchall()]
+        if not rows:
+            connection.rollback()
+            return 0
+
+        seats_by_ticket = {}
+        for _, ticket_id in rows:
+            seats_by_ticket[ticket_id] = seats_by_ticket.get(ticket_id, 0) + 1
+        cursor.execute(
+            f"UPDATE user_reservations SET status = 'canceled' WHERE id IN ({', '.join(['%s'] * len(rows))})",
+            [reservation_id for reservation_id, _ in rows],
+        )
+        _restore_seats(cursor, seats_by_ticket)
+    connection.commit()
+    return len(rows)
+
+
+class HoldSweeper(threading.Thread):
+    """Background thread that releases expired holds every `interval` seconds."""
+
+    def __init__(self, pool=None, ttl=HOLD_TTL, batch_size=SWEEP_BATCH, interval=5.0):
+        super().__init__(name="hold-sweeper", daemon=True)
+        self.pool = pool or get_pool()
+        self.ttl = ttl
+        self.batch_size = batch_size
+        self.interval = interval
+        self.released = 0
+        self.batches = 0
+        self._stopped = threading.Event()
+
+    def sweep(self):
+        released = 0
+        with self.pool.connection(autocommit=False) as connection:
+            while not self._stopped.is_set():
+                try:
+                    count = release_expired(connection, self.ttl, self.batch_size)
+                except pymysql.err.OperationalError as e:
+                    connection.rollback()
+                    if e.args[0] != DEADLOCK:
+                        raise
+                    continue
+                released += count
+                self.batches += 1
+                if count < self.batch_size:
+                    break
+        self.released += released
+        return released
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                released = self.sweep()
+            except pymysql.MySQLError as e:
+                print(f"⚠️ Hold sweep failed: {e}")
+            else:
+                if released:
+                    print(f"🧹 Released {released} expired holds")
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Release expired temporary seat holds.")
+    parser.add_argument("--ttl", type=int, default=HOLD_TTL, help="hold lifetime in seconds")
+    parser.add_argument("--batch-size", type=int, default=SWEEP_BATCH)
+    parser.add_argument("--interval", type=float, default=5.0)
+    parser.add_argument("--once", action="store_true", help="sweep once and exit")
+    args = parser.parse_args(argv)
+
+    sweeper = HoldSweeper(ttl=args.ttl, batch_size=args.batch_size, interval=args.interval)
+    if args.once:
+        print(f"🧹 Released {sweeper.sweep()} expired holds in {sweeper.batches} batches")
+        return
+    print(f"🚀 Sweeping holds older than {args.ttl}s every {args.interval}s (Ctrl+C to stop)")
+    sweeper.start()
+    try:
+        while sweeper.is_alive():
+            time.sleep(1)
+    except KeyboardInterrupt:
+        sweeper.stop()
+
+
+if __name__ == "__main__":
+    main()
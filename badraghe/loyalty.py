@@ -0,0 +1,303 @@
+import argparse
+import sys
+import time
+from array import array
+from datetime import timedelta
+
+from badraghe.pool import get_pool
+
+WATERMARK = "user_loyalty"
+POINT_VALUE = 10000
+TIER_PERCENT = (10, 5, 2)
+OVERLAP = timedelta(seconds=60)
+USERS_PER_BATCH = 50000
+IDS_PER_QUERY = 1000
+UPSERT_BATCH = 5000
+
+
+def _rows(cursor):
+    return [tuple(row.values()) if isinstance(row, dict) else row for row in cursor.fetchall()]
+
+
+def _scalar(cursor, sql, args=None):
+    cursor.execute(sql, args)
+    return _rows(cursor)[0][0]
+
+
+def _zeros(size):
+    return array("q", bytes(8 * size))
+
+
+def points_for(amount):
+    """Own points earned for `amount` paid (in IRR)."""
+    return int((amount or 0) // POINT_VALUE)
+
+
+class ReferralGraph:
+    """Referral edges in CSR form, indexed directly by user id.
+
+    The users that `u` points at are targets[offsets[u]:offsets[u + 1]].
+    Built `down`, u is a referrer and the targets are the users it
+    referred; built `up`, the targets are u's referrers. Two int64 arrays
+    hold the whole graph: (max_user_id + 2) offsets and one slot per edge.
+    """
+
+    def __init__(self, size, edges):
+        self.size = size
+        counts = _zeros(size + 1)
+        for source, _ in edges:
+            counts[source + 1] += 1
+        for i in range(size):
+            counts[i + 1] += counts[i]
+        self.offsets = counts
+        self.targets = _zeros(len(edges))
+        cursor = array("q", counts)
+        for source, target in edges:
+            self.targets[cursor[source]] = target
+            cursor[source] += 1
+        self.sources = [u for u in range(size) if counts[u + 1] != counts[u]]
+
+    @classmethod
+    def load(cls, cursor, size, through_id=None, direction="down"):
+        sql = "SELECT referrer_id, referred_id FROM user_referrals WHERE referrer_id <> referred_id"
+        args = None
+        if through_id is not None:
+            sql += " AND id <= %s"
+            args = (through_id,)
+        cursor.execute(sql, args)
+        edges = _rows(cursor)
+        if direction == "up":
+            edges = [(referred, referrer) for referrer, referred in edges]
+        return cls(size, edges)
+
+    def neighbours(self, user_id):
+        if user_id >= self.size:
+            return self.targets[0:0]
+        return self.targets[self.offsets[user_id]:self.offsets[user_id + 1]]
+
+    def level_sums(self, values, depth):
+        """levels[k][u] = sum of `values` over users k + 1 hops from u, one array pass per level."""
+        levels = []
+        current = values
+        offsets, targets = self.offsets, self.targets
+        for _ in range(depth):
+            following = _zeros(self.size)
+            for u in self.sources:
+                following[u] = sum(current[targets[i]] for i in range(offsets[u], offsets[u + 1]))
+            levels.append(following)
+            current = following
+        return levels
+
+    def within(self, users, depth):
+        """`users` plus everyone reachable from them in at most `depth` hops."""
+        found = set(users)
+        frontier = set(users)
+        for _ in range(depth):
+            frontier = {target for user_id in frontier for target in self.neighbours(user_id)} - found
+            found |= frontier
+        return found
+
+
+def referral_credit(levels_at):
+    """Referral points from the downline sums at each tier (nearest tier first)."""
+    return sum(amount * percent for amount, percent in zip(levels_at, TIER_PERCENT)) // 100
+
+
+def _own_points_range(cursor, first, last):
+    cursor.execute(
+        """
+        SELECT user_id, SUM(price_paid) FROM user_reservations
+        WHERE status = 'paid' AND user_id BETWEEN %s AND %s
+        GROUP BY user_id
+        """,
+        (first, last),
+    )
+    return {user_id: points_for(amount) for user_id, amount in _rows(cursor)}
+
+
+def _own_points_of(cursor, user_ids):
+    own = {}
+    user_ids = sorted(user_ids)
+    for start in range(0, len(user_ids), IDS_PER_QUERY):
+        chunk = user_ids[start:start + IDS_PER_QUERY]
+        cursor.execute(
+            f"""
+            SELECT user_id, SUM(price_paid) FROM user_reservations
+            WHERE status = 'paid' AND user_id IN ({', '.join(['%s'] * len(chunk))})
+            GROUP BY user_id
+            """,
+            chunk,
+        )
+        own.update({user_id: points_for(amount) for user_id, amount in _rows(cursor)})
+    return own
+
+
+def _stored(cursor, sql, args):
+    cursor.execute(sql, args)
+    return dict(_rows(cursor))
+
+
+def _changed(totals, stored):
+    """The totals that differ from user_loyalty; a missing row counts as 0 points."""
+    return {user_id: total for user_id, total in totals.items() if stored.get(user_id, 0) != total}
+
+
+def _upsert(connection, totals, now):
+    """Write {user_id: total_points} with multi-row upserts; needs the UNIQUE index on user_loyalty.user_id."""
+    items = sorted(totals.items())
+    for start in range(0, len(items), UPSERT_BATCH):
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                """
+                INSERT INTO user_loyalty (user_id, total_points, last_transaction) VALUES (%s, %s, %s)
+                ON DUPLICATE KEY UPDATE total_points = VALUES(total_points), last_transaction = VALUES(last_transaction)
+                """,
+                [(user_id, points, now) for user_id, points in items[start:start + UPSERT_BATCH]],
+            )
+        connection.commit()
+
+
+def _save_watermark(connection, now, last_referral_id):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            INSERT INTO summary_watermarks (name, changed_through, last_id) VALUES (%s, %s, %s)
+            ON DUPLICATE KEY UPDATE changed_through = VALUES(changed_through), last_id = VALUES(last_id)
+            """,
+            (WATERMARK, now, last_referral_id),
+        )
+    connection.commit()
+
+
+def rebuild(pool=None, users_per_batch=USERS_PER_BATCH):
+    """Recompute every user's total_points in one batch pass and reset the incremental watermark.
+
+    Own points come from one GROUP BY per user-id range. Referral credits
+    come from propagating them len(TIER_PERCENT) levels up the CSR graph,
+    one pass over the edges per tier, instead of a recursive CTE per user.
+    Only rows whose total changed are written. Returns the stats of the run.
+    """
+    pool = pool or get_pool()
+    started = time.perf_counter()
+    with pool.connection(autocommit=False) as connection:
+        with connection.cursor() as cursor:
+            now = _scalar(cursor, "SELECT NOW()")
+            last_referral_id = _scalar(cursor, "SELECT COALESCE(MAX(id), 0) FROM user_referrals")
+            max_user_id = _scalar(cursor, "SELECT COALESCE(MAX(id), 0) FROM users")
+            size = max_user_id + 1
+            graph = ReferralGraph.load(cursor, size, last_referral_id)
+            own = _zeros(size)
+            for first in range(1, size, users_per_batch):
+                for user_id, points in _own_points_range(cursor, first, first + users_per_batch - 1).items():
+                    if user_id < size:
+                        own[user_id] = points
+        connection.commit()
+
+        levels = graph.level_sums(own, len(TIER_PERCENT))
+        written = 0
+        for first in range(1, size, users_per_batch):
+            last = min(first + users_per_batch, size) - 1
+            with connection.cursor() as cursor:
+                stored = _stored(cursor, "SELECT user_id, total_points FROM user_loyalty WHERE user_id BETWEEN %s AND %s",
+                                 (first, last))
+            connection.commit()
+            totals = {user_id: own[user_id] + referral_credit([level[user_id] for level in levels])
+                      for user_id in range(first, last + 1)}
+            changed = _changed(totals, stored)
+            _upsert(connection, changed, now)
+            written += len(changed)
+        _save_watermark(connection, now, last_referral_id)
+    return {"users": max_user_id, "referrals": len(graph.targets), "written": written,
+            "seconds": time.perf_counter() - started}
+
+
+def refresh(pool=None):
+    """Recompute only the users whose totals can have changed since the last run.
+
+    A user's total changes when their own paid reservations change, or when
+    anything within len(TIER_PERCENT) referral levels below them does. The
+    changed users are found through user_reservations.updated_at (re-read
+    with OVERLAP) and new user_referrals ids; they and their uplines are
+    recomputed by walking the graph, which only needs the own points of
+    their downlines. Deleted rows are not seen; rebuild() catches those.
+    Without a watermark this falls back to rebuild().
+    """
+    pool = pool or get_pool()
+    started = time.perf_counter()
+    depth = len(TIER_PERCENT)
+    with pool.connection(autocommit=False) as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT changed_through, last_id FROM summary_watermarks WHERE name = %s", (WATERMARK,))
+            watermark = _rows(cursor)
+        connection.commit()
+        if not watermark:
+            return rebuild(pool)
+        changed_through, last_referral_id = watermark[0]
+
+        with connection.cursor() as cursor:
+            now = _scalar(cursor, "SELECT NOW()")
+            new_last_referral_id = _scalar(cursor, "SELECT COALESCE(MAX(id), 0) FROM user_referrals")
+            size = _scalar(cursor, "SELECT COALESCE(MAX(id), 0) FROM users") + 1
+            cursor.execute("SELECT DISTINCT user_id FROM user_reservations WHERE updated_at > %s",
+                           (changed_through - OVERLAP,))
+            changed = {row[0] for row in _rows(cursor)}
+            cursor.execute("SELECT referred_id FROM user_referrals WHERE id > %s AND id <= %s",
+                           (last_referral_id, new_last_referral_id))
+            changed |= {row[0] for row in _rows(cursor)}
+
+            written = 0
+            if changed:
+                up = ReferralGraph.load(cursor, size, new_last_referral_id, direction="up")
+                down = ReferralGraph.load(cursor, size, new_last_referral_id)
+                affected = up.within(changed, depth)
+                own = _own_points_of(cursor, down.within(affected, depth))
+                totals = {}
+                for user_id in affected:
+                    frontier = [user_id]
+                    levels_at = []
+                    for _ in range(depth):
+                        frontier = [target for node in frontier for target in down.neighbours(node)]
+                        levels_at.append(sum(own.get(node, 0) for node in frontier))
+                    totals[user_id] = own.get(user_id, 0) + referral_credit(levels_at)
+        connection.commit()
+
+        if changed:
+            with connection.cursor() as cursor:
+                stored = {}
+                ids = sorted(totals)
+                for start in range(0, len(ids), IDS_PER_QUERY):
+                    chunk = ids[start:start + IDS_PER_QUERY]
+                    stored.update(_stored(
+                        cursor,
+                        f"SELECT user_id, total_points FROM user_loyalty WHERE user_id IN ({', '.join(['%s'] * len(chunk))})",
+                        chunk,
+                    ))
+            connection.commit()
+            totals = _changed(totals, stored)
+            _upsert(connection, totals, now)
+            written = len(totals)
+        _save_watermark(connection, now, new_last_referral_id)
+    return {"changed": len(changed), "written": written, "seconds": time.perf_counter() - started}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recompute user_loyalty points from payments and referrals.")
+    parser.add_argument("command", choices=["rebuild", "refresh"])
+    parser.add_argument("--users-per-batch", type=int, default=USERS_PER_BATCH)
+    args = parser.parse_args(argv)
+
+    if args.command == "rebuild":
+        stats = rebuild(users_per_batch=args.users_per_batch)
+        print(f"✅ Rebuilt loyalty for {stats['users']:,} users over {stats['referrals']:,} referrals: "
+              f"{stats['written']:,} rows written in {stats['seconds']:.1f}s")
+    else:
+        stats = refresh()
+        if "changed" in stats:
+            print(f"✅ {stats['changed']:,} users changed, {stats['written']:,} rows written in {stats['seconds']:.2f}s")
+        else:
+            print(f"✅ No watermark yet; rebuilt {stats['written']:,} rows in {stats['seconds']:.1f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,197 @@
+import argparse
+import re
+import threading
+import time
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+
+import pymysql
+
+from badraghe import schema as schema_module
+from badraghe import seed
+from badraghe.config import SQL_FILE
+from badraghe.pool import ConnectionPool
+from badraghe.statements import Statement, iter_statements
+
+
+class MigrationError(Exception):
+    def __init__(self, statement, error):
+        super().__init__(f"line {statement.line}: {statement.head()}: {error}")
+        self.statement = statement
+        self.error = error
+
+
+class StatementTiming:
+    def __init__(self, statement, seconds):
+        self.statement = statement
+        self.seconds = seconds
+
+    def as_dict(self):
+        return {
+            "line": self.statement.line,
+            "kind": self.statement.kind,
+            "table": self.statement.table,
+            "sql": self.statement.head(),
+            "seconds": self.seconds,
+        }
+
+
+def create_table_levels(statements):
+    """Group CREATE TABLE statements into levels that can run concurrently.
+
+    A table lands one level after the deepest table it references inside the
+    same group; references to tables created earlier do not hold it back.
+    """
+    tables = {statement.table: schema_module.parse_create_table(statement.sql) for statement in statements}
+    depth = {}
+
+    def level(name, seen=()):
+        if name not in depth:
+            refs = [ref for ref in tables[name].references() if ref in tables and ref != name and ref not in seen]
+            depth[name] = 1 + max((level(ref, seen + (name,)) for ref in refs), default=-1)
+        return depth[name]
+
+    levels = []
+    for statement in statements:
+        index = level(statement.table)
+        while len(levels) <= index:
+            levels.append([])
+        levels[index].append(statement)
+    return levels
+
+
+def combine_indexes(statements):
+    """Fold deferred CREATE INDEX statements into one ALTER TABLE per table,
+    so each table is scanned once no matter how many indexes it gets."""
+    by_table = {}
+    for statement in statements:
+        by_table.setdefault(statement.table, []).append(statement)
+
+    combined = []
+    for table, group in by_table.items():
+        clauses = []
+        for statement in group:
+            match = re.match(r"CREATE\s+((?:UNIQUE\s+|FULLTEXT\s+)?)INDEX\s+(`?\w+`?)\s+ON\s+`?\w+`?\s*(\(.*\))\s*$",
+                             statement.sql, re.S | re.I)
+            clauses.append(f"ADD {match.group(1).upper()}INDEX {match.group(2)} {match.group(3)}")
+        sql = f"ALTER TABLE {table} " + ", ".join(clauses)
+        combined.append(Statement(sql, group[0].line))
+    return combined
+
+
+class MigrationRunner:
+    """Runs a migration statement by statement while it is being read.
+
+    Consecutive CREATE TABLE statements are batched and created level by
+    level on a small thread pool, CREATE INDEX statements can be held back
+    until after the bulk load, and every statement's wall time is recorded.
+    The first failing statement stops the run with a MigrationError.
+    """
+
+    def __init__(self, workers=4, defer_indexes=False, pool=None):
+        self.workers = workers
+        self.defer_indexes = defer_indexes
+        self.pool = pool or ConnectionPool(size=workers, autocommit=True)
+        self._owns_pool = pool is None
+        self.timings = []
+        self.wall_seconds = 0.0
+        self.deferred = []
+        self._lock = threading.Lock()
+
+    def _execute(self, statement):
+        started = time.perf_counter()
+        try:
+            with self.pool.connection() as connection, connection.cursor() as cursor:
+                cursor.execute(statement.sql)
+        except pymysql.MySQLError as e:
+            raise MigrationError(statement, e) from e
+        timing = StatementTiming(statement, time.perf_counter() - started)
+        with self._lock:
+            self.timings.append(timing)
+        return timing
+
+    def _execute_parallel(self, statements, executor):
+        if len(statements) == 1:
+            self._execute(statements[0])
+            return
+        futures = [executor.submit(self._execute, statement) for statement in statements]
+        done, pending = wait(futures, return_when=FIRST_EXCEPTION)
+        for future in pending:
+            future.cancel()
+        wait(pending)
+        for future in done:
+            future.result()
+
+    def run(self, lines):
+        batch = []
+        with ThreadPoolExecutor(self.workers) as executor:
+            for statement in iter_statements(lines):
+                if statement.kind == "create_table":
+                    batch.append(statement)
+                    continue
+                if batch:
+                    for level in create_table_levels(batch):
+                        self._execute_parallel(level, executor)
+                    batch = []
+                if statement.kind == "create_index" and self.defer_indexes:
+                    self.deferred.append(statement)
+                else:
+                    self._execute(statement)
+            for level in create_table_levels(batch):
+                self._execute_parallel(level, executor)
+        return self.deferred
+
+    def build_indexes(self):
+        with ThreadPoolExecutor(self.workers) as executor:
+            self._execute_parallel(combine_indexes(self.deferred), executor)
+        self.deferred = []
+
+    def close(self):
+        if self._owns_pool:
+            self.pool.close()
+
+    def total_seconds(self):
+        return sum(timing.seconds for timing in self.timings)
+
+    def report(self, top=10):
+        print(f"⏱️  {len(self.timings)} statements in {self.wall_seconds:.2f}s ({self.total_seconds():.2f}s of statement time)")
+        for timing in sorted(self.timings, key=lambda t: t.seconds, reverse=True)[:top]:
+            print(f"   {timing.seconds:8.3f}s  line {timing.statement.line:<5} {timing.statement.head()}")
+
+
+def migrate(path=SQL_FILE, workers=4, defer_indexes=False, before_indexes=None, pool=None):
+    runner = MigrationRunner(workers, defer_indexes, pool)
+    started = time.perf_counter()
+    try:
+        with open(path, "r") as f:
+            runner.run(f)
+        if before_indexes:
+            before_indexes()
+        if runner.deferred:
+            runner.build_indexes()
+    finally:
+        runner.close()
+        runner.wall_seconds = time.perf_counter() - started
+    return runner
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Apply the migration with per-statement timing.")
+    parser.add_argument("path", nargs="?", default=SQL_FILE)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--defer-indexes", action="store_true", help="build all indexes after the tables")
+    parser.add_argument("--seed", metavar="PRESET", help="bulk seed with this preset before building indexes")
+    parser.add_argument("--top", type=int, default=10, help="number of slowest statements to print")
+    args = parser.parse_args(argv)
+
+    def before_indexes():
+        if args.seed:
+            seed.seed(seed.PRESETS[args.seed])
+
+    print(f"📥 Applying {args.path}...")
+    runner = migrate(args.path, args.workers, args.defer_indexes or bool(args.seed), before_indexes)
+    print("✅ Migration applied.")
+    runner.report(args.top)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+import argparse
+import json
+import multiprocessing
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pymysql
+
+from badraghe.pool import ConnectionPool, get_pool
+
+BATCH_SIZE = 500
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 2.0
+BACKOFF_MAX = 3600.0
+DELIVERY_THREADS = 8
+RETRYABLE = {1205, 1213}
+
+
+class NullSink:
+    def __call__(self, notification):
+        pass
+
+
+class LogSink:
+    def __call__(self, notification):
+        print(f"📨 #{notification['id']} -> user {notification['user_id']}: {notification['message'][:60]}")
+
+
+class FileSink:
+    """Appends every delivered notification to a JSON lines file."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def __call__(self, notification):
+        line = json.dumps(notification, default=str) + "\n"
+        with self._lock, open(self.path, "a") as f:
+            f.write(line)
+
+
+SINKS = {"null": NullSink, "log": LogSink, "file": FileSink}
+
+
+def make_sink(spec):
+    """Build a sink from "null", "log" or "file:/path/to/out.jsonl"."""
+    name, _, argument = spec.partition(":")
+    return SINKS[name](argument) if argument else SINKS[name]()
+
+
+def enqueue(connection, notifications):
+    """Insert pending notifications and return their ids.
+
+    notifications.id has no AUTO_INCREMENT, so ids are taken from the
+    current maximum under a lock on the end of the primary key, which
+    serializes producers for the length of one INSERT.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT COALESCE(MAX(id), 0) FROM notifications FOR UPDATE")
+        row = cursor.fetchone()
+        first_id = (next(iter(row.values())) if isinstance(row, dict) else row[0]) + 1
+        ids = list(range(first_id, first_id + len(notifications)))
+        cursor.executemany(
+            "INSERT INTO notifications (id, user_id, message, notification_type) VALUES (%s, %s, %s, %s)",
+            [(notification_id, notification["user_id"], notification["message"],
+              notification.get("notification_type", "system"))
+             for notification_id, notification in zip(ids, notifications)],
+        )
+    connection.commit()
+    return ids
+
+
+def backoff(attempts, base=BACKOFF_BASE, limit=BACKOFF_MAX, rng=random):
+    """Seconds to wait before retry number `attempts`: exponential, capped, with jitter."""
+    return min(limit, base * 2 ** (attempts - 1)) * rng.uniform(0.5, 1.0)
+
+
+class Dispatcher:
+    """Claims pending notifications in batches and delivers them through `sink`.
+
+    A batch is claimed with FOR UPDATE SKIP LOCKED in created_at order, so
+    any number of dispatchers (threads or processes) can share the table
+    without waiting on each other. The batch is delivered on a thread pool
+    while its rows stay locked, then all successes are marked sent with one
+    UPDATE. Failures are rescheduled with exponential backoff and marked
+    'failed' after `max_attempts`.
+    """
+
+    def __init__(self, sink, pool=None, batch_size=BATCH_SIZE, threads=DELIVERY_THREADS,
+                 max_attempts=MAX_ATTEMPTS, backoff_base=BACKOFF_BASE, backoff_max=BACKOFF_MAX):
+        self.sink = sink
+        self.pool = pool or get_pool()
+        self.batch_size = batch_size
+        self.threads = threads
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.stats = {"batches": 0, "sent": 0, "retried": 0, "failed": 0}
+
+    def _deliver(self, notification):
+        try:
+            self.sink(notification)
+        except Exception as e:
+            return f"{type(e).__name__}: {e}"[:255]
+        return None
+
+    def claim(self, connection):
+        with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+            cursor.execute(
+                """
+                SELECT id, user_id, message, notification_type, attempts, created_at FROM notifications
+                WHERE status = 'pending' AND (next_attempt_at IS NULL OR next_attempt_at <= NOW())
+                ORDER BY created_at
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+                """,
+                (self.batch_size,),
+            )
+            return cursor.fetchall()
+
+    def dispatch_batch(self, connection, executor):
+        connection.begin()
+        notifications = self.claim(connection)
+        if not notifications:
+            connection.rollback()
+            return 0
+
+        errors = list(executor.map(self._deliver, notifications))
+        sent = [n["id"] for n, error in zip(notifications, errors) if error is None]
+        retries = []
+        for notification, error in zip(notifications, errors):
+            if error is None:
+                continue
+            attempts = notification["attempts"] + 1
+            if attempts >= self.max_attempts:
+                retries.append(("failed", 0, error, notification["id"]))
+            else:
+                delay = backoff(attempts, self.backoff_base, self.backoff_max)
+                retries.append(("pending", delay, error, notification["id"]))
+
+        with connection.cursor() as cursor:
+            if sent:
+                cursor.execute(
+                    f"UPDATE notifications SET status = 'sent', sent_at = NOW(), attempts = attempts + 1, "
+                    f"next_attempt_at = NULL, last_error = NULL WHERE id IN ({', '.join(['%s'] * len(sent))})",
+                    sent,
+                )
+            if retries:
+                cursor.executemany(
+                    """
+                    UPDATE notifications
+                    SET status = %s, attempts = attempts + 1,
+                        next_attempt_at = NOW() + INTERVAL %s MICROSECOND, last_error = %s
+                    WHERE id = %s
+                    """,
+                    [(status, int(delay * 1e6), error, notification_id)
+                     for status, delay, error, notification_id in retries],
+                )
+        connection.commit()
+
+        self.stats["batches"] += 1
+        self.stats["sent"] += len(sent)
+        self.stats["failed"] += sum(1 for status, *_ in retries if status == "failed")
+        self.stats["retried"] += sum(1 for status, *_ in retries if status == "pending")
+        return len(notifications)
+
+    def run(self, until_idle=False, idle_sleep=0.5, max_batches=None):
+        with self.pool.connection(autocommit=False) as connection, ThreadPoolExecutor(self.threads) as executor:
+            while max_batches is None or self.stats["batches"] < max_batches:
+                try:
+                    claimed = self.dispatch_batch(connection, executor)
+                except pymysql.err.OperationalError as e:
+                    connection.rollback()
+                    if e.args[0] not in RETRYABLE:
+                        raise
+                    continue
+                if claimed:
+                    continue
+                if until_idle:
+                    break
+                time.sleep(idle_sleep)
+        return self.stats
+
+
+def _run_process(options):
+    pool = ConnectionPool(size=1, autocommit=False)
+    try:
+        dispatcher = Dispatcher(make_sink(options["sink"]), pool, options["batch_size"], options["threads"],
+                                options["max_attempts"])
+        return dispatcher.run(until_idle=options["until_idle"])
+    finally:
+        pool.close()
+
+
+def dispatch(processes=1, sink="null", batch_size=BATCH_SIZE, threads=DELIVERY_THREADS,
+             max_attempts=MAX_ATTEMPTS, until_idle=False):
+    """Run `processes` dispatcher processes and return their combined stats."""
+    options = {"sink": sink, "batch_size": batch_size, "threads": threads,
+               "max_attempts": max_attempts, "until_idle": until_idle}
+    if processes == 1:
+        results = [_run_process(options)]
+    else:
+        with multiprocessing.Pool(processes) as workers:
+            results = workers.map(_run_process, [options] * processes)
+    return {key: sum(result[key] for result in results) for key in results[0]}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Deliver pending notifications from the outbox.")
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=DELIVERY_THREADS, help="delivery threads per process")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--max-attempts", type=int, default=MAX_ATTEMPTS)
+    parser.add_argument("--sink", default="null", help="null, log or file:/path/to/out.jsonl")
+    parser.add_argument("--until-idle", action="store_true", help="exit once nothing is left to deliver")
+    args = parser.parse_args(argv)
+
+    print(f"🚀 Dispatching with {args.processes} processes x {args.threads} threads into {args.sink}...")
+    started = time.perf_counter()
+    stats = dispatch(args.processes, args.sink, args.batch_size, args.threads, args.max_attempts, args.until_idle)
+    elapsed = time.perf_counter() - started
+    print(f"✅ {stats['sent']:,} sent, {stats['retried']:,} retried, {stats['failed']:,} failed "
+          f"in {stats['batches']:,} batches ({stats['sent'] / elapsed:,.0f} notifications/s)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
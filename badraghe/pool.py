@@ -0,0 +1,218 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import pymysql
+from pymysql.constants import SERVER_STATUS
+
+from badraghe import config, instrument as instrument_module
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class PoolStats:
+    def __init__(self):
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.timeouts = 0
+        self.created = 0
+        self.recycled = 0
+        self.failed_pings = 0
+
+    def as_dict(self):
+        return {
+            "checkouts": self.checkouts,
+            "waits": self.waits,
+            "wait_seconds": self.wait_seconds,
+            "avg_wait_seconds": self.wait_seconds / self.checkouts if self.checkouts else 0.0,
+            "max_wait_seconds": self.max_wait_seconds,
+            "timeouts": self.timeouts,
+            "created": self.created,
+            "recycled": self.recycled,
+            "failed_pings": self.failed_pings,
+        }
+
+
+class ConnectionPool:
+    """A bounded pool of pymysql connections.
+
+    At most `size` connections exist at once; a checkout beyond that waits up
+    to `timeout` seconds. Connections older than `max_lifetime` are closed
+    instead of reused, and a connection that sat idle for more than
+    `ping_after` seconds is pinged before it is handed out. `autocommit` and
+    `cursorclass` are the session defaults and can be overridden per
+    checkout; they are restored when the connection comes back.
+
+    With `instrument` (True for the process-wide recorder, or a Recorder)
+    every cursor opened on a pooled connection is timed and fingerprinted;
+    it defaults to the BADRAGHE_INSTRUMENT environment variable.
+    """
+
+    def __init__(self, size=10, timeout=30.0, max_lifetime=3600.0, ping_after=1.0,
+                 autocommit=True, cursorclass=pymysql.cursors.Cursor, connector=config.connect,
+                 instrument=config.INSTRUMENT, **connect_args):
+        self.size = size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.ping_after = ping_after
+        self.autocommit = autocommit
+        self.cursorclass = cursorclass
+        self.connector = connector
+        self.connect_args = connect_args
+        self.instrument = instrument
+        self.stats = PoolStats()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._idle = []
+        self._born = {}
+        self._closed = False
+
+    def _create(self):
+        connection = self.connector(autocommit=self.autocommit, cursorclass=self.cursorclass, **self.connect_args)
+        if self.instrument:
+            recorder = self.instrument if isinstance(self.instrument, instrument_module.Recorder) else None
+            instrument_module.instrument_connection(connection, recorder)
+        with self._lock:
+            self.stats.created += 1
+            self._born[id(connection)] = time.monotonic()
+        return connection
+
+    def _discard(self, connection):
+        with self._lock:
+            self._born.pop(id(connection), None)
+        try:
+            connection.close()
+        except pymysql.Error:
+            pass
+
+    def _checkout_idle(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                connection, returned_at = self._idle.pop()
+                born = self._born.get(id(connection), 0)
+            now = time.monotonic()
+            if now - born > self.max_lifetime:
+                with self._lock:
+                    self.stats.recycled += 1
+                self._discard(connection)
+                continue
+            if now - returned_at > self.ping_after:
+                try:
+                    connection.ping(reconnect=False)
+                except pymysql.Error:
+                    with self._lock:
+                        self.stats.failed_pings += 1
+                    self._discard(connection)
+                    continue
+            return connection
+
+    def acquire(self, autocommit=None, cursorclass=None):
+        if self._closed:
+            raise PoolTimeout("pool is closed")
+        started = time.perf_counter()
+        if not self._slots.acquire(blocking=False):
+            if not self._slots.acquire(timeout=self.timeout):
+                with self._lock:
+                    self.stats.timeouts += 1
+                raise PoolTimeout(f"no connection available within {self.timeout}s (size={self.size})")
+            waited = time.perf_counter() - started
+            with self._lock:
+                self.stats.waits += 1
+                self.stats.wait_seconds += waited
+                self.stats.max_wait_seconds = max(self.stats.max_wait_seconds, waited)
+        with self._lock:
+            self.stats.checkouts += 1
+
+        connection = None
+        try:
+            connection = self._checkout_idle() or self._create()
+            if autocommit is not None and autocommit != self.autocommit:
+                connection.autocommit(autocommit)
+        except Exception:
+            if connection is not None:
+                self._discard(connection)
+            self._slots.release()
+            raise
+        connection.cursorclass = cursorclass or self.cursorclass
+        return connection
+
+    def release(self, connection):
+        try:
+            if not connection.open:
+                self._discard(connection)
+                return
+            if connection.server_status & SERVER_STATUS.SERVER_STATUS_IN_TRANS:
+                connection.rollback()
+            if connection.get_autocommit() != self.autocommit:
+                connection.autocommit(self.autocommit)
+            connection.cursorclass = self.cursorclass
+            if self._closed:
+                self._discard(connection)
+            else:
+                with self._lock:
+                    self._idle.append((connection, time.monotonic()))
+        except pymysql.Error:
+            self._discard(connection)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self, autocommit=None, cursorclass=None):
+        connection = self.acquire(autocommit, cursorclass)
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    def close(self):
+        self._closed = True
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection, _ in idle:
+            self._discard(connection)
+
+    def status(self):
+        with self._lock:
+            idle = len(self._idle)
+            opened = len(self._born)
+        return dict(self.stats.as_dict(), size=self.size, open=opened, idle=idle, in_use=opened - idle)
+
+
+_default_pool = None
+_default_lock = threading.Lock()
+POOL_SETTINGS = ("size", "timeout", "max_lifetime", "ping_after", "autocommit", "cursorclass", "connector", "instrument")
+_UNSET = object()
+
+
+def _setting(pool, name):
+    return getattr(pool, name) if name in POOL_SETTINGS else pool.connect_args.get(name, _UNSET)
+
+
+def get_pool(**options):
+    """Return the process-wide pool, creating it on first use.
+
+    Options only apply when the pool is created; asking for different ones
+    once it exists raises ValueError instead of silently ignoring them.
+    """
+    global _default_pool
+    with _default_lock:
+        if _default_pool is None or _default_pool._closed:
+            _default_pool = ConnectionPool(**options)
+            return _default_pool
+        conflicting = sorted(name for name, value in options.items() if _setting(_default_pool, name) != value)
+        if conflicting:
+            raise ValueError(
+                f"the process-wide pool already exists with different {', '.join(conflicting)}; "
+                "close it first or create a ConnectionPool of your own"
+            )
+        return _default_pool
+
+
+def connection(autocommit=None, cursorclass=None):
+    return get_pool().connection(autocommit, cursorclass)
@@ -0,0 +1,317 @@
+import argparse
+import heapq
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from decimal import ROUND_HALF_UP, Decimal
+
+from badraghe import search
+from badraghe.pool import get_pool
+
+REFRESH_INTERVAL = 5.0
+MAX_AGE = 300.0
+OVERLAP = timedelta(seconds=60)
+HUNDRED = Decimal(100)
+CENT = Decimal("0.01")
+
+DISCOUNT_COLUMNS = "id, code, discount_type, discount_value, valid_from, valid_until, status"
+
+
+class DiscountUnavailable(Exception):
+    pass
+
+
+def _rows(cursor):
+    return [tuple(row.values()) if isinstance(row, dict) else row for row in cursor.fetchall()]
+
+
+class Discount:
+    def __init__(self, id, code, discount_type, value, valid_from, valid_until, status):
+        self.id = id
+        self.code = code
+        self.discount_type = discount_type
+        self.value = Decimal(value or 0)
+        self.valid_from = valid_from
+        self.valid_until = valid_until
+        self.status = bool(status)
+        self.key = (discount_type, self.value, valid_from, valid_until, self.status)
+
+    def apply(self, price):
+        price = Decimal(price)
+        if self.discount_type == "percentage":
+            off = (price * min(self.value, HUNDRED) / HUNDRED).quantize(CENT, ROUND_HALF_UP)
+        else:
+            off = self.value
+        return max(price - off, Decimal(0))
+
+    def __repr__(self):
+        return f"Discount({self.id}, {self.code!r}, {self.discount_type} {self.value})"
+
+
+class DiscountIndex:
+    """In-process index of the discounts that are valid right now.
+
+    Every enabled discount sits in one of two heaps: `pending`, ordered by
+    valid_from, or `expiring`, ordered by valid_until, whose members form
+    the active set. Advancing the clock moves discounts from pending to
+    active and drops the expired ones, so each discount is touched twice
+    over its lifetime rather than on every lookup. Rows changed in the
+    database are picked up every `refresh_interval` seconds through
+    discounts.updated_at; a full reload every `max_age` seconds catches
+    deleted rows. Heap entries of a replaced or deleted discount are
+    skipped when they surface.
+
+    Which discounts apply to which ticket is not cached: a page of search
+    results costs one lookup on ticket_discounts(ticket_id, discount_id),
+    and is skipped entirely while nothing is active.
+    """
+
+    def __init__(self, pool=None, refresh_interval=REFRESH_INTERVAL, max_age=MAX_AGE):
+        self.pool = pool or get_pool()
+        self.refresh_interval = refresh_interval
+        self.max_age = max_age
+        self.loads = 0
+        self.refreshes = 0
+        self._lock = threading.RLock()
+        self._discounts = {}
+        self._pending = []
+        self._expiring = []
+        self._active = {}
+        self._watermark = None
+        self._skew = timedelta(0)
+        self._loaded_at = None
+        self._refreshed_at = None
+
+    # Maintenance
+
+    def _place(self, discount):
+        current = self._discounts.get(discount.id)
+        if current is not None and current.key == discount.key:
+            return
+        self._active.pop(discount.id, None)
+        if not discount.status or discount.valid_until < discount.valid_from:
+            self._discounts.pop(discount.id, None)
+            return
+        self._discounts[discount.id] = discount
+        heapq.heappush(self._pending, (discount.valid_from, discount.id, discount))
+
+    def _fetch(self, since=None):
+        with self.pool.connection() as connection, connection.cursor() as cursor:
+            cursor.execute("SELECT NOW()")
+            db_now = _rows(cursor)[0][0]
+            if since is None:
+                cursor.execute(f"SELECT {DISCOUNT_COLUMNS} FROM discounts WHERE status AND valid_until >= NOW()")
+            else:
+                cursor.execute(f"SELECT {DISCOUNT_COLUMNS} FROM discounts WHERE updated_at >= %s", (since,))
+            rows = _rows(cursor)
+        return db_now, [Discount(*row) for row in rows]
+
+    def load(self):
+        """Replace the whole index with the enabled, unexpired discounts."""
+        db_now, discounts = self._fetch()
+        with self._lock:
+            self._discounts = {}
+            self._pending = []
+            self._expiring = []
+            self._active = {}
+            for discount in discounts:
+                self._place(discount)
+            self._adopt_clock(db_now)
+            self.loads += 1
+            self._loaded_at = self._refreshed_at = time.monotonic()
+
+    def refresh(self):
+        """Apply the discounts changed since the last refresh (rows updated within OVERLAP are re-read)."""
+        db_now, discounts = self._fetch(self._watermark - OVERLAP)
+        with self._lock:
+            for discount in discounts:
+                self._place(discount)
+            self._adopt_clock(db_now)
+            self.refreshes += 1
+            self._refreshed_at = time.monotonic()
+
+    def _adopt_clock(self, db_now):
+        self._watermark = db_now
+        self._skew = db_now - datetime.now()
+
+    def _ensure_fresh(self):
+        now = time.monotonic()
+        if self._loaded_at is None or now - self._loaded_at >= self.max_age:
+            self.load()
+        elif now - self._refreshed_at >= self.refresh_interval:
+            self.refresh()
+
+    def now(self):
+        """The database clock, as estimated from the skew seen at the last refresh."""
+        return datetime.now() + self._skew
+
+    def advance(self, now=None):
+        """Move the active set to `now` and return it as {discount_id: Discount}."""
+        now = now or self.now()
+        with self._lock:
+            while self._pending and self._pending[0][0] <= now:
+                _, discount_id, discount = heapq.heappop(self._pending)
+                if self._discounts.get(discount_id) is discount:
+                    self._active[discount_id] = discount
+                    heapq.heappush(self._expiring, (discount.valid_until, discount_id, discount))
+            while self._expiring and self._expiring[0][0] < now:
+                _, discount_id, discount = heapq.heappop(self._expiring)
+                if self._active.get(discount_id) is discount:
+                    del self._active[discount_id]
+                    self._discounts.pop(discount_id, None)
+            return self._active
+
+    def active(self):
+        self._ensure_fresh()
+        return dict(self.advance())
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+    # Pricing
+
+    def price(self, connection, tickets):
+        """Add final_price and discount_id to every ticket row of a page, in one pass.
+
+        `tickets` are rows with `id` and `price` (as returned by search).
+        The best active discount linked to a ticket wins; tickets with none
+        keep their price and get discount_id None.
+        """
+        self._ensure_fresh()
+        active = self.advance()
+        links = {}
+        ids = [ticket["id"] for ticket in tickets]
+        if active and ids:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"SELECT ticket_id, discount_id FROM ticket_discounts "
+                    f"WHERE ticket_id IN ({', '.join(['%s'] * len(ids))})",
+                    ids,
+                )
+                for ticket_id, discount_id in _rows(cursor):
+                    discount = active.get(discount_id)
+                    if discount is not None:
+                        links.setdefault(ticket_id, []).append(discount)
+
+        for ticket in tickets:
+            best_price, best_id = ticket["price"], None
+            for discount in links.get(ticket["id"], ()):
+                candidate = discount.apply(ticket["price"])
+                if candidate < best_price:
+                    best_price, best_id = candidate, discount.id
+            ticket["final_price"] = best_price
+            ticket["discount_id"] = best_id
+        return tickets
+
+
+_default_index = None
+_default_lock = threading.Lock()
+
+
+def get_index(**options):
+    """Return the process-wide discount index, creating it on first use."""
+    global _default_index
+    with _default_lock:
+        if _default_index is None:
+            _default_index = DiscountIndex(**options)
+        return _default_index
+
+
+def price_tickets(connection, tickets, index=None):
+    return (index or get_index()).price(connection, tickets)
+
+
+def price_tickets_sql(connection, tickets):
+    """Price a page with a correlated join per ticket; the baseline the index is benchmarked against."""
+    with connection.cursor() as cursor:
+        for ticket in tickets:
+            cursor.execute(
+                """
+                SELECT d.id, d.code, d.discount_type, d.discount_value, d.valid_from, d.valid_until, d.status
+                FROM ticket_discounts td JOIN discounts d ON d.id = td.discount_id
+                WHERE td.ticket_id = %s AND d.status AND NOW() BETWEEN d.valid_from AND d.valid_until
+                """,
+                (ticket["id"],),
+            )
+            best_price, best_id = ticket["price"], None
+            for row in _rows(cursor):
+                candidate = Discount(*row).apply(ticket["price"])
+                if candidate < best_price:
+                    best_price, best_id = candidate, row[0]
+            ticket["final_price"] = best_price
+            ticket["discount_id"] = best_id
+    return tickets
+
+
+def complete_payment(connection, payment_id, discount_id=None):
+    """Mark a pending payment successful and record the discount it used, in one transaction.
+
+    The user_discounts row is written only if the discount is enabled,
+    valid now and linked to the payment's ticket; otherwise nothing is
+    committed and DiscountUnavailable is raised, so the caller can reprice.
+    Returns False if the payment was not pending.
+    """
+    connection.begin()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE payments SET status = 'successful' WHERE id = %s AND status = 'pending'",
+                           (payment_id,))
+            if not cursor.rowcount:
+                connection.rollback()
+                return False
+            if discount_id is not None:
+                cursor.execute(
+                    """
+                    INSERT INTO user_discounts (user_id, discount_id, payment_id)
+                    SELECT p.user_id, td.discount_id, p.id
+                    FROM payments p
+                    JOIN user_reservations r ON r.id = p.reservation_id
+                    JOIN ticket_discounts td ON td.ticket_id = r.ticket_id AND td.discount_id = %s
+                    JOIN discounts d ON d.id = td.discount_id
+                    WHERE p.id = %s AND d.status AND NOW() BETWEEN d.valid_from AND d.valid_until
+                    LIMIT 1
+                    """,
+                    (discount_id, payment_id),
+                )
+                if not cursor.rowcount:
+                    raise DiscountUnavailable(f"discount {discount_id} does not apply to payment {payment_id}")
+    except Exception:
+        connection.rollback()
+        raise
+    connection.commit()
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Price a page of route search results with active discounts.")
+    parser.add_argument("departure_city")
+    parser.add_argument("arrival_city")
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=200, help="pricing rounds to time")
+    args = parser.parse_args(argv)
+
+    index = get_index()
+    with get_pool().connection() as connection:
+        rows = search.search_routes(connection, args.departure_city, args.arrival_city, limit=args.limit).rows
+        index.price(connection, rows)
+        print(f"🏷️ {len(index.active())} active discounts, {len(rows)} tickets")
+        for row in rows:
+            marker = f"  (discount #{row['discount_id']})" if row["discount_id"] else ""
+            print(f"   #{row['id']:<10} {row['price']:>12} -> {row['final_price']:>12}{marker}")
+
+        timings = {}
+        for name, function in (("index", lambda: index.price(connection, rows)),
+                               ("per-ticket SQL", lambda: price_tickets_sql(connection, rows))):
+            started = time.perf_counter()
+            for _ in range(args.repeat):
+                function()
+            timings[name] = (time.perf_counter() - started) / args.repeat
+        for name, seconds in timings.items():
+            print(f"⏱️ {name:<15} {seconds * 1000:>8.3f} ms per page")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
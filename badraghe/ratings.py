@@ -0,0 +1,264 @@
+import argparse
+import sys
+import time
+
+from badraghe.pool import get_pool
+
+TICKETS = "ticket_rating_summary"
+PROVIDERS = "provider_rating_summary"
+STARS = range(1, 6)
+COLUMNS = ["reviews", "rating_sum"] + [f"rating_{star}" for star in STARS]
+TICKETS_PER_BATCH = 100000
+UNCHANGED = object()
+
+TICKET_SELECT = f"""
+    SELECT ticket_id, COUNT(*), SUM(rating), {', '.join(f'SUM(rating = {star})' for star in STARS)}
+    FROM reviews WHERE rating IS NOT NULL AND {{where}}
+    GROUP BY ticket_id
+"""
+PROVIDER_SELECT = f"""
+    SELECT t.transport_company_id, {', '.join(f'SUM(s.{column})' for column in COLUMNS)}
+    FROM {TICKETS} s JOIN travel_tickets t ON t.id = s.ticket_id
+    WHERE t.transport_company_id IS NOT NULL AND {{where}}
+    GROUP BY t.transport_company_id
+"""
+
+
+def _rows(cursor):
+    return [tuple(row.values()) if isinstance(row, dict) else row for row in cursor.fetchall()]
+
+
+def delta(rating, sign=1):
+    """The change one rated review makes to a summary row, in COLUMNS order."""
+    if rating is None:
+        return [0] * len(COLUMNS)
+    return [sign, sign * rating] + [sign if star == rating else 0 for star in STARS]
+
+
+def _apply(cursor, table, key, key_value, change):
+    """Add `change` to a summary row. Increments upsert; anything that subtracts updates the existing row."""
+    if not any(change):
+        return
+    if min(change) >= 0:
+        cursor.execute(
+            f"INSERT INTO {table} ({key}, {', '.join(COLUMNS)}) VALUES (%s, {', '.join(['%s'] * len(COLUMNS))}) "
+            f"ON DUPLICATE KEY UPDATE {', '.join(f'{column} = {column} + VALUES({column})' for column in COLUMNS)}",
+            [key_value] + change,
+        )
+    else:
+        cursor.execute(
+            f"UPDATE {table} SET {', '.join(f'{column} = {column} + %s' for column in COLUMNS)} WHERE {key} = %s",
+            change + [key_value],
+        )
+
+
+def _record(cursor, ticket_id, change):
+    """Apply `change` to the ticket's row and then to its provider's row (always in that order)."""
+    _apply(cursor, TICKETS, "ticket_id", ticket_id, change)
+    cursor.execute("SELECT transport_company_id FROM travel_tickets WHERE id = %s", (ticket_id,))
+    row = _rows(cursor)
+    if row and row[0][0] is not None:
+        _apply(cursor, PROVIDERS, "provider_id", row[0][0], change)
+
+
+# Writes that keep the summaries exact. Each runs in its own transaction and
+# changes the review and both summary rows together.
+
+def add_review(connection, user_id, ticket_id, rating, review_text=None):
+    connection.begin()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("INSERT INTO reviews (user_id, ticket_id, rating, review_text) VALUES (%s, %s, %s, %s)",
+                           (user_id, ticket_id, rating, review_text))
+            review_id = cursor.lastrowid
+            _record(cursor, ticket_id, delta(rating))
+    except Exception:
+        connection.rollback()
+        raise
+    connection.commit()
+    return review_id
+
+
+def update_review(connection, review_id, rating=UNCHANGED, review_text=UNCHANGED):
+    """Change a review's rating and/or text. Returns False if the review does not exist."""
+    connection.begin()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT ticket_id, rating FROM reviews WHERE id = %s FOR UPDATE", (review_id,))
+            row = _rows(cursor)
+            if not row:
+                connection.rollback()
+                return False
+            ticket_id, old_rating = row[0]
+            changes = {}
+            if rating is not UNCHANGED:
+                changes["rating"] = rating
+            if review_text is not UNCHANGED:
+                changes["review_text"] = review_text
+            if changes:
+                cursor.execute(f"UPDATE reviews SET {', '.join(f'{column} = %s' for column in changes)} WHERE id = %s",
+                               list(changes.values()) + [review_id])
+            if rating is not UNCHANGED and rating != old_rating:
+                _record(cursor, ticket_id, [new + old for new, old in zip(delta(rating), delta(old_rating, -1))])
+    except Exception:
+        connection.rollback()
+        raise
+    connection.commit()
+    return True
+
+
+def delete_review(connection, review_id):
+    """Delete a review. Returns False if it does not exist."""
+    connection.begin()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT ticket_id, rating FROM reviews WHERE id = %s FOR UPDATE", (review_id,))
+            row = _rows(cursor)
+            if not row:
+                connection.rollback()
+                return False
+            ticket_id, rating = row[0]
+            cursor.execute("DELETE FROM reviews WHERE id = %s", (review_id,))
+            _record(cursor, ticket_id, delta(rating, -1))
+    except Exception:
+        connection.rollback()
+        raise
+    connection.commit()
+    return True
+
+
+def forget_tickets(cursor, ticket_ids):
+    """Take tickets that are about to be deleted out of the summaries.
+
+    Deleting a ticket cascades to its reviews without passing through
+    delete_review, so callers that delete tickets (the archiver) run this
+    in the same transaction first.
+    """
+    if not ticket_ids:
+        return
+    placeholders = ", ".join(["%s"] * len(ticket_ids))
+    cursor.execute(PROVIDER_SELECT.format(where=f"s.ticket_id IN ({placeholders})"), list(ticket_ids))
+    for provider_id, *change in _rows(cursor):
+        _apply(cursor, PROVIDERS, "provider_id", provider_id, [-int(value) for value in change])
+    cursor.execute(f"DELETE FROM {TICKETS} WHERE ticket_id IN ({placeholders})", list(ticket_ids))
+
+
+# Reads
+
+def summarize(row):
+    """{'reviews', 'rating', 'histogram'} from a summary row in COLUMNS order (or None)."""
+    if row is None or not row[0]:
+        return {"reviews": 0, "rating": None, "histogram": [0] * len(STARS)}
+    reviews, rating_sum, *histogram = (int(value) for value in row)
+    return {"reviews": reviews, "rating": round(rating_sum / reviews, 2), "histogram": histogram}
+
+
+def _ratings(connection, table, key, ids):
+    if not ids:
+        return {}
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT {key}, {', '.join(COLUMNS)} FROM {table} WHERE {key} IN ({', '.join(['%s'] * len(ids))})",
+                       list(ids))
+        rows = {row[0]: row[1:] for row in _rows(cursor)}
+    return {key_value: summarize(rows.get(key_value)) for key_value in ids}
+
+
+def ticket_ratings(connection, ticket_ids):
+    return _ratings(connection, TICKETS, "ticket_id", ticket_ids)
+
+
+def provider_ratings(connection, provider_ids):
+    return _ratings(connection, PROVIDERS, "provider_id", provider_ids)
+
+
+# Rebuild and consistency check
+
+def rebuild(pool=None, tickets_per_batch=TICKETS_PER_BATCH):
+    """Recompute both summaries from reviews, `tickets_per_batch` ticket ids per transaction.
+
+    Ticket rows are rebuilt range by range from reviews; provider rows are
+    then rolled up from the ticket rows in one statement. Returns the
+    number of ticket batches.
+    """
+    pool = pool or get_pool()
+    batches = 0
+    with pool.connection(autocommit=False) as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT COALESCE(MAX(id), 0) FROM travel_tickets")
+            last_ticket_id = _rows(cursor)[0][0]
+            cursor.execute(f"DELETE FROM {TICKETS} WHERE ticket_id > %s", (last_ticket_id,))
+        connection.commit()
+        for first in range(1, last_ticket_id + 1, tickets_per_batch):
+            last = first + tickets_per_batch - 1
+            with connection.cursor() as cursor:
+                cursor.execute(f"DELETE FROM {TICKETS} WHERE ticket_id BETWEEN %s AND %s", (first, last))
+                cursor.execute(
+                    f"INSERT INTO {TICKETS} (ticket_id, {', '.join(COLUMNS)}) "
+                    + TICKET_SELECT.format(where="ticket_id BETWEEN %s AND %s"),
+                    (first, last),
+                )
+            connection.commit()
+            batches += 1
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {PROVIDERS}")
+            cursor.execute(f"INSERT INTO {PROVIDERS} (provider_id, {', '.join(COLUMNS)}) "
+                           + PROVIDER_SELECT.format(where="TRUE"))
+        connection.commit()
+    return batches
+
+
+def verify(pool=None):
+    """Compare both summaries against a recompute from reviews and return the differences."""
+    pool = pool or get_pool()
+    mismatches = []
+    with pool.connection() as connection, connection.cursor() as cursor:
+        cursor.execute(TICKET_SELECT.format(where="TRUE"))
+        expected_tickets = {row[0]: [int(value) for value in row[1:]] for row in _rows(cursor)}
+        cursor.execute(f"""
+            SELECT t.transport_company_id, r.rating FROM reviews r JOIN travel_tickets t ON t.id = r.ticket_id
+            WHERE r.rating IS NOT NULL AND t.transport_company_id IS NOT NULL
+        """)
+        expected_providers = {}
+        for provider_id, rating in _rows(cursor):
+            totals = expected_providers.setdefault(provider_id, [0] * len(COLUMNS))
+            for i, value in enumerate(delta(rating)):
+                totals[i] += value
+
+        for table, key, expected in ((TICKETS, "ticket_id", expected_tickets),
+                                     (PROVIDERS, "provider_id", expected_providers)):
+            cursor.execute(f"SELECT {key}, {', '.join(COLUMNS)} FROM {table}")
+            stored = {row[0]: [int(value) for value in row[1:]] for row in _rows(cursor)}
+            for key_value in sorted(set(expected) | set(stored)):
+                want = expected.get(key_value, [0] * len(COLUMNS))
+                have = stored.get(key_value, [0] * len(COLUMNS))
+                if want != have:
+                    mismatches.append({"table": table, key: key_value,
+                                       "expected": dict(zip(COLUMNS, want)), "stored": dict(zip(COLUMNS, have))})
+    return mismatches
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintain the per-ticket and per-provider rating summaries.")
+    parser.add_argument("command", choices=["rebuild", "verify"])
+    parser.add_argument("--tickets-per-batch", type=int, default=TICKETS_PER_BATCH)
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    if args.command == "rebuild":
+        batches = rebuild(tickets_per_batch=args.tickets_per_batch)
+        print(f"✅ Rating summaries rebuilt in {batches} batches ({time.perf_counter() - started:.1f}s)")
+        return 0
+
+    mismatches = verify()
+    if not mismatches:
+        print(f"✅ Rating summaries match the reviews ({time.perf_counter() - started:.1f}s)")
+        return 0
+    print(f"⛔ {len(mismatches)} summary rows differ from the reviews:")
+    for mismatch in mismatches[:20]:
+        key = "ticket_id" if mismatch["table"] == TICKETS else "provider_id"
+        print(f"   {mismatch['table']} {key}={mismatch[key]}: stored {mismatch['stored']}, expected {mismatch['expected']}")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,282 @@
+import argparse
+import threading
+import time
+
+from badraghe.pool import get_pool
+
+MAX_AGE = 60.0
+
+
+def _rows(cursor):
+    return [tuple(row.values()) if isinstance(row, dict) else row for row in cursor.fetchall()]
+
+
+def bits_to_ids(bits):
+    ids = []
+    while bits:
+        low = bits & -bits
+        ids.append(low.bit_length() - 1)
+        bits ^= low
+    return ids
+
+
+class PermissionResolver:
+    """In-process cache of effective permissions.
+
+    Role level: every role's permission set, merged with all of its
+    ancestors along roles.parent_role_id, is kept as an int bitset where
+    bit N is permissions.id N. User level: a user's effective set is the
+    OR of the closures of their unexpired roles. It stays cached until the
+    earliest expired_at among those roles, `max_age` seconds, or an
+    invalidation, whichever comes first.
+
+    Inactive roles contribute no permissions of their own but still pass on
+    their ancestors' permissions; inactive permissions are never granted.
+    """
+
+    def __init__(self, pool=None, max_age=MAX_AGE):
+        self.pool = pool or get_pool()
+        self.max_age = max_age
+        self.loads = 0
+        self._lock = threading.RLock()
+        self._version = 0
+        self._parents = {}
+        self._children = {}
+        self._direct = {}
+        self._closure = None
+        self._permission_ids = {}
+        self._users = {}
+        self._role_users = {}
+
+    # Role closure
+
+    def _load_roles(self):
+        with self.pool.connection() as connection, connection.cursor() as cursor:
+            cursor.execute("SELECT id, parent_role_id, status FROM roles")
+            roles = _rows(cursor)
+            cursor.execute("""
+            SELECT rp.role_id, rp.permission_id FROM role_permissions rp
+            JOIN permissions p ON p.id = rp.permission_id
+            WHERE p.status
+            """)
+            grants = _rows(cursor)
+            cursor.execute("SELECT id, name FROM permissions")
+            permission_ids = {name: permission_id for permission_id, name in _rows(cursor)}
+
+        active = {role_id for role_id, _, status in roles if status}
+        parents = {role_id: parent_id for role_id, parent_id, _ in roles}
+        direct = dict.fromkeys(parents, 0)
+        for role_id, permission_id in grants:
+            if role_id in active:
+                direct[role_id] |= 1 << permission_id
+
+        self._parents = parents
+        self._children = {}
+        for role_id, parent_id in parents.items():
+            if parent_id is not None:
+                self._children.setdefault(parent_id, set()).add(role_id)
+        self._direct = direct
+        self._permission_ids = permission_ids
+        self._closure = {}
+        for role_id in parents:
+            self._role_closure(role_id)
+
+    def _role_closure(self, role_id):
+        chain = []
+        seen = set()
+        current = role_id
+        while current is not None and current not in self._closure and current not in seen:
+            seen.add(current)
+            chain.append(current)
+            current = self._parents.get(current)
+        bits = self._closure.get(current, 0) if current is not None and current not in seen else 0
+        for role in reversed(chain):
+            bits |= self._direct.get(role, 0)
+            self._closure[role] = bits
+        return self._closure.get(role_id, 0)
+
+    def _descendants(self, role_id):
+        found = {role_id}
+        stack = [role_id]
+        while stack:
+            for child in self._children.get(stack.pop(), ()):
+                if child not in found:
+                    found.add(child)
+                    stack.append(child)
+        return found
+
+    def _ensure_roles(self):
+        if self._closure is None:
+            with self._lock:
+                if self._closure is None:
+                    self._load_roles()
+
+    # User sets
+
+    def _load_user(self, user_id):
+        self._ensure_roles()
+        version = self._version
+        with self.pool.connection() as connection, connection.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT role_id, TIMESTAMPDIFF(SECOND, NOW(), expired_at) FROM user_role
+                WHERE user_id = %s AND (expired_at IS NULL OR expired_at > NOW())
+                """,
+                (user_id,),
+            )
+            assignments = _rows(cursor)
+
+        now = time.monotonic()
+        bits = 0
+        valid_until = now + self.max_age
+        for role_id, seconds_left in assignments:
+            bits |= self._closure.get(role_id, 0)
+            if seconds_left is not None:
+                valid_until = min(valid_until, now + seconds_left)
+
+        with self._lock:
+            self.loads += 1
+            if version == self._version:
+                self._users[user_id] = (bits, valid_until)
+                for role_id, _ in assignments:
+                    self._role_users.setdefault(role_id, set()).add(user_id)
+        return bits
+
+    def permission_bits(self, user_id):
+        entry = self._users.get(user_id)
+        if entry is None or entry[1] <= time.monotonic():
+            return self._load_user(user_id)
+        return entry[0]
+
+    def has_permission(self, user_id, permission):
+        """True if the user holds `permission` (a permissions.id or name)."""
+        if not isinstance(permission, int):
+            self._ensure_roles()
+            permission = self._permission_ids.get(permission)
+            if permission is None:
+                return False
+        return self.permission_bits(user_id) >> permission & 1 == 1
+
+    def permissions(self, user_id):
+        return bits_to_ids(self.permission_bits(user_id))
+
+    def cached(self, user_id):
+        return user_id in self._users
+
+    # Invalidation
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            self._version += 1
+            self._users.pop(user_id, None)
+
+    def invalidate_role(self, role_id):
+        """Forget the closure of `role_id` and its descendants and the users holding any of them."""
+        with self._lock:
+            self._version += 1
+            if self._closure is None:
+                return
+            self._load_roles()
+            for role in self._descendants(role_id):
+                for user_id in self._role_users.pop(role, ()):
+                    self._users.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._version += 1
+            self._closure = None
+            self._users = {}
+            self._role_users = {}
+
+
+_default_resolver = None
+_default_lock = threading.Lock()
+
+
+def get_resolver(**options):
+    """Return the process-wide resolver, creating it on first use."""
+    global _default_resolver
+    with _default_lock:
+        if _default_resolver is None:
+            _default_resolver = PermissionResolver(**options)
+        return _default_resolver
+
+
+def has_permission(user_id, permission):
+    return get_resolver().has_permission(user_id, permission)
+
+
+# Writes that keep the cache precise. Each commits and then invalidates
+# exactly the users or roles it touched.
+
+def grant_role(connection, user_id, role_id, expired_at=None, resolver=None):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            INSERT INTO user_role (user_id, role_id, expired_at) VALUES (%s, %s, %s)
+            ON DUPLICATE KEY UPDATE expired_at = VALUES(expired_at)
+            """,
+            (user_id, role_id, expired_at),
+        )
+    connection.commit()
+    (resolver or get_resolver()).invalidate_user(user_id)
+
+
+def revoke_role(connection, user_id, role_id, resolver=None):
+    with connection.cursor() as cursor:
+        cursor.execute("DELETE FROM user_role WHERE user_id = %s AND role_id = %s", (user_id, role_id))
+    connection.commit()
+    (resolver or get_resolver()).invalidate_user(user_id)
+
+
+def grant_permission(connection, role_id, permission_id, resolver=None):
+    with connection.cursor() as cursor:
+        cursor.execute("INSERT IGNORE INTO role_permissions (role_id, permission_id) VALUES (%s, %s)",
+                       (role_id, permission_id))
+    connection.commit()
+    (resolver or get_resolver()).invalidate_role(role_id)
+
+
+def revoke_permission(connection, role_id, permission_id, resolver=None):
+    with connection.cursor() as cursor:
+        cursor.execute("DELETE FROM role_permissions WHERE role_id = %s AND permission_id = %s",
+                       (role_id, permission_id))
+    connection.commit()
+    (resolver or get_resolver()).invalidate_role(role_id)
+
+
+def set_parent_role(connection, role_id, parent_role_id, resolver=None):
+    with connection.cursor() as cursor:
+        cursor.execute("UPDATE roles SET parent_role_id = %s WHERE id = %s", (parent_role_id, role_id))
+    connection.commit()
+    (resolver or get_resolver()).invalidate_role(role_id)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Resolve a user's effective permissions.")
+    parser.add_argument("user_id", type=int)
+    parser.add_argument("--check", help="permission id or name to check")
+    parser.add_argument("--repeat", type=int, default=1000000, help="lookups to time with --check")
+    args = parser.parse_args(argv)
+
+    resolver = get_resolver()
+    if args.check is None:
+        ids = resolver.permissions(args.user_id)
+        names = {permission_id: name for name, permission_id in resolver._permission_ids.items()}
+        print(f"🔐 User {args.user_id} has {len(ids)} permissions")
+        for permission_id in ids:
+            print(f"   {permission_id:>6}  {names.get(permission_id, '?')}")
+        return
+
+    permission = int(args.check) if args.check.isdigit() else args.check
+    allowed = resolver.has_permission(args.user_id, permission)
+    started = time.perf_counter()
+    for _ in range(args.repeat):
+        resolver.has_permission(args.user_id, permission)
+    per_check = (time.perf_counter() - started) / args.repeat
+    print(f"{'✅' if allowed else '⛔'} user {args.user_id} {'has' if allowed else 'lacks'} {args.check} "
+          f"({per_check * 1e9:.0f}ns per cached check)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+import argparse
+import gzip
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+from collections import Counter
+from contextlib import ExitStack
+from itertools import groupby
+from operator import itemgetter
+
+import pymysql
+
+from badraghe.pool import ConnectionPool, get_pool
+
+CHUNK_IDS = 200000
+FETCH_ROWS = 2000
+NET_WRITE_TIMEOUT = 600
+HEADER = "check\treservation_id\tpayment_id\tstored\texpected\n"
+
+RESERVATIONS = """
+    SELECT id, refund_status FROM user_reservations
+    WHERE id BETWEEN %s AND %s ORDER BY id
+"""
+PAYMENTS = """
+    SELECT reservation_id, id, refund_amount FROM payments
+    WHERE reservation_id BETWEEN %s AND %s ORDER BY reservation_id, id
+"""
+REFUNDS = """
+    SELECT p.reservation_id, r.payment_id, r.status, r.refund_amount
+    FROM payments p JOIN refund_requests r ON r.payment_id = p.id
+    WHERE p.reservation_id BETWEEN %s AND %s ORDER BY p.reservation_id, p.id
+"""
+
+_worker = {}
+
+
+def _stream(connection, sql, args):
+    """Rows of `sql` read FETCH_ROWS at a time from an unbuffered cursor.
+
+    The server waits for the client while a stream is behind the others
+    in the merge, so the session's write timeout is raised first.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SET SESSION net_write_timeout = %s", (NET_WRITE_TIMEOUT,))
+        cursor.execute(sql, args)
+        while True:
+            rows = cursor.fetchmany(FETCH_ROWS)
+            if not rows:
+                return
+            yield from rows
+
+
+def _groups(rows):
+    """(reservation_id, rows) for consecutive rows sharing their first column."""
+    return ((key, list(group)) for key, group in groupby(rows, key=itemgetter(0)))
+
+
+def expected_status(refund_statuses):
+    """The refund_status a reservation should have given its refund requests' statuses."""
+    if "approved" in refund_statuses:
+        return "approved"
+    if "pending" in refund_statuses:
+        return "pending"
+    if "rejected" in refund_statuses:
+        return "denied"
+    return "not_requested"
+
+
+def check_reservation(reservation, payments, refunds):
+    """Mismatches of one reservation as (check, reservation_id, payment_id, stored, expected) tuples.
+
+    `reservation` is (id, refund_status) or None when payments point at a
+    reservation that does not exist; `payments` are its (reservation_id,
+    id, refund_amount) rows and `refunds` its (reservation_id, payment_id,
+    status, refund_amount) rows.
+    """
+    reservation_id = reservation[0] if reservation else payments[0][0]
+    approved = Counter()
+    for _, payment_id, status, amount in refunds:
+        if status == "approved":
+            approved[payment_id] += int(amount)
+    mismatches = []
+    if reservation is None:
+        mismatches.append(("missing_reservation", reservation_id, "", "", ""))
+    for _, payment_id, refund_amount in payments:
+        if int(refund_amount or 0) != approved[payment_id]:
+            mismatches.append(("payment_refund_amount", reservation_id, payment_id, int(refund_amount or 0),
+                               approved[payment_id]))
+    if reservation is not None:
+        expected = expected_status({status for _, _, status, _ in refunds})
+        if reservation[1] != expected:
+            mismatches.append(("reservation_refund_status", reservation_id, "", reservation[1], expected))
+    return mismatches
+
+
+def merge(reservations, payments, refunds):
+    """Merge-join three streams ordered by reservation id and yield each reservation's mismatches.
+
+    Only one reservation's payments and refund requests are held at a
+    time, so memory does not grow with the size of the range.
+    """
+    payment_groups = _groups(payments)
+    refund_groups = _groups(refunds)
+    payment = next(payment_groups, None)
+    refund = next(refund_groups, None)
+    for reservation in reservations:
+        reservation_id = reservation[0]
+        while payment is not None and payment[0] < reservation_id:
+            yield check_reservation(None, payment[1], [])
+            payment = next(payment_groups, None)
+        while refund is not None and refund[0] < reservation_id:
+            refund = next(refund_groups, None)
+        own_payments, own_refunds = [], []
+        if payment is not None and payment[0] == reservation_id:
+            own_payments = payment[1]
+            payment = next(payment_groups, None)
+        if refund is not None and refund[0] == reservation_id:
+            own_refunds = refund[1]
+            refund = next(refund_groups, None)
+        yield check_reservation(reservation, own_payments, own_refunds)
+    while payment is not None:
+        yield check_reservation(None, payment[1], [])
+        payment = next(payment_groups, None)
+
+
+def reconcile_range(pool, first, last, part_path):
+    """Reconcile reservations first..last into a gzipped TSV part file; returns per-check counts.
+
+    The three streams each need their own connection, since a connection
+    can only have one unbuffered result open at a time.
+    """
+    stats = Counter()
+    with ExitStack() as stack:
+        streams = []
+        for sql in (RESERVATIONS, PAYMENTS, REFUNDS):
+            connection = stack.enter_context(pool.connection(cursorclass=pymysql.cursors.SSCursor))
+            streams.append(_stream(connection, sql, (first, last)))
+            stack.callback(streams[-1].close)
+        with gzip.open(part_path, "wt", compresslevel=6) as output:
+            for mismatches in merge(*streams):
+                stats["reservations"] += 1
+                for mismatch in mismatches:
+                    stats[mismatch[0]] += 1
+                    output.write("\t".join(str(value) for value in mismatch) + "\n")
+    return stats
+
+
+def _init_worker():
+    _worker["pool"] = ConnectionPool(size=3)
+
+
+def _reconcile_task(task):
+    return reconcile_range(_worker["pool"], *task)
+
+
+def reconcile(output, processes=1, chunk_ids=CHUNK_IDS, pool=None):
+    """Check payments, refund requests and reservations against each other and write mismatches to `output`.
+
+    Reservation ids are split into ranges of `chunk_ids`, reconciled by
+    `processes` worker processes (in this process when 1) into one part
+    file each. The parts are gzip members, so they are concatenated into
+    `output` as they are, in id order. Returns the combined counts.
+    Rows written while the run is in progress can show up as mismatches;
+    re-check those before acting on them.
+    """
+    pool = pool or get_pool()
+    started = time.perf_counter()
+    with pool.connection(cursorclass=pymysql.cursors.Cursor) as connection, connection.cursor() as cursor:
+        cursor.execute("SELECT COALESCE(MAX(id), 0) FROM user_reservations")
+        last_id = cursor.fetchone()[0]
+        cursor.execute("SELECT COALESCE(MAX(reservation_id), 0) FROM payments")
+        last_id = max(last_id, cursor.fetchone()[0])
+    tasks = [(first, min(first + chunk_ids - 1, last_id), f"{output}.part-{first:012d}")
+             for first in range(1, last_id + 1, chunk_ids)]
+
+    stats = Counter()
+    try:
+        if processes == 1:
+            for task in tasks:
+                stats.update(reconcile_range(pool, *task))
+        else:
+            with multiprocessing.Pool(processes, initializer=_init_worker) as workers:
+                for result in workers.imap_unordered(_reconcile_task, tasks):
+                    stats.update(result)
+        with open(output, "wb") as combined:
+            with gzip.open(combined, "wt") as header:
+                header.write(HEADER)
+            for _, _, part_path in tasks:
+                with open(part_path, "rb") as part:
+                    shutil.copyfileobj(part, combined)
+    finally:
+        for _, _, part_path in tasks:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+    stats["mismatches"] = sum(count for check, count in stats.items() if check != "reservations")
+    stats["ranges"] = len(tasks)
+    stats["seconds"] = time.perf_counter() - started
+    return dict(stats)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Reconcile payment refunds, refund requests and reservation refund status.")
+    parser.add_argument("--output", default="reconcile.tsv.gz", help="gzipped TSV of mismatches")
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--chunk-ids", type=int, default=CHUNK_IDS, help="reservation ids per work unit")
+    args = parser.parse_args(argv)
+
+    print(f"🔎 Reconciling with {args.processes} processes in ranges of {args.chunk_ids:,} reservation ids...")
+    stats = reconcile(args.output, args.processes, args.chunk_ids)
+    print(f"✅ {stats.get('reservations', 0):,} reservations in {stats['ranges']} ranges "
+          f"({stats['seconds']:.1f}s, {stats.get('reservations', 0) / max(stats['seconds'], 1e-9):,.0f}/s)")
+    if not stats["mismatches"]:
+        return 0
+    for check in ("payment_refund_amount", "reservation_refund_status", "missing_reservation"):
+        if stats.get(check):
+            print(f"   {check}: {stats[check]:,}")
+    print(f"⛔ {stats['mismatches']:,} mismatches written to {args.output}")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,211 @@
+import argparse
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import pymysql
+
+from badraghe import config
+from badraghe.pool import ConnectionPool, PoolTimeout, get_pool
+
+MAX_LAG = 2.0
+CHECK_INTERVAL = 1.0
+WAIT_TIMEOUT = 0.05
+
+
+class Session:
+    """What one user has written: the primary's executed GTID set after their last write.
+
+    Pass the same Session to Router.write() and Router.read() for reads
+    that must see that user's own bookings.
+    """
+
+    def __init__(self):
+        self.gtids = None
+
+
+class RouterStats:
+    def __init__(self):
+        self.writes = 0
+        self.replica_reads = 0
+        self.primary_reads = 0
+        self.lag_fallbacks = 0
+        self.wait_fallbacks = 0
+        self.error_fallbacks = 0
+        self.lag_checks = 0
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+def replica_lag(connection):
+    """Seconds_Behind_Source from SHOW REPLICA STATUS, or None when the replica is not replicating."""
+    with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+        cursor.execute("SHOW REPLICA STATUS")
+        status = cursor.fetchone()
+    if not status or status.get("Replica_SQL_Running") != "Yes" or status.get("Replica_IO_Running") != "Yes":
+        return None
+    lag = status.get("Seconds_Behind_Source")
+    return None if lag is None else float(lag)
+
+
+def executed_gtids(connection):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT @@GLOBAL.gtid_executed")
+        row = cursor.fetchone()
+    return row[0] if not isinstance(row, dict) else next(iter(row.values()))
+
+
+def caught_up(connection, gtids, timeout):
+    """Whether the replica has applied `gtids`, waiting at most `timeout` seconds for it."""
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT WAIT_FOR_EXECUTED_GTID_SET(%s, %s)", (gtids, timeout))
+        row = cursor.fetchone()
+    return (row[0] if not isinstance(row, dict) else next(iter(row.values()))) == 0
+
+
+class Router:
+    """Send writes to the primary pool and reads to the replica pool when it is fresh enough.
+
+    The replica's lag is checked at most every `check_interval` seconds by
+    whichever reader gets there first; other readers use the last result
+    instead of waiting. While the lag is above `max_lag` (or replication is
+    stopped, or the check fails) every read goes to the primary.
+
+    Reads given a Session that has written something first wait up to
+    `wait_timeout` seconds on the replica for that session's GTIDs, and go
+    to the primary if they have not arrived. Other reads never wait. A read
+    that cannot get a replica connection, or whose wait fails, also goes to
+    the primary.
+    Without a replica pool everything goes to the primary.
+    """
+
+    def __init__(self, primary, replica=None, max_lag=MAX_LAG, check_interval=CHECK_INTERVAL,
+                 wait_timeout=WAIT_TIMEOUT):
+        self.primary = primary
+        self.replica = replica
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.wait_timeout = wait_timeout
+        self.stats = RouterStats()
+        self.lag = None
+        self._checked_at = None
+        self._check_lock = threading.Lock()
+
+    # Replication hooks, overridable for other backends and in tests.
+
+    def replica_lag(self, connection):
+        return replica_lag(connection)
+
+    def executed_gtids(self, connection):
+        return executed_gtids(connection)
+
+    def caught_up(self, connection, gtids):
+        return caught_up(connection, gtids, self.wait_timeout)
+
+    def _check_lag(self):
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < self.check_interval:
+            return
+        if not self._check_lock.acquire(blocking=False):
+            return
+        try:
+            self._checked_at = now
+            self.stats.lag_checks += 1
+            try:
+                with self.replica.connection() as connection:
+                    self.lag = self.replica_lag(connection)
+            except pymysql.MySQLError:
+                self.lag = None
+        finally:
+            self._check_lock.release()
+
+    def replica_usable(self):
+        if self.replica is None:
+            return False
+        self._check_lag()
+        return self.lag is not None and self.lag <= self.max_lag
+
+    @contextmanager
+    def write(self, session=None, autocommit=None, cursorclass=None):
+        """A primary connection. Commit inside the block; on exit the session records what was written."""
+        with self.primary.connection(autocommit, cursorclass) as connection:
+            self.stats.writes += 1
+            yield connection
+            if session is not None and self.replica is not None:
+                session.gtids = self.executed_gtids(connection)
+
+    @contextmanager
+    def read(self, session=None, autocommit=None, cursorclass=None):
+        """A replica connection when the replica is fresh enough for `session`, else a primary one."""
+        if self.replica_usable():
+            connection, fresh = None, False
+            try:
+                connection = self.replica.acquire(autocommit, cursorclass)
+                gtids = session.gtids if session is not None else None
+                fresh = not gtids or self.caught_up(connection, gtids)
+            except (pymysql.MySQLError, PoolTimeout):
+                self.stats.error_fallbacks += 1
+            else:
+                if not fresh:
+                    self.stats.wait_fallbacks += 1
+            if fresh:
+                try:
+                    self.stats.replica_reads += 1
+                    yield connection
+                finally:
+                    self.replica.release(connection)
+                return
+            if connection is not None:
+                self.replica.release(connection)
+        elif self.replica is not None:
+            self.stats.lag_fallbacks += 1
+        with self.primary.connection(autocommit, cursorclass) as connection:
+            self.stats.primary_reads += 1
+            yield connection
+
+    def status(self):
+        return dict(self.stats.as_dict(), lag=self.lag, replica=self.replica is not None)
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_router(**options):
+    """Return the process-wide router: get_pool() as primary, plus a replica pool when BADRAGHE_REPLICA_HOST is set."""
+    global _router
+    with _router_lock:
+        if _router is None:
+            replica = ConnectionPool(connector=config.connect_replica) if config.REPLICA_HOST else None
+            _router = Router(get_pool(), replica, **options)
+        return _router
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Show where reads are routed and how far the replica is behind.")
+    parser.add_argument("--max-lag", type=float, default=MAX_LAG)
+    args = parser.parse_args(argv)
+
+    if not config.REPLICA_HOST:
+        print("⚠️ BADRAGHE_REPLICA_HOST is not set; every read goes to the primary.")
+        return 1
+    router = get_router(max_lag=args.max_lag)
+    session = Session()
+    with router.write(session):
+        pass
+    replica_reads = router.stats.replica_reads
+    started = time.perf_counter()
+    with router.read(session):
+        pass
+    target = "replica" if router.stats.replica_reads > replica_reads else "primary"
+    waited = (time.perf_counter() - started) * 1000
+    marker = "✅" if router.replica_usable() else "⛔"
+    print(f"{marker} replica lag {router.lag if router.lag is not None else 'unknown'}s (max {args.max_lag}s); "
+          f"read-your-writes read went to the {target} in {waited:.1f} ms")
+    return 0 if marker == "✅" else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,257 @@
+import re
+
+from badraghe.config import SQL_FILE
+from badraghe.statements import iter_statements
+
+
+class Column:
+    def __init__(self, name, type_name, size=None, unsigned=False, nullable=True, default=None,
+                 auto_increment=False, primary_key=False, unique=False, values=None, value_range=None,
+                 on_update=None):
+        self.name = name
+        self.type_name = type_name
+        self.size = size
+        self.unsigned = unsigned
+        self.nullable = nullable
+        self.default = default
+        self.auto_increment = auto_increment
+        self.primary_key = primary_key
+        self.unique = unique
+        self.values = values
+        self.value_range = value_range
+        self.on_update = on_update
+
+    def __repr__(self):
+        return f"Column({self.name!r}, {self.type_name!r})"
+
+
+class ForeignKey:
+    def __init__(self, columns, ref_table, ref_columns, on_delete=None, deferred=False):
+        self.columns = columns
+        self.ref_table = ref_table
+        self.ref_columns = ref_columns
+        self.on_delete = on_delete
+        self.deferred = deferred
+
+    def __repr__(self):
+        return f"ForeignKey({self.columns!r} -> {self.ref_table}{self.ref_columns!r})"
+
+
+class Index:
+    def __init__(self, name, table, columns, unique=False):
+        self.name = name
+        self.table = table
+        self.columns = columns
+        self.unique = unique
+
+    def __repr__(self):
+        return f"Index({self.name!r}, {self.table!r}, {self.columns!r})"
+
+
+class Table:
+    def __init__(self, name):
+        self.name = name
+        self.columns = {}
+        self.primary_key = []
+        self.unique_keys = []
+        self.foreign_keys = []
+        self.checks = []
+
+    def __repr__(self):
+        return f"Table({self.name!r})"
+
+    def references(self):
+        return {fk.ref_table for fk in self.foreign_keys}
+
+
+class Schema:
+    def __init__(self):
+        self.tables = {}
+        self.indexes = []
+
+    def dependency_order(self):
+        """Tables ordered so every table comes after the tables it references.
+
+        Self references (roles.parent_role_id) and foreign keys added later by
+        ALTER TABLE (user_reservations.payment_id) do not constrain the order,
+        which is how the migration itself breaks its cycles.
+        """
+        order = []
+        visited = set()
+
+        def visit(name):
+            if name in visited:
+                return
+            visited.add(name)
+            for fk in self.tables[name].foreign_keys:
+                if fk.ref_table != name and not fk.deferred:
+                    visit(fk.ref_table)
+            order.append(name)
+
+        for name in self.tables:
+            visit(name)
+        return order
+
+
+def split_items(body):
+    items = []
+    depth = 0
+    quote = None
+    current = []
+    for char in body:
+        if quote:
+            current.append(char)
+            if char == quote:
+                quote = None
+            continue
+        if char in "'\"`":
+            quote = char
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "," and depth == 0:
+            items.append("".join(current).strip())
+            current = []
+            continue
+        current.append(char)
+    if "".join(current).strip():
+        items.append("".join(current).strip())
+    return items
+
+
+def _names(text):
+    return [name.strip().strip("`") for name in text.split(",")]
+
+
+def _quoted_values(text):
+    return re.findall(r"'((?:[^'\\]|\\.)*)'", text)
+
+
+COLUMN_RE = re.compile(r"^`?(\w+)`?\s+(\w+)(?:\s*\(((?:[^()']|'[^']*')*)\))?(.*)$", re.S)
+FOREIGN_KEY_RE = re.compile(
+    r"FOREIGN KEY\s*\(([^)]*)\)\s*REFERENCES\s+`?(\w+)`?\s*\(([^)]*)\)(?:\s+ON DELETE\s+(SET NULL|CASCADE|RESTRICT|NO ACTION))?",
+    re.I,
+)
+CHECK_IN_RE = re.compile(r"CHECK\s*\(\s*\w+\s+IN\s*\(([^)]*)\)\s*\)", re.I)
+CHECK_BETWEEN_RE = re.compile(r"CHECK\s*\(\s*\w+\s+BETWEEN\s+(-?\d+)\s+AND\s+(-?\d+)\s*\)", re.I)
+DEFAULT_RE = re.compile(r"DEFAULT\s+(\('[^']*'\)|'[^']*'|[\w.]+(?:\(\))?)", re.I)
+ON_UPDATE_RE = re.compile(r"ON UPDATE\s+([\w.]+(?:\(\))?)", re.I)
+
+
+def parse_column(item):
+    match = COLUMN_RE.match(item)
+    name, type_name, args, rest = match.groups()
+    type_name = type_name.upper()
+    upper_rest = rest.upper()
+    column = Column(name, type_name)
+
+    if type_name == "ENUM":
+        column.values = _quoted_values(args)
+    elif args:
+        column.size = tuple(int(part) for part in args.split(","))
+
+    column.unsigned = "UNSIGNED" in upper_rest
+    column.nullable = "NOT NULL" not in upper_rest
+    column.auto_increment = "AUTO_INCREMENT" in upper_rest
+    column.primary_key = "PRIMARY KEY" in upper_rest
+    column.unique = bool(re.search(r"\bUNIQUE\b", upper_rest))
+    if column.primary_key:
+        column.nullable = False
+
+    default = DEFAULT_RE.search(rest)
+    if default:
+        column.default = default.group(1)
+    on_update = ON_UPDATE_RE.search(rest)
+    if on_update:
+        column.on_update = on_update.group(1)
+
+    check_in = CHECK_IN_RE.search(rest)
+    if check_in:
+        column.values = _quoted_values(check_in.group(1))
+    check_between = CHECK_BETWEEN_RE.search(rest)
+    if check_between:
+        column.value_range = (int(check_between.group(1)), int(check_between.group(2)))
+    return column
+
+
+def parse_create_table(statement):
+    match = re.match(r"CREATE TABLE\s+(?:IF NOT EXISTS\s+)?`?(\w+)`?\s*\((.*)\)\s*$", statement, re.S | re.I)
+    table = Table(match.group(1))
+
+    for item in split_items(match.group(2)):
+        upper = item.upper()
+        if upper.startswith("PRIMARY KEY"):
+            table.primary_key = _names(re.search(r"\(([^)]*)\)", item).group(1))
+        elif upper.startswith("FOREIGN KEY"):
+            table.foreign_keys.append(_parse_foreign_key(item))
+        elif upper.startswith("UNIQUE"):
+            table.unique_keys.append(_names(re.search(r"\(([^)]*)\)", item).group(1)))
+        elif upper.startswith("CONSTRAINT") or upper.startswith("CHECK"):
+            if "FOREIGN KEY" in upper:
+                table.foreign_keys.append(_parse_foreign_key(item))
+            else:
+                table.checks.append(item)
+        elif upper.startswith(("INDEX", "KEY", "FULLTEXT")):
+            continue
+        else:
+            column = parse_column(item)
+            table.columns[column.name] = column
+            if column.primary_key:
+                table.primary_key = [column.name]
+            if column.unique:
+                table.unique_keys.append([column.name])
+    return table
+
+
+def _parse_foreign_key(text, deferred=False):
+    match = FOREIGN_KEY_RE.search(text)
+    return ForeignKey(
+        _names(match.group(1)),
+        match.group(2),
+        _names(match.group(3)),
+        on_delete=match.group(4).upper() if match.group(4) else None,
+        deferred=deferred,
+    )
+
+
+def apply_alter_table(schema, statement):
+    match = re.match(r"ALTER TABLE\s+`?(\w+)`?\s+(.*)$", statement, re.S | re.I)
+    table = schema.tables[match.group(1)]
+    for action in split_items(match.group(2)):
+        upper = action.upper()
+        if upper.startswith("ADD COLUMN"):
+            column = parse_column(action[len("ADD COLUMN"):].strip())
+            table.columns[column.name] = column
+        elif upper.startswith("ADD FOREIGN KEY") or (upper.startswith("ADD CONSTRAINT") and "FOREIGN KEY" in upper):
+            table.foreign_keys.append(_parse_foreign_key(action, deferred=True))
+
+
+def parse_create_index(statement):
+    match = re.match(r"CREATE\s+(UNIQUE\s+)?INDEX\s+`?(\w+)`?\s+ON\s+`?(\w+)`?\s*\(([^)]*)\)", statement, re.I)
+    return Index(match.group(2), match.group(3), _names(match.group(4)), unique=bool(match.group(1)))
+
+
+def add_statement(schema, statement):
+    if statement.kind == "create_table":
+        table = parse_create_table(statement.sql)
+        schema.tables[table.name] = table
+    elif statement.kind == "alter_table":
+        apply_alter_table(schema, statement.sql)
+    elif statement.kind == "create_index":
+        schema.indexes.append(parse_create_index(statement.sql))
+
+
+def parse(text):
+    schema = Schema()
+    for statement in iter_statements(text.splitlines(True)):
+        add_statement(schema, statement)
+    return schema
+
+
+def load(path=SQL_FILE):
+    schema = Schema()
+    with open(path, "r") as f:
+        for statement in iter_statements(f):
+            add_statement(schema, statement)
+    return schema
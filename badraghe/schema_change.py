@@ -0,0 +1,493 @@
+import argparse
+import glob
+import hashlib
+import os
+import re
+import sys
+import time
+
+import pymysql
+
+from badraghe import config, migrate
+from badraghe.config import SQL_FILE
+from badraghe.pool import get_pool
+from badraghe.statements import iter_statements
+
+MIGRATIONS_DIR = os.path.join(config.ROOT_DIR, "migrations")
+BASELINE = "0000_baseline"
+VERSION_RE = re.compile(r"^(\d{4})_\w+\.sql$")
+CHUNK_ROWS = 1000
+MIN_CHUNK_ROWS = 100
+MAX_CHUNK_ROWS = 50000
+CHUNK_TIME = 0.5
+REPORT_INTERVAL = 5.0
+INTEGER_TYPES = {"tinyint", "smallint", "mediumint", "int", "bigint"}
+UPDATE_RE = re.compile(r"^\s*UPDATE\s+`?(\w+)`?(?:\s+(?:AS\s+)?`?(?!SET\b|JOIN\b|INNER\b|LEFT\b)(\w+)`?)?\s", re.I)
+
+
+class SchemaChangeError(Exception):
+    pass
+
+
+def _rows(cursor):
+    return [tuple(row.values()) if isinstance(row, dict) else row for row in cursor.fetchall()]
+
+
+def _scalar(cursor, sql, args=()):
+    cursor.execute(sql, args)
+    rows = _rows(cursor)
+    return rows[0][0] if rows else None
+
+
+def checksum(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        digest.update(f.read())
+    return digest.hexdigest()
+
+
+def _duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    return f"{minutes}m{seconds:02d}s" if minutes else f"{seconds}s"
+
+
+class Progress:
+    """Reports how far a chunked job has got and when it should finish, at most every `interval` seconds."""
+
+    def __init__(self, label, report=print, interval=REPORT_INTERVAL):
+        self.label = label
+        self.report = report
+        self.interval = interval
+        self.started = time.perf_counter()
+        self.rows = 0
+        self.fraction = 0.0
+        self._reported_at = self.started
+
+    def eta(self):
+        elapsed = time.perf_counter() - self.started
+        return elapsed / self.fraction * (1 - self.fraction) if self.fraction else None
+
+    def update(self, rows, fraction):
+        self.rows += rows
+        self.fraction = fraction
+        now = time.perf_counter()
+        if now - self._reported_at >= self.interval:
+            self._reported_at = now
+            eta = self.eta()
+            self.report(f"⏳ {self.label}: {self.fraction:.0%}, {self.rows:,} rows, "
+                        f"ETA {_duration(eta) if eta is not None else 'unknown'}")
+
+    def done(self):
+        self.report(f"✅ {self.label}: {self.rows:,} rows in {_duration(time.perf_counter() - self.started)}")
+
+
+# Chunks. Work is split into primary key ranges of about `chunk_rows` rows,
+# each in its own short transaction; the chunk size adapts so one chunk takes
+# about `chunk_time` seconds, and `sleep` seconds pass between chunks.
+
+def primary_key(cursor, table):
+    """The single integer primary key column of `table`."""
+    if config.BACKEND == "sqlite":
+        cursor.execute("SELECT name, type FROM pragma_table_info(%s) WHERE pk > 0", (table,))
+        rows = _rows(cursor)
+        if len(rows) != 1 or "INT" not in rows[0][1].upper():
+            raise SchemaChangeError(f"{table} needs a single integer primary key to be changed in chunks")
+        return rows[0][0]
+    cursor.execute(
+        """
+        SELECT k.COLUMN_NAME, c.DATA_TYPE FROM information_schema.KEY_COLUMN_USAGE k
+        JOIN information_schema.COLUMNS c
+          ON c.TABLE_SCHEMA = k.TABLE_SCHEMA AND c.TABLE_NAME = k.TABLE_NAME AND c.COLUMN_NAME = k.COLUMN_NAME
+        WHERE k.TABLE_SCHEMA = DATABASE() AND k.TABLE_NAME = %s AND k.CONSTRAINT_NAME = 'PRIMARY'
+        """,
+        (table,),
+    )
+    rows = _rows(cursor)
+    if len(rows) != 1 or rows[0][1].lower() not in INTEGER_TYPES:
+        raise SchemaChangeError(f"{table} needs a single integer primary key to be changed in chunks")
+    return rows[0][0]
+
+
+def _chunk_end(cursor, table, pk, start, rows, last):
+    end = _scalar(cursor, f"SELECT {pk} FROM {table} WHERE {pk} >= %s ORDER BY {pk} LIMIT 1 OFFSET %s",
+                  (start, rows - 1))
+    return last if end is None else min(end, last)
+
+
+def run_chunks(pool, table, pk, work, progress, chunk_rows=CHUNK_ROWS, chunk_time=CHUNK_TIME, sleep=0.0):
+    """Call work(cursor, start, end) for consecutive `pk` ranges of `table` existing now; returns rows touched."""
+    with pool.connection(autocommit=False) as connection:
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT MIN({pk}), MAX({pk}) FROM {table}")
+            first, last = _rows(cursor)[0]
+        connection.commit()
+        if first is None:
+            progress.done()
+            return 0
+        start = first
+        while start <= last:
+            started = time.perf_counter()
+            with connection.cursor() as cursor:
+                end = _chunk_end(cursor, table, pk, start, chunk_rows, last)
+                rows = work(cursor, start, end)
+            connection.commit()
+            elapsed = time.perf_counter() - started
+            chunk_rows = max(MIN_CHUNK_ROWS, min(MAX_CHUNK_ROWS, int(chunk_rows * chunk_time / max(elapsed, 1e-3))))
+            progress.update(max(rows, 0), (end - first + 1) / (last - first + 1))
+            start = end + 1
+            if sleep:
+                time.sleep(sleep)
+    progress.done()
+    return progress.rows
+
+
+def _split_where(sql):
+    """(statement before its top-level WHERE, condition or None)."""
+    depth, quote, index, where = 0, None, 0, None
+    while index < len(sql):
+        char = sql[index]
+        if quote:
+            if char == "\\":
+                index += 1
+            elif char == quote:
+                quote = None
+        elif char in "'\"`":
+            quote = char
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif depth == 0 and re.match(r"WHERE\b", sql[index:index + 6], re.I) and \
+                (index == 0 or not (sql[index - 1].isalnum() or sql[index - 1] == "_")):
+            where = index
+        index += 1
+    if where is None:
+        return sql.rstrip(), None
+    return sql[:where].rstrip(), sql[where + len("WHERE"):].strip()
+
+
+def backfill(pool, sql, chunk_rows=CHUNK_ROWS, chunk_time=CHUNK_TIME, sleep=0.0, report=print):
+    """Run an UPDATE statement in primary key chunks of its table; returns the rows changed.
+
+    `sql` is a complete UPDATE without ORDER BY or LIMIT (joins are fine);
+    each chunk adds a primary key range to its WHERE.
+    """
+    match = UPDATE_RE.match(sql)
+    if not match:
+        raise SchemaChangeError(f"not an UPDATE statement: {sql[:60]}")
+    table, alias = match.groups()
+    head, condition = _split_where(sql.strip().rstrip(";"))
+    with pool.connection() as connection, connection.cursor() as cursor:
+        pk = primary_key(cursor, table)
+    column = f"{alias or table}.{pk}"
+    chunk_sql = (head.replace("%", "%%") + f" WHERE {column} BETWEEN %s AND %s" +
+                 (f" AND ({condition.replace('%', '%%')})" if condition else ""))
+
+    def work(cursor, start, end):
+        cursor.execute(chunk_sql, (start, end))
+        return cursor.rowcount
+
+    return run_chunks(pool, table, pk, work, Progress(f"backfill {table}", report), chunk_rows, chunk_time, sleep)
+
+
+# Online ALTER TABLE (MySQL). The change is made on an empty shadow copy of
+# the table, triggers mirror writes to it while existing rows are copied in
+# chunks, and one RENAME TABLE swaps it in.
+
+def _shadow(table):
+    return f"_{table}_new", f"_{table}_old", [f"{table}_osc_{event}" for event in ("ins", "upd", "del")]
+
+
+def _columns(cursor, table):
+    cursor.execute(
+        """
+        SELECT COLUMN_NAME FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND EXTRA NOT LIKE '%%GENERATED%%'
+        ORDER BY ORDINAL_POSITION
+        """,
+        (table,),
+    )
+    return [row[0] for row in _rows(cursor)]
+
+
+def child_foreign_keys(cursor, table):
+    """(child table, constraint, columns, referenced columns, on delete, on update) of keys referencing `table`."""
+    cursor.execute(
+        """
+        SELECT rc.TABLE_NAME, rc.CONSTRAINT_NAME,
+               GROUP_CONCAT(k.COLUMN_NAME ORDER BY k.ORDINAL_POSITION),
+               GROUP_CONCAT(k.REFERENCED_COLUMN_NAME ORDER BY k.ORDINAL_POSITION),
+               rc.DELETE_RULE, rc.UPDATE_RULE
+        FROM information_schema.REFERENTIAL_CONSTRAINTS rc
+        JOIN information_schema.KEY_COLUMN_USAGE k
+          ON k.CONSTRAINT_SCHEMA = rc.CONSTRAINT_SCHEMA AND k.TABLE_NAME = rc.TABLE_NAME
+         AND k.CONSTRAINT_NAME = rc.CONSTRAINT_NAME
+        WHERE rc.CONSTRAINT_SCHEMA = DATABASE() AND rc.REFERENCED_TABLE_NAME = %s AND rc.TABLE_NAME <> %s
+        GROUP BY rc.TABLE_NAME, rc.CONSTRAINT_NAME, rc.DELETE_RULE, rc.UPDATE_RULE
+        """,
+        (table, table),
+    )
+    return _rows(cursor)
+
+
+def cleanup(pool, table):
+    """Drop the triggers and shadow table an interrupted online_alter() left behind."""
+    shadow, _, triggers = _shadow(table)
+    with pool.connection(autocommit=True) as connection, connection.cursor() as cursor:
+        for trigger in triggers:
+            cursor.execute(f"DROP TRIGGER IF EXISTS `{trigger}`")
+        cursor.execute(f"DROP TABLE IF EXISTS `{shadow}`")
+
+
+def _create_shadow(cursor, table, shadow, actions):
+    cursor.execute(f"SHOW CREATE TABLE `{table}`")
+    create = _rows(cursor)[0][1]
+    create = re.sub(rf"^CREATE TABLE `{table}`", f"CREATE TABLE `{shadow}`", create)
+    # Constraint names are unique per schema; let MySQL name the shadow's own.
+    create = re.sub(r"CONSTRAINT `[^`]+` (FOREIGN KEY|CHECK)", r"\1", create)
+    cursor.execute(create)
+    cursor.execute(f"ALTER TABLE `{shadow}` {actions}")
+
+
+def _create_triggers(cursor, table, shadow, pk, columns, triggers):
+    names = ", ".join(f"`{column}`" for column in columns)
+    new = ", ".join(f"NEW.`{column}`" for column in columns)
+    insert, update, delete = triggers
+    cursor.execute(f"CREATE TRIGGER `{insert}` AFTER INSERT ON `{table}` FOR EACH ROW "
+                   f"REPLACE INTO `{shadow}` ({names}) VALUES ({new})")
+    cursor.execute(f"CREATE TRIGGER `{update}` AFTER UPDATE ON `{table}` FOR EACH ROW BEGIN "
+                   f"DELETE IGNORE FROM `{shadow}` WHERE `{pk}` = OLD.`{pk}` AND OLD.`{pk}` <> NEW.`{pk}`; "
+                   f"REPLACE INTO `{shadow}` ({names}) VALUES ({new}); END")
+    cursor.execute(f"CREATE TRIGGER `{delete}` AFTER DELETE ON `{table}` FOR EACH ROW "
+                   f"DELETE IGNORE FROM `{shadow}` WHERE `{pk}` = OLD.`{pk}`")
+
+
+def _rebuild_child_keys(cursor, table, keys):
+    """Point child foreign keys (which RENAME TABLE moved to the old table) back at `table`.
+
+    With foreign_key_checks off MySQL adds the keys in place, without
+    scanning the child tables.
+    """
+    cursor.execute("SET SESSION foreign_key_checks = 0")
+    try:
+        for child, constraint, columns, ref_columns, on_delete, on_update in keys:
+            renamed = constraint[1:] if constraint.startswith("_") else f"_{constraint}"
+            cursor.execute(
+                f"ALTER TABLE `{child}` DROP FOREIGN KEY `{constraint}`, "
+                f"ADD CONSTRAINT `{renamed}` FOREIGN KEY ({columns}) REFERENCES `{table}` ({ref_columns}) "
+                f"ON DELETE {on_delete} ON UPDATE {on_update}"
+            )
+    finally:
+        cursor.execute("SET SESSION foreign_key_checks = 1")
+
+
+def online_alter(pool, table, actions, chunk_rows=CHUNK_ROWS, chunk_time=CHUNK_TIME, sleep=0.0, keep_old=False,
+                 report=print):
+    """Apply ALTER TABLE `actions` to `table` without blocking writes to it; returns the rows copied.
+
+    Writes keep going to `table` throughout: triggers replay every insert,
+    update and delete onto the altered shadow table while the rows that
+    existed when they were created are copied across in chunks. Copied rows
+    never overwrite ones the triggers already wrote. RENAME TABLE then swaps
+    the two tables in one step and foreign keys of other tables are pointed
+    at the new one. The old table is dropped unless `keep_old`.
+    """
+    shadow, old, triggers = _shadow(table)
+    with pool.connection(autocommit=True) as connection, connection.cursor() as cursor:
+        if _scalar(cursor, "SELECT COUNT(*) FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() "
+                           "AND TABLE_NAME IN (%s, %s)", (shadow, old)):
+            raise SchemaChangeError(f"{shadow} or {old} already exists; a previous change of {table} was "
+                                    f"interrupted (python -m badraghe.schema_change cleanup {table})")
+        pk = primary_key(cursor, table)
+        _create_shadow(cursor, table, shadow, actions)
+    try:
+        with pool.connection(autocommit=True) as connection, connection.cursor() as cursor:
+            shadow_columns = set(_columns(cursor, shadow))
+            columns = [column for column in _columns(cursor, table) if column in shadow_columns]
+            if pk not in columns:
+                raise SchemaChangeError(f"the change drops or renames the primary key of {table}")
+            _create_triggers(cursor, table, shadow, pk, columns, triggers)
+        names = ", ".join(f"`{column}`" for column in columns)
+
+        def work(cursor, start, end):
+            cursor.execute(f"INSERT IGNORE INTO `{shadow}` ({names}) SELECT {names} FROM `{table}` "
+                           f"FORCE INDEX (PRIMARY) WHERE `{pk}` BETWEEN %s AND %s LOCK IN SHARE MODE", (start, end))
+            return cursor.rowcount
+
+        copied = run_chunks(pool, table, pk, work, Progress(f"copy {table}", report), chunk_rows, chunk_time, sleep)
+
+        with pool.connection(autocommit=True) as connection, connection.cursor() as cursor:
+            keys = child_foreign_keys(cursor, table)
+            cursor.execute(f"RENAME TABLE `{table}` TO `{old}`, `{shadow}` TO `{table}`")
+            for trigger in triggers:
+                cursor.execute(f"DROP TRIGGER IF EXISTS `{trigger}`")
+            _rebuild_child_keys(cursor, table, keys)
+            if not keep_old:
+                cursor.execute(f"DROP TABLE `{old}`")
+    except Exception:
+        cleanup(pool, table)
+        raise
+    return copied
+
+
+# Versions. badrage-migration.sql is version 0000_baseline; later changes are
+# migrations/NNNN_name.sql files applied once each, in order, and recorded in
+# schema_migrations with their checksum.
+
+def versions(directory=MIGRATIONS_DIR):
+    """[(version, path)] of the migration files in `directory`, in order."""
+    paths = glob.glob(os.path.join(directory, "*.sql"))
+    return sorted((os.path.basename(path)[:-len(".sql")], path) for path in paths
+                  if VERSION_RE.match(os.path.basename(path)))
+
+
+def _ensure_table(cursor):
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version VARCHAR(100) PRIMARY KEY,
+            checksum CHAR(64) NOT NULL,
+            seconds DOUBLE,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """
+    )
+
+
+def applied_versions(pool):
+    """{version: checksum} of everything recorded in schema_migrations."""
+    with pool.connection(autocommit=True) as connection, connection.cursor() as cursor:
+        _ensure_table(cursor)
+        cursor.execute("SELECT version, checksum FROM schema_migrations")
+        return dict(_rows(cursor))
+
+
+def _record(pool, version, digest, seconds):
+    with pool.connection(autocommit=True) as connection, connection.cursor() as cursor:
+        cursor.execute("INSERT INTO schema_migrations (version, checksum, seconds) VALUES (%s, %s, %s)",
+                       (version, digest, seconds))
+
+
+def _baseline_applied(pool, path):
+    """Whether the baseline's first table exists, i.e. the database was built without recording it."""
+    with open(path, "r") as f:
+        first = next(statement.table for statement in iter_statements(f) if statement.kind == "create_table")
+    with pool.connection(autocommit=True) as connection, connection.cursor() as cursor:
+        try:
+            cursor.execute(f"SELECT 1 FROM {first} LIMIT 1")
+            cursor.fetchall()
+        except pymysql.err.ProgrammingError as e:
+            if e.args[0] != 1146:
+                raise
+            return False
+    return True
+
+
+def apply_file(pool, path, online=None, chunk_rows=CHUNK_ROWS, chunk_time=CHUNK_TIME, sleep=0.0, report=print):
+    """Run one migration file: ALTER TABLE online, UPDATE as a chunked backfill, anything else as is.
+
+    `online` defaults to True on MySQL; on SQLite statements run directly.
+    """
+    online = config.BACKEND != "sqlite" if online is None else online
+    with open(path, "r") as f:
+        statements = list(iter_statements(f))
+    for statement in statements:
+        report(f"▶️  {statement.head()}")
+        if statement.kind == "alter_table" and online:
+            actions = re.match(r"ALTER\s+TABLE\s+`?\w+`?\s+(.*)$", statement.sql, re.S | re.I).group(1)
+            online_alter(pool, statement.table, actions, chunk_rows, chunk_time, sleep, report=report)
+        elif UPDATE_RE.match(statement.sql) and not re.search(r"\b(?:ORDER\s+BY|LIMIT)\b", statement.sql, re.I):
+            backfill(pool, statement.sql, chunk_rows, chunk_time, sleep, report)
+        else:
+            with pool.connection(autocommit=True) as connection, connection.cursor() as cursor:
+                cursor.execute(statement.sql)
+
+
+def upgrade(pool=None, path=SQL_FILE, directory=MIGRATIONS_DIR, online=None, chunk_rows=CHUNK_ROWS,
+            chunk_time=CHUNK_TIME, sleep=0.0, report=print):
+    """Bring the database to the latest version and return the versions applied now ([] when up to date).
+
+    An empty database gets the baseline migration; one that already has the
+    baseline's tables (built by migrate, snapshot or the SQLite backend) has
+    it recorded without running it. A file whose checksum changed after it
+    was applied stops the upgrade: add a new version instead. A file that
+    fails part way is not recorded, so keep one change per file.
+    """
+    pool = pool or get_pool()
+    done = applied_versions(pool)
+    pending = [(BASELINE, path)] + versions(directory)
+    for version, file_path in pending:
+        if version in done and done[version] != checksum(file_path):
+            hint = " (rebuild the database)" if version == BASELINE else ""
+            raise SchemaChangeError(f"{file_path} changed after version {version} was applied{hint}")
+
+    applied = []
+    for version, file_path in pending:
+        if version in done:
+            continue
+        started = time.perf_counter()
+        if version == BASELINE:
+            if not _baseline_applied(pool, file_path):
+                if config.BACKEND == "sqlite":
+                    from badraghe import sqlite_backend
+
+                    sqlite_backend.migrate(file_path)
+                else:
+                    migrate.migrate(file_path, pool=pool)
+        else:
+            apply_file(pool, file_path, online, chunk_rows, chunk_time, sleep, report)
+        _record(pool, version, checksum(file_path), time.perf_counter() - started)
+        applied.append(version)
+    return applied
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Versioned, online schema changes.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for name, help_text in (("upgrade", "apply pending versions"), ("alter", "change one table online")):
+        command = subparsers.add_parser(name, help=help_text)
+        command.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS, help="rows in the first chunk")
+        command.add_argument("--chunk-time", type=float, default=CHUNK_TIME, help="target seconds per chunk")
+        command.add_argument("--sleep", type=float, default=0.0, help="seconds to pause between chunks")
+        if name == "upgrade":
+            command.add_argument("--directory", default=MIGRATIONS_DIR)
+        else:
+            command.add_argument("table")
+            command.add_argument("actions", help='e.g. "ADD COLUMN paid_at TIMESTAMP NULL"')
+            command.add_argument("--keep-old", action="store_true", help="keep the original as _<table>_old")
+    status_parser = subparsers.add_parser("status", help="list applied and pending versions")
+    status_parser.add_argument("--directory", default=MIGRATIONS_DIR)
+    cleanup_parser = subparsers.add_parser("cleanup", help="remove what an interrupted alter left behind")
+    cleanup_parser.add_argument("table")
+    args = parser.parse_args(argv)
+
+    pool = get_pool()
+    started = time.perf_counter()
+    if args.command == "upgrade":
+        applied = upgrade(pool, directory=args.directory, chunk_rows=args.chunk_rows, chunk_time=args.chunk_time,
+                          sleep=args.sleep)
+        if not applied:
+            print("✅ Already up to date.")
+        else:
+            print(f"✅ Applied {', '.join(applied)} in {_duration(time.perf_counter() - started)}.")
+    elif args.command == "alter":
+        online_alter(pool, args.table, args.actions, args.chunk_rows, args.chunk_time, args.sleep, args.keep_old)
+        print(f"✅ {args.table} changed in {_duration(time.perf_counter() - started)}.")
+    elif args.command == "status":
+        done = applied_versions(pool)
+        for version, path in [(BASELINE, SQL_FILE)] + versions(args.directory):
+            if version not in done:
+                marker = "⏳ pending"
+            elif done[version] != checksum(path):
+                marker = "⛔ changed since applied"
+            else:
+                marker = "✅ applied"
+            print(f"{marker:<26} {version}")
+    else:
+        cleanup(pool, args.table)
+        print(f"🧹 Removed the shadow table and triggers of {args.table}.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,259 @@
+import argparse
+from datetime import datetime, timedelta
+
+import pymysql
+
+from badraghe import facets
+from badraghe.pool import get_pool
+
+ROUTE_INDEX = "idx_travel_tickets_route"
+ROUTE_STATUS_INDEX = "idx_travel_tickets_route_status"
+LEGACY_INDEX = "idx_travel_tickets_departure_city"
+
+TICKET_COLUMNS = [
+    "id", "transport_type", "departure_city", "arrival_city", "departure_time", "arrival_time",
+    "price", "currency", "available_seats", "total_seats", "transport_company_id", "class_type", "status",
+]
+RATING_COLUMNS = ["reviews", "rating"]
+DETAILS = {
+    "plane": ("flight_details", ["airline_name", "flight_class", "stops", "flight_number",
+                                 "departure_airport", "arrival_airport"]),
+    "train": ("train_details", ["train_star_rating", "private_cabin"]),
+    "bus": ("bus_details", ["bus_company", "bus_type", "seats_per_row"]),
+}
+
+
+class Page:
+    def __init__(self, rows, after):
+        self.rows = rows
+        self.after = after
+
+    def __repr__(self):
+        return f"Page({len(self.rows)} rows, after={self.after!r})"
+
+
+def _route_filter(departure_city, arrival_city, departure_from, departure_until, class_type, status):
+    conditions = ["t.departure_city = %s", "t.arrival_city = %s"]
+    args = [departure_city, arrival_city]
+    if departure_from is not None:
+        conditions.append("t.departure_time >= %s")
+        args.append(departure_from)
+    if departure_until is not None:
+        conditions.append("t.departure_time < %s")
+        args.append(departure_until)
+    if status is not None:
+        conditions.append("t.status = %s")
+        args.append(status)
+    if class_type is not None:
+        conditions.append("t.class_type = %s")
+        args.append(class_type)
+    return conditions, args
+
+
+def _details_sql():
+    columns = []
+    joins = []
+    for transport_type, (table, names) in DETAILS.items():
+        alias = f"{table[0]}d"
+        columns += [f"{alias}.{name} AS {alias}_{name}" for name in names]
+        joins.append(f"LEFT JOIN {table} {alias} ON {alias}.ticket_id = t.id AND t.transport_type = '{transport_type}'")
+    return columns, joins
+
+
+def _attach_details(rows):
+    tickets = {}
+    for row in rows:
+        ticket = tickets.get(row["id"])
+        if ticket is None:
+            ticket = {name: row[name] for name in TICKET_COLUMNS + RATING_COLUMNS if name in row}
+            ticket["details"] = None
+            tickets[row["id"]] = ticket
+        table, names = DETAILS[row["transport_type"]]
+        alias = f"{table[0]}d"
+        if ticket["details"] is None and row[f"{alias}_{names[0]}"] is not None:
+            ticket["details"] = {name: row[f"{alias}_{name}"] for name in names}
+    return list(tickets.values())
+
+
+def _attach_ratings(rows):
+    for row in rows:
+        reviews = row.pop("rating_reviews") or 0
+        rating_sum = row.pop("rating_sum")
+        row["reviews"] = reviews
+        row["rating"] = round(rating_sum / reviews, 2) if reviews else None
+    return rows
+
+
+def _fetch(connection, page_sql, args, details, ratings=False):
+    """Run the id-only page query and join the full ticket rows onto it.
+
+    The inner query only touches the route index; the ticket rows (and the
+    details tables, and the one-row rating summary) are looked up for the
+    page's ids alone.
+    """
+    columns = [f"t.{name}" for name in TICKET_COLUMNS]
+    joins = []
+    if details:
+        detail_columns, joins = _details_sql()
+        columns += detail_columns
+    if ratings:
+        columns += ["rs.reviews AS rating_reviews", "rs.rating_sum AS rating_sum"]
+        joins.append("LEFT JOIN ticket_rating_summary rs ON rs.ticket_id = t.id")
+    sql = (
+        f"SELECT {', '.join(columns)} FROM ({page_sql}) page "
+        f"JOIN travel_tickets t ON t.id = page.id {' '.join(joins)} "
+        f"ORDER BY t.departure_time, t.id"
+    )
+    with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+        cursor.execute(sql, args)
+        rows = cursor.fetchall()
+    if ratings:
+        _attach_ratings(rows)
+    return _attach_details(rows) if details else list(rows)
+
+
+def _amenity_filter(connection, amenities, match_all):
+    """(join, conditions, args) restricting tickets to all (or any) of the `amenities` feature ids."""
+    if not amenities:
+        return "", [], []
+    with connection.cursor() as cursor:
+        bits = facets.feature_bits(cursor, amenities)
+    if match_all and len(bits) < len(set(amenities)):
+        return "", ["FALSE"], []
+    sql, args = facets.condition(facets.masks(bits.values()), match_all)
+    return "JOIN ticket_amenities a ON a.ticket_id = t.id", [sql], args
+
+
+def search_routes(connection, departure_city, arrival_city, departure_from=None, departure_until=None,
+                  class_type=None, status="available", after=None, limit=20, details=False, index=None,
+                  ratings=False, amenities=None, match_all=True):
+    """Return one page of tickets on a route, ordered by departure time.
+
+    Pages are keyset paginated: pass the previous page's `after` to get the
+    next one, which costs the same at page 1000 as at page 1. `details`
+    joins flight_details/train_details/bus_details onto each ticket, and
+    `ratings` adds `reviews` and average `rating` from ticket_rating_summary.
+    `amenities` keeps tickets with all (or, without `match_all`, any) of
+    those feature ids, using the ticket_amenities bitmasks.
+
+    With a status, idx_travel_tickets_route_status (migration 0002) returns
+    the route in page order, so a page is read without a filesort.
+    """
+    conditions, args = _route_filter(departure_city, arrival_city, departure_from, departure_until, class_type, status)
+    join, amenity_conditions, amenity_args = _amenity_filter(connection, amenities, match_all)
+    conditions += amenity_conditions
+    args += amenity_args
+    if after is not None:
+        conditions.append("(t.departure_time > %s OR (t.departure_time = %s AND t.id > %s))")
+        args += [after[0], after[0], after[1]]
+    hint = f" FORCE INDEX ({index})" if index else ""
+    page_sql = (
+        f"SELECT t.id FROM travel_tickets t{hint} {join} WHERE {' AND '.join(conditions)} "
+        f"ORDER BY t.departure_time, t.id LIMIT %s"
+    )
+    rows = _fetch(connection, page_sql, args + [limit], details, ratings)
+    next_after = (rows[-1]["departure_time"], rows[-1]["id"]) if len(rows) == limit else None
+    return Page(rows, next_after)
+
+
+def amenity_facets(connection, departure_city, arrival_city, departure_from=None, departure_until=None,
+                   class_type=None, status="available", amenities=None, match_all=True):
+    """Count the tickets search_routes would return, and how many of them have each amenity.
+
+    Every feature's count comes out of the same scan over the matching
+    tickets' masks. Returns {"tickets": n, "features": {feature_id: count}}
+    with the features that have at least one ticket.
+    """
+    conditions, args = _route_filter(departure_city, arrival_city, departure_from, departure_until, class_type, status)
+    join, amenity_conditions, amenity_args = _amenity_filter(connection, amenities, match_all)
+    with connection.cursor() as cursor:
+        bits = facets.feature_bits(cursor)
+    sql = (
+        f"SELECT {', '.join(['COUNT(*) AS tickets'] + facets.counts_sql(bits))} FROM travel_tickets t "
+        f"{join or 'LEFT JOIN ticket_amenities a ON a.ticket_id = t.id'} "
+        f"WHERE {' AND '.join(conditions + amenity_conditions)}"
+    )
+    with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+        cursor.execute(sql, args + amenity_args)
+        row = cursor.fetchone()
+    counts = {feature_id: int(row[f"f_{feature_id}"] or 0) for feature_id in sorted(bits)}
+    return {"tickets": int(row["tickets"]), "features": {key: value for key, value in counts.items() if value}}
+
+
+def amenity_facets_join(connection, departure_city, arrival_city, departure_from=None, departure_until=None,
+                        class_type=None, status="available"):
+    """amenity_facets through the details and junction tables, one join per transport type (bench baseline)."""
+    conditions, args = _route_filter(departure_city, arrival_city, departure_from, departure_until, class_type, status)
+    where = " AND ".join(conditions)
+    parts = [
+        f"SELECT f.feature_id, COUNT(DISTINCT t.id) FROM travel_tickets t "
+        f"JOIN {details} d ON d.ticket_id = t.id JOIN {features} f ON f.{key} = d.id "
+        f"WHERE t.transport_type = '{transport_type}' AND {where} GROUP BY f.feature_id"
+        for transport_type, (details, features, key) in facets.FEATURE_TABLES.items()
+    ]
+    with connection.cursor(pymysql.cursors.Cursor) as cursor:
+        cursor.execute(f"SELECT COUNT(*) FROM travel_tickets t WHERE {where}", args)
+        tickets = cursor.fetchone()[0]
+        cursor.execute(" UNION ALL ".join(parts), args * len(parts))
+        counts = {}
+        for feature_id, count in cursor.fetchall():
+            counts[feature_id] = counts.get(feature_id, 0) + int(count)
+    return {"tickets": int(tickets), "features": dict(sorted(counts.items()))}
+
+
+def search_routes_offset(connection, departure_city, arrival_city, departure_from=None, departure_until=None,
+                         class_type=None, status="available", page=0, limit=20, details=False, index=LEGACY_INDEX):
+    """OFFSET paginated variant of search_routes, kept as the benchmark baseline."""
+    conditions, args = _route_filter(departure_city, arrival_city, departure_from, departure_until, class_type, status)
+    hint = f" FORCE INDEX ({index})" if index else ""
+    page_sql = (
+        f"SELECT t.id FROM travel_tickets t{hint} WHERE {' AND '.join(conditions)} "
+        f"ORDER BY t.departure_time, t.id LIMIT %s OFFSET %s"
+    )
+    rows = _fetch(connection, page_sql, args + [limit, page * limit], details)
+    return Page(rows, None)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Search tickets on a route.")
+    parser.add_argument("departure_city")
+    parser.add_argument("arrival_city")
+    parser.add_argument("--date", type=lambda text: datetime.strptime(text, "%Y-%m-%d"))
+    parser.add_argument("--class-type", choices=["economy", "business", "VIP"])
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--pages", type=int, default=1)
+    parser.add_argument("--details", action="store_true")
+    parser.add_argument("--ratings", action="store_true")
+    parser.add_argument("--amenity", dest="amenities", type=int, action="append", help="feature id (repeatable)")
+    parser.add_argument("--any-amenity", action="store_true", help="match any --amenity instead of all")
+    parser.add_argument("--facets", action="store_true", help="print amenity counts for the whole result set")
+    args = parser.parse_args(argv)
+
+    departure_until = args.date + timedelta(days=1) if args.date else None
+    after = None
+    with get_pool().connection() as connection:
+        for number in range(1, args.pages + 1):
+            page = search_routes(connection, args.departure_city, args.arrival_city, args.date, departure_until,
+                                 args.class_type, after=after, limit=args.limit, details=args.details,
+                                 ratings=args.ratings, amenities=args.amenities, match_all=not args.any_amenity)
+            print(f"📄 Page {number}: {len(page.rows)} tickets")
+            for row in page.rows:
+                rating = f"  ⭐ {row['rating'] or '-'} ({row['reviews']} reviews)" if args.ratings else ""
+                print(f"   #{row['id']:<10} {row['departure_time']}  {row['class_type']:<9} {row['price']:>12} "
+                      f"{row['available_seats']:>4} seats{rating}")
+            after = page.after
+            if after is None:
+                break
+        if args.facets:
+            result = amenity_facets(connection, args.departure_city, args.arrival_city, args.date, departure_until,
+                                    args.class_type, amenities=args.amenities, match_all=not args.any_amenity)
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT id, name FROM features")
+                names = dict(cursor.fetchall())
+            print(f"🧩 {result['tickets']} tickets")
+            for feature_id, count in sorted(result["features"].items(), key=lambda item: -item[1]):
+                print(f"   {names.get(feature_id, feature_id):<30} {count:>6}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,607 @@
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import time
+import zlib
+from datetime import date, datetime, timedelta
+
+from pymysql.converters import escape_item
+
+from badraghe import schema as schema_module
+from badraghe.config import SQL_FILE
+from badraghe.pool import ConnectionPool
+
+DEFAULT_ROWS = {
+    "users": 10000,
+    "roles": 50,
+    "features": 60,
+    "permissions": 200,
+    "role_permissions": 2000,
+    "user_role": 12000,
+    "service_providers": 200,
+    "travel_tickets": 50000,
+    "user_reservations": 100000,
+    "payment_methods": 10,
+    "payments": 80000,
+    "reports": 2000,
+    "notifications": 50000,
+    "refund_requests": 5000,
+    "reviews": 30000,
+    "train_details": 15000,
+    "flight_details": 20000,
+    "bus_details": 15000,
+    "discounts": 500,
+    "user_loyalty": 10000,
+    "user_discounts": 10000,
+    "ticket_discounts": 20000,
+    "user_referrals": 5000,
+    "support_categories": 20,
+    "support_tickets": 5000,
+    "support_ticket_conversations": 40000,
+    "train_features": 45000,
+    "flight_features": 60000,
+    "bus_features": 45000,
+}
+
+PRODUCTION_ROWS = dict(
+    DEFAULT_ROWS,
+    users=10000000,
+    roles=500,
+    permissions=2000,
+    role_permissions=50000,
+    user_role=12000000,
+    service_providers=2000,
+    travel_tickets=50000000,
+    user_reservations=100000000,
+    payments=80000000,
+    reports=1000000,
+    notifications=30000000,
+    refund_requests=4000000,
+    reviews=20000000,
+    train_details=15000000,
+    flight_details=20000000,
+    bus_details=15000000,
+    discounts=20000,
+    user_loyalty=10000000,
+    user_discounts=8000000,
+    ticket_discounts=20000000,
+    user_referrals=3000000,
+    support_tickets=2000000,
+    support_ticket_conversations=20000000,
+    train_features=45000000,
+    flight_features=60000000,
+    bus_features=45000000,
+)
+
+PRESETS = {"dev": DEFAULT_ROWS, "production": PRODUCTION_ROWS}
+
+CITIES = [
+    "Tehran", "Mashhad", "Isfahan", "Karaj", "Shiraz", "Tabriz", "Qom", "Ahvaz", "Kermanshah", "Urmia",
+    "Rasht", "Zahedan", "Hamadan", "Kerman", "Yazd", "Ardabil", "Bandar Abbas", "Arak", "Zanjan", "Sanandaj",
+    "Qazvin", "Khorramabad", "Gorgan", "Sari", "Bushehr", "Kish", "Birjand", "Bojnurd", "Semnan", "Ilam",
+]
+FIRST_NAMES = [
+    "Ali", "Sara", "Reza", "Maryam", "Mohammad", "Zahra", "Hossein", "Fatemeh", "Amir", "Narges",
+    "Mehdi", "Leila", "Hamed", "Niloofar", "Saeed", "Parisa", "Arash", "Shirin", "Kaveh", "Yasaman",
+]
+LAST_NAMES = [
+    "Ahmadi", "Hosseini", "Karimi", "Rezaei", "Moradi", "Mohammadi", "Jafari", "Rahimi", "Kazemi", "Sadeghi",
+    "Ebrahimi", "Ghasemi", "Mousavi", "Heidari", "Najafi", "Nazari", "Bagheri", "Shahbazi", "Azizi", "Tehrani",
+]
+WORDS = (
+    "ticket seat travel flight train bus refund payment delay service comfort station airport route "
+    "booking schedule luggage meal wifi window aisle crew support quick late early price discount "
+    "journey cabin sleeper express direct transfer transit gate platform terminal night morning"
+).split()
+
+SKIPPED_COLUMNS = {"created_at", "updated_at"}
+TIME_WINDOW_START = datetime(2022, 1, 1)
+TIME_WINDOW_SECONDS = 4 * 365 * 24 * 3600
+MASK = (1 << 64) - 1
+
+_worker = {}
+
+
+def _mix(value):
+    value = (value + 0x9E3779B97F4A7C15) & MASK
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & MASK
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & MASK
+    return value ^ (value >> 31)
+
+
+def _salt(seed, table, column):
+    return zlib.crc32(f"{seed}:{table}.{column}".encode()) << 32
+
+
+class RowGenerator:
+    """Builds rows for one table from its parsed definition.
+
+    Foreign keys are picked with a deterministic hash of the row id, so a
+    child table can recompute its parent's references (payments.user_id is
+    the user of the reservation it pays for) without sharing state between
+    worker processes. `ranges` maps each parent to the (first id, count) of
+    the contiguous ids a reference may point at.
+    """
+
+    def __init__(self, table, ranges, offsets, seed):
+        self.table = table
+        self.ranges = ranges
+        self.offsets = offsets
+        self.seed = seed
+        self.columns = [name for name in table.columns if name not in SKIPPED_COLUMNS]
+        self.positions = {name: i for i, name in enumerate(self.columns)}
+        self.generators = [self._column_generator(table.columns[name]) for name in self.columns]
+        self.fixup = FIXUPS.get(table.name)
+
+    def pick(self, table, column, row_id, ref_table):
+        first, count = self.ranges.get(ref_table, (0, 0))
+        if not count:
+            return None
+        return first + _mix(row_id ^ _salt(self.seed, table, column)) % count
+
+    def reservation_user(self, reservation_id):
+        return self.pick("user_reservations", "user_id", reservation_id, "users")
+
+    def payment_reservation(self, payment_id):
+        first, count = self.ranges.get("user_reservations", (1, 1))
+        return first + (payment_id - self.offsets.get("payments", 0) - 1) % count
+
+    def _column_generator(self, column):
+        table = self.table
+        name = column.name
+        foreign_keys = {fk.columns[0]: fk for fk in table.foreign_keys}
+
+        if table.primary_key == [name]:
+            return lambda row_id, rng: row_id
+        if name in foreign_keys:
+            return self._foreign_key_generator(foreign_keys[name])
+        return _value_generator(table.name, column, column.unique or name in table.primary_key)
+
+    def _foreign_key_generator(self, fk):
+        table = self.table
+        name = fk.columns[0]
+        ref_table = fk.ref_table
+        if fk.deferred:
+            return lambda row_id, rng: None
+        if ref_table == table.name:
+            own = self.ranges.get(table.name, (1, 0))[0]
+            return lambda row_id, rng: rng.randint(own, row_id - 1) if row_id > own and rng.random() < 0.5 else None
+        if len(table.primary_key) == 2 and name in table.primary_key:
+            first, second = table.primary_key
+            first_ref = next(fk.ref_table for fk in table.foreign_keys if fk.columns[0] == first)
+            first_start, first_count = self.ranges.get(first_ref, (1, 1))
+            if name == first:
+                return lambda row_id, rng: first_start + (row_id - 1) % first_count
+            start, count = self.ranges.get(ref_table, (1, 1))
+            return lambda row_id, rng: start + ((row_id - 1) // first_count) % count
+        salt = _salt(self.seed, table.name, name)
+        start, count = self.ranges.get(ref_table, (0, 0))
+        if not count:
+            return lambda row_id, rng: None
+        return lambda row_id, rng: start + _mix(row_id ^ salt) % count
+
+    def row(self, row_id, rng):
+        values = [generate(row_id, rng) for generate in self.generators]
+        if self.fixup:
+            self.fixup(self, values, row_id, rng)
+        return values
+
+
+def _random_time(rng):
+    return TIME_WINDOW_START + timedelta(seconds=rng.randrange(TIME_WINDOW_SECONDS))
+
+
+def _words(rng, low, high):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(low, high)))
+
+
+def _value_generator(table_name, column, unique):
+    name = column.name
+    type_name = column.type_name
+    size = column.size[0] if column.size else None
+    prefix = table_name.rstrip("s")
+
+    if "email" in name:
+        return lambda row_id, rng: f"{prefix}{row_id}@example.com"
+    if "phone" in name:
+        return lambda row_id, rng: f"+98{9000000000 + row_id}"
+    if name == "currency":
+        return lambda row_id, rng: "IRR"
+    if name.endswith("_url"):
+        return lambda row_id, rng: f"https://example.com/{table_name}/{row_id}"
+    if name == "password":
+        return lambda row_id, rng: f"{_mix(row_id):016x}"
+    if name.endswith("city"):
+        return lambda row_id, rng: rng.choice(CITIES)
+    if name == "country":
+        return lambda row_id, rng: "Iran"
+    if name == "first_name":
+        return lambda row_id, rng: rng.choice(FIRST_NAMES)
+    if name == "last_name":
+        return lambda row_id, rng: rng.choice(LAST_NAMES)
+    if name == "zip_code":
+        return lambda row_id, rng: f"{rng.randrange(10 ** 10):010d}"
+    if column.values:
+        values = column.values
+        return lambda row_id, rng: rng.choice(values)
+    if type_name == "JSON":
+        return lambda row_id, rng: "{}"
+    if type_name == "BOOLEAN":
+        return lambda row_id, rng: rng.getrandbits(1)
+    if type_name in ("INT", "BIGINT", "SMALLINT", "TINYINT"):
+        low, high = column.value_range or (0, 100)
+        return lambda row_id, rng: rng.randint(low, high)
+    if type_name == "DECIMAL":
+        if column.size and len(column.size) == 2:
+            return lambda row_id, rng: round(rng.uniform(1, 90), column.size[1])
+        return lambda row_id, rng: rng.randint(1, 500) * 10000
+    if type_name == "DATE":
+        return lambda row_id, rng: date(1950, 1, 1) + timedelta(days=rng.randrange(20000))
+    if type_name in ("TIMESTAMP", "DATETIME"):
+        return lambda row_id, rng: _random_time(rng)
+    if unique:
+        return lambda row_id, rng: f"{rng.choice(WORDS)} {row_id}"[-size:] if size else f"{name}-{row_id}"
+    if type_name == "VARCHAR":
+        return lambda row_id, rng: _words(rng, 1, 4)[:size]
+    return lambda row_id, rng: _words(rng, 8, 30)
+
+
+def _fix_travel_ticket(generator, values, row_id, rng):
+    pos = generator.positions
+    departure = values[pos["departure_time"]]
+    values[pos["arrival_time"]] = departure + timedelta(minutes=rng.randint(45, 1200))
+    if values[pos["arrival_city"]] == values[pos["departure_city"]]:
+        values[pos["arrival_city"]] = CITIES[(CITIES.index(values[pos["departure_city"]]) + 1) % len(CITIES)]
+    total = rng.randint(20, 400)
+    available = rng.randint(0, total)
+    values[pos["total_seats"]] = total
+    values[pos["available_seats"]] = available
+    if available == 0:
+        values[pos["status"]] = "sold_out"
+    elif values[pos["status"]] == "sold_out" or rng.random() < 0.9:
+        values[pos["status"]] = "available"
+
+
+def _fix_payment(generator, values, row_id, rng):
+    pos = generator.positions
+    reservation_id = generator.payment_reservation(row_id)
+    values[pos["reservation_id"]] = reservation_id
+    values[pos["user_id"]] = generator.reservation_user(reservation_id)
+    values[pos["transaction_id"]] = f"TX{row_id:012d}"
+    values[pos["refund_amount"]] = 0 if rng.random() < 0.9 else values[pos["amount"]] // 2
+    values[pos["payment_details"]] = None
+
+
+def _fix_refund_request(generator, values, row_id, rng):
+    pos = generator.positions
+    reservation_id = generator.payment_reservation(values[pos["payment_id"]])
+    values[pos["user_id"]] = generator.reservation_user(reservation_id)
+
+
+def _fix_user_discount(generator, values, row_id, rng):
+    pos = generator.positions
+    reservation_id = generator.payment_reservation(values[pos["payment_id"]])
+    values[pos["user_id"]] = generator.reservation_user(reservation_id)
+
+
+def _fix_discount(generator, values, row_id, rng):
+    pos = generator.positions
+    values[pos["valid_until"]] = values[pos["valid_from"]] + timedelta(days=rng.randint(1, 90))
+    if values[pos["discount_type"]] == "fixed":
+        values[pos["discount_value"]] = rng.randint(1, 50) * 1000
+
+
+def _fix_user_role(generator, values, row_id, rng):
+    pos = generator.positions
+    if rng.random() < 0.8:
+        values[pos["expired_at"]] = None
+    else:
+        values[pos["expired_at"]] = values[pos["assigned_at"]] + timedelta(days=rng.randint(1, 365))
+
+
+def _fix_notification(generator, values, row_id, rng):
+    pos = generator.positions
+    values[pos["attempts"]] = 0
+    values[pos["next_attempt_at"]] = None
+    values[pos["last_error"]] = None
+    if values[pos["status"]] != "sent":
+        values[pos["sent_at"]] = None
+
+
+def _fix_user_loyalty(generator, values, row_id, rng):
+    first, users = generator.ranges.get("users", (1, 1))
+    values[generator.positions["user_id"]] = first + (row_id - generator.offsets.get("user_loyalty", 0) - 1) % users
+
+
+def _rare_word(rng):
+    """A word from a heavy-tailed vocabulary, so text search sees both common and rare terms."""
+    return f"{rng.choice(WORDS)}{min(int(rng.paretovariate(1.0)), 99999)}"
+
+
+def _fix_support_ticket(generator, values, row_id, rng):
+    pos = generator.positions
+    values[pos["subject"]] = f"{values[pos['subject']]} {rng.choice(CITIES)} {_rare_word(rng)}"[:255]
+    values[pos["description"]] = f"{values[pos['description']]} {rng.choice(CITIES)} {_rare_word(rng)}"
+
+
+def _fix_support_conversation(generator, values, row_id, rng):
+    pos = generator.positions
+    values[pos["message"]] = f"{values[pos['message']]} {_rare_word(rng)}"
+
+
+def _fix_user_referral(generator, values, row_id, rng):
+    pos = generator.positions
+    first, users = generator.ranges.get("users", (1, 1))
+    referred = first + (row_id - 1) % users
+    values[pos["referred_id"]] = referred
+    values[pos["referrer_id"]] = rng.randint(first, referred - 1) if referred > first else first + min(1, users - 1)
+
+
+FIXUPS = {
+    "travel_tickets": _fix_travel_ticket,
+    "payments": _fix_payment,
+    "refund_requests": _fix_refund_request,
+    "user_discounts": _fix_user_discount,
+    "discounts": _fix_discount,
+    "user_role": _fix_user_role,
+    "notifications": _fix_notification,
+    "user_loyalty": _fix_user_loyalty,
+    "user_referrals": _fix_user_referral,
+    "support_tickets": _fix_support_ticket,
+    "support_ticket_conversations": _fix_support_conversation,
+}
+
+
+def _tsv_value(value):
+    if value is None:
+        return "\\N"
+    if isinstance(value, str):
+        return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+    return str(value)
+
+
+def _init_worker(sql_file, ranges, offsets, seed, method, batch_rows, spool_dir):
+    schema = schema_module.load(sql_file)
+    _worker.update(
+        schema=schema,
+        ranges=ranges,
+        offsets=offsets,
+        seed=seed,
+        method=method,
+        batch_rows=batch_rows,
+        spool_dir=spool_dir,
+        generators={},
+    )
+
+
+def _generate_chunk(task):
+    table_name, first_row, count = task
+    generators = _worker["generators"]
+    if table_name not in generators:
+        generators[table_name] = RowGenerator(
+            _worker["schema"].tables[table_name], _worker["ranges"], _worker["offsets"], _worker["seed"]
+        )
+    generator = generators[table_name]
+    rng = random.Random(_mix(first_row ^ _salt(_worker["seed"], table_name, "")))
+    rows = [generator.row(row_id, rng) for row_id in range(first_row, first_row + count)]
+
+    if _worker["method"] == "infile":
+        path = os.path.join(_worker["spool_dir"], f"{table_name}-{first_row}.tsv")
+        with open(path, "w") as f:
+            f.writelines("\t".join(_tsv_value(value) for value in row) + "\n" for row in rows)
+        return table_name, count, [path]
+
+    ignore = "IGNORE " if len(generator.table.primary_key) > 1 else ""
+    head = f"INSERT {ignore}INTO {table_name} ({', '.join(generator.columns)}) VALUES "
+    batch_rows = _worker["batch_rows"]
+    statements = []
+    for start in range(0, len(rows), batch_rows):
+        values = ",".join(
+            "(" + ",".join(escape_item(value, "utf8mb4") for value in row) + ")"
+            for row in rows[start:start + batch_rows]
+        )
+        statements.append(head + values)
+    return table_name, count, statements
+
+
+def _load_chunk(cursor, table, columns, payload, method):
+    """Load one generated chunk and return the number of rows the server actually inserted."""
+    loaded = 0
+    if method == "infile":
+        ignore = "IGNORE " if len(table.primary_key) > 1 else ""
+        for path in payload:
+            loaded += cursor.execute(
+                f"LOAD DATA LOCAL INFILE %s {ignore}INTO TABLE {table.name} "
+                f"FIELDS TERMINATED BY '\\t' LINES TERMINATED BY '\\n' ({', '.join(columns)})",
+                (path,),
+            )
+            os.remove(path)
+    else:
+        for statement in payload:
+            loaded += cursor.execute(statement)
+    return loaded
+
+
+def plan_rows(schema, rows, scale=1.0):
+    planned = {}
+    for name in schema.dependency_order():
+        count = int(rows.get(name, 0) * scale)
+        table = schema.tables[name]
+        refs = [fk.ref_table for fk in table.foreign_keys if fk.columns[0] in table.primary_key]
+        if len(table.primary_key) == 2 and len(refs) == 2 and len(refs) == len(table.foreign_keys):
+            count = min(count, planned.get(refs[0], 0) * planned.get(refs[1], 0))
+        if name == "user_loyalty":
+            # One row per user (idx_user_loyalty_user_id), and only for the users seeded alongside it.
+            count = min(count, planned.get("users", 0))
+        planned[name] = count
+    return planned
+
+
+def id_ranges(cursor, schema, planned):
+    """The existing MAX(id) (or row count) of every table, and the ids seeded references may point at.
+
+    A parent being seeded is referenced through its new ids only. One that
+    is not being seeded is referenced through its existing ids, which must
+    then be contiguous: a gap would turn a picked id into an orphan.
+    """
+    offsets, ranges = {}, {}
+    for name, table in schema.tables.items():
+        if table.primary_key != ["id"]:
+            cursor.execute(f"SELECT COUNT(*) FROM {name}")
+            offsets[name] = cursor.fetchone()[0]
+            continue
+        cursor.execute(f"SELECT COALESCE(MIN(id), 0), COALESCE(MAX(id), 0), COUNT(*) FROM {name}")
+        low, high, existing = cursor.fetchone()
+        offsets[name] = high
+        if planned.get(name):
+            ranges[name] = (high + 1, planned[name])
+        elif existing and high - low + 1 == existing:
+            ranges[name] = (low, existing)
+
+    for name, count in planned.items():
+        if not count:
+            continue
+        for fk in schema.tables[name].foreign_keys:
+            if fk.ref_table not in ranges and offsets.get(fk.ref_table):
+                raise ValueError(
+                    f"{fk.ref_table} has gaps in its ids and is not being seeded, so {name}.{fk.columns[0]} "
+                    f"cannot reference it; seed {fk.ref_table} in the same run"
+                )
+    return offsets, ranges
+
+
+def find_orphans(cursor, schema, offsets, planned):
+    """Every foreign key of a seeded table that points at a missing parent, as (table, column, ref_table, rows).
+
+    Only the rows added by this run are checked when the table has an id.
+    """
+    orphans = []
+    for name, count in planned.items():
+        table = schema.tables[name]
+        if not count:
+            continue
+        seeded = "AND c.id > %s" if table.primary_key == ["id"] else ""
+        for fk in table.foreign_keys:
+            column, ref_column = fk.columns[0], fk.ref_columns[0]
+            cursor.execute(
+                f"SELECT COUNT(*) FROM {name} c LEFT JOIN {fk.ref_table} p ON p.{ref_column} = c.{column} "
+                f"WHERE c.{column} IS NOT NULL AND p.{ref_column} IS NULL {seeded}",
+                (offsets[name],) if seeded else None,
+            )
+            missing = cursor.fetchone()[0]
+            if missing:
+                orphans.append((name, column, fk.ref_table, missing))
+    return orphans
+
+
+def link_reservation_payments(cursor, first_payment_id, last_payment_id, chunk_rows=50000):
+    for start in range(first_payment_id, last_payment_id + 1, chunk_rows):
+        cursor.execute(
+            """
+            UPDATE user_reservations r JOIN payments p ON p.reservation_id = r.id
+            SET r.payment_id = p.id
+            WHERE p.id BETWEEN %s AND %s AND p.status = 'successful'
+            """,
+            (start, start + chunk_rows - 1),
+        )
+        cursor.connection.commit()
+
+
+def seed(rows=None, scale=1.0, processes=None, method="insert", chunk_rows=20000, batch_rows=2000,
+         random_seed=0, sql_file=SQL_FILE, pool=None):
+    schema = schema_module.load(sql_file)
+    planned = plan_rows(schema, rows or DEFAULT_ROWS, scale)
+    stats = {}
+
+    owned_pool = pool is None
+    if owned_pool:
+        pool = ConnectionPool(size=1, autocommit=False, local_infile=method == "infile")
+    spool_dir = tempfile.mkdtemp(prefix="badraghe-seed-")
+    try:
+        with pool.connection(autocommit=False) as connection, connection.cursor() as cursor:
+            offsets, ranges = id_ranges(cursor, schema, planned)
+            totals = {name: offsets[name] + planned[name] for name in planned}
+
+            print(f"🌱 Seeding {sum(planned.values()):,} rows into {len(planned)} tables...")
+            cursor.execute("SET SESSION foreign_key_checks = 0, unique_checks = 0")
+            try:
+                initargs = (sql_file, ranges, offsets, random_seed, method, batch_rows, spool_dir)
+                with multiprocessing.Pool(processes, initializer=_init_worker, initargs=initargs) as workers:
+                    for name in schema.dependency_order():
+                        count = planned[name]
+                        if not count:
+                            continue
+                        table = schema.tables[name]
+                        columns = [column for column in table.columns if column not in SKIPPED_COLUMNS]
+                        tasks = [
+                            (name, offsets[name] + start + 1, min(chunk_rows, count - start))
+                            for start in range(0, count, chunk_rows)
+                        ]
+
+                        started = time.perf_counter()
+                        loaded = 0
+                        for _, _, payload in workers.imap_unordered(_generate_chunk, tasks):
+                            loaded += _load_chunk(cursor, table, columns, payload, method)
+                            connection.commit()
+                        elapsed = time.perf_counter() - started
+
+                        stats[name] = {
+                            "rows": loaded, "planned": count, "seconds": elapsed, "rows_per_sec": loaded / elapsed,
+                        }
+                        print(f"✅ {name}: {loaded:,} of {count:,} rows in {elapsed:.1f}s "
+                              f"({loaded / elapsed:,.0f} rows/s)")
+
+                if planned.get("payments"):
+                    started = time.perf_counter()
+                    link_reservation_payments(cursor, offsets["payments"] + 1, totals["payments"])
+                    print(f"🔗 Linked user_reservations.payment_id in {time.perf_counter() - started:.1f}s")
+
+                orphans = find_orphans(cursor, schema, offsets, planned)
+                if orphans:
+                    raise RuntimeError("Seeded rows reference missing parents: " + ", ".join(
+                        f"{name}.{column} -> {ref_table} ({rows:,} rows)" for name, column, ref_table, rows in orphans
+                    ))
+            finally:
+                connection.rollback()
+                cursor.execute("SET SESSION foreign_key_checks = 1, unique_checks = 1")
+    finally:
+        if owned_pool:
+            pool.close()
+        shutil.rmtree(spool_dir, ignore_errors=True)
+    return stats
+
+
+def _parse_rows(values):
+    rows = {}
+    for value in values:
+        name, _, count = value.partition("=")
+        rows[name] = int(count)
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate bulk seed data for every table in the migration.")
+    parser.add_argument("--preset", choices=sorted(PRESETS), default="dev")
+    parser.add_argument("--rows", action="append", default=[], metavar="TABLE=N", help="override a table's row count")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply every row count")
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--method", choices=["insert", "infile"], default="insert")
+    parser.add_argument("--chunk-rows", type=int, default=20000)
+    parser.add_argument("--batch-rows", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--report", help="write per-table rows/sec to this JSON file")
+    args = parser.parse_args(argv)
+
+    rows = dict(PRESETS[args.preset], **_parse_rows(args.rows))
+    stats = seed(rows, args.scale, args.processes, args.method, args.chunk_rows, args.batch_rows, args.seed)
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(stats, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+import argparse
+import glob
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+from badraghe import config, migrate, seed
+from badraghe.config import SQL_FILE
+
+SNAPSHOT_DIR = os.environ.get("BADRAGHE_SNAPSHOT_DIR", os.path.join(config.ROOT_DIR, ".snapshots"))
+CHUNK_BYTES = 1 << 20
+DUMP_OPTIONS = ["--single-transaction", "--routines", "--triggers", "--events", "--no-tablespaces",
+                "--set-gtid-purged=OFF", "--skip-comments"]
+
+
+def snapshot_key(path=SQL_FILE, seed_config=None):
+    """Hash of the migration file and the seed configuration the snapshot was built with."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        digest.update(f.read())
+    digest.update(json.dumps(seed_config, sort_keys=True).encode())
+    return digest.hexdigest()[:16]
+
+
+def snapshot_path(key):
+    return os.path.join(SNAPSHOT_DIR, f"{key}.sql.gz")
+
+
+def _docker(tool, *args, stdin=None, stdout=None):
+    command = ["docker", "exec", "-i", "-e", f"MYSQL_PWD={config.DB_ROOT_PASSWORD}", config.DB_CONTAINER,
+               tool, "-uroot", *args]
+    return subprocess.Popen(command, stdin=stdin, stdout=stdout)
+
+
+def _wait(process, what):
+    if process.wait() != 0:
+        raise RuntimeError(f"{what} failed with exit code {process.returncode}")
+
+
+def reset():
+    """Drop and recreate the application database (as root, inside the container)."""
+    process = _docker("mysql", "-e", f"DROP DATABASE IF EXISTS {config.DB_NAME}; CREATE DATABASE {config.DB_NAME}",
+                      stdin=subprocess.DEVNULL)
+    _wait(process, "reset")
+
+
+def dump(path):
+    """Write a gzipped logical dump of the application database to `path`."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial = f"{path}.partial"
+    process = _docker("mysqldump", *DUMP_OPTIONS, config.DB_NAME, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+    with gzip.open(partial, "wb", compresslevel=1) as f:
+        shutil.copyfileobj(process.stdout, f, CHUNK_BYTES)
+    _wait(process, "mysqldump")
+    os.replace(partial, path)
+
+
+def restore(path):
+    """Replace the application database with the dump at `path`."""
+    reset()
+    process = _docker("mysql", config.DB_NAME, stdin=subprocess.PIPE)
+    with gzip.open(path, "rb") as f:
+        shutil.copyfileobj(f, process.stdin, CHUNK_BYTES)
+    process.stdin.close()
+    _wait(process, "restore")
+
+
+def build(path=SQL_FILE, seed_config=None, pool=None):
+    """Migrate (and seed) an empty database from scratch and return the migration runner."""
+    reset()
+
+    def before_indexes():
+        if seed_config:
+            seed.seed(sql_file=path, **seed_config)
+
+    return migrate.migrate(path, defer_indexes=bool(seed_config), before_indexes=before_indexes, pool=pool)
+
+
+def ensure(path=SQL_FILE, seed_config=None, pool=None):
+    """Bring the database to the state of `path` plus `seed_config` as cheaply as possible.
+
+    A cached dump for the same migration and seed configuration is restored
+    in place of running the DDL and seeding. Otherwise the database is built
+    from scratch and dumped for next time. Returns (key, runner); the
+    runner is None when the snapshot was restored.
+    """
+    key = snapshot_key(path, seed_config)
+    cached = snapshot_path(key)
+    if os.path.exists(cached):
+        restore(cached)
+        return key, None
+    runner = build(path, seed_config, pool)
+    dump(cached)
+    return key, runner
+
+
+def snapshots():
+    return sorted(glob.glob(os.path.join(SNAPSHOT_DIR, "*.sql.gz")), key=os.path.getmtime, reverse=True)
+
+
+def prune(keep=3):
+    """Delete all but the `keep` most recently built snapshots and return the removed paths."""
+    removed = snapshots()[keep:]
+    for path in removed:
+        os.remove(path)
+    return removed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Restore or build the cached schema-and-seed snapshot.")
+    parser.add_argument("command", choices=["ensure", "build", "list", "prune"])
+    parser.add_argument("--path", default=SQL_FILE)
+    parser.add_argument("--preset", choices=sorted(seed.PRESETS), help="seed this preset into the snapshot")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep", type=int, default=3, help="snapshots to keep when pruning")
+    args = parser.parse_args(argv)
+
+    seed_config = {"rows": seed.PRESETS[args.preset], "random_seed": args.seed} if args.preset else None
+    if args.command == "list":
+        for path in snapshots():
+            print(f"📦 {os.path.basename(path):<28}{os.path.getsize(path) / 1e6:>10.1f} MB  "
+                  f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(os.path.getmtime(path)))}")
+        return 0
+    if args.command == "prune":
+        for path in prune(args.keep):
+            print(f"🧹 Removed {path}")
+        return 0
+
+    if args.command == "build":
+        key = snapshot_key(args.path, seed_config)
+        started = time.perf_counter()
+        build(args.path, seed_config)
+        dump(snapshot_path(key))
+        print(f"✅ Snapshot {key} built in {time.perf_counter() - started:.1f}s.")
+        return 0
+
+    started = time.perf_counter()
+    key, runner = ensure(args.path, seed_config)
+    action = "built" if runner else "restored"
+    print(f"✅ Snapshot {key} {action} in {time.perf_counter() - started:.1f}s.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
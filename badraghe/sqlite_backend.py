@@ -0,0 +1,769 @@
+import argparse
+import random
+import re
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from datetime import date, datetime
+from decimal import Decimal
+
+import pymysql
+from pymysql.constants import SERVER_STATUS
+from pymysql.converters import escape_item
+
+from badraghe import config, schema as schema_module
+from badraghe.config import SQL_FILE
+from badraghe.statements import iter_statements
+
+BUSY_TIMEOUT_MS = 10000
+LOCAL_NOW = "datetime('now', 'localtime')"
+INTEGER_TYPES = {"BIGINT", "INT", "INTEGER", "SMALLINT", "TINYINT", "MEDIUMINT"}
+
+LITERAL_RE = re.compile(r"'(?:[^'\\]|\\.|'')*'")
+MYSQL_ESCAPES = {"0": "\0", "b": "\b", "n": "\n", "r": "\r", "t": "\t", "Z": "\x1a"}
+TEMP_SELECT_RE = re.compile(
+    r"^\s*CREATE\s+TEMPORARY\s+TABLE\s+(?:IF NOT EXISTS\s+)?`?(\w+)`?\s*\((.*?)\)\s*"
+    r"SELECT\s+(.*?)\s+FROM\s+`?(\w+)`?\s+LIMIT\s+0\s*$",
+    re.S | re.I,
+)
+ALTER_RE = re.compile(r"^\s*ALTER\s+TABLE\s+`?(\w+)`?\s+(.*)$", re.S | re.I)
+CREATE_LIKE_RE = re.compile(r"^\s*CREATE\s+TABLE\s+(IF NOT EXISTS\s+)?`?(\w+)`?\s+LIKE\s+`?(\w+)`?\s*$", re.I)
+UPDATE_JOIN_RE = re.compile(
+    r"^\s*UPDATE\s+(\w+)\s+(?:AS\s+)?(\w+)\s+(?:INNER\s+)?JOIN\s+(\w+)\s+(?:AS\s+)?(\w+)\s+ON\s+(.*?)\s+"
+    r"SET\s+(.*?)(?:\s+WHERE\s+(.*))?$",
+    re.S | re.I,
+)
+INTERVAL_UNITS = {"MICROSECOND": 1e-6, "SECOND": 1, "MINUTE": 60, "HOUR": 3600, "DAY": 86400}
+
+# Applied in order to statement text with its string literals masked out.
+QUERY_RULES = [
+    (re.compile(r"\bFOR\s+(?:UPDATE|SHARE)(?:\s+(?:SKIP\s+LOCKED|NOWAIT))?|\bLOCK\s+IN\s+SHARE\s+MODE", re.I), ""),
+    (re.compile(r"\b(?:FORCE|USE|IGNORE)\s+INDEX\s*\([^)]*\)", re.I), ""),
+    (re.compile(r"\bSTRAIGHT_JOIN\b", re.I), "JOIN"),
+    (re.compile(r"\bINSERT\s+IGNORE\b", re.I), "INSERT OR IGNORE"),
+    (re.compile(r"\bON\s+DUPLICATE\s+KEY\s+UPDATE\b", re.I), "ON CONFLICT DO UPDATE SET"),
+    (re.compile(r"(ON CONFLICT DO UPDATE SET\b)(.*)$", re.S),
+     lambda m: m.group(1) + re.sub(r"\bVALUES\s*\(\s*`?(\w+)`?\s*\)", r"excluded.\1", m.group(2), flags=re.I)),
+    (re.compile(r"<=>"), " IS "),
+    (re.compile(r"\bDIV\b", re.I), "/"),
+    (re.compile(r"\bAS\s+CHAR\b(?:\s*\(\d+\))?", re.I), "AS TEXT"),
+    (re.compile(r"\bAS\s+(?:UNSIGNED|SIGNED)(?:\s+INTEGER)?\b", re.I), "AS INTEGER"),
+    (re.compile(r"\bIF\s*\(", re.I), "iif("),
+    (re.compile(r"\bTIMESTAMPDIFF\s*\(\s*(\w+)\s*,", re.I), r"TIMESTAMPDIFF('\1',"),
+    (re.compile(r"\bLAST_INSERT_ID\s*\(\s*\)", re.I), "last_insert_rowid()"),
+    (re.compile(r"\bCURRENT_TIMESTAMP\b(?:\s*\(\s*\))?", re.I), "NOW()"),
+    (re.compile(r"\bDROP\s+TEMPORARY\s+TABLE\b", re.I), "DROP TABLE"),
+]
+INTERVAL_RE = re.compile(
+    r"(\b\w+\s*\(\s*\)|[\w.]+)\s*([+-])\s*INTERVAL\s+(\?|:\w+|-?\d+(?:\.\d+)?)\s+(MICROSECOND|SECOND|MINUTE|HOUR|DAY)\b",
+    re.I,
+)
+
+
+class BitXor:
+    def __init__(self):
+        self.value = 0
+
+    def step(self, value):
+        if value is not None:
+            self.value ^= int(value)
+
+    def finalize(self):
+        return self.value
+
+
+def _now():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _regexp(pattern, value):
+    if pattern is None or value is None:
+        return None
+    return re.search(pattern, str(value), re.I) is not None
+
+
+def _concat_ws(separator, *values):
+    return separator.join(str(value) for value in values if value is not None)
+
+
+def _crc32(value):
+    return None if value is None else zlib.crc32(str(value).encode())
+
+
+def _parse_time(value):
+    return datetime.fromisoformat(str(value).replace("T", " ")) if value is not None else None
+
+
+def _timestampdiff(unit, start, end):
+    if start is None or end is None:
+        return None
+    seconds = (_parse_time(end) - _parse_time(start)).total_seconds()
+    return int(seconds / INTERVAL_UNITS[unit.upper()])
+
+
+def _greatest(*values):
+    return None if any(value is None for value in values) else max(values)
+
+
+def _least(*values):
+    return None if any(value is None for value in values) else min(values)
+
+
+def _convert_time(raw):
+    text = raw.decode()
+    try:
+        return datetime.fromisoformat(text.replace("T", " "))
+    except ValueError:
+        return text
+
+
+def _convert_date(raw):
+    text = raw.decode()
+    try:
+        return date.fromisoformat(text[:10])
+    except ValueError:
+        return text
+
+
+for _name in ("TIMESTAMP", "DATETIME"):
+    sqlite3.register_converter(_name, _convert_time)
+sqlite3.register_converter("DATE", _convert_date)
+sqlite3.register_converter("DECIMAL", lambda raw: Decimal(raw.decode()))
+
+
+def _sqlite_literal(literal, formatted=False):
+    """Re-quote a MySQL string literal (backslash escapes) for SQLite (doubled quotes only)."""
+    body = literal[1:-1]
+    if formatted:
+        body = body.replace("%%", "%")
+    text = re.sub(r"\\(.)", lambda m: MYSQL_ESCAPES.get(m.group(1), m.group(1))
+                  if m.group(1) not in "%_" else m.group(0), body, flags=re.S)
+    return "'" + text.replace("''", "'").replace("'", "''") + "'"
+
+
+def _mask(sql, formatted=False):
+    literals = []
+
+    def keep(match):
+        literals.append(_sqlite_literal(match.group(), formatted))
+        return f"\0{len(literals) - 1}\0"
+
+    return LITERAL_RE.sub(keep, sql), literals
+
+
+def _unmask(sql, literals):
+    return re.sub(r"\0(\d+)\0", lambda m: literals[int(m.group(1))], sql)
+
+
+def _interval(match):
+    value, sign, amount, unit = match.groups()
+    seconds = INTERVAL_UNITS[unit.upper()]
+    return f"datetime({value}, printf('%+f seconds', {sign}({amount}) * {seconds}))"
+
+
+def _split_top_level(text):
+    return schema_module.split_items(text)
+
+
+UPDATE_SET_RE = re.compile(r"^(\s*UPDATE\s+.*?\s+SET\s+)(.*?)(\s+(?:WHERE|ORDER\s+BY|LIMIT)\b.*)?$", re.S | re.I)
+
+
+def _sequential_set(text):
+    """MySQL evaluates a single-table UPDATE's assignments left to right, so a later
+    expression sees the new value of an earlier column; SQLite sees the old row.
+    Earlier expressions are inlined (unless they hold a positional placeholder)."""
+    match = UPDATE_SET_RE.match(text)
+    if not match or match.group(2).count("(") != match.group(2).count(")") or \
+            re.search(r"\bJOIN\b", match.group(1), re.I):
+        return text
+    head, assignments, tail = match.groups()
+    assigned, items = {}, []
+    for item in schema_module.split_items(assignments):
+        column, _, expression = item.partition("=")
+        for name, value in assigned.items():
+            expression = re.sub(rf"(?<![\w.]){name}\b", f"({value})", expression)
+        name = column.strip().split(".")[-1].strip("`")
+        if "?" in expression:
+            assigned.pop(name, None)
+        else:
+            assigned[name] = expression.strip()
+        items.append(f"{column.strip()} = {expression.strip()}")
+    return head + ", ".join(items) + (tail or "")
+
+
+def _update_join(match):
+    table, alias, joined, joined_alias, condition, assignments, where = match.groups()
+    assignments = ", ".join(re.sub(rf"^{alias}\.", "", item) for item in _split_top_level(assignments))
+    where = f"({condition}) AND ({where})" if where else condition
+    return f"UPDATE {table} AS {alias} SET {assignments} FROM {joined} AS {joined_alias} WHERE {where}"
+
+
+_translations = {}
+
+
+def translate_query(sql, formatted=True):
+    """Rewrite one MySQL DML statement for SQLite.
+
+    `formatted` means the statement takes parameters: %s and %(name)s become
+    ? and :name, and %% becomes %, exactly as pymysql would format it.
+    """
+    key = (sql, formatted)
+    cached = _translations.get(key)
+    if cached is not None:
+        return cached
+    text, literals = _mask(sql, formatted)
+    if formatted:
+        text = re.sub(r"%\((\w+)\)s", r":\1", text).replace("%s", "?").replace("%%", "%")
+    for pattern, replacement in QUERY_RULES:
+        text = pattern.sub(replacement, text)
+    text = INTERVAL_RE.sub(_interval, text)
+    text = _sequential_set(text)
+    update_join = UPDATE_JOIN_RE.match(text)
+    if update_join:
+        text = _update_join(update_join)
+    if re.search(r"\bINSERT\b.*\bSELECT\b.*\bON CONFLICT\b", text, re.S | re.I) and \
+            not re.search(r"\bWHERE\b[^()]*\bON CONFLICT\b", text, re.S | re.I):
+        text = re.sub(r"\s+ON CONFLICT\b", " WHERE true ON CONFLICT", text, count=1, flags=re.I)
+    cached = _unmask(text, literals)
+    if len(sql) < 4096 and len(_translations) < 10000:
+        _translations[key] = cached
+    return cached
+
+
+def translate_column(table, item):
+    """Translate one column definition; returns (sql, triggers-needed-for-ON-UPDATE)."""
+    column = schema_module.parse_column(item)
+    name, type_name, args, rest = schema_module.COLUMN_RE.match(item).groups()
+    type_name = type_name.upper()
+    rest, literals = _mask(rest)
+    checks = []
+
+    if type_name == "ENUM":
+        sql_type = "TEXT"
+        checks.append(f"{name} IN ({args})")
+    elif type_name == "JSON":
+        sql_type = "TEXT"
+        checks.append(f"{name} IS NULL OR json_valid({name})")
+    elif column.primary_key and type_name in INTEGER_TYPES:
+        sql_type = "INTEGER"
+    else:
+        sql_type = type_name + (f"({args})" if args else "")
+        if type_name in ("VARCHAR", "CHAR") and column.size:
+            checks.append(f"length({name}) <= {column.size[0]}")
+    if column.unsigned:
+        checks.append(f"{name} >= 0")
+
+    rest = re.sub(r"\bUNSIGNED\b|\bZEROFILL\b", "", rest, flags=re.I)
+    rest = re.sub(r"\bON UPDATE\s+[\w.]+(?:\(\))?", "", rest, flags=re.I)
+    rest = re.sub(r"\bDEFAULT\s+(?:CURRENT_TIMESTAMP|NOW)\b(?:\s*\(\s*\))?", f"DEFAULT ({LOCAL_NOW})", rest, flags=re.I)
+    rest = re.sub(r"\bCOMMENT\s+\0\d+\0", "", rest, flags=re.I)
+    if column.auto_increment:
+        rest = re.sub(r"\bAUTO_INCREMENT\b", "", rest, flags=re.I)
+        rest = re.sub(r"\bPRIMARY KEY\b", "PRIMARY KEY AUTOINCREMENT", rest, flags=re.I)
+    rest = " ".join(rest.split())
+    sql = " ".join(part for part in [name, sql_type, rest] + [f"CHECK ({check})" for check in checks] if part)
+    return _unmask(sql, literals), column
+
+
+def _on_update_trigger(table, column, columns):
+    others = " OR ".join(f"NEW.{name} IS NOT OLD.{name}" for name in columns if name != column)
+    return (
+        f"CREATE TRIGGER IF NOT EXISTS {table}_{column}_on_update AFTER UPDATE ON {table} FOR EACH ROW "
+        f"WHEN NEW.{column} IS OLD.{column} AND ({others or '1'}) "
+        f"BEGIN UPDATE {table} SET {column} = {LOCAL_NOW} WHERE rowid = NEW.rowid; END"
+    )
+
+
+def translate_table(sql, extra_columns=(), extra_constraints=()):
+    """Translate a MySQL CREATE TABLE into SQLite statements (table, indexes and triggers)."""
+    match = re.match(r"\s*CREATE\s+(TEMPORARY\s+)?TABLE\s+(IF NOT EXISTS\s+)?`?(\w+)`?\s*\((.*)\)[^)]*$",
+                     sql, re.S | re.I)
+    temporary, if_not_exists, table, body = match.groups()
+    columns, constraints, statements, on_update = [], [], [], []
+    names = []
+    for item in schema_module.split_items(body):
+        upper = item.upper()
+        if upper.startswith(("PRIMARY KEY", "FOREIGN KEY", "CONSTRAINT", "CHECK")):
+            constraints.append(item)
+        elif upper.startswith("UNIQUE"):
+            constraints.append(re.sub(r"^UNIQUE\s+(?:KEY|INDEX)?\s*`?\w*`?\s*\(", "UNIQUE (", item, flags=re.I))
+        elif upper.startswith(("INDEX", "KEY")):
+            index = re.match(r"(?:INDEX|KEY)\s+`?(\w+)`?\s*\(([^)]*)\)", item, re.I)
+            statements.append(f"CREATE INDEX IF NOT EXISTS {index.group(1)} ON {table}({index.group(2)})")
+        elif upper.startswith("FULLTEXT"):
+            continue
+        else:
+            translated, column = translate_column(table, item)
+            columns.append(translated)
+            names.append(column.name)
+            if column.on_update:
+                on_update.append(column.name)
+    for item in extra_columns:
+        translated, column = translate_column(table, item)
+        columns.append(translated)
+        names.append(column.name)
+    constraints.extend(extra_constraints)
+
+    items = columns + [_mask_and_convert(item) for item in constraints]
+    create = (f"CREATE {'TEMP ' if temporary else ''}TABLE {'IF NOT EXISTS ' if if_not_exists else ''}{table} "
+              f"(\n    " + ",\n    ".join(items) + "\n)")
+    return [create] + statements + [_on_update_trigger(table, column, names) for column in on_update]
+
+
+def _mask_and_convert(text):
+    masked, literals = _mask(text)
+    return _unmask(masked, literals)
+
+
+def translate_index(sql):
+    """CREATE [UNIQUE] INDEX passes through; FULLTEXT indexes have no SQLite equivalent and are dropped."""
+    if re.match(r"\s*CREATE\s+FULLTEXT\b", sql, re.I):
+        return []
+    index = schema_module.parse_create_index(sql)
+    return [f"CREATE {'UNIQUE ' if index.unique else ''}INDEX IF NOT EXISTS {index.name} "
+            f"ON {index.table}({', '.join(index.columns)})"]
+
+
+def translate_migration(path=SQL_FILE):
+    """The SQLite statements equivalent to the migration at `path`.
+
+    SQLite cannot add a foreign key to an existing table, so every
+    ALTER TABLE ... ADD COLUMN / ADD FOREIGN KEY is folded into the CREATE
+    TABLE of its table. SQLite does not need referenced tables to exist yet,
+    so the cycle the ALTERs break in MySQL is harmless here.
+    """
+    with open(path, "r") as f:
+        statements = list(iter_statements(f))
+
+    extra_columns, extra_constraints = {}, {}
+    for statement in statements:
+        if statement.kind != "alter_table":
+            continue
+        match = re.match(r"ALTER TABLE\s+`?(\w+)`?\s+(.*)$", statement.sql, re.S | re.I)
+        for action in schema_module.split_items(match.group(2)):
+            upper = action.upper()
+            if upper.startswith("ADD COLUMN"):
+                extra_columns.setdefault(match.group(1), []).append(action[len("ADD COLUMN"):].strip())
+            elif upper.startswith(("ADD FOREIGN KEY", "ADD CONSTRAINT")):
+                extra_constraints.setdefault(match.group(1), []).append(action[len("ADD"):].strip())
+            else:
+                raise pymysql.err.NotSupportedError(f"cannot translate ALTER TABLE action: {action}")
+
+    translated = []
+    for statement in statements:
+        if statement.kind == "create_table":
+            translated.extend(translate_table(statement.sql, extra_columns.get(statement.table, ()),
+                                              extra_constraints.get(statement.table, ())))
+        elif statement.kind == "create_index":
+            translated.extend(translate_index(statement.sql))
+        elif statement.kind == "other":
+            translated.append(translate_query(statement.sql, formatted=False))
+    return translated
+
+
+def _error(e):
+    """The pymysql exception a MySQL server would have raised for sqlite3 error `e`."""
+    message = str(e)
+    if isinstance(e, sqlite3.IntegrityError):
+        if message.startswith("UNIQUE") or message.startswith("PRIMARY KEY"):
+            return pymysql.err.IntegrityError(1062, message)
+        if message.startswith("FOREIGN KEY"):
+            return pymysql.err.IntegrityError(1452, message)
+        if message.startswith("NOT NULL"):
+            return pymysql.err.IntegrityError(1048, message)
+        if message.startswith("CHECK"):
+            return pymysql.err.OperationalError(3819, message)
+        return pymysql.err.IntegrityError(1062, message)
+    if isinstance(e, sqlite3.OperationalError):
+        if "locked" in message or "busy" in message:
+            return pymysql.err.OperationalError(1205, message)
+        if "no such table" in message:
+            return pymysql.err.ProgrammingError(1146, message)
+        return pymysql.err.ProgrammingError(1064, message)
+    return pymysql.err.InternalError(0, message)
+
+
+def _param(value):
+    if isinstance(value, datetime):
+        return value.isoformat(" ", "seconds")
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, str) and len(value) >= 19 and value[10] == "T" and value[:4].isdigit():
+        return value.replace("T", " ", 1)
+    return value
+
+
+def _typed(value):
+    """Expression results carry no declared type; give date-shaped strings back as MySQL would."""
+    if isinstance(value, str) and len(value) in (10, 19) and value[4:5] == "-" and value[7:8] == "-":
+        try:
+            return datetime.fromisoformat(value) if len(value) == 19 else date.fromisoformat(value)
+        except ValueError:
+            return value
+    return value
+
+
+def _params(args):
+    if args is None:
+        return ()
+    if isinstance(args, dict):
+        return {key: _param(value) for key, value in args.items()}
+    if not isinstance(args, (list, tuple)):
+        args = (args,)
+    return tuple(_param(value) for value in args)
+
+
+def _is_write(sql):
+    return bool(re.match(r"\s*(INSERT|UPDATE|DELETE|REPLACE|CREATE|DROP|ALTER)\b", sql, re.I)) or \
+        bool(re.search(r"\bFOR\s+UPDATE\b", sql, re.I))
+
+
+class Cursor:
+    """The subset of pymysql's Cursor/DictCursor the repo uses, on top of sqlite3.
+
+    Like pymysql's SSCursor, an `unbuffered` cursor reads result rows from
+    sqlite as they are fetched instead of materialising them in execute().
+    """
+
+    def __init__(self, connection, dict_rows=False, unbuffered=False):
+        self.connection = connection
+        self.dict_rows = dict_rows
+        self.unbuffered = unbuffered
+        self._source = None
+        self.description = None
+        self.rowcount = -1
+        self.lastrowid = None
+        self.arraysize = 1
+        self._rows = []
+        self._position = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def close(self):
+        self._rows = []
+        self._source = None
+
+    def mogrify(self, query, args=None):
+        if args is None:
+            return query
+        if isinstance(args, dict):
+            return query % {key: escape_item(value, "utf8") for key, value in args.items()}
+        return query % tuple(escape_item(value, "utf8") for value in (args if isinstance(args, (list, tuple)) else (args,)))
+
+    def _run(self, sql, params, many=False):
+        connection = self.connection
+        connection._begin_if_needed(sql)
+        try:
+            cursor = connection._db.executemany(sql, params) if many else connection._db.execute(sql, params)
+        except sqlite3.Error as e:
+            raise _error(e) from e
+        self.lastrowid = cursor.lastrowid
+        self._source = None
+        if cursor.description is None:
+            self.description = None
+            self._rows = []
+            self.rowcount = cursor.rowcount
+        elif self.unbuffered and not many:
+            self.description = tuple((column[0], None, None, None, None, None, None) for column in cursor.description)
+            self._source = cursor
+            self._rows = []
+            self.rowcount = -1
+        else:
+            self.description = tuple((column[0], None, None, None, None, None, None) for column in cursor.description)
+            self._rows = self._convert(cursor.fetchall())
+            self.rowcount = len(self._rows)
+        self._position = 0
+        return self.rowcount
+
+    def _convert(self, rows):
+        rows = [tuple(_typed(value) for value in row) for row in rows]
+        if self.dict_rows:
+            names = [column[0] for column in self.description]
+            rows = [dict(zip(names, row)) for row in rows]
+        return rows
+
+    def execute(self, query, args=None):
+        handled = self.connection._execute_special(self, query)
+        if handled is not None:
+            return handled
+        return self._run(translate_query(query, args is not None), _params(args))
+
+    def executemany(self, query, args):
+        args = list(args)
+        if not args:
+            return 0
+        if not re.match(r"\s*(INSERT|UPDATE|DELETE|REPLACE)\b", query, re.I):
+            return sum(self.execute(query, item) for item in args)
+        return self._run(translate_query(query, True), [_params(item) for item in args], many=True)
+
+    def fetchone(self):
+        if self._source is not None:
+            rows = self.fetchmany(1)
+            return rows[0] if rows else None
+        if self._position >= len(self._rows):
+            return None
+        row = self._rows[self._position]
+        self._position += 1
+        return row
+
+    def fetchmany(self, size=None):
+        size = size or self.arraysize
+        if self._source is not None:
+            try:
+                return self._convert(self._source.fetchmany(size))
+            except sqlite3.Error as e:
+                raise _error(e) from e
+        rows = self._rows[self._position:self._position + size]
+        self._position += len(rows)
+        return rows
+
+    def fetchall(self):
+        if self._source is not None:
+            try:
+                rows = self._convert(self._source.fetchall())
+            except sqlite3.Error as e:
+                raise _error(e) from e
+            self._source = None
+            return rows
+        rows = self._rows[self._position:]
+        self._position = len(self._rows)
+        return rows
+
+
+class Connection:
+    """A pymysql-compatible connection to the shared embedded database.
+
+    MySQL's implicit transactions are emulated: outside autocommit (or after
+    begin()) the first statement opens a transaction, BEGIN IMMEDIATE when it
+    writes or locks rows, so writers queue on the database lock the way
+    locking reads queue on InnoDB row locks.
+    """
+
+    def __init__(self, database=None, autocommit=False, cursorclass=pymysql.cursors.Cursor):
+        self._db = sqlite3.connect(database or config.SQLITE_DATABASE, uri=True, isolation_level=None,
+                                   check_same_thread=False, detect_types=sqlite3.PARSE_DECLTYPES)
+        self._db.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+        self._db.execute("PRAGMA foreign_keys = ON")
+        for name, arity, function in [
+            ("NOW", 0, _now), ("SYSDATE", 0, _now), ("RAND", 0, random.random), ("RAND", 1, lambda seed: random.Random(seed).random()),
+            ("REGEXP", 2, _regexp), ("CRC32", 1, _crc32), ("CONCAT_WS", -1, _concat_ws),
+            ("TIMESTAMPDIFF", 3, _timestampdiff), ("GREATEST", -1, _greatest), ("LEAST", -1, _least),
+        ]:
+            self._db.create_function(name, arity, function)
+        self._db.create_aggregate("BIT_XOR", 1, BitXor)
+        self._autocommit = autocommit
+        self._begin_pending = False
+        self._wrote = False
+        self.cursorclass = cursorclass
+        self.open = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def server_status(self):
+        return SERVER_STATUS.SERVER_STATUS_IN_TRANS if self._db.in_transaction or self._begin_pending else 0
+
+    def _begin_if_needed(self, sql):
+        write = _is_write(sql)
+        if not self._db.in_transaction and (self._begin_pending or not self._autocommit):
+            try:
+                self._db.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+            except sqlite3.Error as e:
+                raise _error(e) from e
+            self._begin_pending = False
+            self._wrote = False
+        self._wrote = self._wrote or write
+
+    def _foreign_keys(self, enabled):
+        """SET foreign_key_checks: PRAGMA foreign_keys only works outside a transaction, so a
+        transaction that has only read so far is ended first; after writes, checks are deferred."""
+        if self._db.in_transaction and not self._wrote:
+            self._db.execute("COMMIT")
+            self._begin_pending = True
+        if self._db.in_transaction:
+            self._db.execute(f"PRAGMA defer_foreign_keys = {'OFF' if enabled else 'ON'}")
+        else:
+            self._db.execute(f"PRAGMA foreign_keys = {'ON' if enabled else 'OFF'}")
+
+    def _execute_special(self, cursor, query):
+        """Statements with no direct SQLite translation; returns None for everything else."""
+        stripped = query.strip()
+        upper = stripped[:40].upper()
+        if upper.startswith("SET "):
+            if re.search(r"foreign_key_checks\s*=\s*0", stripped, re.I):
+                self._foreign_keys(False)
+            elif re.search(r"foreign_key_checks\s*=\s*1", stripped, re.I):
+                self._foreign_keys(True)
+            return 0
+        if upper.startswith(("START TRANSACTION", "BEGIN")):
+            self.begin()
+            return 0
+        if upper.startswith("CREATE TEMPORARY TABLE") and TEMP_SELECT_RE.match(stripped):
+            temp, definitions, columns, source = TEMP_SELECT_RE.match(stripped).groups()
+            types = {row[1]: row[2] for row in self._db.execute(f"PRAGMA table_info({source})")}
+            items = [translate_column(temp, item)[0] for item in schema_module.split_items(definitions)]
+            items += [f"{name} {types[name]}" for name in (column.strip() for column in columns.split(","))]
+            return cursor._run(f"CREATE TEMP TABLE {temp} ({', '.join(items)})", ())
+        like = CREATE_LIKE_RE.match(stripped)
+        if like:
+            if_not_exists, table, source = like.groups()
+            if if_not_exists and self._db.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (table,)).fetchone():
+                return 0
+            for (sql,) in self._db.execute("SELECT sql FROM sqlite_master WHERE tbl_name = ? AND sql IS NOT NULL "
+                                           "AND type IN ('table', 'index')", (source,)).fetchall():
+                sql = re.sub(rf"\b{source}\b", table, sql)
+                sql = re.sub(r"^(CREATE\s+(?:UNIQUE\s+)?INDEX\s+)(\w+)", rf"\1\2_{table}", sql, flags=re.I)
+                cursor._run(sql, ())
+            return 0
+        if upper.startswith("CREATE TABLE") or upper.startswith("CREATE TEMPORARY TABLE"):
+            for statement in translate_table(stripped):
+                cursor._run(statement, ())
+            return 0
+        if re.match(r"CREATE\s+(UNIQUE\s+|FULLTEXT\s+)?INDEX\b", upper):
+            for statement in translate_index(stripped):
+                cursor._run(statement, ())
+            return 0
+        alter = ALTER_RE.match(stripped)
+        if alter:
+            for action in schema_module.split_items(alter.group(2)):
+                if not action.upper().startswith("ADD COLUMN"):
+                    raise pymysql.err.NotSupportedError(f"cannot translate ALTER TABLE action: {action}")
+                column = translate_column(alter.group(1), action[len("ADD COLUMN"):].strip())[0]
+                cursor._run(f"ALTER TABLE {alter.group(1)} ADD COLUMN {column}", ())
+            return 0
+        return None
+
+    def cursor(self, cursor=None):
+        cursorclass = cursor or self.cursorclass
+        return Cursor(self, dict_rows=issubclass(cursorclass, pymysql.cursors.DictCursorMixin),
+                      unbuffered=issubclass(cursorclass, pymysql.cursors.SSCursor))
+
+    def begin(self):
+        if self._db.in_transaction:
+            self.commit()
+        self._begin_pending = True
+        self._wrote = False
+
+    def commit(self):
+        self._begin_pending = False
+        if self._db.in_transaction:
+            try:
+                self._db.execute("COMMIT")
+            except sqlite3.Error as e:
+                raise _error(e) from e
+
+    def rollback(self):
+        self._begin_pending = False
+        if self._db.in_transaction:
+            self._db.execute("ROLLBACK")
+
+    def autocommit(self, value):
+        if value and not self._autocommit:
+            self.commit()
+        self._autocommit = bool(value)
+
+    def get_autocommit(self):
+        return self._autocommit
+
+    def ping(self, reconnect=True):
+        if not self.open:
+            raise pymysql.err.InterfaceError(0, "connection is closed")
+
+    def select_db(self, database):
+        pass
+
+    def close(self):
+        if self.open:
+            self.open = False
+            self._db.close()
+
+
+_keeper = None
+_keeper_lock = threading.Lock()
+
+
+def connect(autocommit=False, cursorclass=pymysql.cursors.Cursor, **ignored):
+    """Open a connection to the embedded database; MySQL connection arguments are accepted and ignored.
+
+    The first call also opens a connection that is never closed, so an
+    in-memory database outlives the pool connections that come and go.
+    """
+    global _keeper
+    with _keeper_lock:
+        if _keeper is None:
+            _keeper = Connection(autocommit=True)
+    return Connection(autocommit=autocommit, cursorclass=cursorclass)
+
+
+def reset():
+    """Drop every table, index and trigger in the embedded database."""
+    with connect(autocommit=True) as connection:
+        connection._db.execute("PRAGMA foreign_keys = OFF")
+        for kind, name in connection._db.execute(
+                "SELECT type, name FROM sqlite_master WHERE type IN ('table', 'trigger', 'view') "
+                "AND name NOT LIKE 'sqlite_%'").fetchall():
+            connection._db.execute(f"DROP {kind.upper()} IF EXISTS {name}")
+
+
+def migrate(path=SQL_FILE):
+    """Create the schema of `path` in the embedded database and return the number of statements run."""
+    statements = translate_migration(path)
+    with connect(autocommit=True) as connection:
+        for statement in statements:
+            try:
+                connection._db.execute(statement)
+            except sqlite3.Error as e:
+                raise _error(e) from e
+    return len(statements)
+
+
+def build(path=SQL_FILE, seed_config=None):
+    """Reset the embedded database, create the schema and optionally seed it."""
+    from badraghe import seed
+
+    reset()
+    migrate(path)
+    if seed_config:
+        seed.seed(sql_file=path, **seed_config)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Translate the migration for SQLite or build an SQLite database.")
+    parser.add_argument("path", nargs="?", default=SQL_FILE)
+    parser.add_argument("--print", action="store_true", help="print the translated DDL and exit")
+    parser.add_argument("--database", help="SQLite file to build (default: BADRAGHE_SQLITE_DATABASE)")
+    parser.add_argument("--preset", choices=["dev", "production"], help="seed this preset after creating the schema")
+    args = parser.parse_args(argv)
+
+    if args.print:
+        for statement in translate_migration(args.path):
+            print(statement + ";\n")
+        return 0
+    config.BACKEND = "sqlite"
+    if args.database:
+        config.SQLITE_DATABASE = args.database
+    from badraghe import seed
+
+    started = time.perf_counter()
+    build(args.path, {"rows": seed.PRESETS[args.preset]} if args.preset else None)
+    print(f"✅ SQLite database {config.SQLITE_DATABASE} built in {time.perf_counter() - started:.2f}s.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,104 @@
+import re
+
+DELIMITER_RE = re.compile(r"^\s*DELIMITER\s+(\S+)\s*$", re.I)
+SPECIAL_CHARS = set("'\"`\\-#/")
+
+
+class Statement:
+    def __init__(self, sql, line):
+        self.sql = sql
+        self.line = line
+        self.kind, self.table = classify(sql)
+
+    def __repr__(self):
+        return f"Statement({self.kind!r}, {self.table!r}, line={self.line})"
+
+    def head(self, width=60):
+        text = " ".join(self.sql.split())
+        return text if len(text) <= width else text[:width - 3] + "..."
+
+
+def classify(sql):
+    match = re.match(r"CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?`?(\w+)`?", sql, re.I)
+    if match:
+        return "create_table", match.group(1)
+    match = re.match(r"CREATE\s+(?:UNIQUE\s+|FULLTEXT\s+)?INDEX\s+`?\w+`?\s+ON\s+`?(\w+)`?", sql, re.I)
+    if match:
+        return "create_index", match.group(1)
+    match = re.match(r"ALTER\s+TABLE\s+`?(\w+)`?", sql, re.I)
+    if match:
+        return "alter_table", match.group(1)
+    return "other", None
+
+
+def iter_statements(lines):
+    """Yield the statements of a SQL script as they are read.
+
+    `lines` is any iterable of text lines (an open file works), so a dump
+    never has to fit in memory. Semicolons inside quotes, backticks and
+    comments do not end a statement, and mysql client style `DELIMITER`
+    lines are honoured for trigger and procedure bodies.
+    """
+    delimiter = ";"
+    buffer = []
+    quote = None
+    block_comment = False
+    start_line = None
+
+    for line_number, line in enumerate(lines, 1):
+        if quote is None and not block_comment and start_line is None:
+            match = DELIMITER_RE.match(line)
+            if match:
+                delimiter = match.group(1)
+                buffer = []
+                continue
+
+        i = 0
+        length = len(line)
+        while i < length:
+            char = line[i]
+            if block_comment:
+                end = line.find("*/", i)
+                if end == -1:
+                    i = length
+                    continue
+                block_comment = False
+                i = end + 2
+                continue
+            if quote:
+                if char == "\\" and quote != "`":
+                    buffer.append(line[i:i + 2])
+                    i += 2
+                    continue
+                buffer.append(char)
+                if char == quote:
+                    quote = None
+                i += 1
+                continue
+            if line.startswith(delimiter, i):
+                sql = "".join(buffer).strip()
+                if sql:
+                    yield Statement(sql, start_line)
+                buffer = []
+                start_line = None
+                i += len(delimiter)
+                continue
+            if char in SPECIAL_CHARS:
+                if char in "'\"`":
+                    quote = char
+                elif char == "#" or (line.startswith("--", i) and line[i + 2:i + 3] in ("", " ", "\t", "\n", "\r")):
+                    break
+                elif line.startswith("/*", i):
+                    block_comment = True
+                    i += 2
+                    continue
+            if start_line is None and not char.isspace():
+                start_line = line_number
+            buffer.append(char)
+            i += 1
+        if quote is None and (not buffer or buffer[-1] != "\n"):
+            buffer.append("\n")
+
+    sql = "".join(buffer).strip()
+    if sql:
+        yield Statement(sql, start_line)
@@ -0,0 +1,411 @@
+import argparse
+import sys
+from datetime import date, datetime, timedelta
+
+import pymysql
+
+from badraghe import config
+from badraghe.pool import get_pool
+
+REVENUE = "daily_revenue_summary"
+OCCUPANCY = "daily_occupancy_summary"
+WATERMARK = "daily_summaries"
+ROW_DAYS = "summary_row_days"
+DIRTY_DAYS = "summary_dirty_days"
+KEY_COLUMNS = ["day", "provider_id", "transport_type", "class_type"]
+OVERLAP = timedelta(seconds=60)
+DAYS_PER_BATCH = 31
+
+SUMMARIES = {
+    REVENUE: {
+        "columns": ["payments", "revenue", "refunds"],
+        "time_column": "p.payment_date",
+        "ids": "SELECT p.id FROM payments p WHERE {where}",
+        "rows": "SELECT %s, p.id, DATE(p.payment_date) FROM payments p WHERE {where}",
+        "select": """
+            SELECT DATE(p.payment_date) AS day, COALESCE(t.transport_company_id, 0) AS provider_id,
+                   t.transport_type, t.class_type,
+                   COUNT(*) AS payments, SUM(p.amount) AS revenue, COALESCE(SUM(p.refund_amount), 0) AS refunds
+            FROM payments p
+            JOIN user_reservations r ON r.id = p.reservation_id
+            JOIN travel_tickets t ON t.id = r.ticket_id
+            WHERE p.status = 'successful' AND {where}
+            GROUP BY day, provider_id, t.transport_type, t.class_type
+        """,
+    },
+    OCCUPANCY: {
+        "columns": ["tickets", "total_seats", "sold_seats"],
+        "time_column": "t.departure_time",
+        "ids": "SELECT t.id FROM travel_tickets t WHERE {where}",
+        "rows": "SELECT %s, t.id, DATE(t.departure_time) FROM travel_tickets t WHERE {where}",
+        "select": """
+            SELECT DATE(t.departure_time) AS day, COALESCE(t.transport_company_id, 0) AS provider_id,
+                   t.transport_type, t.class_type,
+                   COUNT(*) AS tickets, SUM(t.total_seats) AS total_seats,
+                   COALESCE(SUM((SELECT COUNT(*) FROM user_reservations r
+                                 WHERE r.ticket_id = t.id AND r.status IN ('reserved', 'paid'))), 0) AS sold_seats
+            FROM travel_tickets t
+            WHERE {where}
+            GROUP BY day, provider_id, t.transport_type, t.class_type
+        """,
+    },
+}
+
+
+def day_ranges(days):
+    """Collapse days into [start, end) datetime ranges of consecutive days."""
+    ranges = []
+    for day in sorted(set(days)):
+        start = datetime(day.year, day.month, day.day)
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], start + timedelta(days=1))
+        else:
+            ranges.append((start, start + timedelta(days=1)))
+    return ranges
+
+
+def _select(table, ranges=None, query="select"):
+    summary = SUMMARIES[table]
+    if ranges is None:
+        return summary[query].format(where="TRUE"), []
+    column = summary["time_column"]
+    where = " OR ".join(f"({column} >= %s AND {column} < %s)" for _ in ranges)
+    return summary[query].format(where=f"({where})"), [value for bounds in ranges for value in bounds]
+
+
+def _rows(cursor):
+    rows = cursor.fetchall()
+    if rows and not isinstance(rows[0], dict):
+        names = [description[0] for description in cursor.description]
+        rows = [dict(zip(names, row)) for row in rows]
+    return rows
+
+
+def _scalar(cursor, sql, args=None):
+    cursor.execute(sql, args)
+    row = cursor.fetchone()
+    return next(iter(row.values())) if isinstance(row, dict) else row[0]
+
+
+def _column(cursor):
+    return [row[0] if not isinstance(row, dict) else next(iter(row.values())) for row in cursor.fetchall()]
+
+
+def recompute(cursor, table, ranges):
+    """Replace the summary rows of `table` inside `ranges` with a fresh aggregate.
+
+    The day each source row was counted on is recorded in summary_row_days,
+    so a row that later moves to another day also recomputes the old one.
+    """
+    columns = KEY_COLUMNS + SUMMARIES[table]["columns"]
+    where = " OR ".join("(day >= %s AND day < %s)" for _ in ranges)
+    args = [value.date() for bounds in ranges for value in bounds]
+    cursor.execute(f"DELETE FROM {table} WHERE {where}", args)
+    select, select_args = _select(table, ranges)
+    cursor.execute(f"INSERT INTO {table} ({', '.join(columns)}) {select}", select_args)
+    ids, ids_args = _select(table, ranges, "ids")
+    cursor.execute(f"DELETE FROM {ROW_DAYS} WHERE summary = %s AND row_id IN ({ids})", [table] + ids_args)
+    rows, rows_args = _select(table, ranges, "rows")
+    cursor.execute(f"INSERT INTO {ROW_DAYS} (summary, row_id, day) {rows}", [table] + rows_args)
+
+
+def _recompute_days(connection, table, days, days_per_batch=DAYS_PER_BATCH):
+    ranges = day_ranges(days)
+    for start in range(0, len(ranges), days_per_batch):
+        with connection.cursor() as cursor:
+            recompute(cursor, table, ranges[start:start + days_per_batch])
+        connection.commit()
+
+
+def _changed_days(cursor, since, last_ticket_id):
+    cursor.execute(
+        f"""
+        SELECT DATE(payment_date) FROM payments WHERE updated_at > %s
+        UNION
+        SELECT d.day FROM payments p JOIN {ROW_DAYS} d ON d.summary = %s AND d.row_id = p.id WHERE p.updated_at > %s
+        UNION
+        SELECT DATE(p.payment_date) FROM user_reservations r
+        JOIN payments p ON p.reservation_id = r.id
+        WHERE r.updated_at > %s
+        UNION
+        SELECT DATE(p.payment_date) FROM travel_tickets t
+        JOIN user_reservations r ON r.ticket_id = t.id
+        JOIN payments p ON p.reservation_id = r.id
+        WHERE t.updated_at > %s
+        """,
+        (since, REVENUE, since, since, since),
+    )
+    revenue_days = _column(cursor)
+    cursor.execute(
+        f"""
+        SELECT DATE(t.departure_time) FROM user_reservations r
+        JOIN travel_tickets t ON t.id = r.ticket_id
+        WHERE r.updated_at > %s
+        UNION
+        SELECT DATE(departure_time) FROM travel_tickets WHERE id > %s OR updated_at > %s
+        UNION
+        SELECT d.day FROM travel_tickets t JOIN {ROW_DAYS} d ON d.summary = %s AND d.row_id = t.id
+        WHERE t.updated_at > %s
+        """,
+        (since, last_ticket_id, since, OCCUPANCY, since),
+    )
+    occupancy_days = _column(cursor)
+    return {REVENUE: revenue_days, OCCUPANCY: occupancy_days}
+
+
+def _take_dirty_days(cursor):
+    """Remove and return the days marked by forget_tickets()/forget_payments(), per summary."""
+    cursor.execute(f"SELECT summary, day FROM {DIRTY_DAYS} FOR UPDATE")
+    rows = [tuple(row.values()) if isinstance(row, dict) else tuple(row) for row in cursor.fetchall()]
+    cursor.execute(f"DELETE FROM {DIRTY_DAYS}")
+    days = {table: [] for table in SUMMARIES}
+    for table, day in rows:
+        days[table].append(day)
+    return days
+
+
+def _mark_dirty(cursor, table, days):
+    cursor.executemany(f"INSERT IGNORE INTO {DIRTY_DAYS} (summary, day) VALUES (%s, %s)",
+                       [(table, day) for day in days])
+
+
+def _forget(cursor, table, source, column, ids):
+    if not ids:
+        return
+    placeholders = ", ".join(["%s"] * len(ids))
+    cursor.execute(
+        f"""
+        INSERT IGNORE INTO {DIRTY_DAYS} (summary, day)
+        SELECT %s, DATE({column}) FROM {source} WHERE id IN ({placeholders})
+        UNION
+        SELECT %s, day FROM {ROW_DAYS} WHERE summary = %s AND row_id IN ({placeholders})
+        """,
+        [table] + list(ids) + [table, table] + list(ids),
+    )
+    cursor.execute(f"DELETE FROM {ROW_DAYS} WHERE summary = %s AND row_id IN ({placeholders})", [table] + list(ids))
+
+
+def forget_payments(cursor, payment_ids):
+    """Mark the revenue days of payments that are about to be deleted for the next refresh.
+
+    A deleted row leaves no updated_at behind, so callers that delete
+    payments (the archiver) run this in the same transaction first.
+    """
+    _forget(cursor, REVENUE, "payments", "payment_date", payment_ids)
+
+
+def forget_tickets(cursor, ticket_ids):
+    """Mark the days of tickets about to be deleted, and of their payments, for the next refresh."""
+    if not ticket_ids:
+        return
+    cursor.execute(
+        f"""
+        SELECT p.id FROM user_reservations r JOIN payments p ON p.reservation_id = r.id
+        WHERE r.ticket_id IN ({', '.join(['%s'] * len(ticket_ids))})
+        """,
+        list(ticket_ids),
+    )
+    forget_payments(cursor, _column(cursor))
+    _forget(cursor, OCCUPANCY, "travel_tickets", "departure_time", ticket_ids)
+
+
+def _watermark_time(cursor):
+    """NOW(), held back to the start of the oldest other open transaction.
+
+    updated_at is stamped when a row is written, but the row is only seen
+    once its transaction commits, so a transaction still open now can later
+    commit rows stamped before NOW(). Starting the next scan from its start
+    picks those rows up. Reading innodb_trx needs the PROCESS privilege;
+    without it this is plain NOW() and only the overlap covers late commits.
+    """
+    if config.BACKEND == "sqlite":
+        return _scalar(cursor, "SELECT NOW()")
+    try:
+        return _scalar(cursor, """
+            SELECT LEAST(NOW(), COALESCE(MIN(trx_started), NOW())) FROM information_schema.innodb_trx
+            WHERE trx_mysql_thread_id <> CONNECTION_ID()
+        """)
+    except pymysql.err.OperationalError as e:
+        if e.args[0] != 1227:
+            raise
+        return _scalar(cursor, "SELECT NOW()")
+
+
+def _save_watermark(cursor, changed_through, last_ticket_id):
+    cursor.execute(
+        """
+        INSERT INTO summary_watermarks (name, changed_through, last_id) VALUES (%s, %s, %s)
+        ON DUPLICATE KEY UPDATE changed_through = VALUES(changed_through), last_id = VALUES(last_id)
+        """,
+        (WATERMARK, changed_through, last_ticket_id),
+    )
+
+
+def rebuild(pool=None, start=None, end=None, days_per_batch=DAYS_PER_BATCH):
+    """Recompute both summaries from scratch, `days_per_batch` days per transaction.
+
+    Without `start`/`end` the whole history is rebuilt and the incremental
+    watermark is reset; with them only that backfill window is rewritten.
+    """
+    pool = pool or get_pool()
+    with pool.connection(autocommit=False) as connection:
+        with connection.cursor() as cursor:
+            now = _scalar(cursor, "SELECT NOW()")
+            last_ticket_id = _scalar(cursor, "SELECT COALESCE(MAX(id), 0) FROM travel_tickets")
+            if start is None:
+                first = [_scalar(cursor, "SELECT MIN(payment_date) FROM payments"),
+                         _scalar(cursor, "SELECT MIN(departure_time) FROM travel_tickets")]
+                first = [value for value in first if value is not None]
+                start = min(first).date() if first else now.date()
+            full = end is None
+            if end is None:
+                last = [_scalar(cursor, "SELECT MAX(payment_date) FROM payments"),
+                        _scalar(cursor, "SELECT MAX(departure_time) FROM travel_tickets")]
+                end = max([value for value in last if value is not None], default=now).date() + timedelta(days=1)
+            if full:
+                for table in SUMMARIES:
+                    cursor.execute(f"DELETE FROM {table} WHERE day < %s OR day >= %s", (start, end))
+                cursor.execute(f"DELETE FROM {ROW_DAYS}")
+                cursor.execute(f"DELETE FROM {DIRTY_DAYS}")
+        connection.commit()
+
+        batches = 0
+        day = start
+        while day < end:
+            batch_end = min(day + timedelta(days=days_per_batch), end)
+            ranges = [(datetime(day.year, day.month, day.day), datetime(batch_end.year, batch_end.month, batch_end.day))]
+            with connection.cursor() as cursor:
+                for table in SUMMARIES:
+                    recompute(cursor, table, ranges)
+            connection.commit()
+            batches += 1
+            day = batch_end
+
+        if full:
+            with connection.cursor() as cursor:
+                _save_watermark(cursor, now, last_ticket_id)
+            connection.commit()
+    return batches
+
+
+def refresh(pool=None, days_per_batch=DAYS_PER_BATCH, overlap=OVERLAP):
+    """Recompute only the days touched since the last refresh and return them per summary.
+
+    Changes are found through the updated_at of payments, user_reservations
+    and travel_tickets, and through new travel_tickets ids. A payment or
+    ticket whose payment_date or departure_time moved also recomputes the
+    day it was last counted on, kept in summary_row_days, and a ticket
+    whose class, provider or type changed recomputes its payments' days.
+    Rows deleted through the archiver are marked by forget_tickets() and
+    forget_payments(). The watermark is held back to the start of the
+    oldest transaction still open (see _watermark_time), and each scan also
+    reaches `overlap` further back for clock skew between the session and
+    the server; recomputing a day twice is harmless. Without a watermark
+    this falls back to rebuild().
+
+    Not covered: rows deleted by hand, and a reservation moved to another
+    ticket (the old ticket's departure day keeps its sold seat). verify()
+    finds those, and rebuild() repairs them.
+    """
+    pool = pool or get_pool()
+    with pool.connection(autocommit=False) as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT changed_through, last_id FROM summary_watermarks WHERE name = %s", (WATERMARK,))
+            watermark = cursor.fetchone()
+        connection.commit()
+        if watermark is None:
+            rebuild(pool, days_per_batch=days_per_batch)
+            return None
+
+        changed_through, last_ticket_id = watermark.values() if isinstance(watermark, dict) else watermark
+        with connection.cursor() as cursor:
+            now = _watermark_time(cursor)
+            new_last_ticket_id = _scalar(cursor, "SELECT COALESCE(MAX(id), 0) FROM travel_tickets")
+            changed = _changed_days(cursor, changed_through - overlap, last_ticket_id)
+            dirty = _take_dirty_days(cursor)
+        connection.commit()
+
+        try:
+            for table, days in changed.items():
+                days = sorted(set(days) | set(dirty[table]))
+                changed[table] = days
+                if days:
+                    _recompute_days(connection, table, days, days_per_batch)
+        except Exception:
+            connection.rollback()
+            with connection.cursor() as cursor:
+                for table, days in dirty.items():
+                    _mark_dirty(cursor, table, days)
+            connection.commit()
+            raise
+
+        with connection.cursor() as cursor:
+            _save_watermark(cursor, now, new_last_ticket_id)
+        connection.commit()
+    return changed
+
+
+def verify(pool=None, start=None, end=None):
+    """Compare the stored summaries against a full recompute and return the differences."""
+    pool = pool or get_pool()
+    ranges = [(datetime(start.year, start.month, start.day), datetime(end.year, end.month, end.day))] \
+        if start and end else None
+    mismatches = []
+    with pool.connection() as connection, connection.cursor() as cursor:
+        for table, summary in SUMMARIES.items():
+            select, args = _select(table, ranges)
+            cursor.execute(select, args)
+            expected = {tuple(row[column] for column in KEY_COLUMNS): row for row in _rows(cursor)}
+
+            where, stored_args = "TRUE", []
+            if ranges:
+                where, stored_args = "day >= %s AND day < %s", [ranges[0][0].date(), ranges[0][1].date()]
+            cursor.execute(f"SELECT {', '.join(KEY_COLUMNS + summary['columns'])} FROM {table} WHERE {where}",
+                           stored_args)
+            stored = {tuple(row[column] for column in KEY_COLUMNS): row for row in _rows(cursor)}
+
+            for key in sorted(set(expected) | set(stored), key=str):
+                want = expected.get(key)
+                have = stored.get(key)
+                if want is None or have is None or any(want[c] != have[c] for c in summary["columns"]):
+                    mismatches.append({
+                        "table": table,
+                        "key": dict(zip(KEY_COLUMNS, key)),
+                        "expected": {c: want[c] for c in summary["columns"]} if want else None,
+                        "stored": {c: have[c] for c in summary["columns"]} if have else None,
+                    })
+    return mismatches
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintain the daily revenue and occupancy summaries.")
+    parser.add_argument("command", choices=["refresh", "rebuild", "verify"])
+    parser.add_argument("--start", type=date.fromisoformat, help="first day (rebuild/verify a window)")
+    parser.add_argument("--end", type=date.fromisoformat, help="day after the last one")
+    parser.add_argument("--days-per-batch", type=int, default=DAYS_PER_BATCH)
+    parser.add_argument("--overlap-seconds", type=float, default=OVERLAP.total_seconds(),
+                        help="how far before the watermark refresh rescans (refresh)")
+    args = parser.parse_args(argv)
+
+    if args.command == "rebuild":
+        batches = rebuild(start=args.start, end=args.end, days_per_batch=args.days_per_batch)
+        print(f"✅ Summaries rebuilt in {batches} batches.")
+    elif args.command == "refresh":
+        changed = refresh(days_per_batch=args.days_per_batch, overlap=timedelta(seconds=args.overlap_seconds))
+        if changed is None:
+            print("✅ No watermark yet, summaries rebuilt from scratch.")
+        else:
+            print("✅ Summaries refreshed: " + ", ".join(f"{len(days)} days of {table}" for table, days in changed.items()))
+    else:
+        mismatches = verify(start=args.start, end=args.end)
+        for mismatch in mismatches[:20]:
+            print(f"⛔ {mismatch['table']} {mismatch['key']}: expected {mismatch['expected']}, stored {mismatch['stored']}")
+        if mismatches:
+            print(f"⛔ {len(mismatches)} summary rows differ from a full recompute.")
+            return 1
+        print("✅ Summaries match a full recompute.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,470 @@
+import argparse
+import hashlib
+import math
+import re
+import sys
+import time
+import unicodedata
+from collections import Counter
+from datetime import timedelta
+
+from badraghe.pool import get_pool
+from badraghe.search import Page
+
+WATERMARK = "support_search"
+OVERLAP = timedelta(seconds=60)
+TOKEN_RE = re.compile(r"[^\W_]+")
+STOPWORDS = frozenset(
+    "a an and are as at be but by can do for from has have i in is it its me my no not of on or our so that the "
+    "this to was we were will with you your".split()
+)
+MIN_TERM = 2
+MAX_TERM = 64
+SUBJECT_WEIGHT = 3
+IDF_SCALE = 1000
+DOCUMENTS = ""
+TERMS_PER_QUERY = 500
+TICKETS_PER_BATCH = 500
+TICKET_COLUMNS = ["id", "user_id", "category_id", "subject", "status", "priority", "created_at", "updated_at"]
+
+
+def _rows(cursor):
+    return [tuple(row.values()) if isinstance(row, dict) else row for row in cursor.fetchall()]
+
+
+def _chunks(items, size=TERMS_PER_QUERY):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def tokenize(text):
+    """Lower-cased, accent-folded words of `text`, without stopwords and very short or long tokens."""
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(char for char in text if not unicodedata.combining(char)).casefold()
+    return [term for term in TOKEN_RE.findall(text)
+            if MIN_TERM <= len(term) <= MAX_TERM and term not in STOPWORDS]
+
+
+def text_hash(subject, description):
+    return hashlib.md5(f"{subject}\0{description}".encode()).hexdigest()
+
+
+def ticket_weights(subject, description):
+    weights = Counter()
+    for term in tokenize(subject):
+        weights[term] += SUBJECT_WEIGHT
+    weights.update(tokenize(description))
+    return weights
+
+
+# Index maintenance
+
+def _existing_terms(cursor, ticket_id, terms):
+    found = set()
+    for chunk in _chunks(terms):
+        cursor.execute(
+            f"SELECT term FROM support_search_terms WHERE ticket_id = %s AND term IN ({', '.join(['%s'] * len(chunk))})",
+            [ticket_id] + chunk,
+        )
+        found.update(row[0] for row in _rows(cursor))
+    return found
+
+
+def _count_terms(cursor, counts):
+    """Add {term: tickets} to the vocabulary's document frequencies."""
+    cursor.executemany(
+        """
+        INSERT INTO support_search_vocabulary (term, tickets) VALUES (%s, %s)
+        ON DUPLICATE KEY UPDATE tickets = tickets + VALUES(tickets)
+        """,
+        sorted(counts.items()),
+    )
+
+
+def _add_postings(cursor, ticket_id, weights):
+    if not weights:
+        return
+    new_terms = set(weights) - _existing_terms(cursor, ticket_id, weights)
+    cursor.executemany(
+        """
+        INSERT INTO support_search_terms (term, ticket_id, weight) VALUES (%s, %s, %s)
+        ON DUPLICATE KEY UPDATE weight = weight + VALUES(weight)
+        """,
+        [(term, ticket_id, weight) for term, weight in sorted(weights.items())],
+    )
+    if new_terms:
+        _count_terms(cursor, dict.fromkeys(new_terms, 1))
+
+
+def _remove_postings(cursor, ticket_id):
+    cursor.execute("SELECT term FROM support_search_terms WHERE ticket_id = %s", (ticket_id,))
+    terms = sorted(row[0] for row in _rows(cursor))
+    if not terms:
+        return
+    cursor.execute("DELETE FROM support_search_terms WHERE ticket_id = %s", (ticket_id,))
+    for chunk in _chunks(terms):
+        cursor.execute(
+            f"UPDATE support_search_vocabulary SET tickets = tickets - 1 WHERE term IN ({', '.join(['%s'] * len(chunk))})",
+            chunk,
+        )
+
+
+def index_ticket(cursor, ticket_id):
+    """Bring one ticket's postings up to date; safe to call any number of times.
+
+    support_search_documents remembers the last conversation id indexed
+    and a hash of the subject and description. New messages are added on
+    top of the existing postings. A changed subject or description (or a
+    ticket never indexed) removes the ticket's postings and indexes it
+    again from scratch. The document row is locked first, so concurrent
+    callers for the same ticket queue instead of double counting.
+    Must run inside a transaction. Returns False if the ticket does not exist.
+    """
+    cursor.execute("SELECT subject, description FROM support_tickets WHERE id = %s", (ticket_id,))
+    ticket = _rows(cursor)
+    if not ticket:
+        return False
+    subject, description = ticket[0]
+    cursor.execute("INSERT IGNORE INTO support_search_documents (ticket_id) VALUES (%s)", (ticket_id,))
+    if cursor.rowcount:
+        _count_terms(cursor, {DOCUMENTS: 1})
+    cursor.execute("SELECT last_message_id, text_hash FROM support_search_documents WHERE ticket_id = %s FOR UPDATE",
+                   (ticket_id,))
+    last_message_id, indexed_hash = _rows(cursor)[0]
+
+    current_hash = text_hash(subject, description)
+    weights = Counter()
+    if current_hash != indexed_hash:
+        _remove_postings(cursor, ticket_id)
+        weights = ticket_weights(subject, description)
+        last_message_id = 0
+    cursor.execute(
+        "SELECT id, message FROM support_ticket_conversations WHERE ticket_id = %s AND id > %s ORDER BY id",
+        (ticket_id, last_message_id),
+    )
+    for message_id, message in _rows(cursor):
+        weights.update(tokenize(message))
+        last_message_id = message_id
+    _add_postings(cursor, ticket_id, weights)
+    cursor.execute("UPDATE support_search_documents SET last_message_id = %s, text_hash = %s WHERE ticket_id = %s",
+                   (last_message_id, current_hash, ticket_id))
+    return True
+
+
+def open_ticket(connection, user_id, category_id, subject, description, priority="low"):
+    """Create a support ticket and index it in the same transaction. Returns its id."""
+    connection.begin()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO support_tickets (user_id, category_id, subject, description, priority) "
+                "VALUES (%s, %s, %s, %s, %s)",
+                (user_id, category_id, subject, description, priority),
+            )
+            ticket_id = cursor.lastrowid
+            index_ticket(cursor, ticket_id)
+    except Exception:
+        connection.rollback()
+        raise
+    connection.commit()
+    return ticket_id
+
+
+def append_message(connection, ticket_id, user_id, message, message_type="user"):
+    """Add a message to a ticket's conversation and index it in the same transaction. Returns its id."""
+    connection.begin()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO support_ticket_conversations (ticket_id, user_id, message, message_type) "
+                "VALUES (%s, %s, %s, %s)",
+                (ticket_id, user_id, message, message_type),
+            )
+            message_id = cursor.lastrowid
+            index_ticket(cursor, ticket_id)
+    except Exception:
+        connection.rollback()
+        raise
+    connection.commit()
+    return message_id
+
+
+def _save_watermark(connection, changed_through, last_message_id):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            INSERT INTO summary_watermarks (name, changed_through, last_id) VALUES (%s, %s, %s)
+            ON DUPLICATE KEY UPDATE changed_through = VALUES(changed_through), last_id = VALUES(last_id)
+            """,
+            (WATERMARK, changed_through, last_message_id),
+        )
+    connection.commit()
+
+
+def refresh(pool=None, tickets_per_batch=TICKETS_PER_BATCH):
+    """Index the tickets changed or appended to since the last refresh; returns how many were checked.
+
+    Catches up with rows written without open_ticket/append_message
+    (bulk loads, other services). Tickets come from support_tickets.updated_at
+    (a status change only costs a hash comparison) and from conversation
+    ids past the watermark. Messages edited in place are not seen;
+    rebuild() catches those. Without a watermark this falls back to rebuild().
+    """
+    pool = pool or get_pool()
+    with pool.connection(autocommit=False) as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT changed_through, last_id FROM summary_watermarks WHERE name = %s", (WATERMARK,))
+            watermark = _rows(cursor)
+        connection.commit()
+        if not watermark:
+            return rebuild(pool, tickets_per_batch)
+        changed_through, last_message_id = watermark[0]
+
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT NOW(), (SELECT COALESCE(MAX(id), 0) FROM support_ticket_conversations)")
+            now, new_last_message_id = _rows(cursor)[0]
+            cursor.execute("SELECT id FROM support_tickets WHERE updated_at > %s", (changed_through - OVERLAP,))
+            tickets = {row[0] for row in _rows(cursor)}
+            cursor.execute("SELECT DISTINCT ticket_id FROM support_ticket_conversations WHERE id > %s AND id <= %s",
+                           (last_message_id, new_last_message_id))
+            tickets |= {row[0] for row in _rows(cursor)}
+        connection.commit()
+
+        for chunk in _chunks(sorted(tickets), tickets_per_batch):
+            connection.begin()
+            with connection.cursor() as cursor:
+                for ticket_id in chunk:
+                    index_ticket(cursor, ticket_id)
+            connection.commit()
+        _save_watermark(connection, now, new_last_message_id)
+    return len(tickets)
+
+
+def _replace_range(cursor, low, high, tickets, last_message_id):
+    """Replace the postings of every ticket id in (low, high] (no upper bound when `high` is None).
+
+    `tickets` are the (id, subject, description) rows in the range.
+    Postings of tickets deleted since the last build go too, and the
+    vocabulary is adjusted by the difference, so readers see either the
+    range's old postings or its new ones.
+    """
+    bound, args = "ticket_id > %s", [low]
+    if high is not None:
+        bound, args = "ticket_id > %s AND ticket_id <= %s", [low, high]
+    cursor.execute(f"SELECT ticket_id FROM support_search_documents WHERE {bound} FOR UPDATE", args)
+    changes = Counter({DOCUMENTS: -len(_rows(cursor))})
+    cursor.execute(f"SELECT term, COUNT(*) FROM support_search_terms WHERE {bound} GROUP BY term", args)
+    for term, tickets_with_term in _rows(cursor):
+        changes[term] -= int(tickets_with_term)
+    cursor.execute(f"DELETE FROM support_search_terms WHERE {bound}", args)
+    cursor.execute(f"DELETE FROM support_search_documents WHERE {bound}", args)
+
+    documents = {ticket_id: [ticket_weights(subject, description), 0, text_hash(subject, description)]
+                 for ticket_id, subject, description in tickets}
+    if documents:
+        cursor.execute(
+            """
+            SELECT ticket_id, id, message FROM support_ticket_conversations
+            WHERE ticket_id BETWEEN %s AND %s AND id <= %s
+            """,
+            (tickets[0][0], tickets[-1][0], last_message_id),
+        )
+        for ticket_id, message_id, message in _rows(cursor):
+            document = documents.get(ticket_id)
+            if document is not None:
+                document[0].update(tokenize(message))
+                document[1] = max(document[1], message_id)
+
+        postings = [(term, ticket_id, weight) for ticket_id, (weights, _, _) in documents.items()
+                    for term, weight in weights.items()]
+        for chunk in _chunks(postings, 5000):
+            cursor.executemany("INSERT INTO support_search_terms (term, ticket_id, weight) VALUES (%s, %s, %s)", chunk)
+        cursor.executemany(
+            "INSERT INTO support_search_documents (ticket_id, last_message_id, text_hash) VALUES (%s, %s, %s)",
+            [(ticket_id, last_id, hashed) for ticket_id, (_, last_id, hashed) in documents.items()],
+        )
+        changes[DOCUMENTS] += len(documents)
+        for weights, _, _ in documents.values():
+            changes.update(weights.keys())
+
+    _count_terms(cursor, {term: change for term, change in changes.items() if change > 0})
+    fewer = sorted((-change, term) for term, change in changes.items() if change < 0)
+    if fewer:
+        cursor.executemany(
+            "UPDATE support_search_vocabulary SET tickets = tickets - LEAST(tickets, %s) WHERE term = %s", fewer)
+        for chunk in _chunks([term for _, term in fewer]):
+            cursor.execute(f"DELETE FROM support_search_vocabulary WHERE tickets = 0 AND term <> '' "
+                           f"AND term IN ({', '.join(['%s'] * len(chunk))})", chunk)
+
+
+def rebuild(pool=None, tickets_per_batch=TICKETS_PER_BATCH):
+    """Index every ticket again from scratch, `tickets_per_batch` tickets per transaction.
+
+    Each batch replaces the postings of one ticket id range: it reads its
+    tickets and their conversations with one query apiece, writes the
+    postings with multi-row inserts and adjusts the document frequencies
+    in the same transaction. The index stays searchable throughout, with
+    each range either in its old or its new state. Returns the number of
+    tickets indexed.
+    """
+    pool = pool or get_pool()
+    indexed = 0
+    with pool.connection(autocommit=False) as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT NOW(), (SELECT COALESCE(MAX(id), 0) FROM support_ticket_conversations)")
+            now, last_message_id = _rows(cursor)[0]
+        connection.commit()
+
+        after = 0
+        while True:
+            connection.begin()
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT id, subject, description FROM support_tickets WHERE id > %s ORDER BY id "
+                                   "LIMIT %s", (after, tickets_per_batch))
+                    tickets = _rows(cursor)
+                    last = len(tickets) < tickets_per_batch
+                    _replace_range(cursor, after, None if last else tickets[-1][0], tickets, last_message_id)
+            except Exception:
+                connection.rollback()
+                raise
+            connection.commit()
+            indexed += len(tickets)
+            if last:
+                break
+            after = tickets[-1][0]
+        _save_watermark(connection, now, last_message_id)
+    return indexed
+
+
+# Search
+
+def _idf(documents, tickets):
+    return int(IDF_SCALE * math.log(1 + documents / max(tickets, 1)))
+
+
+def search_tickets(connection, query, status=None, priority=None, category_id=None, after=None, limit=20,
+                   match_all=True):
+    """Return one page of support tickets matching `query`, best first.
+
+    Each ticket scores sum(weight * idf) over the query terms, where a
+    term's weight counts its occurrences in the ticket (subject words count
+    SUBJECT_WEIGHT times) and idf is an integer, so scores are exact and
+    pages are keyset paginated on (score, id): pass the previous page's
+    `after`. With `match_all` every term must occur in the ticket.
+    """
+    terms = list(dict.fromkeys(tokenize(query)))
+    if not terms:
+        return Page([], None)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT term, tickets FROM support_search_vocabulary WHERE term IN ({', '.join(['%s'] * (len(terms) + 1))})",
+            terms + [DOCUMENTS],
+        )
+        frequencies = dict(_rows(cursor))
+    documents = frequencies.pop(DOCUMENTS, 0)
+    known = [term for term in terms if frequencies.get(term)]
+    if not known or (match_all and len(known) < len(terms)):
+        return Page([], None)
+
+    cases = " ".join("WHEN %s THEN %s" for _ in known)
+    args = [value for term in known for value in (term, _idf(documents, frequencies[term]))] + known
+    conditions = [f"p.term IN ({', '.join(['%s'] * len(known))})"]
+    for column, value in (("status", status), ("priority", priority), ("category_id", category_id)):
+        if value is not None:
+            conditions.append(f"st.{column} = %s")
+            args.append(value)
+    having = []
+    if match_all:
+        having.append("COUNT(*) = %s")
+        args.append(len(known))
+    if after is not None:
+        having.append("(score < %s OR (score = %s AND p.ticket_id > %s))")
+        args += [after[0], after[0], after[1]]
+    sql = (
+        f"SELECT p.ticket_id, SUM(p.weight * CASE p.term {cases} END) AS score "
+        f"FROM support_search_terms p JOIN support_tickets st ON st.id = p.ticket_id "
+        f"WHERE {' AND '.join(conditions)} GROUP BY p.ticket_id "
+        + (f"HAVING {' AND '.join(having)} " if having else "")
+        + "ORDER BY score DESC, p.ticket_id LIMIT %s"
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, args + [limit])
+        ranked = [(ticket_id, int(score)) for ticket_id, score in _rows(cursor)]
+        rows = {}
+        if ranked:
+            cursor.execute(
+                f"SELECT {', '.join(TICKET_COLUMNS)} FROM support_tickets "
+                f"WHERE id IN ({', '.join(['%s'] * len(ranked))})",
+                [ticket_id for ticket_id, _ in ranked],
+            )
+            rows = {row[0]: dict(zip(TICKET_COLUMNS, row)) for row in _rows(cursor)}
+    page = []
+    for ticket_id, score in ranked:
+        if ticket_id in rows:
+            page.append(dict(rows[ticket_id], score=score))
+    next_after = (ranked[-1][1], ranked[-1][0]) if len(ranked) == limit else None
+    return Page(page, next_after)
+
+
+def search_tickets_like(connection, query, status=None, limit=20):
+    """The LIKE '%...%' scan over subjects, descriptions and messages that the index replaces (bench baseline)."""
+    pattern = f"%{query}%"
+    conditions = ["""(st.subject LIKE %s OR st.description LIKE %s OR EXISTS (
+        SELECT 1 FROM support_ticket_conversations c WHERE c.ticket_id = st.id AND c.message LIKE %s))"""]
+    args = [pattern, pattern, pattern]
+    if status is not None:
+        conditions.append("st.status = %s")
+        args.append(status)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT {', '.join(f'st.{column}' for column in TICKET_COLUMNS)} FROM support_tickets st "
+            f"WHERE {' AND '.join(conditions)} ORDER BY st.id DESC LIMIT %s",
+            args + [limit],
+        )
+        return Page([dict(zip(TICKET_COLUMNS, row)) for row in _rows(cursor)], None)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Search support tickets and their conversations.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    query_parser = subparsers.add_parser("query", help="run a ranked search")
+    query_parser.add_argument("text")
+    query_parser.add_argument("--status", choices=["open", "in_progress", "resolved", "closed"])
+    query_parser.add_argument("--priority", choices=["low", "medium", "high"])
+    query_parser.add_argument("--category-id", type=int)
+    query_parser.add_argument("--any", action="store_true", help="match tickets with any of the words")
+    query_parser.add_argument("--limit", type=int, default=20)
+    query_parser.add_argument("--pages", type=int, default=1)
+    for command in ("refresh", "rebuild"):
+        subparsers.add_parser(command).add_argument("--tickets-per-batch", type=int, default=TICKETS_PER_BATCH)
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    if args.command == "rebuild":
+        count = rebuild(tickets_per_batch=args.tickets_per_batch)
+        print(f"✅ Indexed {count:,} support tickets in {time.perf_counter() - started:.1f}s")
+        return 0
+    if args.command == "refresh":
+        count = refresh(tickets_per_batch=args.tickets_per_batch)
+        print(f"✅ Checked {count:,} changed support tickets in {time.perf_counter() - started:.2f}s")
+        return 0
+
+    after = None
+    with get_pool().connection() as connection:
+        for number in range(1, args.pages + 1):
+            started = time.perf_counter()
+            page = search_tickets(connection, args.text, args.status, args.priority, args.category_id, after,
+                                  args.limit, match_all=not args.any)
+            print(f"📄 Page {number}: {len(page.rows)} tickets in {(time.perf_counter() - started) * 1000:.1f} ms")
+            for row in page.rows:
+                print(f"   #{row['id']:<10} {row['score']:>8}  {row['status']:<12} {row['priority']:<7} {row['subject']}")
+            after = page.after
+            if after is None:
+                break
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,108 @@
+def _null_safe_match(left, right, columns):
+    return " AND ".join(f"{left}.{column} <=> {right}.{column}" for column in columns)
+
+
+def _row_checksum(alias, columns):
+    fields = ", ".join(f"IFNULL(CAST({alias}.{column} AS CHAR), '\\\\N')" for column in columns)
+    return f"BIT_XOR(CRC32(CONCAT_WS('#', {fields})))"
+
+
+def verify_rows(connection, table, rows, keys, columns=None, chunk_size=5000):
+    """Check that `rows` are stored in `table` and return the ones that are not.
+
+    The expected rows are bulk loaded into a temporary table shaped like
+    `table`, then compared chunk by chunk with an aggregated CRC32. Only the
+    chunks whose checksum differs are joined row by row, so a clean check of
+    a large seed costs a handful of round trips. Each mismatch is a dict with
+    the `expected` row and the `stored` rows found for its key (empty if the
+    row is missing).
+    """
+    columns = list(columns or rows[0].keys()) if rows else list(columns or keys)
+    columns = list(dict.fromkeys(list(keys) + columns))
+    temp = f"_verify_{table}"
+    column_list = ", ".join(columns)
+
+    with connection.cursor() as cursor:
+        cursor.execute(f"DROP TEMPORARY TABLE IF EXISTS {temp}")
+        cursor.execute(
+            f"CREATE TEMPORARY TABLE {temp} (_seq BIGINT UNSIGNED PRIMARY KEY) "
+            f"SELECT {column_list} FROM {table} LIMIT 0"
+        )
+        try:
+            insert = f"INSERT INTO {temp} (_seq, {column_list}) VALUES (%s, {', '.join(['%s'] * len(columns))})"
+            for start in range(0, len(rows), chunk_size):
+                cursor.executemany(insert, [
+                    (seq, *(row.get(column) for column in columns))
+                    for seq, row in enumerate(rows[start:start + chunk_size], start)
+                ])
+
+            dirty = _dirty_chunks(cursor, temp, table, keys, columns, chunk_size)
+            return _mismatches(cursor, temp, table, keys, columns, chunk_size, dirty)
+        finally:
+            cursor.execute(f"DROP TEMPORARY TABLE IF EXISTS {temp}")
+
+
+def _fetch_rows(cursor):
+    rows = cursor.fetchall()
+    if rows and not isinstance(rows[0], dict):
+        names = [description[0] for description in cursor.description]
+        rows = [dict(zip(names, row)) for row in rows]
+    return rows
+
+
+def _dirty_chunks(cursor, temp, table, keys, columns, chunk_size):
+    cursor.execute(
+        f"SELECT _seq DIV %s AS chunk, COUNT(*) AS row_count, {_row_checksum('e', columns)} AS checksum "
+        f"FROM {temp} e GROUP BY chunk",
+        (chunk_size,),
+    )
+    expected = {row["chunk"]: (row["row_count"], row["checksum"]) for row in _fetch_rows(cursor)}
+
+    cursor.execute(
+        f"SELECT e._seq DIV %s AS chunk, COUNT(*) AS row_count, {_row_checksum('s', columns)} AS checksum "
+        f"FROM {temp} e JOIN {table} s ON {_null_safe_match('s', 'e', keys)} GROUP BY chunk",
+        (chunk_size,),
+    )
+    stored = {row["chunk"]: (row["row_count"], row["checksum"]) for row in _fetch_rows(cursor)}
+
+    return sorted(chunk for chunk, summary in expected.items() if stored.get(chunk) != summary)
+
+
+def _mismatches(cursor, temp, table, keys, columns, chunk_size, dirty):
+    mismatches = []
+    for chunk in dirty:
+        cursor.execute(
+            f"SELECT e.* FROM {temp} e WHERE e._seq BETWEEN %s AND %s AND NOT EXISTS ("
+            f"SELECT 1 FROM {table} s WHERE {_null_safe_match('s', 'e', columns)}) ORDER BY e._seq",
+            (chunk * chunk_size, (chunk + 1) * chunk_size - 1),
+        )
+        expected = _fetch_rows(cursor)
+        if not expected:
+            continue
+
+        sequences = [row["_seq"] for row in expected]
+        cursor.execute(
+            f"SELECT e._seq AS _seq, s.* FROM {temp} e JOIN {table} s ON {_null_safe_match('s', 'e', keys)} "
+            f"WHERE e._seq IN ({', '.join(['%s'] * len(sequences))})",
+            sequences,
+        )
+        stored = {}
+        for row in _fetch_rows(cursor):
+            stored.setdefault(row.pop("_seq"), []).append(row)
+
+        for row in expected:
+            seq = row.pop("_seq")
+            mismatches.append({"expected": row, "stored": stored.get(seq, [])})
+    return mismatches
+
+
+def describe(mismatches, limit=5):
+    lines = []
+    for mismatch in mismatches[:limit]:
+        if mismatch["stored"]:
+            lines.append(f"differs: expected {mismatch['expected']}, stored {mismatch['stored'][0]}")
+        else:
+            lines.append(f"missing: {mismatch['expected']}")
+    if len(mismatches) > limit:
+        lines.append(f"... and {len(mismatches) - limit} more")
+    return "\n".join(lines)
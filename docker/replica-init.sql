@@ -0,0 +1,18 @@
+-- Runs once, when the replica's data directory is first initialised.
+-- The reader account only exists on the replica, so nothing from the
+-- primary's binlog can collide with it.
+SET SESSION sql_log_bin = 0;
+CREATE USER IF NOT EXISTS 'reader'@'%' IDENTIFIED BY 'password';
+GRANT SELECT ON badrage_database.* TO 'reader'@'%';
+GRANT REPLICATION CLIENT ON *.* TO 'reader'@'%';
+SET SESSION sql_log_bin = 1;
+
+CHANGE REPLICATION SOURCE TO
+    SOURCE_HOST = 'mysql',
+    SOURCE_PORT = 3306,
+    SOURCE_USER = 'root',
+    SOURCE_PASSWORD = 'rootpass',
+    SOURCE_AUTO_POSITION = 1,
+    GET_SOURCE_PUBLIC_KEY = 1,
+    SOURCE_CONNECT_RETRY = 5;
+START REPLICA;
@@ -0,0 +1,24 @@
+CREATE TABLE summary_row_days (
+    summary VARCHAR(64) NOT NULL,
+    row_id BIGINT UNSIGNED NOT NULL,
+    day DATE NOT NULL,
+    PRIMARY KEY (summary, row_id)
+);
+
+CREATE TABLE summary_dirty_days (
+    summary VARCHAR(64) NOT NULL,
+    day DATE NOT NULL,
+    PRIMARY KEY (summary, day)
+);
+
+-- summary.refresh() finds changed rows with `updated_at > watermark` on three tables, every few
+-- minutes. Each index below costs one extra B-tree write per INSERT and per UPDATE of its table
+-- (updated_at is ON UPDATE CURRENT_TIMESTAMP), and saves a full table scan per refresh:
+--   payments(updated_at): in the baseline; refunds and status changes keep payment ids, so new ids
+--     alone would miss them. Also read by the advisor's sample workload.
+--   user_reservations(updated_at): in the baseline; cancellations change sold seats of an old
+--     ticket. loyalty.refresh() reads it the same way.
+--   travel_tickets(updated_at): added here; a moved departure_time or a new class/provider keeps
+--     the ticket id. Tickets are written far less often than they are read, so the extra write is
+--     the cheapest of the three.
+CREATE INDEX idx_travel_tickets_updated_at ON travel_tickets(updated_at);
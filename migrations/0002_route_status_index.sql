@@ -0,0 +1,8 @@
+-- search_routes() filters a route by status (always 'available' from the app) and pages it with
+-- ORDER BY departure_time, id. idx_travel_tickets_route puts departure_time before status, so
+-- within one departure_time its entries are ordered by status and class_type, not by id, and every
+-- page is filesorted. With status as an equality column ahead of (departure_time, id), the index
+-- order is the page order and the LIMIT stops after one page of entries. class_type comes last
+-- so a class filter is answered from the index without reading the ticket rows.
+-- idx_travel_tickets_route stays for searches that do not filter by status.
+CREATE INDEX idx_travel_tickets_route_status ON travel_tickets(departure_city, arrival_city, status, departure_time, id, class_type);
@@ -3,32 +3,71 @@ import unittest
 import docker
 import time
 import os
+import json
+import gzip
+import tempfile
+import threading
+from datetime import date, datetime, timedelta
 import pymysql
 from faker import Faker
 import random
-
-SQL_FILE = "badrage-migration.sql"
-DB_HOST = "127.0.0.1"
-DB_PORT = 3306
-DB_USER = "user"
-DB_PASSWORD = "password"
-DB_NAME = "badrage_database"
+from badraghe import schema as schema_module
+from badraghe import advisor
+from badraghe import archive
+from badraghe import bench
+from badraghe import facets
+from badraghe import ingest
+from badraghe import instrument
+from badraghe import inventory
+from badraghe import loyalty
+from badraghe import migrate
+from badraghe import outbox
+from badraghe import pricing
+from badraghe import ratings
+from badraghe import rbac
+from badraghe import reconcile
+from badraghe import schema_change
+from badraghe import search
+from badraghe import seed
+from badraghe import snapshot
+from badraghe import sqlite_backend
+from badraghe import summary
+from badraghe import support_search
+from badraghe import verify
+from badraghe import config
+from badraghe import router as router_module
+from badraghe.config import SQL_FILE
+from badraghe.pool import ConnectionPool, PoolTimeout, get_pool
+from badraghe.statements import iter_statements
 
 fake = Faker()
 
+POLL_INTERVAL = 0.25
+USE_SNAPSHOT = os.environ.get("BADRAGHE_SNAPSHOT", "1") != "0"
+TEST_SEED = {"rows": {table: 20 for table in seed.DEFAULT_ROWS}, "random_seed": 0}
+SQLITE = config.BACKEND == "sqlite"
+mysql_only = unittest.skipIf(SQLITE, "needs a MySQL server (BADRAGHE_BACKEND=sqlite)")
+
 class TestDockerCompose(unittest.TestCase):
+    migration = None
+
     @classmethod
     def setUpClass(cls):
-        cls.docker_client = docker.from_env()
         cls.containers = {}
+        cls.pool = get_pool(size=5)
+        if SQLITE:
+            cls.import_sql_file()
+            return
+        cls.docker_client = docker.from_env()
 
-        print("\n🔄 Stopping existing containers...")
-        try:
-            subprocess.run("docker compose down -v".split(), check=True)
-        except subprocess.CalledProcessError:
-            pass
-        
-        print("🚀 Starting Docker Compose...")
+        if not USE_SNAPSHOT:
+            print("\n🔄 Stopping existing containers...")
+            try:
+                subprocess.run("docker compose down -v".split(), check=True)
+            except subprocess.CalledProcessError:
+                pass
+
+        print("\n🚀 Starting Docker Compose...")
         subprocess.run("docker compose up --no-build -d".split(), check=True)
 
         cls.wait_for_containers(["mysql_server", "phpmyadmin"])
@@ -55,7 +94,7 @@ class TestDockerCompose(unittest.TestCase):
             if all_ready:
                 print("✅ All containers are up!")
                 return
-            time.sleep(3)
+            time.sleep(POLL_INTERVAL)
 
         raise TimeoutError("⛔ Timeout: Containers failed to start within the time limit.")
 
@@ -66,52 +105,67 @@ class TestDockerCompose(unittest.TestCase):
 
         while time.time() - start_time < timeout:
             try:
-                connection = pymysql.connect(
-                    host=DB_HOST,
-                    user=DB_USER,
-                    password=DB_PASSWORD,
-                    database=DB_NAME,
-                    port=DB_PORT,
-                    cursorclass=pymysql.cursors.Cursor
-                )
-                connection.close()
+                with cls.pool.connection():
+                    pass
                 print("✅ MySQL is ready!")
                 return
             except pymysql.MySQLError:
-                time.sleep(3)
+                time.sleep(POLL_INTERVAL)
 
         raise TimeoutError("⛔ Timeout: MySQL did not become ready in time.")
 
     @classmethod
     def import_sql_file(cls):
-        if os.path.exists(SQL_FILE):
-            print(f"📥 Importing SQL file: {SQL_FILE}")
-            try:
-                connection = pymysql.connect(
-                    host=DB_HOST,
-                    user=DB_USER,
-                    password=DB_PASSWORD,
-                    database=DB_NAME,
-                    port=DB_PORT,
-                    autocommit=True,
-                    cursorclass=pymysql.cursors.Cursor
-                )
-
-                with connection.cursor() as cursor:
-                    with open(SQL_FILE, "r") as f:
-                        sql_commands = f.read().strip().split(";")
-
-                    for command in sql_commands:
-                        if command.strip():
-                            cursor.execute(command.strip())
-
-                print("✅ SQL file imported successfully.")
-                connection.close()
-            except pymysql.MySQLError as e:
-                print(f"⛔ Error importing SQL file: {e}")
-        else:
+        if not os.path.exists(SQL_FILE):
             print(f"⚠️ SQL file {SQL_FILE} not found, skipping import.")
+            return
+        started = time.perf_counter()
+        if SQLITE:
+            sqlite_backend.build(SQL_FILE, TEST_SEED)
+            print(f"✅ SQLite schema created and seeded in {time.perf_counter() - started:.1f}s.")
+            cls.upgrade_schema()
+            return
+        try:
+            if USE_SNAPSHOT:
+                key, cls.migration = snapshot.ensure(SQL_FILE, TEST_SEED, pool=cls.pool)
+            else:
+                cls.migration = snapshot.build(SQL_FILE, TEST_SEED, pool=cls.pool)
+        except migrate.MigrationError as e:
+            print(f"⛔ Error importing SQL file: {e}")
+            raise
+        if cls.migration is None:
+            print(f"✅ Snapshot {key} restored in {time.perf_counter() - started:.1f}s.")
+        else:
+            print(f"✅ SQL file imported and seeded in {time.perf_counter() - started:.1f}s.")
+            cls.migration.report(top=5)
+        cls.upgrade_schema()
+
+    @classmethod
+    def upgrade_schema(cls):
+        """Apply the versioned changes in migrations/ on top of the baseline (restored or just built)."""
+        applied = schema_change.upgrade(pool=cls.pool)
+        versions = [version for version in applied if version != schema_change.BASELINE]
+        print(f"✅ Schema versions applied: {', '.join(versions)}." if versions else "✅ Schema is up to date.")
 
+    @classmethod
+    def tearDownClass(cls):
+        print(f"\n📊 Connection pool: {cls.pool.status()}")
+        cls.pool.close()
+
+    def connect(self, cursorclass=pymysql.cursors.DictCursor):
+        connection = self.pool.acquire(cursorclass=cursorclass)
+        self.addCleanup(self.pool.release, connection)
+        return connection
+
+    def isolated(self, cursorclass=pymysql.cursors.DictCursor):
+        """A connection inside a transaction that is rolled back when the test ends."""
+        connection = self.pool.acquire(autocommit=False, cursorclass=cursorclass)
+        self.addCleanup(self.pool.release, connection)
+        self.addCleanup(connection.rollback)
+        connection.begin()
+        return connection
+
+    @mysql_only
     def test_01_containers_up(self):
         for service in ["mysql_server", "phpmyadmin"]:
             self.assertIn(service, self.containers, f"❌ Container {service} not found")
@@ -150,27 +204,13 @@ class TestDockerCompose(unittest.TestCase):
         %(bio)s, %(preferences)s)
         """
 
-        connection = pymysql.connect(
-                    host=DB_HOST,
-                    user=DB_USER,
-                    password=DB_PASSWORD,
-                    database=DB_NAME,
-                    port=DB_PORT,
-                    autocommit=True,
-                    cursorclass=pymysql.cursors.DictCursor
-                )
+        connection = self.isolated()
 
         with connection.cursor() as cursor:
             cursor.executemany(insert_query, users_data)
 
-            for user_data in users_data:
-                cursor.execute("SELECT * FROM users WHERE email = %s", (user_data["email"],))
-                retrieved_user = cursor.fetchone()
-
-                self.assertIsNotNone(retrieved_user, f"User with email {user_data['email']} was not inserted correctly")
-                self.assertEqual(retrieved_user["email"], user_data["email"], "Retrieved email does not match")
-                self.assertEqual(retrieved_user["first_name"], user_data["first_name"], "First name mismatch")
-                self.assertEqual(retrieved_user["last_name"], user_data["last_name"], "Last name mismatch")
+            mismatches = verify.verify_rows(connection, "users", users_data, keys=["email"], columns=["first_name", "last_name"])
+            self.assertEqual(mismatches, [], f"Users were not inserted correctly:\n{verify.describe(mismatches)}")
 
     def test_03_insert_and_retrieve_multiple_roles(self):
         roles_data = []
@@ -190,26 +230,13 @@ class TestDockerCompose(unittest.TestCase):
         VALUES (%(name)s, %(description)s, %(parent_role_id)s, %(status)s)
         """
         
-        connection = pymysql.connect(
-            host=DB_HOST,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            database=DB_NAME,
-            port=DB_PORT,
-            autocommit=True,
-            cursorclass=pymysql.cursors.DictCursor
-        )
+        connection = self.isolated()
         
         with connection.cursor() as cursor:
             cursor.executemany(insert_query, roles_data)
             
-            for role_data in roles_data:
-                cursor.execute("SELECT * FROM roles WHERE name = %s", (role_data["name"],))
-                retrieved_role = cursor.fetchone()
-                
-                self.assertIsNotNone(retrieved_role, f"Role {role_data['name']} was not inserted correctly")
-                self.assertEqual(retrieved_role["name"], role_data["name"], "Role name mismatch")
-                self.assertEqual(retrieved_role["description"], role_data["description"], "Role description mismatch")
+            mismatches = verify.verify_rows(connection, "roles", roles_data, keys=["name"], columns=["description"])
+            self.assertEqual(mismatches, [], f"Roles were not inserted correctly:\n{verify.describe(mismatches)}")
     
     def test_04_insert_and_retrieve_multiple_features(self):
         features_data = []
@@ -227,25 +254,13 @@ class TestDockerCompose(unittest.TestCase):
         VALUES (%(name)s, %(description)s)
         """
         
-        connection = pymysql.connect(
-            host=DB_HOST,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            database=DB_NAME,
-            port=DB_PORT,
-            autocommit=True,
-            cursorclass=pymysql.cursors.DictCursor
-        )
+        connection = self.isolated()
         
         with connection.cursor() as cursor:
             cursor.executemany(insert_query, features_data)
             
-            for feature_data in features_data:
-                cursor.execute("SELECT * FROM features WHERE name = %s", (feature_data["name"],))
-                retrieved_feature = cursor.fetchone()
-                
-                self.assertIsNotNone(retrieved_feature, f"Feature {feature_data['name']} was not inserted correctly")
-                self.assertEqual(retrieved_feature["name"], feature_data["name"], "Feature name mismatch")
+            mismatches = verify.verify_rows(connection, "features", features_data, keys=["name"])
+            self.assertEqual(mismatches, [], f"Features were not inserted correctly:\n{verify.describe(mismatches)}")
     
     def test_05_insert_and_retrieve_multiple_permissions(self):
         permissions_data = []
@@ -266,36 +281,16 @@ class TestDockerCompose(unittest.TestCase):
         VALUES (%(name)s, %(description)s, %(type)s, %(status)s)
         """
         
-        connection = pymysql.connect(
-            host=DB_HOST,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            database=DB_NAME,
-            port=DB_PORT,
-            autocommit=True,
-            cursorclass=pymysql.cursors.DictCursor
-        )
+        connection = self.isolated()
         
         with connection.cursor() as cursor:
             cursor.executemany(insert_query, permissions_data)
             
-            for permission_data in permissions_data:
-                cursor.execute("SELECT * FROM permissions WHERE name = %s", (permission_data["name"],))
-                retrieved_permission = cursor.fetchone()
-                
-                self.assertIsNotNone(retrieved_permission, f"Permission {permission_data['name']} was not inserted correctly")
-                self.assertEqual(retrieved_permission["name"], permission_data["name"], "Permission name mismatch")
+            mismatches = verify.verify_rows(connection, "permissions", permissions_data, keys=["name"])
+            self.assertEqual(mismatches, [], f"Permissions were not inserted correctly:\n{verify.describe(mismatches)}")
     
     def test_06_insert_and_retrieve_role_permissions(self):
-        connection = pymysql.connect(
-            host=DB_HOST,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            database=DB_NAME,
-            port=DB_PORT,
-            autocommit=True,
-            cursorclass=pymysql.cursors.DictCursor
-        )
+        connection = self.isolated()
         
         with connection.cursor() as cursor:
             cursor.execute("SELECT id FROM roles ORDER BY RAND() LIMIT 10")
@@ -304,9 +299,14 @@ class TestDockerCompose(unittest.TestCase):
             cursor.execute("SELECT id FROM permissions ORDER BY RAND() LIMIT 10")
             permission_ids = [row['id'] for row in cursor.fetchall()]
 
+            cursor.execute("SELECT role_id, permission_id FROM role_permissions")
+            existing = {(row['role_id'], row['permission_id']) for row in cursor.fetchall()}
+
         role_permissions_data = []
         for role_id in role_ids:
             for permission_id in permission_ids:
+                if (role_id, permission_id) in existing:
+                    continue
                 role_permissions_data.append({
                     "role_id": role_id,
                     "permission_id": permission_id
@@ -320,22 +320,11 @@ class TestDockerCompose(unittest.TestCase):
         with connection.cursor() as cursor:
             cursor.executemany(insert_query, role_permissions_data)
             
-            for data in role_permissions_data:
-                cursor.execute("SELECT * FROM role_permissions WHERE role_id = %s AND permission_id = %s", (data["role_id"], data["permission_id"]))
-                retrieved_entry = cursor.fetchone()
-                
-                self.assertIsNotNone(retrieved_entry, f"Role-Permission pair {data['role_id']}-{data['permission_id']} was not inserted correctly")
+            mismatches = verify.verify_rows(connection, "role_permissions", role_permissions_data, keys=["role_id", "permission_id"])
+            self.assertEqual(mismatches, [], f"Role-Permission pairs were not inserted correctly:\n{verify.describe(mismatches)}")
     
     def test_07_insert_and_retrieve_multiple_user_roles(self):
-        connection = pymysql.connect(
-            host=DB_HOST,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            database=DB_NAME,
-            port=DB_PORT,
-            autocommit=True,
-            cursorclass=pymysql.cursors.DictCursor
-        )
+        connection = self.isolated()
 
         with connection.cursor() as cursor:
             cursor.execute("SELECT id FROM users ORDER BY RAND() LIMIT 10")
@@ -344,9 +333,14 @@ class TestDockerCompose(unittest.TestCase):
             cursor.execute("SELECT id FROM roles ORDER BY RAND() LIMIT 10")
             role_ids = [row['id'] for row in cursor.fetchall()]
 
+            cursor.execute("SELECT user_id, role_id FROM user_role")
+            existing = {(row['user_id'], row['role_id']) for row in cursor.fetchall()}
+
         user_roles_data = []
         for user_id in user_ids:
             for role_id in role_ids:
+                if (user_id, role_id) in existing:
+                    continue
                 user_roles_data.append({
                     "user_id": user_id,
                     "role_id": role_id
@@ -360,11 +354,8 @@ class TestDockerCompose(unittest.TestCase):
         with connection.cursor() as cursor:
             cursor.executemany(insert_query, user_roles_data)
 
-            for data in user_roles_data:
-                cursor.execute("SELECT * FROM user_role WHERE user_id = %s AND role_id = %s", (data["user_id"], data["role_id"]))
-                retrieved_entry = cursor.fetchone()
-
-                self.assertIsNotNone(retrieved_entry, f"User-Role pair {data['user_id']}-{data['role_id']} was not inserted correctly")
+            mismatches = verify.verify_rows(connection, "user_role", user_roles_data, keys=["user_id", "role_id"])
+            self.assertEqual(mismatches, [], f"User-Role pairs were not inserted correctly:\n{verify.describe(mismatches)}")
 
     def test_08_insert_and_retrieve_multiple_service_providers(self):
         providers_data = []
@@ -385,35 +376,16 @@ class TestDockerCompose(unittest.TestCase):
         VALUES (%(name)s, %(contact_email)s, %(contact_phone)s, %(address)s, %(website_url)s)
         """
 
-        connection = pymysql.connect(
-            host=DB_HOST,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            database=DB_NAME,
-            port=DB_PORT,
-            autocommit=True,
-            cursorclass=pymysql.cursors.DictCursor
-        )
+        connection = self.isolated()
 
         with connection.cursor() as cursor:
             cursor.executemany(insert_query, providers_data)
 
-            for provider_data in providers_data:
-                cursor.execute("SELECT * FROM service_providers WHERE name = %s", (provider_data["name"],))
-                retrieved_provider = cursor.fetchone()
-
-                self.assertIsNotNone(retrieved_provider, f"Service Provider {provider_data['name']} was not inserted correctly")
+            mismatches = verify.verify_rows(connection, "service_providers", providers_data, keys=["name"])
+            self.assertEqual(mismatches, [], f"Service Providers were not inserted correctly:\n{verify.describe(mismatches)}")
 
     def test_09_insert_and_retrieve_multiple_travel_tickets(self):
-        connection = pymysql.connect(
-            host=DB_HOST,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            database=DB_NAME,
-            port=DB_PORT,
-            autocommit=True,
-            cursorclass=pymysql.cursors.DictCursor
-        )
+        connection = self.isolated()
 
         with connection.cursor() as cursor:
             cursor.execute("SELECT id FROM service_providers ORDER BY RAND() LIMIT 10")
@@ -450,11 +422,8 @@ class TestDockerCompose(unittest.TestCase):
         with connection.cursor() as cursor:
             cursor.executemany(insert_query, tickets_data)
 
-            for ticket_data in tickets_data:
-                cursor.execute("SELECT * FROM travel_tickets WHERE departure_city = %s AND arrival_city = %s", (ticket_data["departure_city"], ticket_data["arrival_city"]))
-                retrieved_ticket = cursor.fetchone()
-
-                self.assertIsNotNone(retrieved_ticket, f"Travel Ticket from {ticket_data['departure_city']} to {ticket_data['arrival_city']} was not inserted correctly")
+            mismatches = verify.verify_rows(connection, "travel_tickets", tickets_data, keys=["departure_city", "arrival_city"])
+            self.assertEqual(mismatches, [], f"Travel Tickets were not inserted correctly:\n{verify.describe(mismatches)}")
 
     def test_10_insert_and_retrieve_multiple_payment_methods(self):
         payment_methods_data = []
@@ -473,24 +442,13 @@ class TestDockerCompose(unittest.TestCase):
         VALUES (%(name)s, %(description)s, %(is_active)s)
         """
 
-        connection = pymysql.connect(
-            host=DB_HOST,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            database=DB_NAME,
-            port=DB_PORT,
-            autocommit=True,
-            cursorclass=pymysql.cursors.DictCursor
-        )
+        connection = self.isolated()
 
         with connection.cursor() as cursor:
             cursor.executemany(insert_query, payment_methods_data)
 
-            for method_data in payment_methods_data:
-                cursor.execute("SELECT * FROM payment_methods WHERE name = %s", (method_data["name"],))
-                retrieved_method = cursor.fetchone()
-
-                self.assertIsNotNone(retrieved_method, f"Payment Method {method_data['name']} was not inserted correctly")
+            mismatches = verify.verify_rows(connection, "payment_methods", payment_methods_data, keys=["name"])
+            self.assertEqual(mismatches, [], f"Payment Methods were not inserted correctly:\n{verify.describe(mismatches)}")
 
     def test_11_insert_and_retrieve_multiple_user_reservations(self):
         reservations_data = []
@@ -498,15 +456,7 @@ class TestDockerCompose(unittest.TestCase):
         statuses = ['temporary', 'reserved', 'paid', 'canceled']
         refund_statuses = ['not_requested', 'pending', 'approved', 'denied']
 
-        connection = pymysql.connect(
-            host=DB_HOST,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            database=DB_NAME,
-            port=DB_PORT,
-            autocommit=True,
-            cursorclass=pymysql.cursors.DictCursor
-        )
+        connection = self.isolated()
 
         with connection.cursor() as cursor:
             cursor.execute("SELECT id FROM users ORDER BY RAND() LIMIT 10")
@@ -514,7 +464,6 @@ class TestDockerCompose(unittest.TestCase):
             if not user_ids:
                 cursor.execute("INSERT INTO users (first_name, last_name, email) VALUES (%s, %s, %s)",
                                (fake.first_name(), fake.last_name(), fake.email()))
-                connection.commit()
                 cursor.execute("SELECT id FROM users ORDER BY RAND() LIMIT 10")
                 user_ids = [row['id'] for row in cursor.fetchall()]
 
@@ -523,7 +472,6 @@ class TestDockerCompose(unittest.TestCase):
             if not ticket_ids:
                 cursor.execute("INSERT INTO travel_tickets (transport_type, departure_city, arrival_city, departure_time, arrival_time, price, currency, available_seats, total_seats, transport_company_id, class_type, status) VALUES (%s, %s, %s, NOW(), NOW() + INTERVAL 5 HOUR, %s, 'IRR', %s, %s, NULL, %s, %s)", 
                                ("plane", fake.city(), fake.city(), 100, 50, 100, "economy", "available"))
-                connection.commit()
                 cursor.execute("SELECT id FROM travel_tickets ORDER BY RAND() LIMIT 10")
                 ticket_ids = [row['id'] for row in cursor.fetchall()]
 
@@ -545,25 +493,11 @@ class TestDockerCompose(unittest.TestCase):
         with connection.cursor() as cursor:
             cursor.executemany(insert_query, reservations_data)
 
-            for reservation_data in reservations_data:
-                cursor.execute("SELECT * FROM user_reservations WHERE user_id = %s AND ticket_id = %s", 
-                               (reservation_data["user_id"], reservation_data["ticket_id"]))
-                retrieved_reservation = cursor.fetchone()
-
-                self.assertIsNotNone(retrieved_reservation, f"Reservation for user {reservation_data['user_id']} and ticket {reservation_data['ticket_id']} was not inserted correctly")
-                self.assertEqual(retrieved_reservation["user_id"], reservation_data["user_id"], "User ID mismatch")
-                self.assertEqual(retrieved_reservation["ticket_id"], reservation_data["ticket_id"], "Ticket ID mismatch")
+            mismatches = verify.verify_rows(connection, "user_reservations", reservations_data, keys=["user_id", "ticket_id"])
+            self.assertEqual(mismatches, [], f"Reservations were not inserted correctly:\n{verify.describe(mismatches)}")
 
     def test_12_insert_and_retrieve_multiple_payments(self):
-        connection = pymysql.connect(
-            host=DB_HOST,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            database=DB_NAME,
-            port=DB_PORT,
-            autocommit=True,
-            cursorclass=pymysql.cursors.DictCursor
-        )
+        connection = self.isolated()
 
         with connection.cursor() as cursor:
             cursor.execute("SELECT id FROM users ORDER BY RAND() LIMIT 10")
@@ -597,6 +531,1096 @@ class TestDockerCompose(unittest.TestCase):
 
             cursor.executemany(insert_query, payments_data)
 
+            mismatches = verify.verify_rows(connection, "payments", payments_data, keys=["transaction_id"])
+            self.assertEqual(mismatches, [], f"Payments were not inserted correctly:\n{verify.describe(mismatches)}")
+
+    def test_13_bulk_seed_every_table(self):
+        rows = {table: 20 for table in seed.DEFAULT_ROWS}
+        stats = seed.seed(rows, processes=2, chunk_rows=7, batch_rows=5)
+
+        self.assertEqual(set(stats), set(seed.DEFAULT_ROWS), "Seeder skipped some tables")
+        for table, table_stats in stats.items():
+            self.assertGreater(table_stats["rows_per_sec"], 0, f"No throughput reported for {table}")
+            self.assertLessEqual(table_stats["rows"], table_stats["planned"], f"{table} loaded more rows than planned")
+
+        planned = seed.plan_rows(schema_module.load(SQL_FILE), {"users": 5, "user_loyalty": 8})
+        self.assertEqual(planned["user_loyalty"], 5, "user_loyalty was planned with more rows than users")
+
+        connection = self.connect()
+
+        with connection.cursor() as cursor:
+            cursor.execute("""
+            SELECT COUNT(*) AS orphans FROM payments p
+            LEFT JOIN user_reservations r ON r.id = p.reservation_id
+            WHERE p.transaction_id LIKE 'TX%' AND (r.id IS NULL OR r.user_id <> p.user_id)
+            """)
+            self.assertEqual(cursor.fetchone()["orphans"], 0, "Seeded payments do not match their reservations")
+
+            cursor.execute("SELECT COUNT(*) AS rows_, COUNT(DISTINCT user_id) AS users FROM user_loyalty")
+            counts = cursor.fetchone()
+            self.assertEqual(counts["rows_"], counts["users"], "Seeded user_loyalty repeats a user")
+
+    def test_14_migration_statement_timings(self):
+        if self.migration is None:
+            self.skipTest("no migration was run; use BADRAGHE_SNAPSHOT=0 against MySQL to time it")
+        with open(SQL_FILE, "r") as f:
+            statements = list(iter_statements(f))
+
+        self.assertEqual(len(self.migration.timings), len(statements), "Some statements were not timed")
+        for timing in self.migration.timings:
+            self.assertGreaterEqual(timing.seconds, 0, f"Invalid timing for line {timing.statement.line}")
+
+    def test_15_connection_pool_reuses_and_bounds_connections(self):
+        pool = ConnectionPool(size=2, timeout=0.2, ping_after=0)
+        self.addCleanup(pool.close)
+
+        with pool.connection() as connection:
+            first_connection = connection
+        with pool.connection(cursorclass=pymysql.cursors.DictCursor) as connection:
+            self.assertIs(connection, first_connection, "Idle connection was not reused")
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1 AS ok")
+                self.assertEqual(cursor.fetchone()["ok"], 1)
+        self.assertIs(first_connection.cursorclass, pymysql.cursors.Cursor, "Session settings were not restored")
+
+        with pool.connection(), pool.connection():
+            with self.assertRaises(PoolTimeout):
+                pool.acquire()
+
+        status = pool.status()
+        self.assertEqual(status["created"], 2, "Pool opened more connections than it needed")
+        self.assertEqual(status["timeouts"], 1, "Checkout timeout was not recorded")
+
+        def drops_on_autocommit(**connect_args):
+            connection = config.connect(**connect_args)
+
+            def autocommit(value):
+                raise pymysql.err.OperationalError(2013, "Lost connection to MySQL server during query")
+
+            connection.autocommit = autocommit
+            return connection
+
+        broken = ConnectionPool(size=1, timeout=0.2, connector=drops_on_autocommit)
+        self.addCleanup(broken.close)
+        for _ in range(2):
+            with self.assertRaises(pymysql.Error):
+                broken.acquire(autocommit=False)
+        self.assertEqual(broken.status()["open"], 0, "A connection that failed its checkout was kept")
+
+        self.assertIs(get_pool(size=self.pool.size), self.pool)
+        with self.assertRaises(ValueError):
+            get_pool(size=self.pool.size + 1)
+
+    def test_16_benchmark_mixed_workload(self):
+        results = bench.run(duration=1.0, concurrency=2, label="test", pool=self.pool)
+
+        self.assertEqual(set(results["operations"]), set(bench.DEFAULT_MIX))
+        self.assertGreater(results["total"]["count"], 0, "Benchmark did not run any operation")
+        for name, summary in results["operations"].items():
+            self.assertLessEqual(summary["p50_ms"], summary["p95_ms"], f"Unordered percentiles for {name}")
+            self.assertLessEqual(summary["p95_ms"], summary["p99_ms"], f"Unordered percentiles for {name}")
+            self.assertEqual(sum(summary["histogram"].values()), summary["count"], f"Histogram misses samples of {name}")
+
+        slower = json.loads(json.dumps(results))
+        slower["operations"]["search"]["p95_ms"] = results["operations"]["search"]["p95_ms"] * 2 + 1
+        _, regressions = bench.compare(results, slower, threshold=0.10)
+        self.assertIn("search.p95_ms", regressions, "Latency regression was not flagged")
+        self.assertEqual(bench.compare(results, results)[1], [], "Identical runs reported regressions")
+        idle = json.loads(json.dumps(results))
+        idle["operations"]["refund"].update(p95_ms=0.0, throughput=0.0)
+        rows, regressions = bench.compare(idle, results)
+        self.assertEqual({row[4] for row in rows if row[0] == "refund" and row[1] in ("p95_ms", "throughput")
+                          and results["operations"]["refund"][row[1]]}, {None}, "A zero baseline was not reported")
+        self.assertFalse([name for name in regressions if name.startswith("refund.")])
+
+        connection = self.connect(cursorclass=pymysql.cursors.Cursor)
+        connection.begin()
+        with connection.cursor() as cursor:
+            first = bench.allocate_id(cursor, "refund_requests")
+            cursor.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM refund_requests")
+            self.assertEqual(first, cursor.fetchone()[0])
+        connection.rollback()
+
+    def test_17_route_search_keyset_pagination(self):
+        connection = self.connect()
+        departure = datetime(2030, 1, 1, 8, 0, 0)
+
+        with connection.cursor() as cursor:
+            tickets = [
+                ("plane", "Keyset-Tehran", "Keyset-Mashhad", departure + timedelta(hours=i // 2),
+                 departure + timedelta(hours=i // 2 + 1), 1000 + i, 10, 10, "economy", "available")
+                for i in range(7)
+            ] + [("bus", "Keyset-Tehran", "Keyset-Mashhad", departure, departure, 1, 0, 10, "economy", "sold_out")]
+            cursor.executemany("""
+            INSERT INTO travel_tickets (transport_type, departure_city, arrival_city, departure_time, arrival_time,
+                                        price, available_seats, total_seats, class_type, status)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            """, tickets)
+            cursor.execute("""
+            SELECT id FROM travel_tickets WHERE departure_city = 'Keyset-Tehran' AND status = 'available'
+            ORDER BY departure_time, id
+            """)
+            expected_ids = [row["id"] for row in cursor.fetchall()]
+            cursor.execute("""
+            INSERT INTO flight_details (ticket_id, airline_name, flight_class, flight_number, departure_airport, arrival_airport)
+            VALUES (%s, 'Iran Air', 'economy', 'IR101', 'IKA', 'MHD')
+            """, (expected_ids[0],))
+
+            if not SQLITE:
+                cursor.execute("""
+                EXPLAIN SELECT id FROM travel_tickets
+                WHERE departure_city = 'Keyset-Tehran' AND arrival_city = 'Keyset-Mashhad' AND status = 'available'
+                ORDER BY departure_time, id
+                """)
+                plan = cursor.fetchone()
+                self.assertIn(search.ROUTE_INDEX, plan["possible_keys"], "Route index is not usable")
+                self.assertEqual(plan["key"], search.ROUTE_STATUS_INDEX, "Status-filtered pages skip the status index")
+                self.assertNotIn("filesort", plan["Extra"] or "", "Status-filtered pages are filesorted")
+
+        keyset_ids, after = [], None
+        while True:
+            page = search.search_routes(connection, "Keyset-Tehran", "Keyset-Mashhad", after=after, limit=3, details=True)
+            keyset_ids += [row["id"] for row in page.rows]
+            after = page.after
+            if after is None:
+                break
+        self.assertEqual(keyset_ids, expected_ids, "Keyset pages skipped or repeated tickets")
+
+        offset_ids = []
+        for number in range(3):
+            offset_ids += [row["id"] for row in search.search_routes_offset(
+                connection, "Keyset-Tehran", "Keyset-Mashhad", page=number, limit=3).rows]
+        self.assertEqual(offset_ids, expected_ids, "Offset pages do not match keyset pages")
+
+        first = search.search_routes(connection, "Keyset-Tehran", "Keyset-Mashhad", limit=1, details=True).rows[0]
+        self.assertEqual(first["details"]["flight_number"], "IR101", "Flight details were not joined")
+
+    def test_18_seat_holds_never_oversell(self):
+        pool = ConnectionPool(size=9, autocommit=False)
+        self.addCleanup(pool.close)
+        results = bench.hot_ticket(seats=25, threads=8, pool=pool)
+
+        self.assertEqual(results["holds"], 25, "Not every seat was sold")
+        self.assertEqual(results["reservations"], 25, "Holds and reservations disagree")
+        self.assertLessEqual(results["oversold"], 0, "Ticket was oversold")
+        self.assertEqual(results["available_seats"], 0)
+        self.assertEqual(results["status"], "sold_out", "Ticket did not switch to sold_out")
+
+        connection = self.connect()
+        with connection.cursor() as cursor:
+            cursor.execute("""
+            UPDATE user_reservations SET reserved_at = NOW() - INTERVAL 1 HOUR
+            WHERE ticket_id = %s AND status = 'temporary'
+            """, (results["ticket_id"],))
+            connection.commit()
+
+        sweeper = inventory.HoldSweeper(pool=pool, ttl=600, batch_size=10)
+        self.assertGreaterEqual(sweeper.sweep(), 25, "Expired holds were not released")
+
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT available_seats, status FROM travel_tickets WHERE id = %s", (results["ticket_id"],))
+            ticket = cursor.fetchone()
+            connection.commit()
+        self.assertEqual(ticket["available_seats"], 25, "Seats were not restored")
+        self.assertEqual(ticket["status"], "available", "Ticket did not reopen after release")
+
+    def test_19_permission_resolver_inheritance_and_invalidation(self):
+        connection = self.connect()
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT id FROM users ORDER BY id LIMIT 2")
+            manager, clerk = [row["id"] for row in cursor.fetchall()]
+            permission_ids = {}
+            for name, kind in [("rbac-read", "read"), ("rbac-write", "update"), ("rbac-delete", "delete")]:
+                cursor.execute("INSERT INTO permissions (name, type) VALUES (%s, %s)", (name, kind))
+                permission_ids[name] = cursor.lastrowid
+            cursor.execute("INSERT INTO roles (name) VALUES ('rbac-base')")
+            base = cursor.lastrowid
+            cursor.execute("INSERT INTO roles (name, parent_role_id) VALUES ('rbac-manager', %s)", (base,))
+            manager_role = cursor.lastrowid
+            cursor.execute("INSERT INTO roles (name) VALUES ('rbac-clerk')")
+            clerk_role = cursor.lastrowid
+            connection.commit()
+
+        resolver = rbac.PermissionResolver(pool=self.pool)
+        rbac.grant_permission(connection, base, permission_ids["rbac-read"], resolver)
+        rbac.grant_permission(connection, manager_role, permission_ids["rbac-write"], resolver)
+        rbac.grant_role(connection, manager, manager_role, resolver=resolver)
+        rbac.grant_role(connection, clerk, clerk_role, resolver=resolver)
+        rbac.grant_role(connection, clerk, base, expired_at=datetime(2000, 1, 1), resolver=resolver)
+
+        self.assertTrue(resolver.has_permission(manager, "rbac-read"), "Parent role permission was not inherited")
+        self.assertTrue(resolver.has_permission(manager, permission_ids["rbac-write"]))
+        self.assertFalse(resolver.has_permission(clerk, "rbac-read"), "Expired role still grants permissions")
+
+        rbac.grant_permission(connection, base, permission_ids["rbac-delete"], resolver)
+        self.assertFalse(resolver.cached(manager), "Inheriting user was not invalidated")
+        self.assertTrue(resolver.cached(clerk), "Unrelated user was invalidated")
+        self.assertTrue(resolver.has_permission(manager, "rbac-delete"), "New parent permission not visible")
+
+        rbac.revoke_role(connection, manager, manager_role, resolver)
+        self.assertFalse(set(permission_ids.values()) & set(resolver.permissions(manager)),
+                         "Revoked role still grants permissions")
+
+    @mysql_only
+    def test_20_archive_old_tickets_with_dependents(self):
+        connection = self.connect()
+        departure = datetime(2001, 6, 1, 9, 0, 0)
+
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT MIN(id) AS id FROM users")
+            user_id = cursor.fetchone()["id"]
+            cursor.execute("SELECT MIN(id) AS id FROM payment_methods")
+            method_id = cursor.fetchone()["id"]
+            ticket_ids = []
+            for i in range(3):
+                cursor.execute("""
+                INSERT INTO travel_tickets (transport_type, departure_city, arrival_city, departure_time, arrival_time,
+                                            price, available_seats, total_seats, class_type)
+                VALUES ('bus', 'Archive-Tabriz', 'Archive-Shiraz', %s, %s, 500, 10, 10, 'economy')
+                """, (departure + timedelta(days=i), departure + timedelta(days=i, hours=8)))
+                ticket_ids.append(cursor.lastrowid)
+            cursor.execute("INSERT INTO user_reservations (user_id, ticket_id, status, price_paid) VALUES (%s, %s, 'paid', 500)",
+                           (user_id, ticket_ids[0]))
+            reservation_id = cursor.lastrowid
+            cursor.execute("""
+            INSERT INTO payments (user_id, reservation_id, amount, payment_method_id, status, transaction_id)
+            VALUES (%s, %s, 500, %s, 'successful', %s)
+            """, (user_id, reservation_id, method_id, f"ARCHIVE-{reservation_id}"))
+            payment_id = cursor.lastrowid
+            cursor.execute("SELECT COALESCE(MAX(id), 0) + 1 AS id FROM refund_requests")
+            cursor.execute("INSERT INTO refund_requests (id, user_id, payment_id, reason, refund_amount) VALUES (%s, %s, %s, 'late', 100)",
+                           (cursor.fetchone()["id"], user_id, payment_id))
+            cursor.execute("INSERT INTO reviews (user_id, ticket_id, rating) VALUES (%s, %s, 4)", (user_id, ticket_ids[1]))
+            connection.commit()
+
+        archiver = archive.Archiver(before=datetime(2002, 1, 1), chunk_size=2, pause=0, pool=self.pool)
+        archived = archiver.run()
+        self.assertGreaterEqual(archiver.chunks, 2, "Archive was not chunked")
+        self.assertGreaterEqual(archived["travel_tickets"], 3)
+
+        with connection.cursor() as cursor:
+            for table, column, value in [("travel_tickets", "id", ticket_ids[0]), ("payments", "id", payment_id),
+                                         ("refund_requests", "payment_id", payment_id),
+                                         ("reviews", "ticket_id", ticket_ids[1])]:
+                cursor.execute(f"SELECT COUNT(*) AS n FROM {table} WHERE {column} = %s", (value,))
+                self.assertEqual(cursor.fetchone()["n"], 0, f"{table} row was left in the live table")
+                cursor.execute(f"SELECT COUNT(*) AS n FROM {table}_archive WHERE {column} = %s", (value,))
+                self.assertEqual(cursor.fetchone()["n"], 1, f"{table} row was not archived")
+            cursor.execute("SELECT last_time FROM archive_checkpoints WHERE root_table = 'travel_tickets'")
+            self.assertGreaterEqual(cursor.fetchone()["last_time"], departure + timedelta(days=2),
+                                    "Checkpoint did not advance")
+            connection.commit()
+
+        self.assertEqual(archive.Archiver(before=datetime(2002, 1, 1), pause=0, pool=self.pool).run(), {},
+                         "Resumed archive moved rows again")
+
+    def test_21_incremental_summaries_match_full_recompute(self):
+        summary.rebuild(pool=self.pool)
+        self.assertEqual(summary.verify(pool=self.pool), [], "Rebuilt summaries differ from a full recompute")
+
+        connection = self.connect()
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT MIN(id) AS id FROM users")
+            user_id = cursor.fetchone()["id"]
+            cursor.execute("SELECT MIN(id) AS id FROM payment_methods")
+            method_id = cursor.fetchone()["id"]
+            cursor.execute("""
+            INSERT INTO travel_tickets (transport_type, departure_city, arrival_city, departure_time, arrival_time,
+                                        price, available_seats, total_seats, class_type)
+            VALUES ('plane', 'Summary-Kish', 'Summary-Tehran', '2031-03-01 10:00:00', '2031-03-01 11:30:00', 900, 40, 40, 'business')
+            """)
+            ticket_id = cursor.lastrowid
+            cursor.execute("INSERT INTO user_reservations (user_id, ticket_id, status, price_paid) VALUES (%s, %s, 'paid', 900)",
+                           (user_id, ticket_id))
+            reservation_id = cursor.lastrowid
+            cursor.execute("""
+            INSERT INTO payments (user_id, reservation_id, amount, payment_method_id, status, transaction_id, refund_amount)
+            VALUES (%s, %s, 900, %s, 'successful', %s, 100)
+            """, (user_id, reservation_id, method_id, f"SUMMARY-{reservation_id}"))
+            connection.commit()
+
+        changed = summary.refresh(pool=self.pool)
+        self.assertIn(date(2031, 3, 1), changed[summary.OCCUPANCY], "New departure day was not refreshed")
+        self.assertEqual(summary.verify(pool=self.pool), [], "Incremental refresh differs from a full recompute")
+
+        with connection.cursor() as cursor:
+            cursor.execute("""
+            SELECT tickets, total_seats, sold_seats FROM daily_occupancy_summary
+            WHERE day = '2031-03-01' AND transport_type = 'plane' AND class_type = 'business'
+            """)
+            row = cursor.fetchone()
+            connection.commit()
+        self.assertGreaterEqual(row["total_seats"], 40)
+        self.assertGreaterEqual(row["sold_seats"], 1)
+
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE travel_tickets SET departure_time = '2031-03-05 10:00:00', class_type = 'VIP' "
+                           "WHERE id = %s", (ticket_id,))
+            cursor.execute("UPDATE payments SET payment_date = '2031-02-20 09:00:00' WHERE reservation_id = %s",
+                           (reservation_id,))
+            connection.commit()
+        changed = summary.refresh(pool=self.pool)
+        self.assertIn(date(2031, 3, 1), changed[summary.OCCUPANCY], "The day a ticket moved off was not refreshed")
+        self.assertIn(date(2031, 3, 5), changed[summary.OCCUPANCY], "The day a ticket moved to was not refreshed")
+        self.assertIn(date(2031, 2, 20), changed[summary.REVENUE], "The day a payment moved to was not refreshed")
+        self.assertEqual(summary.verify(pool=self.pool), [], "Moved rows left stale summary rows")
+
+        with connection.cursor() as cursor:
+            summary.forget_tickets(cursor, [ticket_id])
+            cursor.execute("DELETE FROM travel_tickets WHERE id = %s", (ticket_id,))
+            connection.commit()
+        changed = summary.refresh(pool=self.pool)
+        self.assertIn(date(2031, 3, 5), changed[summary.OCCUPANCY], "A forgotten ticket's day was not refreshed")
+        self.assertEqual(summary.verify(pool=self.pool), [], "A deleted ticket is still counted in the summaries")
+
+    def test_22_outbox_dispatcher_delivers_and_retries(self):
+        connection = self.connect()
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT MIN(id) AS id FROM users")
+            user_id = cursor.fetchone()["id"]
+            connection.commit()
+
+        ids = outbox.enqueue(connection, [{"user_id": user_id, "message": f"outbox test {i}"} for i in range(60)])
+        flaky = set(ids[::6])
+        doomed = ids[-1]
+        deliveries = []
+
+        def sink(notification):
+            deliveries.append(notification["id"])
+            if notification["id"] == doomed or (notification["id"] in flaky and deliveries.count(notification["id"]) == 1):
+                raise ConnectionError("sink unavailable")
+
+        dispatcher = outbox.Dispatcher(sink, pool=self.pool, batch_size=16, threads=4, max_attempts=3, backoff_base=0)
+        dispatcher.run(until_idle=True)
+
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT id, status, attempts, sent_at FROM notifications WHERE id IN ({', '.join(['%s'] * len(ids))})",
+                           ids)
+            rows = {row["id"]: row for row in cursor.fetchall()}
+            connection.commit()
+
+        for notification_id in ids:
+            row = rows[notification_id]
+            if notification_id == doomed:
+                self.assertEqual((row["status"], row["attempts"]), ("failed", 3), "Notification was not given up on")
+            else:
+                self.assertEqual(row["status"], "sent", f"Notification {notification_id} was not delivered")
+                self.assertIsNotNone(row["sent_at"])
+                self.assertEqual(row["attempts"], 2 if notification_id in flaky else 1, "Wrong attempt count")
+        self.assertGreaterEqual(dispatcher.stats["retried"], len(flaky))
+
+    @mysql_only
+    def test_23_instrumentation_reports_shapes_and_n_plus_one(self):
+        recorder = instrument.Recorder(slow_ms=0, n_plus_one=5, sample_rate=1.0)
+        pool = ConnectionPool(size=1, cursorclass=pymysql.cursors.DictCursor, instrument=recorder)
+        self.addCleanup(pool.close)
+
+        with pool.connection() as connection, connection.cursor() as cursor:
+            cursor.execute("SELECT email FROM users ORDER BY id LIMIT 6")
+            emails = [row["email"] for row in cursor.fetchall()]
+            for email in emails:
+                cursor.execute("SELECT * FROM users WHERE email = %s", (email,))
+                self.assertEqual(cursor.fetchone()["email"], email, "Instrumented cursor changed the result")
+            cursor.executemany("SELECT id FROM users WHERE id = %s", [(i,) for i in range(1, 8)])
+            connection.begin()
+            cursor.execute("SELECT id FROM users WHERE id = 1 FOR UPDATE")
+            connection.rollback()
+
+        report = recorder.as_dict()
+        shapes = {item["fingerprint"]: item for item in report["statements"]}
+        lookup = shapes["select * from users where email = ?"]
+        self.assertEqual(lookup["count"], len(emails), "Statements were not grouped by shape")
+        self.assertTrue(lookup["explain"].startswith("->"), "Slow statement was not explained as a plan tree")
+        self.assertFalse(shapes["select id from users where id = ? for update"]["explain"], "A locking read was explained")
+        self.assertTrue(any(site.startswith("test.py:") for site in lookup["sites"]), "Call site not recorded")
+        self.assertEqual(shapes["select id from users where id = ?"]["count"], 1, "executemany was not recorded once")
+
+        repeats = [item for item in report["n_plus_one"] if item["fingerprint"] == lookup["fingerprint"]]
+        self.assertTrue(repeats, "Per-row lookup loop was not flagged as N+1")
+        self.assertFalse([item for item in report["n_plus_one"] if "where id = ?" in item["fingerprint"]],
+                         "executemany was flagged as N+1")
+
+    def test_24_index_advisor_flags_redundant_and_missing_indexes(self):
+        schema, redundant, missing = advisor.advise(SQL_FILE)
+        reasons = {finding.index: finding.reason for finding in redundant}
+        self.assertEqual(reasons.get("idx_users_id"), "duplicates PRIMARY KEY")
+        for name in ("idx_users_email", "idx_users_phone", "idx_roles_name", "idx_discounts_code"):
+            self.assertIn(name, reasons, f"{name} duplicates a UNIQUE constraint but was not flagged")
+        self.assertTrue(reasons.get("idx_role_permissions_role_id", "").startswith("left prefix of PRIMARY KEY"))
+        self.assertNotIn("idx_role_permissions_permission_id", reasons, "Useful index was flagged")
+        self.assertIn(("payments", ["status", "payment_date"]), [(f.table, f.columns) for f in missing])
+
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, "advised.sql")
+            advisor.main([SQL_FILE, "--output", output])
+            with open(output) as f:
+                advised = list(iter_statements(f))
+        names = " ".join(statement.sql for statement in advised if statement.kind == "create_index")
+        self.assertNotIn("idx_users_id ", names, "Redundant index is still in the corrected migration")
+        self.assertIn(search.LEGACY_INDEX, names, "Index used by FORCE INDEX was dropped")
+        self.assertIn("idx_payments_status_payment_date", names)
+
+        advised_schema = schema_module.parse("".join(statement.sql + ";\n" for statement in advised))
+        self.assertEqual(set(advised_schema.tables), set(schema.tables), "Corrected migration lost a table")
+        self.assertFalse([f for f in advisor.redundant_indexes(advised_schema) if f.index not in advisor.KEEP],
+                         "Corrected migration still has redundant indexes")
+
+    def test_25_discount_index_prices_pages_and_records_usage(self):
+        connection = self.connect()
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT MIN(id) AS id FROM users")
+            user_id = cursor.fetchone()["id"]
+            cursor.execute("SELECT MIN(id) AS id FROM payment_methods")
+            method_id = cursor.fetchone()["id"]
+            ticket_ids = []
+            for hour in range(3):
+                cursor.execute("""
+                INSERT INTO travel_tickets (transport_type, departure_city, arrival_city, departure_time, arrival_time,
+                                            price, available_seats, total_seats, class_type)
+                VALUES ('bus', 'Pricing-Yazd', 'Pricing-Kerman', %s, %s, 100000, 30, 30, 'economy')
+                """, (datetime(2032, 5, 1, 8 + hour), datetime(2032, 5, 1, 14 + hour)))
+                ticket_ids.append(cursor.lastrowid)
+            discounts = {}
+            for code, kind, value, starts, ends, status in [
+                ("PRICING-PCT", "percentage", 10, -1, 1, True),
+                ("PRICING-FIX", "fixed", 15000, -1, 1, True),
+                ("PRICING-SOON", "percentage", 50, 2, 3, True),
+                ("PRICING-OFF", "percentage", 90, -1, 1, False),
+            ]:
+                cursor.execute("""
+                INSERT INTO discounts (code, discount_type, discount_value, valid_from, valid_until, status)
+                VALUES (%s, %s, %s, NOW() + INTERVAL %s DAY, NOW() + INTERVAL %s DAY, %s)
+                """, (code, kind, value, starts, ends, status))
+                discounts[code] = cursor.lastrowid
+            links = [(ticket_ids[0], "PRICING-PCT"), (ticket_ids[0], "PRICING-FIX"), (ticket_ids[1], "PRICING-PCT"),
+                     (ticket_ids[1], "PRICING-SOON"), (ticket_ids[1], "PRICING-OFF")]
+            cursor.executemany("INSERT INTO ticket_discounts (ticket_id, discount_id) VALUES (%s, %s)",
+                               [(ticket_id, discounts[code]) for ticket_id, code in links])
+            connection.commit()
+
+        index = pricing.DiscountIndex(pool=self.pool, refresh_interval=0)
+        page = search.search_routes(connection, "Pricing-Yazd", "Pricing-Kerman").rows
+        priced = {row["id"]: (row["final_price"], row["discount_id"]) for row in index.price(connection, page)}
+        self.assertEqual(priced[ticket_ids[0]], (85000, discounts["PRICING-FIX"]), "Best discount was not chosen")
+        self.assertEqual(priced[ticket_ids[1]], (90000, discounts["PRICING-PCT"]), "Future or disabled discount was applied")
+        self.assertEqual(priced[ticket_ids[2]], (100000, None))
+        baseline = pricing.price_tickets_sql(connection, [dict(row) for row in page])
+        self.assertEqual({row["id"]: (row["final_price"], row["discount_id"]) for row in baseline}, priced,
+                         "Index and per-ticket SQL pricing disagree")
+        self.assertIn(discounts["PRICING-SOON"], index.advance(index.now() + timedelta(days=2, hours=1)),
+                      "Pending discount did not become active")
+
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE discounts SET status = FALSE WHERE id = %s", (discounts["PRICING-FIX"],))
+            connection.commit()
+        index = pricing.DiscountIndex(pool=self.pool, refresh_interval=0)
+        index.load()
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE discounts SET status = TRUE, discount_value = 20000 WHERE id = %s",
+                           (discounts["PRICING-FIX"],))
+            connection.commit()
+        priced = {row["id"]: row["final_price"] for row in index.price(connection, page)}
+        self.assertEqual(priced[ticket_ids[0]], 80000, "Changed discount was not refreshed")
+        self.assertEqual(index.loads, 1, "Refresh reloaded the whole index")
+
+        payments = []
+        with connection.cursor() as cursor:
+            for ticket_id in ticket_ids[:2]:
+                cursor.execute("INSERT INTO user_reservations (user_id, ticket_id, status, price_paid) VALUES (%s, %s, 'reserved', 80000)",
+                               (user_id, ticket_id))
+                cursor.execute("""
+                INSERT INTO payments (user_id, reservation_id, amount, payment_method_id, status, transaction_id)
+                VALUES (%s, %s, 80000, %s, 'pending', %s)
+                """, (user_id, cursor.lastrowid, method_id, f"PRICING-{ticket_id}"))
+                payments.append(cursor.lastrowid)
+            connection.commit()
+
+        self.assertTrue(pricing.complete_payment(connection, payments[0], discounts["PRICING-FIX"]))
+        self.assertFalse(pricing.complete_payment(connection, payments[0], discounts["PRICING-FIX"]),
+                         "Payment was completed twice")
+        with self.assertRaises(pricing.DiscountUnavailable):
+            pricing.complete_payment(connection, payments[1], discounts["PRICING-FIX"])
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT payment_id, user_id, discount_id FROM user_discounts WHERE payment_id IN (%s, %s)",
+                           payments)
+            self.assertEqual([tuple(row.values()) for row in cursor.fetchall()],
+                             [(payments[0], user_id, discounts["PRICING-FIX"])])
+            cursor.execute("SELECT status FROM payments WHERE id = %s", (payments[1],))
+            self.assertEqual(cursor.fetchone()["status"], "pending", "Rejected payment was marked successful")
+            connection.commit()
+
+    def test_26_loyalty_points_from_referral_tiers(self):
+        connection = self.connect()
+        with connection.cursor() as cursor:
+            users = []
+            for name in "ABCDE":
+                cursor.execute("""
+                INSERT INTO users (first_name, last_name, email, phone, password)
+                VALUES (%s, 'Loyalty', %s, %s, 'x')
+                """, (name, f"loyalty-{name.lower()}-{time.time_ns()}@example.com", str(time.time_ns())[-12:]))
+                users.append(cursor.lastrowid)
+            cursor.executemany("INSERT INTO user_referrals (referrer_id, referred_id) VALUES (%s, %s)",
+                               list(zip(users[:3], users[1:4])))
+            cursor.execute("""
+            INSERT INTO travel_tickets (transport_type, departure_city, arrival_city, departure_time, arrival_time,
+                                        price, available_seats, total_seats, class_type)
+            VALUES ('train', 'Loyalty-Qom', 'Loyalty-Tabriz', '2033-01-01 08:00:00', '2033-01-01 20:00:00', 1000000, 50, 50, 'economy')
+            """)
+            ticket_id = cursor.lastrowid
+            cursor.executemany("INSERT INTO user_reservations (user_id, ticket_id, status, price_paid) VALUES (%s, %s, 'paid', %s)",
+                               [(users[0], ticket_id, 50000), (users[1], ticket_id, 200000),
+                                (users[2], ticket_id, 300000), (users[3], ticket_id, 1000000)])
+            connection.commit()
+
+        def points():
+            with connection.cursor() as cursor:
+                cursor.execute(f"SELECT user_id, total_points FROM user_loyalty WHERE user_id IN ({', '.join(['%s'] * 5)})",
+                               users)
+                stored = {row["user_id"]: row["total_points"] for row in cursor.fetchall()}
+                connection.commit()
+            return [stored.get(user_id, 0) for user_id in users]
+
+        stats = loyalty.rebuild(pool=self.pool, users_per_batch=7)
+        self.assertGreaterEqual(stats["referrals"], 3)
+        self.assertEqual(points(), [5 + (20 * 10 + 30 * 5 + 100 * 2) // 100, 20 + (30 * 10 + 100 * 5) // 100,
+                                    30 + 100 * 10 // 100, 100, 0])
+
+        with connection.cursor() as cursor:
+            cursor.execute("INSERT INTO user_referrals (referrer_id, referred_id) VALUES (%s, %s)", (users[3], users[4]))
+            cursor.execute("INSERT INTO user_reservations (user_id, ticket_id, status, price_paid) VALUES (%s, %s, 'paid', 2000000)",
+                           (users[4], ticket_id))
+            connection.commit()
+        stats = loyalty.refresh(pool=self.pool)
+        self.assertLessEqual(stats["written"], 10, "Incremental run rewrote unrelated users")
+        self.assertEqual(points(), [10, 20 + (30 * 10 + 100 * 5 + 200 * 2) // 100, 30 + (100 * 10 + 200 * 5) // 100,
+                                    100 + 200 * 10 // 100, 200])
+        self.assertEqual(loyalty.rebuild(pool=self.pool)["written"], 0, "Incremental totals differ from a full rebuild")
+
+    def test_27_rating_summaries_follow_review_writes(self):
+        ratings.rebuild(pool=self.pool, tickets_per_batch=17)
+        self.assertEqual(ratings.verify(pool=self.pool), [], "Rebuilt rating summaries differ from the reviews")
+
+        connection = self.connect()
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT MIN(id) AS id FROM users")
+            user_id = cursor.fetchone()["id"]
+            cursor.execute("INSERT INTO service_providers (name) VALUES (%s)", (f"Ratings Express {time.time_ns()}",))
+            provider_id = cursor.lastrowid
+            ticket_ids = []
+            for hour in range(2):
+                cursor.execute("""
+                INSERT INTO travel_tickets (transport_type, departure_city, arrival_city, departure_time, arrival_time,
+                                            price, available_seats, total_seats, transport_company_id, class_type)
+                VALUES ('bus', 'Ratings-Rasht', 'Ratings-Sari', %s, %s, 300000, 20, 20, %s, 'VIP')
+                """, (datetime(2034, 2, 1, 9 + hour), datetime(2034, 2, 1, 15 + hour), provider_id))
+                ticket_ids.append(cursor.lastrowid)
+            connection.commit()
+
+        reviews = [ratings.add_review(connection, user_id, ticket_ids[0], rating) for rating in (5, 4, 4, 1)]
+        ratings.add_review(connection, user_id, ticket_ids[1], 3)
+        ratings.add_review(connection, user_id, ticket_ids[1], None, "no stars")
+        self.assertEqual(ratings.ticket_ratings(connection, [ticket_ids[0]])[ticket_ids[0]],
+                         {"reviews": 4, "rating": 3.5, "histogram": [1, 0, 0, 2, 1]})
+
+        self.assertTrue(ratings.update_review(connection, reviews[3], rating=5))
+        self.assertTrue(ratings.update_review(connection, reviews[2], review_text="text only"))
+        self.assertTrue(ratings.delete_review(connection, reviews[1]))
+        self.assertFalse(ratings.delete_review(connection, reviews[1]), "Deleted review was deleted again")
+        self.assertEqual(ratings.ticket_ratings(connection, [ticket_ids[0]])[ticket_ids[0]],
+                         {"reviews": 3, "rating": 4.67, "histogram": [0, 0, 0, 1, 2]})
+        self.assertEqual(ratings.provider_ratings(connection, [provider_id])[provider_id],
+                         {"reviews": 4, "rating": 4.25, "histogram": [0, 0, 1, 1, 2]})
+        self.assertEqual(ratings.verify(pool=self.pool), [], "Review writes left the summaries inconsistent")
+
+        page = search.search_routes(connection, "Ratings-Rasht", "Ratings-Sari", ratings=True, details=True).rows
+        self.assertEqual([(row["reviews"], row["rating"]) for row in page], [(3, 4.67), (1, 3.0)])
+
+        connection.begin()
+        with connection.cursor() as cursor:
+            ratings.forget_tickets(cursor, [ticket_ids[0]])
+            cursor.execute("DELETE FROM travel_tickets WHERE id = %s", (ticket_ids[0],))
+        connection.commit()
+        self.assertEqual(ratings.provider_ratings(connection, [provider_id])[provider_id]["reviews"], 1)
+        self.assertEqual(ratings.verify(pool=self.pool), [], "Deleted ticket left stale summaries")
+
+    def test_28_support_search_ranks_filters_and_follows_appends(self):
+        support_search.rebuild(pool=self.pool, tickets_per_batch=37)
+        word = f"quokka{time.time_ns()}"
+        other = f"wombat{time.time_ns()}"
+
+        connection = self.connect()
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT MIN(id) AS id FROM users")
+            user_id = cursor.fetchone()["id"]
+            cursor.execute("SELECT MIN(id) AS id FROM support_categories")
+            category_id = cursor.fetchone()["id"]
+        tickets = [
+            support_search.open_ticket(connection, user_id, category_id, f"{word} refund", "Lost my luggage",
+                                       priority="high"),
+            support_search.open_ticket(connection, user_id, category_id, "Late train", f"The {word} was late"),
+            support_search.open_ticket(connection, user_id, category_id, "Seat change", f"Ünïcode {other}"),
+        ]
+        for _ in range(3):
+            support_search.append_message(connection, tickets[1], user_id, f"{word} again and {word} still")
+
+        def ids(page):
+            return [row["id"] for row in page.rows]
+
+        page = support_search.search_tickets(connection, word.upper())
+        self.assertEqual(ids(page), [tickets[1], tickets[0]], "Six message hits should outrank one subject hit")
+        self.assertEqual(ids(support_search.search_tickets(connection, f"{word} luggage")), [tickets[0]])
+        self.assertEqual(ids(support_search.search_tickets(connection, f"{word} luggage", match_all=False))[:2],
+                         [tickets[1], tickets[0]], "Any-word matches should rank the rare word first")
+        self.assertEqual(ids(support_search.search_tickets(connection, word, priority="high")), [tickets[0]])
+        self.assertEqual(ids(support_search.search_tickets(connection, word, status="closed")), [])
+        self.assertEqual(ids(support_search.search_tickets(connection, f"unicode {other}")), [tickets[2]],
+                         "Accents should be folded")
+
+        pages, after = [], None
+        while True:
+            page = support_search.search_tickets(connection, word, after=after, limit=1)
+            pages += ids(page)
+            after = page.after
+            if after is None:
+                break
+        self.assertEqual(pages, [tickets[1], tickets[0]], "Keyset pages differ from one page")
+
+        with connection.cursor() as cursor:
+            cursor.execute("INSERT INTO support_ticket_conversations (ticket_id, user_id, message, message_type) "
+                           "VALUES (%s, %s, %s, 'bot')", (tickets[2], user_id, f"{word} from a bulk load"))
+            cursor.execute("UPDATE support_tickets SET subject = %s WHERE id = %s", (f"{other} moved", tickets[0]))
+        connection.commit()
+        self.assertGreaterEqual(support_search.refresh(pool=self.pool), 2)
+        self.assertEqual(ids(support_search.search_tickets(connection, word)), [tickets[1], tickets[2]],
+                         "refresh() missed a new message or a changed subject")
+        self.assertEqual(ids(support_search.search_tickets(connection, f"{other} luggage")), [tickets[0]])
+
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT term, ticket_id, weight FROM support_search_terms WHERE ticket_id IN (%s, %s, %s) "
+                           "ORDER BY term, ticket_id", tickets)
+            incremental = cursor.fetchall()
+            cursor.execute("SELECT tickets FROM support_search_vocabulary WHERE term = %s", (word,))
+            self.assertEqual(cursor.fetchone()["tickets"], 2)
+        support_search.refresh(pool=self.pool)
+        support_search.rebuild(pool=self.pool)
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT term, ticket_id, weight FROM support_search_terms WHERE ticket_id IN (%s, %s, %s) "
+                           "ORDER BY term, ticket_id", tickets)
+            self.assertEqual(cursor.fetchall(), incremental, "Incremental postings differ from a rebuild")
+            cursor.execute("SELECT tickets FROM support_search_vocabulary WHERE term = %s", (word,))
+            self.assertEqual(cursor.fetchone()["tickets"], 2)
+
+            # Postings of a ticket deleted behind the index's back are dropped by the range that covers it.
+            cursor.execute("INSERT INTO support_search_terms (term, ticket_id, weight) VALUES (%s, %s, 1)",
+                           (other, 10 ** 12))
+            cursor.execute("UPDATE support_search_vocabulary SET tickets = tickets + 1 WHERE term = %s", (other,))
+            connection.commit()
+        support_search.rebuild(pool=self.pool, tickets_per_batch=37)
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT term, COUNT(*) AS tickets FROM support_search_terms GROUP BY term")
+            expected = {row["term"]: row["tickets"] for row in cursor.fetchall()}
+            cursor.execute("SELECT COUNT(*) AS tickets FROM support_tickets")
+            expected[support_search.DOCUMENTS] = cursor.fetchone()["tickets"]
+            cursor.execute("SELECT term, tickets FROM support_search_vocabulary")
+            self.assertEqual({row["term"]: row["tickets"] for row in cursor.fetchall()}, expected,
+                             "Document frequencies drifted across a range-by-range rebuild")
+            self.assertEqual(expected[other], 2, "A deleted ticket's postings survived the rebuild")
+            connection.commit()
+
+    def test_29_reconcile_streams_refund_mismatches(self):
+        connection = self.connect()
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT MIN(id) AS id FROM users")
+            user_id = cursor.fetchone()["id"]
+            cursor.execute("SELECT MIN(id) AS id FROM travel_tickets")
+            ticket_id = cursor.fetchone()["id"]
+            cursor.execute("SELECT MIN(id) AS id FROM payment_methods")
+            method_id = cursor.fetchone()["id"]
+            cursor.execute("SELECT COALESCE(MAX(id), 0) AS id FROM refund_requests")
+            refund_id = cursor.fetchone()["id"]
+            reservations = {}
+            for name, refund_status, refunded, requests in (
+                ("clean", "not_requested", 0, []),
+                ("refunded", "approved", 5000, [("rejected", 5000), ("approved", 5000)]),
+                ("drifted", "pending", 0, [("approved", 3000)]),
+            ):
+                cursor.execute("INSERT INTO user_reservations (user_id, ticket_id, status, price_paid, refund_status) "
+                               "VALUES (%s, %s, 'paid', 10000, %s)", (user_id, ticket_id, refund_status))
+                reservation_id = cursor.lastrowid
+                cursor.execute("INSERT INTO payments (user_id, reservation_id, amount, payment_method_id, status, "
+                               "transaction_id, refund_amount) VALUES (%s, %s, 10000, %s, 'successful', %s, %s)",
+                               (user_id, reservation_id, method_id, f"RC{time.time_ns()}", refunded))
+                payment_id = cursor.lastrowid
+                for status, amount in requests:
+                    refund_id += 1
+                    cursor.execute("INSERT INTO refund_requests (id, user_id, payment_id, reason, status, refund_amount) "
+                                   "VALUES (%s, %s, %s, 'test', %s, %s)", (refund_id, user_id, payment_id, status, amount))
+                reservations[name] = (reservation_id, payment_id)
+            connection.commit()
+
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, "mismatches.tsv.gz")
+            stats = reconcile.reconcile(output, processes=1, chunk_ids=7, pool=self.pool)
+            self.assertEqual(os.listdir(directory), ["mismatches.tsv.gz"], "Part files were left behind")
+            with gzip.open(output, "rt") as lines:
+                rows = [line.rstrip("\n").split("\t") for line in lines]
+
+        self.assertEqual(rows[0], reconcile.HEADER.strip().split("\t"))
+        self.assertEqual(stats["mismatches"], len(rows) - 1)
+        ids = {str(reservation_id): name for name, (reservation_id, _) in reservations.items()}
+        found = sorted((ids[row[1]], row[0], row[3], row[4]) for row in rows[1:] if row[1] in ids)
+        self.assertEqual(found, [("drifted", "payment_refund_amount", "0", "3000"),
+                                 ("drifted", "reservation_refund_status", "pending", "approved")])
+        self.assertEqual([row[1] for row in rows[1:]], sorted((row[1] for row in rows[1:]), key=int),
+                         "Mismatches are not in reservation id order")
+
+    def test_30_router_sends_fresh_reads_to_replica(self):
+        class ScriptedRouter(router_module.Router):
+            lags = []
+            applied = True
+
+            def replica_lag(self, connection):
+                lag = self.lags.pop(0)
+                if isinstance(lag, Exception):
+                    raise lag
+                return lag
+
+            def executed_gtids(self, connection):
+                return "3e11fa47-71ca-11e1-9e33-c80aa9429562:1-42"
+
+            def caught_up(self, connection, gtids):
+                return self.applied
+
+        # Every replication hook is scripted, so a second pool on the primary stands in for the replica.
+        replica = ConnectionPool(size=2)
+        self.addCleanup(replica.close)
+        router = ScriptedRouter(self.pool, replica, max_lag=1.0, check_interval=3600)
+        router.lags = [0.5]
+
+        def read(session=None):
+            before = router.stats.replica_reads
+            with router.read(session) as connection, connection.cursor() as cursor:
+                cursor.execute("SELECT COUNT(*) FROM users")
+            return "replica" if router.stats.replica_reads > before else "primary"
+
+        self.assertEqual([read(), read()], ["replica", "replica"])
+        self.assertEqual(router.stats.lag_checks, 1, "Lag was checked more often than check_interval")
+
+        session = router_module.Session()
+        with router.write(session) as connection, connection.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        self.assertTrue(session.gtids)
+        router.applied = False
+        self.assertEqual(read(session), "primary", "A read-your-writes read used a replica without the write")
+        self.assertEqual(read(), "replica", "Reads without a session should not wait for other sessions' writes")
+        router.applied = True
+        self.assertEqual(read(session), "replica")
+
+        router.check_interval = 0
+        router.lags = [5.0, pymysql.err.OperationalError(2003, "replica down"), None, 0.0]
+        self.assertEqual([read(), read(), read(), read()], ["primary", "primary", "primary", "replica"])
+        self.assertEqual(router.status()["lag_fallbacks"], 3)
+        self.assertEqual(router.status()["wait_fallbacks"], 1)
+
+        def unreachable(connection, gtids):
+            raise pymysql.err.OperationalError(2013, "Lost connection to MySQL server during query")
+
+        router.lags = [0.0, 0.0]
+        router.caught_up = unreachable
+        self.assertEqual(read(session), "primary", "A failed GTID wait did not fall back to the primary")
+        self.assertEqual(router.status()["error_fallbacks"], 1)
+        self.assertEqual(replica.status()["in_use"], 0, "The failed replica connection was not returned")
+        with self.assertRaises(ZeroDivisionError):
+            with router.read() as connection:
+                1 / 0
+        self.assertEqual(router.status()["primary_reads"], 5, "An error in the caller's block was retried on the primary")
+
+        without_replica = router_module.Router(self.pool)
+        with without_replica.read() as connection:
+            self.assertIsNotNone(connection)
+        self.assertEqual(without_replica.status()["primary_reads"], 1)
+
+    def test_31_amenity_bitmasks_filter_and_count_facets(self):
+        facets.rebuild(pool=self.pool, tickets_per_batch=7)
+        connection = self.connect()
+        route = (f"Facet-Yazd-{time.time_ns()}", "Facet-Kerman")
+        with connection.cursor() as cursor:
+            features = {}
+            for name in ("wifi", "meal", "blanket"):
+                cursor.execute("INSERT INTO features (name) VALUES (%s)", (f"{name} {time.time_ns()}",))
+                features[name] = cursor.lastrowid
+            tickets, details = [], []
+            for hour, transport_type, table, columns, values in (
+                (8, "train", "train_details", "train_star_rating", "4"),
+                (9, "train", "train_details", "train_star_rating", "3"),
+                (10, "bus", "bus_details", "bus_company, bus_type, seats_per_row", "'Facet Bus', 'VIP', '1+2'"),
+            ):
+                cursor.execute("""
+                INSERT INTO travel_tickets (transport_type, departure_city, arrival_city, departure_time, arrival_time,
+                                            price, available_seats, total_seats, class_type)
+                VALUES (%s, %s, %s, %s, %s, 500000, 10, 10, 'VIP')
+                """, (transport_type, *route, datetime(2035, 3, 1, hour), datetime(2035, 3, 1, hour + 6)))
+                tickets.append(cursor.lastrowid)
+                cursor.execute(f"INSERT INTO {table} (ticket_id, {columns}) VALUES (%s, {values})", (tickets[-1],))
+                details.append(cursor.lastrowid)
+            connection.commit()
+
+        facets.add_features(connection, "train", details[0], [features["wifi"], features["meal"]])
+        facets.add_features(connection, "train", details[1], [features["wifi"]])
+        with connection.cursor() as cursor:
+            cursor.execute("INSERT INTO bus_features (bus_id, feature_id) VALUES (%s, %s)", (details[2], features["blanket"]))
+        connection.commit()
+        self.assertGreaterEqual(facets.refresh(pool=self.pool), 1)
+
+        def ids(names, match_all=True):
+            page = search.search_routes(connection, *route, amenities=[features[name] for name in names],
+                                        match_all=match_all)
+            return [row["id"] for row in page.rows]
+
+        self.assertEqual(ids(["wifi"]), tickets[:2])
+        self.assertEqual(ids(["wifi", "meal"]), tickets[:1])
+        self.assertEqual(ids(["meal", "blanket"]), [])
+        self.assertEqual(ids(["meal", "blanket"], match_all=False), [tickets[0], tickets[2]])
+
+        by_masks = search.amenity_facets(connection, *route)
+        self.assertEqual(by_masks, {"tickets": 3, "features": {features["wifi"]: 2, features["meal"]: 1,
+                                                               features["blanket"]: 1}})
+        self.assertEqual(by_masks, search.amenity_facets_join(connection, *route))
+        self.assertEqual(search.amenity_facets(connection, *route, amenities=[features["wifi"]])["features"],
+                         {features["wifi"]: 2, features["meal"]: 1})
+
+        facets.remove_features(connection, "train", details[0], [features["meal"]])
+        self.assertEqual(ids(["wifi", "meal"]), [])
+        with self.assertRaises(LookupError):
+            facets.add_features(connection, "bus", 10 ** 12, [features["wifi"]])
+
+        with connection.cursor() as cursor:
+            bits = facets.feature_bits(cursor, features.values())
+            cursor.execute("DELETE FROM bus_features WHERE bus_id = %s", (details[2],))
+        connection.commit()
+        facets.rebuild(pool=self.pool)
+        self.assertEqual(ids(["wifi"]), tickets[:2])
+        self.assertEqual(ids(["blanket"]), [], "A ticket that lost its amenities kept its mask")
+        self.assertEqual(search.amenity_facets(connection, *route), search.amenity_facets_join(connection, *route))
+        with connection.cursor() as cursor:
+            self.assertEqual(facets.feature_bits(cursor, features.values()), bits, "rebuild() renumbered the bits")
+        connection.commit()
+
+    def test_32_ingest_payment_callbacks_in_deduplicated_batches(self):
+        connection = self.connect()
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT MIN(id) AS id FROM users")
+            user_id = cursor.fetchone()["id"]
+            cursor.execute("SELECT MIN(id) AS id FROM travel_tickets")
+            ticket_id = cursor.fetchone()["id"]
+            cursor.execute("SELECT MIN(id) AS id FROM payment_methods")
+            method_id = cursor.fetchone()["id"]
+            cursor.execute("SELECT COALESCE(MAX(id), 0) + 1000 AS id FROM user_reservations")
+            missing_reservation = cursor.fetchone()["id"]
+            reservations = []
+            for status in ("temporary", "reserved", "reserved", "canceled"):
+                cursor.execute("INSERT INTO user_reservations (user_id, ticket_id, status, price_paid) "
+                               "VALUES (%s, %s, %s, 10000)", (user_id, ticket_id, status))
+                reservations.append(cursor.lastrowid)
+            connection.commit()
+
+        prefix = f"IN{time.time_ns()}"
+
+        def callback(index, reservation_id, status="successful"):
+            return {"transaction_id": f"{prefix}-{index}", "reservation_id": reservation_id, "user_id": user_id,
+                    "amount": 10000, "payment_method_id": method_id, "status": status}
+
+        ingestor = ingest.PaymentIngestor(self.pool, batch_size=3, flush_interval=0.01, cache_size=2).start()
+        accepted = [ingestor.submit(item) for item in (
+            callback(0, reservations[0]), callback(0, reservations[0]), callback(1, reservations[1], "pending"),
+            callback(2, reservations[2], "failed"), callback(3, reservations[3]), callback(4, missing_reservation),
+        )]
+        stats = ingestor.stop()
+        self.assertEqual(accepted, [True, False, True, True, True, True])
+        self.assertEqual((stats["written"], stats["rejected"], stats["dropped"], stats["paid"]), (4, 1, 1, 1))
+        self.assertEqual(len(ingestor.recent), 2, "The dedup cache grew past its size")
+
+        # A fresh ingestor has no cache: retries are absorbed by the unique key, and only upgrade pending payments.
+        retry = ingest.PaymentIngestor(self.pool, batch_size=10)
+        for item in (callback(1, reservations[1]), callback(2, reservations[2]), callback(0, reservations[0], "failed")):
+            self.assertTrue(retry.submit(item))
+        self.assertEqual(retry.flush(), 3)
+        self.assertEqual(retry.stats["paid"], 1)
+        self.assertFalse(ingest.ingest_one(connection, callback(1, reservations[1])))
+        self.assertTrue(ingest.ingest_one(connection, callback(5, reservations[2])))
+
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT transaction_id, status FROM payments WHERE transaction_id LIKE %s ORDER BY transaction_id",
+                           (f"{prefix}-%",))
+            self.assertEqual([(row["transaction_id"][-1], row["status"]) for row in cursor.fetchall()],
+                             [("0", "successful"), ("1", "successful"), ("2", "failed"), ("3", "successful"),
+                              ("5", "successful")])
+            cursor.execute(f"SELECT r.status, p.transaction_id FROM user_reservations r "
+                           f"LEFT JOIN payments p ON p.id = r.payment_id WHERE r.id IN ({', '.join(['%s'] * 4)}) "
+                           f"ORDER BY r.id", reservations)
+            self.assertEqual([(row["status"], (row["transaction_id"] or "")[-1:]) for row in cursor.fetchall()],
+                             [("paid", "0"), ("paid", "1"), ("paid", "5"), ("canceled", "")])
+
+        class FlakyIngestor(ingest.PaymentIngestor):
+            """Loses the connection once, then hits a permanent error on every batch with callback 7."""
+            failures = [pymysql.err.OperationalError(2013, "Lost connection to MySQL server during query")]
+
+            def _write(self, connection, batch):
+                if self.failures:
+                    raise self.failures.pop()
+                if any(item["transaction_id"].endswith("-7") for item in batch):
+                    raise pymysql.err.ProgrammingError(1146, "Table 'payments' doesn't exist")
+                return super()._write(connection, batch)
+
+        flaky = FlakyIngestor(self.pool, batch_size=1, flush_interval=0.01, max_buffer=2).start()
+        for index in (6, 7, 8, 9):
+            flaky.submit(callback(index, reservations[0]))
+        stats = flaky.stop()
+        self.assertEqual((stats["written"], stats["rejected"], stats["retries"]), (3, 1, 1),
+                         "A permanent error was retried, or a lost connection was not")
+        self.assertEqual([item["transaction_id"] for item in flaky.dead_letters], [f"{prefix}-7"])
+
+    def test_33_schema_versions_apply_once_with_chunked_backfill(self):
+        connection = self.connect()
+        report = []
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "0001_create_osc_notes.sql"), "w") as f:
+                f.write("CREATE TABLE osc_notes (\n    id BIGINT UNSIGNED AUTO_INCREMENT PRIMARY KEY,\n"
+                        "    body VARCHAR(100) NOT NULL\n);\n")
+                f.write("INSERT INTO osc_notes (body) VALUES " +
+                        ", ".join(f"('{'skip' if index % 10 == 0 else 'note ' * (index % 4 + 1)}')"
+                                  for index in range(1, 351)) + ";\n")
+            with open(os.path.join(directory, "0002_osc_notes_words.sql"), "w") as f:
+                f.write("ALTER TABLE osc_notes ADD COLUMN words INT NULL;\n")
+                f.write("UPDATE osc_notes SET words = LENGTH(body) / 5 WHERE body <> 'skip' AND body LIKE 'note%';\n")
+            with open(os.path.join(directory, "README.txt"), "w") as f:
+                f.write("not a version")
+
+            self.assertEqual([version for version, _ in schema_change.versions(directory)],
+                             ["0001_create_osc_notes", "0002_osc_notes_words"])
+            applied = schema_change.upgrade(self.pool, directory=directory, chunk_rows=40, report=report.append)
+            self.assertEqual(applied, ["0001_create_osc_notes", "0002_osc_notes_words"])
+            self.assertTrue(any(line.startswith("✅ backfill osc_notes: 315 rows") for line in report), report)
+            self.assertEqual(schema_change.upgrade(self.pool, directory=directory), [], "A second run was not a no-op")
+
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT words, COUNT(*) AS notes FROM osc_notes GROUP BY words ORDER BY words")
+                self.assertEqual([(row["words"], row["notes"]) for row in cursor.fetchall()],
+                                 [(None, 35), (1, 70), (2, 88), (3, 70), (4, 87)])
+                cursor.execute("SELECT version FROM schema_migrations ORDER BY version")
+                self.assertEqual([row["version"] for row in cursor.fetchall()],
+                                 sorted([schema_change.BASELINE, "0001_create_osc_notes", "0002_osc_notes_words"] +
+                                        [version for version, _ in schema_change.versions()]))
+
+            with open(os.path.join(directory, "0002_osc_notes_words.sql"), "a") as f:
+                f.write("UPDATE osc_notes SET words = 0;\n")
+            with self.assertRaises(schema_change.SchemaChangeError):
+                schema_change.upgrade(self.pool, directory=directory)
+
+    @mysql_only
+    def test_34_online_alter_keeps_concurrent_writes(self):
+        connection = self.connect()
+        with connection.cursor() as cursor:
+            cursor.execute("CREATE TABLE osc_parents (id BIGINT UNSIGNED AUTO_INCREMENT PRIMARY KEY, "
+                           "name VARCHAR(50) NOT NULL CHECK (name <> ''))")
+            cursor.execute("CREATE TABLE osc_children (id BIGINT UNSIGNED AUTO_INCREMENT PRIMARY KEY, "
+                           "parent_id BIGINT UNSIGNED NOT NULL, "
+                           "FOREIGN KEY (parent_id) REFERENCES osc_parents(id) ON DELETE CASCADE)")
+            cursor.executemany("INSERT INTO osc_parents (name) VALUES (%s)", [(f"p{index}",) for index in range(3000)])
+            cursor.execute("INSERT INTO osc_children (parent_id) SELECT id FROM osc_parents WHERE id % 10 = 0")
+            cursor.execute("SELECT id, name FROM osc_parents")
+            expected = {row["id"]: row["name"] for row in cursor.fetchall()}
+
+        stop = threading.Event()
+        writes = []
+
+        def writer():
+            rng = random.Random(0)
+            with self.pool.connection(autocommit=True) as writing, writing.cursor() as cursor:
+                while not stop.is_set():
+                    cursor.execute("INSERT INTO osc_parents (name) VALUES (%s)", (f"new{len(writes)}",))
+                    expected[cursor.lastrowid] = f"new{len(writes)}"
+                    victim = rng.choice(sorted(expected))
+                    cursor.execute("UPDATE osc_parents SET name = %s WHERE id = %s", (f"upd{len(writes)}", victim))
+                    expected[victim] = f"upd{len(writes)}"
+                    victim = rng.choice(sorted(expected))
+                    cursor.execute("DELETE FROM osc_parents WHERE id = %s", (victim,))
+                    del expected[victim]
+                    writes.append(victim)
+
+        thread = threading.Thread(target=writer)
+        thread.start()
+        try:
+            copied = schema_change.online_alter(self.pool, "osc_parents",
+                                                "ADD COLUMN score INT NOT NULL DEFAULT 7, MODIFY name VARCHAR(200) NOT NULL",
+                                                chunk_rows=100, chunk_time=0.01, sleep=0.01, report=lambda line: None)
+        finally:
+            stop.set()
+            thread.join()
+        self.assertGreater(len(writes), 0, "No writes overlapped the copy")
+        self.assertLessEqual(copied, 3000)
+
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT id, name, score FROM osc_parents")
+            rows = cursor.fetchall()
+            self.assertEqual({row["id"]: row["name"] for row in rows}, expected)
+            self.assertEqual({row["score"] for row in rows}, {7})
+            cursor.execute("SELECT CHARACTER_MAXIMUM_LENGTH AS size FROM information_schema.COLUMNS "
+                           "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'osc_parents' AND COLUMN_NAME = 'name'")
+            self.assertEqual(cursor.fetchone()["size"], 200)
+            cursor.execute("SELECT REFERENCED_TABLE_NAME AS parent FROM information_schema.REFERENTIAL_CONSTRAINTS "
+                           "WHERE CONSTRAINT_SCHEMA = DATABASE() AND TABLE_NAME = 'osc_children'")
+            self.assertEqual([row["parent"] for row in cursor.fetchall()], ["osc_parents"])
+            cursor.execute("SELECT TABLE_NAME FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() "
+                           "AND TABLE_NAME LIKE '%%osc_parents_%%'")
+            self.assertEqual(cursor.fetchall(), ())
+            cursor.execute("SELECT TRIGGER_NAME FROM information_schema.TRIGGERS WHERE TRIGGER_SCHEMA = DATABASE() "
+                           "AND EVENT_OBJECT_TABLE = 'osc_parents'")
+            self.assertEqual(cursor.fetchall(), ())
+            parent = max(expected)
+            cursor.execute("INSERT INTO osc_children (parent_id) VALUES (%s)", (parent,))
+            cursor.execute("DELETE FROM osc_parents WHERE id = %s", (parent,))
+            cursor.execute("SELECT COUNT(*) AS children FROM osc_children WHERE parent_id = %s", (parent,))
+            self.assertEqual(cursor.fetchone()["children"], 0, "The child foreign key does not cascade from the new table")
+
+    @mysql_only
+    def test_35_archive_resumes_interrupted_run_with_its_cutoff(self):
+        connection = self.connect()
+        with connection.cursor() as cursor:
+            ticket_ids = []
+            for day in range(5):
+                cursor.execute("""
+                INSERT INTO travel_tickets (transport_type, departure_city, arrival_city, departure_time, arrival_time,
+                                            price, available_seats, total_seats, class_type)
+                VALUES ('bus', 'Resume-Ardabil', 'Resume-Rasht', %s, %s, 500, 10, 10, 'economy')
+                """, (datetime(2000, 3, 1 + day, 9), datetime(2000, 3, 1 + day, 15)))
+                ticket_ids.append(cursor.lastrowid)
+            connection.commit()
+
+        first = archive.Archiver(before=datetime(2000, 3, 3), chunk_size=1, pause=0, pool=self.pool)
+        first.run(max_chunks=1)
+        self.assertEqual(first.chunks, 1)
+
+        # A later run computes a later cutoff, but must finish the interrupted run with the original one.
+        second = archive.Archiver(before=datetime(2000, 3, 10), chunk_size=1, pause=0, pool=self.pool)
+        second.run()
+        self.assertEqual(second.before, datetime(2000, 3, 3), "The interrupted run did not keep its cutoff")
+        self.assertEqual(second.chunks, 1, "The resumed run did not continue after the checkpoint")
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT id FROM travel_tickets WHERE id IN ({', '.join(['%s'] * 5)}) ORDER BY id", ticket_ids)
+            self.assertEqual([row["id"] for row in cursor.fetchall()], ticket_ids[2:])
+            cursor.execute("SELECT cutoff FROM archive_checkpoints WHERE root_table = 'travel_tickets'")
+            self.assertIsNone(cursor.fetchone()["cutoff"], "A finished run left its cutoff to resume")
+            connection.commit()
+
+        third = archive.Archiver(before=datetime(2000, 3, 10), chunk_size=2, pause=0, pool=self.pool)
+        third.run(max_chunks=1)
+        restarted = archive.Archiver(before=datetime(2000, 3, 5), chunk_size=2, pause=0, pool=self.pool, restart=True)
+        restarted.run()
+        self.assertEqual(restarted.before, datetime(2000, 3, 5))
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT id FROM travel_tickets WHERE id IN ({', '.join(['%s'] * 5)}) ORDER BY id", ticket_ids)
+            self.assertEqual([row["id"] for row in cursor.fetchall()], ticket_ids[4:])
 
 if __name__ == "__main__":
     unittest.main()